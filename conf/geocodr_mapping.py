@@ -1,10 +1,10 @@
+import os
 import re
 
 from datetime import datetime
 
 from geocodr import proj
 from geocodr.search import (
-  Collection as BaseCollection,
   GermanNGramField as NGramField,
   SimpleField,
   PrefixField,
@@ -12,8 +12,29 @@ from geocodr.search import (
   PatternReplace,
 )
 
+from geocodr_mv.search import (
+  Collection as BaseCollection,
+  UnifiedCollection,
+)
+
 gemarkung_prefix = '13'  # Prefix added to 4-digit Gemarkungsnummern (13=Mecklenburg-Vorpommern)
 
+# Query the unified collections adressen_alle and adressen_alle_hro (one Solr
+# request for each class) instead of strassen, adressen, gemeinden and
+# gemeindeteile (and the HRO variants). Requires the optional collections
+# from scripts/sql/adressen_alle*.sql.
+UNIFIED_ADDRESSES = os.environ.get('GEOCODR_UNIFIED_ADDRESSES', '') == '1'
+
+# Use the geometries, centroids and bboxes in EPSG:4326 that are precomputed
+# by the export (geocodr_mv.export/reindex --precompute-4326) for
+# out_epsg=4326. Requires collections that were imported with this option.
+PRECOMPUTED_4326 = os.environ.get('GEOCODR_PRECOMPUTED_4326', '') == '1'
+
+# Use the pre-simplified geometries (level of detail) that are added by the
+# export (geocodr_mv.export/reindex --geometry-lod) for requests with
+# simplify. Requires collections that were imported with this option.
+GEOMETRY_LOD = os.environ.get('GEOCODR_GEOMETRY_LOD', '') == '1'
+
 
 class Collection(BaseCollection):
   """
@@ -31,6 +52,36 @@ class Collection(BaseCollection):
   # retrieve all fields from Solr, including score and full geometry as WKT
   field_list = '*,score,geometrie:[geo f=geometrie w=WKT]'
 
+  precomputed_4326 = PRECOMPUTED_4326
+  precomputed_fields = {
+    'geometry': 'geometrie_4326',
+    'centroid': 'geometrie_4326_punkt',
+    'bbox': 'geometrie_4326_bbox',
+  }
+  geometry_lod = GEOMETRY_LOD
+  lod_fields = {
+    5: 'geometrie_lod_5',
+    25: 'geometrie_lod_25',
+  }
+
+
+# shortest prefix in flurstuecksnummer_prefix (minGramSize of the parcel schemas)
+FLURSTUECKSNUMMER_MIN_PREFIX = 6
+
+
+def flurstuecksnummer_prefix(prefix):
+  """
+  Return a Solr query for all parcels with a flurstuecksnummer that starts
+  with `prefix`. The parcel schemas index all prefixes (edge n-grams) of the
+  flurstuecksnummer in flurstuecksnummer_prefix, so that this is a single
+  term query instead of a wildcard query. Shorter prefixes than the n-grams
+  (e.g. with a shorter gemarkung_prefix) are queried with a wildcard query.
+  All matches have a constant score, as the wildcard query before.
+  """
+  if len(prefix) < FLURSTUECKSNUMMER_MIN_PREFIX:
+    return 'flurstuecksnummer:' + prefix + '*'
+  return 'flurstuecksnummer_prefix:' + prefix + '^=1'
+
 
 def replace_strasse(field):
   """
@@ -63,6 +114,7 @@ class Strassen(Collection):
     SimpleField('gemeinde_name') ^ 2.2,
   )
   sort = 'score DESC, gemeinde_name ASC, strasse_name ASC'
+  tiebreaker_fields = ('gemeinde_ist_stadt', 'gemeinde_flaeche', 'strasse_laenge')
   sort_fields = ('gemeinde_name', 'strasse_name')
   collection_rank = 3
 
@@ -100,6 +152,7 @@ class Adressen(Collection):
   # will get the same score
   align_score_fields = ('strasse_name', 'gemeindeteil_name', 'gemeinde_name',
                         'postleitzahl')
+  score_tie_ratio = 1.01
   qfields = (
     SimpleField('strasse_name') ^ 1.2,
     replace_strasse(NGramField('strasse_name_ngram') ^ 0.8),
@@ -114,6 +167,8 @@ class Adressen(Collection):
   )
   sort = 'score DESC, gemeinde_ist_stadt DESC, gemeinde_name ASC, strasse_name ASC, ' \
          'strasse_schluessel ASC, hausnummer_int ASC, hausnummer ASC'
+  tiebreaker_fields = ('gemeinde_ist_stadt', 'gemeinde_flaeche', 'strasse_name',
+                       'strasse_schluessel', 'hausnummer')
 
   def to_title(self, prop):
     parts = [prop['gemeinde_name']]
@@ -139,7 +194,7 @@ class Adressen(Collection):
       doc['hausnummer'],
     )
 
-  def to_features(self, docs, **kw):
+  def align_scores(self, docs):
     # Iterate through all docs and align scores.
     #
     # SolrCloud can return different scores for identical search field.
@@ -151,14 +206,12 @@ class Adressen(Collection):
 
     for doc in docs:
       key = tuple(doc.get(f) for f in self.align_score_fields)
-      if key == prev_key and prev_score / doc['score'] < 1.01:
+      if key == prev_key and prev_score / doc['score'] < self.score_tie_ratio:
         doc['score'] = prev_score
 
       prev_key = key
       prev_score = doc['score']
 
-    return Collection.to_features(self, docs, **kw)
-
 
 class Gemeinden(Collection):
   class_ = 'address'
@@ -172,8 +225,10 @@ class Gemeinden(Collection):
     SimpleField('gemeinde_name') ^ 4.4,
   )
   sort = 'score DESC, gemeinde_name ASC'
+  tiebreaker_fields = ('gemeinde_ist_stadt', 'gemeinde_flaeche')
   sort_fields = ('gemeinde_name',)
   collection_rank = 1
+  local_index = True
 
   def sort_tiebreaker(self, doc):
     """
@@ -207,8 +262,10 @@ class GemeindeTeile(Collection):
     SimpleField('gemeinde_name') ^ 2.3,
   )
   sort = 'score DESC, gemeinde_name ASC, gemeindeteil_name ASC'
+  tiebreaker_fields = ('gemeindeteil_flaeche', 'gemeinde_name')
   sort_fields = ('gemeinde_name', 'gemeindeteil_name')
   collection_rank = 2
+  local_index = True
 
   def to_title(self, prop):
     parts = [prop['gemeinde_name']]
@@ -241,6 +298,7 @@ class StrassenHro(Collection):
     SimpleField('gemeinde_name') ^ 2.2,
   )
   sort = 'score DESC, gemeinde_name ASC, strasse_name ASC'
+  tiebreaker_fields = ('strasse_laenge',)
   sort_fields = ('gemeinde_name', 'strasse_name')
   collection_rank = 3
 
@@ -271,6 +329,7 @@ class AdressenHro(Collection):
   # will get the same score
   align_score_fields = ('strasse_name', 'gemeindeteil_name', 'gemeinde_name',
                         'postleitzahl')
+  score_tie_ratio = 1.01
   qfields = (
     SimpleField('strasse_name') ^ 1.2,
     replace_strasse(NGramField('strasse_name_ngram') ^ 0.8),
@@ -285,6 +344,8 @@ class AdressenHro(Collection):
   )
   sort = 'score DESC, gemeinde_name ASC, strasse_name ASC, ' \
          'strasse_schluessel ASC, hausnummer_int ASC, hausnummer ASC'
+  tiebreaker_fields = ('strasse_name', 'strasse_schluessel', 'hausnummer')
+  historic_field = 'historisch'
 
   def to_title(self, prop):
     parts = [prop['gemeindeteil_name'],
@@ -309,7 +370,7 @@ class AdressenHro(Collection):
       doc['hausnummer'],
     )
 
-  def to_features(self, docs, **kw):
+  def align_scores(self, docs):
     # Iterate through all docs and align scores.
     #
     # SolrCloud can return different scores for identical search field.
@@ -321,14 +382,12 @@ class AdressenHro(Collection):
 
     for doc in docs:
       key = tuple(doc.get(f) for f in self.align_score_fields)
-      if key == prev_key and prev_score / doc['score'] < 1.01:
+      if key == prev_key and prev_score / doc['score'] < self.score_tie_ratio:
         doc['score'] = prev_score
 
       prev_key = key
       prev_score = doc['score']
 
-    return Collection.to_features(self, docs, **kw)
-
 
 class GemeindeTeileHro(Collection):
   class_ = 'address_hro'
@@ -343,8 +402,10 @@ class GemeindeTeileHro(Collection):
     SimpleField('gemeinde_name') ^ 2.3,
   )
   sort = 'score DESC, gemeinde_name ASC, gemeindeteil_name ASC'
+  tiebreaker_fields = ('gemeindeteil_flaeche', 'gemeinde_name')
   sort_fields = ('gemeinde_name', 'gemeindeteil_name')
   collection_rank = 2
+  local_index = True
 
   def to_title(self, prop):
     return prop['gemeindeteil_name']
@@ -375,6 +436,7 @@ class Gemarkungen(Collection):
   sort = 'score DESC, gemeinde_name ASC, gemarkung_name ASC'
   sort_fields = ('gemeinde_name', 'gemarkung_name')
   collection_rank = 1
+  local_index = True
 
   def to_title(self, prop):
     parts = [prop['gemeinde_name']]
@@ -383,11 +445,13 @@ class Gemarkungen(Collection):
     parts.append(prop['gemarkung_name'] + ' (' + prop['gemarkung_schluessel'][2:] + ')')
     return ', '.join(parts)
 
-  def query(self, query):
+  def expand_query(self, query):
     if re.match(r'^\d{4}$', query):
       query = gemarkung_prefix + query
+    return query
 
-    return Collection.query(self, query)
+  def query(self, query):
+    return Collection.query(self, self.expand_query(query))
 
 
 class Fluren(Collection):
@@ -458,8 +522,9 @@ class Flurstuecke(Collection):
   sort_fields = ('flurstueckskennzeichen',)
   collection_rank = 3
   min_query_length = 2
+  score_tie_ratio = 1.1
 
-  def to_features(self, docs, **kw):
+  def align_scores(self, docs):
     # Iterate through all docs and align scores.
     #
     # SolrCloud can return different scores for identical search field.
@@ -469,13 +534,11 @@ class Flurstuecke(Collection):
     prev_score = 0
 
     for doc in docs:
-      if prev_score and prev_score / doc['score'] < 1.1:
+      if prev_score and prev_score / doc['score'] < self.score_tie_ratio:
         doc['score'] = prev_score
 
       prev_score = doc['score']
 
-    return Collection.to_features(self, docs, **kw)
-
   def to_title(self, prop):
     parts = [prop['gemeinde_name']]
     if prop['gemeinde_name_suchzusatz']:
@@ -505,15 +568,14 @@ class Flurstuecke(Collection):
     # string. The parts are always from left to right in the long-form (e.g. if we have
     # zaehler, we also have flur).
     if not flst.gemarkung_name and not is_short_form:
-      return 'flurstuecksnummer:' + flst.gemarkung + flst.flur \
-        + flst.zaehler + flst.nenner + '*'
+      return flurstuecksnummer_prefix(flst.gemarkung + flst.flur + flst.zaehler + flst.nenner)
 
     qparts = []
 
     if flst.gemarkung_name:
       qparts.append(Collection.query(self, flst.gemarkung_name))
     elif flst.gemarkung:
-      qparts.append('flurstuecksnummer:' + flst.gemarkung + '*')
+      qparts.append(flurstuecksnummer_prefix(flst.gemarkung))
 
     if flst.flur:
       qparts.append('flur:' + flst.flur)
@@ -541,15 +603,18 @@ class GemarkungenHro(Collection):
   sort = 'score DESC, gemeinde_name ASC, gemarkung_name ASC'
   sort_fields = ('gemeinde_name', 'gemarkung_name')
   collection_rank = 1
+  local_index = True
 
   def to_title(self, prop):
     return prop['gemarkung_name'] + ' (' + prop['gemarkung_schluessel'][2:] + ')'
 
-  def query(self, query):
+  def expand_query(self, query):
     if re.match(r'^\d{4}$', query):
       query = gemarkung_prefix + query
+    return query
 
-    return Collection.query(self, query)
+  def query(self, query):
+    return Collection.query(self, self.expand_query(query))
 
 
 class FlurenHro(Collection):
@@ -617,8 +682,10 @@ class FlurstueckeHro(Collection):
   sort_fields = ('flurstueckskennzeichen',)
   collection_rank = 3
   min_query_length = 2
+  score_tie_ratio = 1.1
+  historic_field = 'historisch'
 
-  def to_features(self, docs, **kw):
+  def align_scores(self, docs):
     # Iterate through all docs and align scores.
     #
     # SolrCloud can return different scores for identical search field.
@@ -628,13 +695,11 @@ class FlurstueckeHro(Collection):
     prev_score = 0
 
     for doc in docs:
-      if prev_score and prev_score / doc['score'] < 1.1:
+      if prev_score and prev_score / doc['score'] < self.score_tie_ratio:
         doc['score'] = prev_score
 
       prev_score = doc['score']
 
-    return Collection.to_features(self, docs, **kw)
-
   def to_title(self, prop):
     parts = [prop['gemarkung_name'] + ' (' + prop['gemarkung_schluessel'][2:] + ')',
              'Flur ' + str(int(prop['flur'], 10)), str(int(prop['zaehler'], 10))]
@@ -666,15 +731,14 @@ class FlurstueckeHro(Collection):
     # string. The parts are always from left to right in the long-form (e.g. if we have
     # zaehler, we also have flur).
     if not flst.gemarkung_name and not is_short_form:
-      return 'flurstuecksnummer:' + flst.gemarkung + flst.flur \
-        + flst.zaehler + flst.nenner + '*'
+      return flurstuecksnummer_prefix(flst.gemarkung + flst.flur + flst.zaehler + flst.nenner)
 
     qparts = []
 
     if flst.gemarkung_name:
       qparts.append(Collection.query(self, flst.gemarkung_name))
     elif flst.gemarkung:
-      qparts.append('flurstuecksnummer:' + flst.gemarkung + '*')
+      qparts.append(flurstuecksnummer_prefix(flst.gemarkung))
 
     if flst.flur:
       qparts.append('flur:' + flst.flur)
@@ -705,8 +769,9 @@ class Flurstueckseigentuemer(Collection):
   sort_fields = ('flurstueckskennzeichen',)
   collection_rank = 3
   min_query_length = 2
+  score_tie_ratio = 1.1
 
-  def to_features(self, docs, **kw):
+  def align_scores(self, docs):
     # Iterate through all docs and align scores.
     #
     # SolrCloud can return different scores for identical search field.
@@ -716,13 +781,11 @@ class Flurstueckseigentuemer(Collection):
     prev_score = 0
 
     for doc in docs:
-      if prev_score and prev_score / doc['score'] < 1.1:
+      if prev_score and prev_score / doc['score'] < self.score_tie_ratio:
         doc['score'] = prev_score
 
       prev_score = doc['score']
 
-    return Collection.to_features(self, docs, **kw)
-
   def to_title(self, prop):
     parts = [prop['gemeinde_name']]
     if prop['gemeinde_name_suchzusatz']:
@@ -752,15 +815,14 @@ class Flurstueckseigentuemer(Collection):
     # string. The parts are always from left to right in the long-form (e.g. if we have
     # zaehler, we also have flur).
     if not flst.gemarkung_name and not is_short_form:
-      return 'flurstuecksnummer:' + flst.gemarkung + flst.flur \
-        + flst.zaehler + flst.nenner + '*'
+      return flurstuecksnummer_prefix(flst.gemarkung + flst.flur + flst.zaehler + flst.nenner)
 
     qparts = []
 
     if flst.gemarkung_name:
       qparts.append(Collection.query(self, flst.gemarkung_name))
     elif flst.gemarkung:
-      qparts.append('flurstuecksnummer:' + flst.gemarkung + '*')
+      qparts.append(flurstuecksnummer_prefix(flst.gemarkung))
 
     if flst.flur:
       qparts.append('flur:' + flst.flur)
@@ -784,6 +846,7 @@ class Postleitzahlengebiete(Collection):
   sort = 'score DESC, postleitzahl ASC'
   sort_fields = ('postleitzahl',)
   collection_rank = 1
+  local_index = True
   min_query_length = 4
 
   def to_title(self, prop):
@@ -852,3 +915,27 @@ class OrkaApp(Collection):
       return ', '.join(parts)
     else:
       return prop['category_title']
+
+
+if UNIFIED_ADDRESSES:
+  class AdressenAlle(UnifiedCollection, Collection):
+    class_ = 'address'
+    class_title = 'Adresse'
+    name = 'adressen_alle'
+    title = 'Adresse'
+    members = (Strassen(), Adressen(), Gemeinden(), GemeindeTeile())
+    sort = Adressen.sort
+    score_tie_ratio = Adressen.score_tie_ratio
+
+  class AdressenAlleHro(UnifiedCollection, Collection):
+    class_ = 'address_hro'
+    class_title = 'Adresse HRO'
+    name = 'adressen_alle_hro'
+    title = 'Adresse HRO'
+    members = (StrassenHro(), AdressenHro(), GemeindeTeileHro())
+    sort = AdressenHro.sort
+    score_tie_ratio = AdressenHro.score_tie_ratio
+
+  # the unified collections replace the separate collections
+  del Strassen, Adressen, Gemeinden, GemeindeTeile
+  del StrassenHro, AdressenHro, GemeindeTeileHro
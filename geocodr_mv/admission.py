@@ -0,0 +1,251 @@
+"""
+The admission module limits the requests of geocodr_mv.api, so that an
+overload is rejected early instead of increasing the latency of all
+requests.
+
+Each API key can have a rate limit (token bucket with `rate` requests per
+second and `burst` requests), a limit for concurrent requests
+(`concurrency`) and a priority lane (`lane`: `interactive` or `batch`),
+see geocodr_mv.keys. Requests over the rate or concurrency limit of their
+key are rejected with 429.
+
+All requests share `max_in_flight` slots. A request waits up to
+`queue_timeout` seconds for a free slot and is rejected with 503
+afterwards. Batch requests use at most `batch_ratio` of all slots and only
+get a slot if no interactive request is waiting.
+
+With waitress, the admission control runs in the waitress threads. A
+request that waits for a slot holds its thread, and requests without a free
+thread wait in the task queue of waitress, where the admission control can
+not see them. waitress_limits therefore keeps `max_in_flight` below the
+number of threads (default: half of them), so that the threads above
+`max_in_flight` wait in the admission control, and sets the connection
+limit of waitress, which bounds the task queue. Idle keep-alive connections
+count towards this limit, it can not be much lower than the default of
+waitress. All limits apply to one process (each worker of
+geocodr_mv.prefork has its own).
+"""
+
+import contextlib
+import math
+import threading
+import time
+
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+LANES = (INTERACTIVE, BATCH)
+
+MAX_IN_FLIGHT = 64
+# waitress threads of each process
+THREADS = 8
+# minimum connection limit of waitress (its default), per thread above
+CONNECTION_LIMIT = 100
+CONNECTIONS_PER_THREAD = 8
+QUEUE_TIMEOUT = 0.5
+BATCH_RATIO = 0.5
+# remove token buckets of keys that were not used for this number of seconds
+BUCKET_TTL = 3600
+
+
+def waitress_limits(threads, max_in_flight=None):
+  """
+  Return `max_in_flight` and the connection limit of waitress for a server
+  with `threads` threads (see module documentation). Raises ValueError if
+  `max_in_flight` is not lower than `threads`.
+  """
+  if threads < 2:
+    raise ValueError('the admission control requires at least 2 threads')
+  if not max_in_flight:
+    max_in_flight = threads // 2
+  if max_in_flight >= threads:
+    raise ValueError('max_in_flight ({}) must be lower than the number of threads ({})'.format(
+      max_in_flight, threads))
+  # further connections wait in the listen backlog
+  return max_in_flight, max(CONNECTION_LIMIT, CONNECTIONS_PER_THREAD * threads)
+
+
+class Rejected(Exception):
+  """
+  Request was rejected with `status` (429 or 503). `retry_after` in seconds.
+  """
+
+  def __init__(self, status, reason, retry_after=1):
+    Exception.__init__(self, reason)
+    self.status = status
+    self.reason = reason
+    self.retry_after = retry_after
+
+
+class TokenBucket(object):
+  """
+  Token bucket with `rate` tokens per second and up to `burst` tokens.
+  """
+
+  def __init__(self, rate, burst, now):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = now
+
+  def take(self, now):
+    """
+    Take a token. Returns 0 or the seconds until the next token is
+    available.
+    """
+    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+    self.updated = now
+    if self.tokens >= 1:
+      self.tokens -= 1
+      return 0
+    return (1 - self.tokens) / self.rate
+
+
+class Ticket(object):
+  def __init__(self, key, lane):
+    self.key = key
+    self.lane = lane
+
+
+class Admission(object):
+  """
+  Admission control for all requests of one process (see module
+  documentation).
+  """
+
+  def __init__(self, max_in_flight=MAX_IN_FLIGHT, queue_timeout=QUEUE_TIMEOUT,
+               batch_ratio=BATCH_RATIO, clock=time.monotonic):
+    self.max_in_flight = max_in_flight
+    self.queue_timeout = queue_timeout
+    self.batch_slots = max(int(max_in_flight * batch_ratio), 1) if max_in_flight else 0
+    self.clock = clock
+    self.in_flight = dict((lane, 0) for lane in LANES)
+    self.waiting = dict((lane, 0) for lane in LANES)
+    self._key_in_flight = {}
+    self._buckets = {}
+    self._cond = threading.Condition()
+
+  def check_key(self, key, limits):
+    """
+    Count a request of `key` with `limits` (dict with `rate`, `burst` and
+    `concurrency`). Raises Rejected (429) if a limit of the key is exceeded.
+    """
+    rate = limits.get('rate')
+    concurrency = limits.get('concurrency')
+    with self._cond:
+      if concurrency and self._key_in_flight.get(key, 0) >= concurrency:
+        raise Rejected(429, 'Too many concurrent requests for this API key.')
+      if rate:
+        now = self.clock()
+        bucket = self._buckets.get(key)
+        if bucket is None or (bucket.rate, bucket.burst) != (rate, limits.get('burst') or rate):
+          bucket = self._buckets[key] = TokenBucket(rate, limits.get('burst') or rate, now)
+        wait = bucket.take(now)
+        if wait:
+          raise Rejected(429, 'Rate limit of this API key exceeded.', math.ceil(wait))
+        if len(self._buckets) > 1000:
+          self._expire(now)
+      self._key_in_flight[key] = self._key_in_flight.get(key, 0) + 1
+
+  def _expire(self, now):
+    for key, bucket in list(self._buckets.items()):
+      if now - bucket.updated > BUCKET_TTL:
+        del self._buckets[key]
+
+  def _has_slot(self, lane):
+    total = sum(self.in_flight.values())
+    if total >= self.max_in_flight:
+      return False
+    if lane == BATCH:
+      return self.in_flight[BATCH] < self.batch_slots and not self.waiting[INTERACTIVE]
+    return True
+
+  def try_acquire(self, lane):
+    """
+    Take a slot for `lane` without waiting. Returns True on success.
+    """
+    with self._cond:
+      if not self.max_in_flight or self._has_slot(lane):
+        self.in_flight[lane] += 1
+        return True
+      return False
+
+  def acquire(self, lane, timeout=None):
+    """
+    Wait for a slot for `lane`. Raises Rejected (503) after `timeout`
+    (default `queue_timeout`).
+    """
+    timeout = self.queue_timeout if timeout is None else timeout
+    with self._cond:
+      if not self.max_in_flight or self._has_slot(lane):
+        self.in_flight[lane] += 1
+        return
+      deadline = self.clock() + timeout
+      self.waiting[lane] += 1
+      try:
+        while not self._has_slot(lane):
+          remaining = deadline - self.clock()
+          if remaining <= 0:
+            raise Rejected(503, 'Service overloaded, try again later.')
+          self._cond.wait(remaining)
+      finally:
+        self.waiting[lane] -= 1
+        # a batch request may wait for this interactive request
+        self._cond.notify_all()
+      self.in_flight[lane] += 1
+
+  def wait_start(self, lane):
+    """
+    Register a waiting request of `lane` (for callers that wait with
+    try_acquire, e.g. geocodr_mv.asgi).
+    """
+    with self._cond:
+      self.waiting[lane] += 1
+
+  def wait_end(self, lane):
+    with self._cond:
+      self.waiting[lane] -= 1
+      self._cond.notify_all()
+
+  def _release_key(self, key):
+    count = self._key_in_flight.get(key, 1) - 1
+    if count:
+      self._key_in_flight[key] = count
+    else:
+      self._key_in_flight.pop(key, None)
+
+  def release_key(self, key):
+    """
+    Release a request of `key` that was counted by check_key but got no
+    slot.
+    """
+    with self._cond:
+      self._release_key(key)
+
+  def release(self, ticket):
+    with self._cond:
+      self.in_flight[ticket.lane] -= 1
+      self._release_key(ticket.key)
+      self._cond.notify_all()
+
+  def enter(self, key, limits):
+    """
+    Admit a request of `key` with `limits` (see check_key, `lane`). Returns
+    the Ticket for release. Raises Rejected.
+    """
+    lane = limits.get('lane') or INTERACTIVE
+    self.check_key(key, limits)
+    try:
+      self.acquire(lane)
+    except Rejected:
+      self.release_key(key)
+      raise
+    return Ticket(key, lane)
+
+  @contextlib.contextmanager
+  def admit(self, key, limits):
+    ticket = self.enter(key, limits)
+    try:
+      yield ticket
+    finally:
+      self.release(ticket)
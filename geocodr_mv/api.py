@@ -0,0 +1,1106 @@
+"""
+The api module contains the geocodr web service for this configuration. It
+extends geocodr.api.Geocodr and keeps its request parameters and responses.
+
+Each collection is queried for the rows the final merge actually needs
+(limit + offset) instead of a fixed number of 1000 rows. More rows are
+fetched only while the last row could still tie with the last required row
+after score alignment and tiebreaker sorting. Small requests fit into the
+queryResultCache of Solr (see queryResultWindowSize in solrconfig.xml).
+
+Collections of the mapping with a `sort_field_list` are first queried only
+for the fields that are required to sort the results of all collections.
+The json blob, the fields and the geometry (`page_field_list`) are loaded
+only for the features of the requested page, with a second request for
+their ids. Reverse geocoding (sorted by distance) and debug=true requests
+load all fields for all docs.
+
+Precomputed EPSG:4326 geometries of the mapping are requested instead of the
+geometry for out_epsg=4326 (see precomputed_field). Otherwise, with
+`geometry_dir` (--geometry-dir), geometries of the page are taken from the
+geometry stores of geocodr_mv.reindex (see geocodr_mv.geomstore) instead of
+WKT from Solr. Documents without precomputed or stored geometry (e.g. during
+an import) are loaded from Solr.
+
+The optional parameters `simplify` (tolerance in meters, EPSG:25833) and
+`precision` (decimal places of all coordinates) reduce the size of the
+returned geometries (see geometry_params).
+
+Historic records (`historic_field` of the mapping) are excluded with a
+filter query (cached by Solr) if the request has `historic=false`. The
+default is set for each API key (`historic` column of the API keys CSV) or
+for the API (--exclude-historic).
+
+Queries with duplicate terms, too many terms or n-grams are shaped by the
+mapping (see shape_query). debug=true reports these decisions in
+`query_shapes`.
+
+With `parameterized` (--parameterized-queries), the query of each collection
+is sent as a template with the terms and n-grams as separate parameters
+(`$t1`, `$g2`, ...) that Solr dereferences (see query_params of the
+mapping). The template is the same for all queries with the same number of
+terms.
+
+With `hedge` (--hedge), Solr requests that take longer than the p95 latency
+of the collection are repeated on another node and the first response is
+used (see geocodr_mv.hedge).
+
+Requests pass the admission control of geocodr_mv.admission: rate and
+concurrency limits of the API key (columns of the API keys CSV) are rejected
+with 429, requests that wait longer than `queue_timeout` (--queue-timeout)
+for one of `max_in_flight` (--max-in-flight) slots with 503. Both responses
+have a Retry-After header. With waitress, `max_in_flight` is lower than the
+number of threads (--threads) and the connections are limited, so that
+requests queue in the admission control (see
+geocodr_mv.admission.waitress_limits).
+
+With `fallback_index` (--fallback-index, see geocodr_mv.fallback), queries
+are answered from a local SQLite index while the health check of Solr fails
+(or always with `fallback_only`, --fallback-only). Only the collections of
+the index are queried, the ranking is approximate and the responses have
+`degraded: true` in their properties.
+
+With `local_index` (--local-index), the search queries of the collections
+with `local_index = True` in the mapping are answered from in-memory
+indexes that are loaded from Solr at startup and reloaded after alias
+changes (see geocodr_mv.localindex). Only the documents of the result page
+are loaded from Solr.
+
+The /feature endpoint returns the features of one or many ids (`id`) of
+the collections `collection` without a search. The documents of each
+collection are loaded with one request to the real-time get handler of Solr
+(see run_lookup).
+
+With `tiered` (--tiered), collections are queried in tiers and collections
+of lower tiers are skipped if they can not change the result page (see
+geocodr_mv.tiers).
+"""
+
+import logging
+import math
+import os
+
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+
+from geocodr import api, proj, solr
+from geocodr.api import MIN_COLLECTION_ROWS
+from geocodr.featurecollection import FeatureCollection as _FeatureCollection
+from geocodr.request import RequestError
+from werkzeug.routing import Rule
+
+from geocodr_mv import admission, fallback, hedge, localindex, tiers
+from geocodr_mv.geomstore import GeometryStores
+from geocodr_mv.keys import APIKeys, parse_bool
+
+
+log = logging.getLogger(__name__)
+
+# Default number of rows for each collection and request. Should be equal to
+# queryResultWindowSize in solrconfig.xml.
+COLLECTION_ROWS = 100
+# Maximum number of rows for each collection and request. Should be equal to
+# queryResultMaxDocsCached in solrconfig.xml.
+MAX_COLLECTION_ROWS = MIN_COLLECTION_ROWS
+# Maximum number of decimal places for the precision parameter.
+MAX_PRECISION = 15
+# Maximum number of ids of a /feature request.
+MAX_FEATURE_IDS = MIN_COLLECTION_ROWS
+
+
+def collection_rows(collection):
+  """
+  Return the minimum and maximum number of rows for `collection`. Set
+  `min_rows` and `max_rows` in the mapping to change the defaults.
+  """
+  return (
+    getattr(collection, 'min_rows', COLLECTION_ROWS),
+    getattr(collection, 'max_rows', MAX_COLLECTION_ROWS),
+  )
+
+
+def may_tie(collection, docs, needed):
+  """
+  Check whether documents after `docs` can tie with the document at
+  position `needed` after the score alignment of `collection.to_features`.
+  Identical scores are sorted by the tiebreaker of the mapping and
+  `to_features` aligns each score to the previous score if it is within
+  `score_tie_ratio`. A tie is only possible if this chain is not interrupted
+  between the `needed` and the last document.
+  """
+  if not needed or len(docs) < needed:
+    return False
+  ratio = getattr(collection, 'score_tie_ratio', 1.0)
+  prev = docs[needed - 1]['score']
+  for doc in docs[needed:]:
+    score = doc['score']
+    if score != prev and prev / score >= ratio:
+      return False
+    prev = score
+  return True
+
+
+def fetch_steps(collection, needed, min_rows=None, max_rows=None):
+  """
+  Generator for the requests of fetch_docs. Yields (start, rows) and
+  receives the Solr response of each request. Returns the documents and the
+  total number of documents.
+  """
+  default_min, default_max = collection_rows(collection)
+  min_rows = default_min if min_rows is None else min_rows
+  max_rows = max(needed, default_max if max_rows is None else max_rows)
+
+  resp = (yield 0, min(max(needed, min_rows), max_rows))['response']
+  docs = resp['docs']
+  num_found = resp['numFound']
+  while len(docs) < min(num_found, max_rows) and may_tie(collection, docs, needed):
+    # double the number of rows (stays within the window of the result cache)
+    rows = min(len(docs), max_rows - len(docs))
+    more = (yield len(docs), rows)['response']['docs']
+    if not more:
+      break
+    docs.extend(more)
+  return docs, num_found
+
+
+def fetch_docs(select, collection, needed, min_rows=None, max_rows=None):
+  """
+  Fetch documents with `select(start, rows)` (returns the Solr response) until
+  all documents for the first `needed` results are fetched.
+  Returns the documents and the total number of documents.
+  """
+  steps = fetch_steps(collection, needed, min_rows, max_rows)
+  try:
+    start, rows = next(steps)
+    while True:
+      start, rows = steps.send(select(start, rows))
+  except StopIteration as ex:
+    return ex.value
+
+
+def is_trimmed(collection):
+  """
+  Check whether `collection` supports sort_field_list and page_field_list.
+  """
+  return hasattr(collection, 'sort_field_list') and hasattr(collection, 'ranked_docs')
+
+
+def sort_features(collection, docs):
+  """
+  Return placeholder features with the sort properties of `docs` (from a
+  query with `collection.sort_field_list`). The `doc` and `collection` of
+  each placeholder are used to load the complete feature with load_page.
+  """
+  features = []
+  for doc in collection.ranked_docs(docs):
+    features.append({
+      'properties': {
+        '_score_': doc['score'],
+        '_sort_tiebreaker_': collection.sort_tiebreaker(doc),
+        '_id_': doc['id'],
+      },
+      'doc': doc,
+      'collection': collection,
+    })
+  return features
+
+
+def search_field_list(collection):
+  """
+  Return the field list of the first request for `collection`.
+  """
+  if is_trimmed(collection):
+    return collection.sort_field_list
+  return collection.field_list
+
+
+def query_shapes(collections, query):
+  """
+  Return a dict with the QueryShape (as mapping) of all `collections` that
+  do not query all terms in all fields (see Collection.shape_query).
+  """
+  shapes = {}
+  for collection in collections:
+    if not hasattr(collection, 'query_shapes'):
+      continue
+    for name, shape in collection.query_shapes(query):
+      if shape.strategy != 'full':
+        shapes[name] = shape.as_mapping()
+  return shapes
+
+
+def is_degraded(request):
+  """
+  Check whether `request` is answered from the fallback index (see
+  Geocodr.query_context).
+  """
+  return getattr(request, 'degraded', False)
+
+
+def fallback_collections(index, collections):
+  """
+  Return the collections of `collections` that are answered from the
+  fallback `index`. Unified collections (with `members`) are replaced by
+  their members, as the index contains the separate collections.
+  """
+  result = []
+  for collection in collections:
+    for c in getattr(collection, 'members', (collection,)):
+      if index.has_collection(c.name):
+        result.append(c)
+  return result
+
+
+def ids_query(ids):
+  return '{!terms f=id}' + ','.join(ids)
+
+
+def realtime_get(client, collection, ids, user_auth=None, **kw):
+  """
+  Return the documents `ids` of `collection` from the real-time get handler
+  of Solr (/get) with the connection pool of `client` (geocodr.solr.Solr).
+  Additional `kw` parameters are sent as further GET parameters.
+  """
+  kw['ids'] = ','.join(ids)
+  resp = client._s.get(
+    '{}/{}/get'.format(client.url, collection), params=kw, auth=user_auth)
+  if resp.status_code == 401:
+    raise solr.SolrUnauthenticatedError()
+  if not resp.ok:
+    raise solr.SolrException(resp)
+  return resp.json()
+
+
+def list_param(request, name, max_values=None):
+  """
+  Return the values of the required parameter `name` of `request` (JSON list
+  or comma separated) without duplicates. More than `max_values` values are
+  rejected before duplicates are removed.
+  """
+  value = request.g.params.get(name)
+  if isinstance(value, str):
+    value = value.split(',')
+  if not isinstance(value, list):
+    raise RequestError("Invalid {} value. Expected a list or comma separated values.".format(
+      name))
+  if max_values is not None and len(value) > max_values:
+    raise RequestError('Too many {} values. Maximum: {}'.format(name, max_values))
+  values = list(dict.fromkeys(v for v in (str(v).strip() for v in value) if v))
+  if not values:
+    raise RequestError("Parameter '{}' is empty.".format(name))
+  return values
+
+
+def reverse_rows(request):
+  """
+  Return the number of rows for each collection of a reverse request.
+  """
+  return max(request.g.limit + request.g.offset, MIN_COLLECTION_ROWS)
+
+
+def reported_total(request, num_found):
+  """
+  Return the total number of features of a collection with `num_found`
+  documents, as reported by geocodr.api with MIN_COLLECTION_ROWS.
+  """
+  return min(num_found, max(request.g.limit + request.g.offset, MIN_COLLECTION_ROWS))
+
+
+def geometry_query(collection, docs):
+  """
+  Return the Solr parameters to load the WKT geometry of `docs` (dict by id).
+  """
+  return {
+    'q': ids_query(list(docs)),
+    'fl': 'id,{0}:[geo f={0} w=WKT]'.format(collection.geometry_field),
+  }
+
+
+def add_geometries(collection, docs, loaded):
+  """
+  Add the geometries of the `loaded` docs to `docs` (dict by id).
+  """
+  for doc in loaded:
+    docs[doc['id']][collection.geometry_field] = doc[collection.geometry_field]
+
+
+def page_placeholders(features):
+  """
+  Return a dict with the placeholders of `features` for each collection.
+  """
+  placeholders = {}
+  for feature in features:
+    if 'collection' in feature:
+      placeholders.setdefault(feature['collection'].name, []).append(feature)
+  return placeholders
+
+
+def merge_page(features, loaded):
+  """
+  Return `features` with all placeholders replaced by the complete features
+  of `loaded` (dict with the features by id for each collection).
+  """
+  page = []
+  for feature in features:
+    if 'collection' not in feature:
+      page.append(feature)
+      continue
+    feature_id = feature['properties']['_id_']
+    complete = loaded[feature['collection'].name].get(feature_id)
+    if complete is None:
+      # removed between both requests (delta update)
+      log.warning("document '%s' of collection '%s' not found", feature_id,
+                  feature['collection'].name)
+      continue
+    page.append(complete)
+  return page
+
+
+class QueryContext(object):
+  """
+  The parameters of a query request that are used by all collections.
+  """
+
+  def __init__(self, app, request):
+    self.dst_proj = request.g.dst_proj
+    self.spatial_filter = request.g.spatial_filter
+    self.distance_pt = self.spatial_filter.distance_pt() if self.spatial_filter else None
+    self.shape = request.g.shape
+    self.geometry = geometry_params(request)
+    self.historic = app.include_historic(request)
+    self.degraded = app.degraded()
+    self.debug = request.args.get('debug', '').lower() == 'true'
+    # load only the sort fields for docs that are not on the requested page
+    self.trim = not self.debug and not request.g.is_reverse
+    self.needed = request.g.limit + request.g.offset
+    classes = request.g.classes
+    self.collections = [c for c in app.collections if c.class_ in classes]
+    if self.degraded:
+      self.collections = fallback_collections(app.fallback, self.collections)
+    self.query_tiers = [self.collections]
+    if (
+        app.score_ceilings and not request.g.is_reverse and not self.degraded
+        and not app.score_ceilings.probe()
+    ):
+      self.query_tiers = tiers.tiers(self.collections)
+
+
+class FeatureCollection(_FeatureCollection):
+  def add_features(self, features, total=None):
+    """
+    Add `features`. `total` is the number of available features, if more
+    than the added features.
+    """
+    _FeatureCollection.add_features(self, features)
+    if total is not None:
+      self.total_features += max(total - len(features), 0)
+
+
+def geometry_params(request):
+  """
+  Return the keyword arguments for to_features with the `simplify`
+  tolerance and the coordinate `precision` of the request.
+  """
+  kw = {}
+  simplify = request.g.params.get('simplify', None)
+  if simplify not in (None, ''):
+    try:
+      simplify = float(simplify)
+    except (TypeError, ValueError):
+      simplify = -1
+    if not math.isfinite(simplify) or simplify < 0:
+      raise RequestError("Invalid simplify value. Expected a tolerance >= 0. Got: '{}'".format(
+        request.g.params.get('simplify')))
+    if simplify:
+      kw['simplify'] = simplify
+  precision = request.g.params.get('precision', None)
+  if precision not in (None, ''):
+    try:
+      precision = int(precision)
+    except (TypeError, ValueError):
+      precision = -1
+    if not 0 <= precision <= MAX_PRECISION:
+      raise RequestError(
+        "Invalid precision value. Expected 0 to {} decimal places. Got: '{}'".format(
+          MAX_PRECISION, request.g.params.get('precision')))
+    kw['precision'] = precision
+  return kw
+
+
+class Geocodr(api.Geocodr):
+
+  def __init__(self, config):
+    api.Geocodr.__init__(self, config)
+    self.url_map.add(Rule('/feature', endpoint='feature'))
+    if config.get('hedge'):
+      self.solr = hedge.HedgedSolr([config['solr_url']] + list(config.get('hedge_urls') or []),
+                                   **config.get('hedge_options', {}))
+    if config.get('api_keys_csv'):
+      self.apikeys = APIKeys(config['api_keys_csv'])
+    self.geometry_stores = GeometryStores(config.get('geometry_dir'))
+    # include historic records by default
+    self.historic = config.get('historic', True)
+    self.parameterized = config.get('parameterized', False)
+    self.admission = admission.Admission(
+      config.get('max_in_flight') or 0,
+      queue_timeout=config.get('queue_timeout', admission.QUEUE_TIMEOUT),
+      batch_ratio=config.get('batch_ratio', admission.BATCH_RATIO),
+    )
+    self.fallback = None
+    self.solr_health = None
+    if config.get('fallback_index'):
+      self.fallback = fallback.FallbackIndex(config['fallback_index'])
+      if not config.get('fallback_only'):
+        self.solr_health = fallback.SolrHealth(config['solr_url'])
+    self.local_index = None
+    if config.get('local_index'):
+      self.local_index = localindex.LocalIndex(
+        config['solr_url'], [c for c in self.collections if getattr(c, 'local_index', False)],
+        **config.get('local_index_options', {}))
+      self.local_index.load()
+    self.score_ceilings = None
+    if config.get('tiered'):
+      self.score_ceilings = tiers.ScoreCeilings(**config.get('tiered_options', {}))
+
+  def include_historic(self, request):
+    """
+    Return whether historic records are included in the results of
+    `request` (`historic` parameter, default of the API key or the API).
+    """
+    value = request.g.params.get('historic', None)
+    if value in (None, ''):
+      if self.apikeys:
+        return self.apikeys.option(request, 'historic', self.historic)
+      return self.historic
+    try:
+      return parse_bool(str(value))
+    except ValueError:
+      raise RequestError("Invalid historic value. Supported: true or false. Got: '{}'".format(
+        value))
+
+  def degraded(self):
+    """
+    Return whether queries are answered from the fallback index.
+    """
+    if self.fallback is None:
+      return False
+    return self.solr_health is None or not self.solr_health.healthy()
+
+  def solr_failed(self, ex):
+    """
+    Switch to the fallback index if `ex` shows that Solr is unavailable.
+    """
+    if self.solr_health is None:
+      return
+    # connection errors and timeouts of requests and geocodr_mv.asyncsolr
+    if (
+        isinstance(ex, (requests.RequestException, OSError))
+        or (isinstance(ex, solr.SolrException) and ex.resp.status_code >= 500)
+    ):
+      self.solr_health.report_failure()
+
+  def solr_params(self, request, collection, spatial_filter, historic=True):
+    """
+    Return the Solr parameters (without rows) for `collection`. Historic
+    records are excluded with a filter query if `historic` is false.
+    """
+    params = {
+      'sort': collection.sort,
+      'fl': collection.field_list,
+    }
+    if request.g.is_reverse:
+      params['q'] = '*'
+    elif is_degraded(request):
+      # plain text for the fallback index
+      params['q'] = request.g.query
+    elif self.parameterized and hasattr(collection, 'query_params'):
+      params.update(collection.query_params(request.g.query))
+    else:
+      params['q'] = collection.query(request.g.query)
+    if spatial_filter:
+      params.update(spatial_filter.query_params(collection.geometry_field))
+    historic_field = getattr(collection, 'historic_field', None)
+    if not historic and historic_field:
+      fq = [params['fq']] if 'fq' in params else []
+      # docs without the field (older imports) are included
+      fq.append('-{}:true'.format(historic_field))
+      params['fq'] = fq
+    return params
+
+  def local_collection(self, request, collection, params):
+    """
+    Return the index of geocodr_mv.localindex that answers `params` for
+    `collection` or None. Only search requests without spatial filters and
+    Solr credentials are answered locally.
+    """
+    if (
+        self.local_index is None or request.g.user_auth or request.g.is_reverse
+        or 'fq' in params or params.get('q', '').startswith(fallback.IDS_QUERY)
+    ):
+      return None
+    index = self.local_index.get(collection.name)
+    if index is None or not index.has_fields(params.get('fl')):
+      return None
+    return index
+
+  def select(self, request, collection, params, start, rows):
+    if is_degraded(request):
+      return self.fallback.query(collection.name, start=start, rows=rows, **params)
+    index = self.local_collection(request, collection, params)
+    if index is not None:
+      return index.query(request.g.query, start=start, rows=rows, fl=params.get('fl'))
+    try:
+      return self.solr.query(
+        collection=collection.name,
+        start=start,
+        rows=rows,
+        user_auth=request.g.user_auth,
+        **params
+      )
+    except Exception as ex:
+      self.solr_failed(ex)
+      raise
+
+  def fetch(self, request, collection, params):
+    """
+    Return the documents for `collection` and the number of features that
+    are reported as total.
+    """
+    def select(start, rows):
+      return self.select(request, collection, params, start, rows)
+
+    if request.g.is_reverse:
+      # results are sorted by distance and not by score, request all
+      # documents as geocodr.api
+      resp = select(0, reverse_rows(request))
+      return resp['response']['docs'], None
+
+    docs, num_found = fetch_docs(select, collection, request.g.limit + request.g.offset)
+    return docs, reported_total(request, num_found)
+
+  def collection_params(self, request, collection, spatial_filter, trim=False, historic=True):
+    """
+    Return the Solr parameters of the first request for `collection` or
+    None if the query is too short. Only the sort fields are requested if
+    `trim` is true (see is_trimmed).
+    """
+    if (
+        not request.g.is_reverse
+        and len(request.g.query.strip()) < collection.min_query_length
+    ):
+      return None
+    params = self.solr_params(request, collection, spatial_filter, historic=historic)
+    if trim:
+      params['fl'] = search_field_list(collection)
+    return params
+
+  def collection_features(self, request, collection, docs, dst_proj, distance_pt, shape,
+                          trim=False, geometry=None):
+    """
+    Return the features (or placeholder features if `trim` is true) for the
+    `docs` of `collection`.
+    """
+    if self.score_ceilings and not request.g.is_reverse and not is_degraded(request):
+      self.score_ceilings.observe(collection, request.g.query, docs)
+    if trim:
+      return sort_features(collection, docs)
+    return collection.to_features(
+      docs,
+      dst_proj=dst_proj,
+      distance_pt=distance_pt,
+      shape=shape,
+      **(geometry or {})
+    )
+
+  def query_collection(self, request, collection, dst_proj, spatial_filter, distance_pt,
+                       shape, trim=False, geometry=None, historic=True):
+    """
+    Query `collection` and return the features and the total number.
+    Returns placeholder features (see sort_features) if `trim` is true and
+    the collection supports it. `geometry` are additional keyword arguments
+    for to_features (see geometry_params). Historic records are excluded if
+    `historic` is false.
+    """
+    trim = trim and is_trimmed(collection)
+    params = self.collection_params(request, collection, spatial_filter, trim, historic)
+    if params is None:
+      # return empty result for short queries
+      return [], None
+    docs, total = self.fetch(request, collection, params)
+    features = self.collection_features(request, collection, docs, dst_proj, distance_pt,
+                                        shape, trim=trim, geometry=geometry)
+    return features, total
+
+  def page_fields(self, collection, dst_proj, distance_pt, shape, geometry=None):
+    """
+    Return the field list to load complete features of `collection`, the
+    precomputed geometry field and the geometry store (see load_features).
+    """
+    geometry = geometry or {}
+    precomputed, store = None, None
+    if hasattr(collection, 'precomputed_field'):
+      precomputed = collection.precomputed_field(dst_proj, shape, distance_pt,
+                                                 geometry.get('simplify'))
+    if not precomputed and hasattr(collection, 'lod_field'):
+      # pre-simplified geometry, simplified further by to_features
+      precomputed = collection.lod_field(shape, geometry.get('simplify'), distance_pt)
+    if not precomputed and hasattr(collection, 'page_fields'):
+      store = self.geometry_stores.get(collection.name)
+    if precomputed:
+      fl = ','.join(collection.page_fields + [precomputed])
+    elif store:
+      fl = ','.join(collection.page_fields)
+    else:
+      fl = collection.page_field_list
+    return fl, precomputed, store
+
+  def page_request(self, collection, placeholders, dst_proj, distance_pt, shape,
+                   geometry=None):
+    """
+    Return the Solr parameters to load the `placeholders` of `collection`,
+    the precomputed geometry field and the geometry store (see
+    load_features).
+    """
+    fl, precomputed, store = self.page_fields(collection, dst_proj, distance_pt, shape,
+                                              geometry)
+    ids = [f['properties']['_id_'] for f in placeholders]
+    return {'q': ids_query(ids), 'fl': fl}, precomputed, store
+
+  def page_docs(self, collection, placeholders, docs, precomputed=None, store=None):
+    """
+    Return the loaded `docs` of `placeholders` with the sort fields of the
+    first request and the geometries of `store`, and a dict with the docs
+    that have no precomputed or stored geometry.
+    """
+    sort_docs = dict((f['properties']['_id_'], f['doc']) for f in placeholders)
+    # aligned score and tiebreaker fields of the first request
+    docs = [dict(sort_docs[doc['id']], **doc) for doc in docs]
+    return self.stored_geometries(collection, docs, precomputed, store)
+
+  def stored_geometries(self, collection, docs, precomputed=None, store=None):
+    """
+    Return `docs` with the geometries of `store`, and a dict with the docs
+    that have no precomputed or stored geometry.
+    """
+    result = []
+    missing = {}
+    for doc in docs:
+      if precomputed and not doc.get(precomputed):
+        missing[doc['id']] = doc
+      elif store:
+        record = store.get(doc['id'])
+        if record is None:
+          missing[doc['id']] = doc
+        else:
+          doc[collection.geometry_record_key] = record
+      result.append(doc)
+    if missing:
+      log.debug('%d documents of %s without precomputed or stored geometry', len(missing),
+                collection.name)
+    return result, missing
+
+  def page_features(self, collection, docs, dst_proj, distance_pt, shape, geometry=None):
+    """
+    Return a dict with the complete features of the loaded `docs` by id.
+    """
+    features = collection.to_features(
+      docs,
+      align_scores=False,
+      dst_proj=dst_proj,
+      distance_pt=distance_pt,
+      shape=shape,
+      **(geometry or {})
+    )
+    return dict((f['properties']['_id_'], f) for f in features)
+
+  def load_features(self, request, collection, placeholders, dst_proj, distance_pt, shape,
+                    geometry=None):
+    """
+    Load the complete features for the `placeholders` of `collection`.
+    Returns a dict with the features by id.
+    """
+    params, precomputed, store = self.page_request(collection, placeholders, dst_proj,
+                                                   distance_pt, shape, geometry)
+    resp = self.select(request, collection, params, 0, len(placeholders))
+    docs, missing = self.page_docs(collection, placeholders, resp['response']['docs'],
+                                   precomputed, store)
+    if missing:
+      resp = self.select(request, collection, geometry_query(collection, missing), 0,
+                         len(missing))
+      add_geometries(collection, missing, resp['response']['docs'])
+    return self.page_features(collection, docs, dst_proj, distance_pt, shape, geometry)
+
+  def get_docs(self, request, collection, ids, fl):
+    """
+    Return the documents `ids` of `collection` with the fields `fl` in one
+    request to the real-time get handler of Solr (or the fallback index).
+    """
+    if is_degraded(request):
+      resp = self.fallback.query(collection.name, ids_query(ids), rows=len(ids), fl=fl)
+      return resp['response']['docs']
+    try:
+      resp = realtime_get(self.solr, collection.name, ids, user_auth=request.g.user_auth,
+                          fl=fl)
+    except Exception as ex:
+      self.solr_failed(ex)
+      raise
+    return resp['response']['docs']
+
+  def lookup_features(self, request, collection, ids, dst_proj, shape, geometry=None):
+    """
+    Load the features `ids` of `collection`. Returns a dict with the
+    features by id, ids that are not in the collection are missing.
+    """
+    fl, precomputed, store = self.page_fields(collection, dst_proj, None, shape, geometry)
+    fields = fl.split(',')
+    # tiebreaker fields for to_features, Solr returns no score for /get
+    for name in getattr(collection, 'sort_field_list', '').split(','):
+      if name and name not in ('score', '*') and name not in fields:
+        fields.append(name)
+    docs = self.get_docs(request, collection, ids, ','.join(fields))
+    for doc in docs:
+      doc['score'] = 1.0
+    docs, missing = self.stored_geometries(collection, docs, precomputed, store)
+    if missing:
+      resp = self.select(request, collection, geometry_query(collection, missing), 0,
+                         len(missing))
+      add_geometries(collection, missing, resp['response']['docs'])
+    return self.page_features(collection, docs, dst_proj, None, shape, geometry)
+
+  def load_page(self, request, executor, features, dst_proj, distance_pt, shape,
+                geometry=None):
+    """
+    Replace all placeholders in `features` with complete features. Returns
+    the new list of features.
+    """
+    placeholders = page_placeholders(features)
+    if not placeholders:
+      return features
+
+    futures = dict(
+      (name, executor.submit(self.load_features, request, p[0]['collection'], p, dst_proj,
+                             distance_pt, shape, geometry))
+      for name, p in placeholders.items()
+    )
+    return merge_page(features, dict((name, f.result()) for name, f in futures.items()))
+
+  def check_auth(self, request):
+    """
+    Return an error response if the API key of `request` is not permitted.
+    """
+    if self.enable_solr_basic_auth and request.g.user_auth:
+      # skip apikey validation if enable_solr_basic_auth is active and the user
+      # provided user/password
+      return None
+    if self.apikeys and not self.apikeys.is_permitted(request):
+      # we have API keys and key is missing or invalid
+      return self.json_error(request, 403, 'API key is invalid or not valid for this requests.')
+    return None
+
+  def admission_limits(self, request):
+    """
+    Return the API key of `request` and its limits for the admission
+    control.
+    """
+    if self.apikeys:
+      return request.args.get('key'), self.apikeys.limits(request)
+    return None, {}
+
+  def rejected(self, request, ex):
+    """
+    Return the response for the admission.Rejected `ex`.
+    """
+    resp = self.json_error(request, ex.status, ex.reason)
+    resp.headers['Retry-After'] = str(ex.retry_after)
+    return resp
+
+  def query_context(self, request):
+    """
+    Return the QueryContext of `request`.
+    """
+    ctx = QueryContext(self, request)
+    # selects the fallback index for all requests of this query
+    request.degraded = ctx.degraded
+    return ctx
+
+  def skip_collection(self, request, ctx, collection, fc):
+    """
+    Return True if `collection` can not change the result page of the
+    features in `fc` (tiered queries).
+    """
+    if len(ctx.query_tiers) > 1 and self.score_ceilings.skip(
+        collection, request.g.query, fc.features, ctx.needed):
+      log.debug("skipped collection '%s' for '%s'", collection.name, request.g.query)
+      return True
+    return False
+
+  def query_response(self, request, ctx, fc):
+    """
+    Return the response with the features of `fc`.
+    """
+    if not ctx.debug:
+      fc.filter_internal_properties()
+
+    resp = fc.as_mapping()
+    if ctx.debug and not request.g.is_reverse:
+      shapes = query_shapes(ctx.collections, request.g.query)
+      if shapes:
+        resp['properties']['query_shapes'] = shapes
+    if ctx.degraded:
+      resp['properties']['degraded'] = True
+    return self.json_resp(request, resp)
+
+  def admitted(self, request, run):
+    """
+    Return the response of `run(request)` if the API key of `request` is
+    permitted and the request passes the admission control.
+    """
+    err = self.check_auth(request)
+    if err:
+      return err
+
+    try:
+      ticket = self.admission.enter(*self.admission_limits(request))
+    except admission.Rejected as ex:
+      return self.rejected(request, ex)
+    try:
+      return run(request)
+    finally:
+      self.admission.release(ticket)
+
+  def on_query(self, request):
+    return self.admitted(request, self.run_query)
+
+  def on_feature(self, request):
+    return self.admitted(request, self.run_lookup)
+
+  def run_query(self, request):
+    # collect all variables here so we can use them in concurrently from
+    # multiple threads in query_collection()
+    ctx = self.query_context(request)
+    err = self.check_req_classes(request, request.g.classes)
+    if err:
+      return err
+
+    fc = FeatureCollection()
+    # query in parallel (each tier after the previous one)
+    with ThreadPoolExecutor(max_workers=4) as e:
+      for tier in ctx.query_tiers:
+        futures = []
+        for collection in tier:
+          if self.skip_collection(request, ctx, collection, fc):
+            continue
+          futures.append((collection.name, e.submit(
+            self.query_collection, request, collection, ctx.dst_proj, ctx.spatial_filter,
+            ctx.distance_pt, ctx.shape, trim=ctx.trim, geometry=ctx.geometry,
+            historic=ctx.historic)))
+
+        for name, f in futures:
+          try:
+            features, total = f.result()
+            fc.add_features(features, total=total)
+          except solr.SolrUnauthenticatedError:
+            return self.json_error(request, 400, 'Invalid user/password')
+          except Exception:
+            log.exception("Fetching result for collection '%s'", name)
+            return self.json_error(request, 500, 'Internal error.')
+
+      fc.sort(limit=request.g.limit, offset=request.g.offset, distance=request.g.is_reverse)
+
+      try:
+        fc.features = self.load_page(request, e, fc.features, ctx.dst_proj, ctx.distance_pt,
+                                     ctx.shape, ctx.geometry)
+      except solr.SolrUnauthenticatedError:
+        return self.json_error(request, 400, 'Invalid user/password')
+      except Exception:
+        log.exception("Loading features of the result page")
+        return self.json_error(request, 500, 'Internal error.')
+
+    return self.query_response(request, ctx, fc)
+
+  def lookup_collections(self, request):
+    """
+    Return the collections of the `collection` parameter of `request`.
+    """
+    collections = []
+    for name in list_param(request, 'collection', max_values=len(self.collections)):
+      collection = next((c for c in self.collections if c.name == name), None)
+      if collection is None:
+        raise RequestError("Invalid collection '{}'".format(name))
+      collections.append(collection)
+    return collections
+
+  def run_lookup(self, request):
+    """
+    Return the features of the `id` parameter of `request` (one or many ids)
+    from the collections of the `collection` parameter, in the order of the
+    ids. Ids that are not found are listed in `missing_ids`.
+    """
+    ids = list_param(request, 'id', max_values=MAX_FEATURE_IDS)
+    collections = self.lookup_collections(request)
+    epsg = request.g.params.get('out_epsg', None)
+    dst_proj = proj.epsg(epsg) if epsg else None
+    shape = request.g.shape
+    geometry = geometry_params(request)
+    debug = request.args.get('debug', '').lower() == 'true'
+    request.degraded = self.degraded()
+    if request.degraded:
+      collections = fallback_collections(self.fallback, collections)
+
+    loaded = {}
+    with ThreadPoolExecutor(max_workers=4) as e:
+      futures = [(c.name, e.submit(self.lookup_features, request, c, ids, dst_proj, shape,
+                                   geometry)) for c in collections]
+      for name, f in futures:
+        try:
+          loaded[name] = f.result()
+        except solr.SolrUnauthenticatedError:
+          return self.json_error(request, 400, 'Invalid user/password')
+        except Exception:
+          log.exception("Looking up features of collection '%s'", name)
+          return self.json_error(request, 500, 'Internal error.')
+
+    features = []
+    missing = []
+    for feature_id in ids:
+      found = [loaded[c.name][feature_id] for c in collections
+               if feature_id in loaded[c.name]]
+      if not found:
+        missing.append(feature_id)
+      features.extend(found)
+
+    fc = FeatureCollection()
+    fc.add_features(features)
+    if not debug:
+      fc.filter_internal_properties()
+    resp = fc.as_mapping()
+    if missing:
+      resp['properties']['missing_ids'] = missing
+    if request.degraded:
+      resp['properties']['degraded'] = True
+    return self.json_resp(request, resp)
+
+
+def create_app(config):
+  app = Geocodr(config)
+
+  if config.get('static_files'):
+    from werkzeug.middleware.shared_data import SharedDataMiddleware
+    app.wsgi_app = SharedDataMiddleware(app.wsgi_app, {
+      '/static': config['static_files'],
+    })
+  return app
+
+
+def argument_parser(**kw):
+  """
+  Return the argument parser for the options of the API (see app_config).
+  """
+  import argparse
+
+  parser = argparse.ArgumentParser(**kw)
+  parser.add_argument("--host", default="127.0.0.1")
+  parser.add_argument("--port", type=int, default=5000)
+  parser.add_argument("--solr-url", default="http://localhost:8983/solr")
+  parser.add_argument("--mapping", required=True, help='mapping file')
+  parser.add_argument("--static-dir", help='optional: additional files to host at /static')
+  parser.add_argument("--api-keys", help='optional: CSV file with permitted API keys and domains')
+  parser.add_argument(
+    "--enable-solr-basic-auth",
+    action='store_true',
+    help='optional: pass user/password params to Solr as HTTP Basic-Authentication'
+  )
+  parser.add_argument("--geometry-dir",
+                      help='optional: directory with geometry stores of geocodr_mv.reindex')
+  parser.add_argument("--exclude-historic", action='store_true',
+                      help='optional: exclude historic records unless requested with '
+                           'historic=true or enabled for the API key')
+  parser.add_argument("--tiered", action='store_true',
+                      help='optional: query collections in tiers and skip collections that '
+                           'can not change the result page')
+  parser.add_argument("--parameterized-queries", action='store_true',
+                      help='optional: send query templates with the terms as separate '
+                           'parameters')
+  parser.add_argument("--hedge", action='store_true',
+                      help='optional: repeat slow Solr requests on another node')
+  parser.add_argument("--hedge-url", action='append', dest='hedge_urls',
+                      help='optional: URL of another Solr node for hedged requests, can be '
+                           'repeated (default: --solr-url)')
+  parser.add_argument("--hedge-ratio", type=float, default=hedge.MAX_RATIO,
+                      help='optional: maximum ratio of hedged requests (default: %(default)s)')
+  parser.add_argument("--fallback-index",
+                      help='optional: SQLite index of geocodr_mv.fallback for queries while Solr '
+                           'is unavailable')
+  parser.add_argument("--fallback-only", action='store_true',
+                      help='optional: answer all queries from --fallback-index (without Solr)')
+  parser.add_argument("--local-index", action='store_true',
+                      help='optional: answer search queries of small collections (local_index '
+                           'in the mapping) from memory')
+  parser.add_argument("--threads", type=int, default=admission.THREADS,
+                      help='waitress threads (of each worker with geocodr_mv.prefork) '
+                           '(default: %(default)s)')
+  parser.add_argument("--max-in-flight", type=int,
+                      help='optional: maximum number of concurrent queries (of each process, '
+                           'default: half of --threads with waitress, {} with ASGI)'.format(
+                             admission.MAX_IN_FLIGHT))
+  parser.add_argument("--queue-timeout", type=float, default=admission.QUEUE_TIMEOUT,
+                      help='optional: seconds a query waits for a slot before it is rejected '
+                           'with 503 (default: %(default)s)')
+  return parser
+
+
+def app_config(args):
+  """
+  Return the config for create_app from the parsed `args` of
+  argument_parser.
+  """
+  return {
+    'solr_url': args.solr_url,
+    'mapping': args.mapping,
+    'static_files': args.static_dir,
+    'api_keys_csv': args.api_keys,
+    'enable_solr_basic_auth': args.enable_solr_basic_auth,
+    'geometry_dir': args.geometry_dir,
+    'historic': not args.exclude_historic,
+    'tiered': args.tiered,
+    'parameterized': args.parameterized_queries,
+    'hedge': args.hedge,
+    'hedge_urls': args.hedge_urls,
+    'hedge_options': {'max_ratio': args.hedge_ratio},
+    'fallback_index': args.fallback_index,
+    'fallback_only': args.fallback_only,
+    'local_index': args.local_index,
+    'max_in_flight': args.max_in_flight,
+    'queue_timeout': args.queue_timeout,
+  }
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+
+  parser = argument_parser()
+  parser.add_argument("--develop", action='store_true',
+                      help='start in development mode (reload on code changes)')
+  args = parser.parse_args()
+
+  from werkzeug.serving import run_simple
+  config = app_config(args)
+  try:
+    config['max_in_flight'], connection_limit = admission.waitress_limits(
+      args.threads, args.max_in_flight)
+  except ValueError as ex:
+    parser.error(str(ex))
+  app = create_app(config)
+  if args.develop:
+    run_simple(args.host, args.port, app,
+               extra_files=[os.path.abspath(args.mapping)],
+               use_debugger=True, use_reloader=True, threaded=True)
+  else:
+    import waitress
+    waitress.serve(app, host=args.host, port=args.port, threads=args.threads,
+                   connection_limit=connection_limit)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,405 @@
+"""
+The asgi module contains an asyncio version of the geocodr_mv.api web
+service. create_asgi_app returns an ASGI application with the same config,
+request parameters and responses as create_app.
+
+The Solr requests of all collections are concurrent tasks on one event loop
+(geocodr_mv.asyncsolr, pooled keep-alive connections) instead of a thread
+pool for each request. The CPU-heavy parts (to_features, sorting and the
+JSON/gzip response) run in a bounded thread pool (`cpu_workers`,
+--cpu-workers), so that slow requests do not block the event loop. The
+thread pool does not run Python code in parallel, start one process for
+each CPU for that.
+
+The admission control of geocodr_mv.admission waits for a free slot on the
+event loop, without blocking a thread.
+
+Requests for other paths than /query (e.g. /static) are passed to the WSGI
+application in the thread pool. Hedged requests (--hedge) are only
+supported by the WSGI application. Queries from the fallback index
+(--fallback-index) and from the local indexes (--local-index) run in the
+thread pool.
+
+Start with `python -m geocodr_mv.asgi` (requires uvicorn) or with any ASGI
+server and the factory `geocodr_mv.asgi:app_from_env` (config from the
+GEOCODR_ARGS environment variable).
+"""
+
+import asyncio
+import io
+import logging
+import os
+import shlex
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from geocodr import solr
+from geocodr.request import GeocodrRequest, RequestError
+
+from geocodr_mv import admission
+from geocodr_mv.api import (
+  FeatureCollection, argument_parser, app_config, create_app, fetch_steps, geometry_query,
+  add_geometries, is_degraded, is_trimmed, merge_page, page_placeholders, reported_total,
+  reverse_rows,
+)
+from geocodr_mv.asyncsolr import AsyncSolr
+
+
+log = logging.getLogger(__name__)
+
+CPU_WORKERS = os.cpu_count() or 4
+MAX_SOLR_CONNECTIONS = 100
+# seconds between checks for a free slot of the admission control
+ADMISSION_POLL = 0.005
+
+
+def wsgi_environ(scope, body):
+  """
+  Return a WSGI environ for the ASGI HTTP `scope` and the request `body`.
+  """
+  server = scope.get('server') or ('localhost', 80)
+  environ = {
+    'REQUEST_METHOD': scope['method'],
+    'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+    'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+    'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+    'SERVER_NAME': server[0],
+    'SERVER_PORT': str(server[1]),
+    'SERVER_PROTOCOL': 'HTTP/{}'.format(scope.get('http_version', '1.1')),
+    'CONTENT_LENGTH': str(len(body)),
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': scope.get('scheme', 'http'),
+    'wsgi.input': io.BytesIO(body),
+    'wsgi.errors': sys.stderr,
+    'wsgi.multithread': True,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False,
+  }
+  if scope.get('client'):
+    environ['REMOTE_ADDR'] = scope['client'][0]
+  for name, value in scope.get('headers', []):
+    name = name.decode('latin-1').upper().replace('-', '_')
+    value = value.decode('latin-1')
+    if name == 'CONTENT_LENGTH':
+      continue
+    if name != 'CONTENT_TYPE':
+      name = 'HTTP_' + name
+    if name in environ:
+      value = environ[name] + ',' + value
+    environ[name] = value
+  return environ
+
+
+def call_wsgi(app, environ):
+  """
+  Call the WSGI `app`. Returns the status code, the headers and the body.
+  """
+  result = {}
+
+  def start_response(status, headers, exc_info=None):
+    result['status'] = int(status.split(None, 1)[0])
+    result['headers'] = headers
+
+  chunks = app(environ, start_response)
+  try:
+    body = b''.join(chunks)
+  finally:
+    if hasattr(chunks, 'close'):
+      chunks.close()
+  return result['status'], result['headers'], body
+
+
+class AsyncGeocodr(object):
+  """
+  ASGI application for the geocodr_mv.api.Geocodr `app`.
+  """
+
+  def __init__(self, app, cpu_workers=CPU_WORKERS, max_connections=MAX_SOLR_CONNECTIONS):
+    self.app = app
+    self.solr = AsyncSolr(app.solr.url, max_connections=max_connections)
+    self.executor = ThreadPoolExecutor(max_workers=cpu_workers)
+
+  def run(self, func, *args, **kw):
+    """
+    Run `func` in the thread pool.
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(self.executor, lambda: func(*args, **kw))
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] == 'lifespan':
+      await self.lifespan(receive, send)
+      return
+    if scope['type'] != 'http':
+      return
+
+    body = []
+    while True:
+      message = await receive()
+      body.append(message.get('body', b''))
+      if not message.get('more_body'):
+        break
+    environ = wsgi_environ(scope, b''.join(body))
+
+    if environ['PATH_INFO'] == '/query':
+      request = GeocodrRequest(environ, self.app.default_params)
+      response = await self.dispatch(request)
+      status, headers, body = response.status_code, response.headers.to_wsgi_list(), \
+        response.get_data()
+    else:
+      status, headers, body = await self.run(call_wsgi, self.app, environ)
+
+    await send({
+      'type': 'http.response.start',
+      'status': status,
+      'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+  async def lifespan(self, receive, send):
+    while True:
+      message = await receive()
+      if message['type'] == 'lifespan.startup':
+        await send({'type': 'lifespan.startup.complete'})
+      elif message['type'] == 'lifespan.shutdown':
+        self.solr.close()
+        self.executor.shutdown(wait=False)
+        await send({'type': 'lifespan.shutdown.complete'})
+        return
+
+  async def dispatch(self, request):
+    """
+    Return the response for the /query `request`, as Geocodr.dispatch_request.
+    """
+    try:
+      return await self.on_query(request)
+    except RequestError as e:
+      return self.app.json_error(request, 400, e.reason)
+    except ValueError as e:
+      return self.app.json_error(request, 400, 'Invalid parameter value: ' + str(e))
+    except Exception:
+      log.exception("Dispatching query {}".format(request))
+      return self.app.json_error(request, 500, 'Internal error')
+
+  async def select(self, request, collection, params, start, rows):
+    if is_degraded(request):
+      return await self.run(self.app.fallback.query, collection.name, start=start, rows=rows,
+                            **params)
+    index = self.app.local_collection(request, collection, params)
+    if index is not None:
+      return await self.run(index.query, request.g.query, start=start, rows=rows,
+                            fl=params.get('fl'))
+    try:
+      return await self.solr.query(
+        collection=collection.name,
+        start=start,
+        rows=rows,
+        user_auth=request.g.user_auth,
+        **params
+      )
+    except Exception as ex:
+      self.app.solr_failed(ex)
+      raise
+
+  async def fetch(self, request, collection, params):
+    """
+    Return the documents for `collection` and the number of features that
+    are reported as total, as Geocodr.fetch.
+    """
+    if request.g.is_reverse:
+      resp = await self.select(request, collection, params, 0, reverse_rows(request))
+      return resp['response']['docs'], None
+
+    steps = fetch_steps(collection, request.g.limit + request.g.offset)
+    try:
+      start, rows = next(steps)
+      while True:
+        start, rows = steps.send(await self.select(request, collection, params, start, rows))
+    except StopIteration as ex:
+      docs, num_found = ex.value
+    return docs, reported_total(request, num_found)
+
+  async def query_collection(self, request, ctx, collection):
+    """
+    Query `collection` and return the features and the total number, as
+    Geocodr.query_collection.
+    """
+    trim = ctx.trim and is_trimmed(collection)
+    params = self.app.collection_params(request, collection, ctx.spatial_filter, trim,
+                                        ctx.historic)
+    if params is None:
+      # return empty result for short queries
+      return [], None
+    docs, total = await self.fetch(request, collection, params)
+    features = await self.run(
+      self.app.collection_features, request, collection, docs, ctx.dst_proj, ctx.distance_pt,
+      ctx.shape, trim=trim, geometry=ctx.geometry)
+    return features, total
+
+  async def load_features(self, request, ctx, collection, placeholders):
+    """
+    Load the complete features for the `placeholders` of `collection`, as
+    Geocodr.load_features.
+    """
+    app = self.app
+    params, precomputed, store = app.page_request(
+      collection, placeholders, ctx.dst_proj, ctx.distance_pt, ctx.shape, ctx.geometry)
+    resp = await self.select(request, collection, params, 0, len(placeholders))
+    docs, missing = app.page_docs(collection, placeholders, resp['response']['docs'],
+                                  precomputed, store)
+    if missing:
+      resp = await self.select(request, collection, geometry_query(collection, missing), 0,
+                               len(missing))
+      add_geometries(collection, missing, resp['response']['docs'])
+    return await self.run(app.page_features, collection, docs, ctx.dst_proj, ctx.distance_pt,
+                          ctx.shape, ctx.geometry)
+
+  async def load_page(self, request, ctx, features):
+    """
+    Replace all placeholders in `features` with complete features.
+    """
+    placeholders = page_placeholders(features)
+    if not placeholders:
+      return features
+    names = list(placeholders)
+    loaded = await asyncio.gather(*[
+      self.load_features(request, ctx, placeholders[name][0]['collection'], placeholders[name])
+      for name in names
+    ])
+    return merge_page(features, dict(zip(names, loaded)))
+
+  async def admit(self, request):
+    """
+    Return the admission.Ticket for `request`, as Admission.enter but waits
+    on the event loop. Raises admission.Rejected.
+    """
+    adm = self.app.admission
+    key, limits = self.app.admission_limits(request)
+    lane = limits.get('lane') or admission.INTERACTIVE
+    adm.check_key(key, limits)
+    if adm.try_acquire(lane):
+      return admission.Ticket(key, lane)
+    deadline = time.monotonic() + adm.queue_timeout
+    adm.wait_start(lane)
+    try:
+      while not adm.try_acquire(lane):
+        if time.monotonic() >= deadline:
+          raise admission.Rejected(503, 'Service overloaded, try again later.')
+        await asyncio.sleep(ADMISSION_POLL)
+    except BaseException:
+      # also if the request was cancelled
+      adm.release_key(key)
+      raise
+    finally:
+      adm.wait_end(lane)
+    return admission.Ticket(key, lane)
+
+  async def on_query(self, request):
+    app = self.app
+    err = app.check_auth(request)
+    if err:
+      return err
+
+    try:
+      ticket = await self.admit(request)
+    except admission.Rejected as ex:
+      return app.rejected(request, ex)
+    try:
+      return await self.run_query(request)
+    finally:
+      app.admission.release(ticket)
+
+  async def run_query(self, request):
+    app = self.app
+    ctx = app.query_context(request)
+    err = app.check_req_classes(request, request.g.classes)
+    if err:
+      return err
+
+    fc = FeatureCollection()
+    for tier in ctx.query_tiers:
+      tasks = [
+        (c.name, asyncio.ensure_future(self.query_collection(request, ctx, c)))
+        for c in tier if not app.skip_collection(request, ctx, c, fc)
+      ]
+      try:
+        for name, task in tasks:
+          try:
+            features, total = await task
+            fc.add_features(features, total=total)
+          except solr.SolrUnauthenticatedError:
+            return app.json_error(request, 400, 'Invalid user/password')
+          except Exception:
+            log.exception("Fetching result for collection '%s'", name)
+            return app.json_error(request, 500, 'Internal error.')
+      finally:
+        for _, task in tasks:
+          task.cancel()
+
+    fc.sort(limit=request.g.limit, offset=request.g.offset, distance=request.g.is_reverse)
+
+    try:
+      fc.features = await self.load_page(request, ctx, fc.features)
+    except solr.SolrUnauthenticatedError:
+      return app.json_error(request, 400, 'Invalid user/password')
+    except Exception:
+      log.exception("Loading features of the result page")
+      return app.json_error(request, 500, 'Internal error.')
+
+    return await self.run(app.query_response, request, ctx, fc)
+
+
+def create_asgi_app(config):
+  """
+  Return the ASGI application for `config` (see geocodr_mv.api.create_app).
+  """
+  return AsyncGeocodr(
+    create_app(config),
+    cpu_workers=config.get('cpu_workers', CPU_WORKERS),
+    max_connections=config.get('max_solr_connections', MAX_SOLR_CONNECTIONS),
+  )
+
+
+def asgi_argument_parser():
+  parser = argument_parser(description='Start the geocodr API as ASGI application.')
+  parser.add_argument("--cpu-workers", type=int, default=CPU_WORKERS,
+                      help='threads for feature building and responses (default: %(default)s)')
+  parser.add_argument("--max-solr-connections", type=int, default=MAX_SOLR_CONNECTIONS,
+                      help='maximum number of connections to Solr (default: %(default)s)')
+  return parser
+
+
+def asgi_config(args):
+  config = dict(app_config(args), cpu_workers=args.cpu_workers,
+                max_solr_connections=args.max_solr_connections)
+  # requests wait for slots on the event loop, independent of threads
+  config['max_in_flight'] = args.max_in_flight or admission.MAX_IN_FLIGHT
+  return config
+
+
+def app_from_env():
+  """
+  Return the ASGI application with the options of the GEOCODR_ARGS
+  environment variable (e.g. for `uvicorn --factory geocodr_mv.asgi:app_from_env`).
+  """
+  args = asgi_argument_parser().parse_args(shlex.split(os.environ.get('GEOCODR_ARGS', '')))
+  return create_asgi_app(asgi_config(args))
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+
+  parser = asgi_argument_parser()
+  args = parser.parse_args()
+  try:
+    import uvicorn
+  except ImportError:
+    parser.error('uvicorn is required to start the ASGI application')
+  uvicorn.run(create_asgi_app(asgi_config(args)), host=args.host, port=args.port,
+              log_level='info')
+
+
+if __name__ == '__main__':
+  main()
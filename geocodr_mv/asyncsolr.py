@@ -0,0 +1,175 @@
+"""
+The asyncsolr module provides an asyncio Solr client for geocodr_mv.asgi.
+
+AsyncSolr.query has the same arguments and results as geocodr.solr.Solr.query.
+Requests are sent with HTTP/1.1 over pooled keep-alive connections (at most
+`max_connections` for all requests). A request on a reused connection that
+was closed by Solr is repeated once on a new connection.
+
+An AsyncSolr must only be used within one event loop.
+"""
+
+import asyncio
+import base64
+import json
+import ssl
+
+from urllib.parse import urlencode, urlsplit
+
+from geocodr.solr import SolrException, SolrUnauthenticatedError
+
+
+MAX_CONNECTIONS = 100
+TIMEOUT = 30
+
+
+class Response(object):
+  """
+  Solr response with the attributes of requests.Response that are used by
+  geocodr.solr.SolrException.
+  """
+
+  def __init__(self, url, status_code, headers, content):
+    self.url = url
+    self.status_code = status_code
+    self.headers = headers
+    self.content = content
+
+  @property
+  def ok(self):
+    return self.status_code < 400
+
+  def json(self):
+    return json.loads(self.content.decode('utf-8'))
+
+
+class ConnectionClosed(Exception):
+  pass
+
+
+async def read_body(reader, headers):
+  """
+  Read the body of a response with `headers` (dict with lower case names).
+  """
+  if headers.get('transfer-encoding', '').lower() == 'chunked':
+    chunks = []
+    while True:
+      size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+      if size == 0:
+        # trailer
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+          pass
+        return b''.join(chunks)
+      chunks.append(await reader.readexactly(size))
+      await reader.readexactly(2)
+  if 'content-length' in headers:
+    return await reader.readexactly(int(headers['content-length']))
+  return await reader.read()
+
+
+async def read_response(reader):
+  """
+  Read a response from `reader`. Returns the status code, the headers and
+  the body.
+  """
+  line = await reader.readline()
+  if not line:
+    raise ConnectionClosed()
+  status = int(line.split(None, 2)[1])
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if line in (b'\r\n', b'\n', b''):
+      break
+    name, value = line.decode('latin-1').split(':', 1)
+    headers[name.strip().lower()] = value.strip()
+  return status, headers, await read_body(reader, headers)
+
+
+class AsyncSolr(object):
+  """
+  Connection pool for asynchronous queries to a Solr server.
+  """
+
+  def __init__(self, url, max_connections=MAX_CONNECTIONS, timeout=TIMEOUT):
+    self.url = url.rstrip('/')
+    parts = urlsplit(self.url)
+    self.host = parts.hostname
+    self.ssl = ssl.create_default_context() if parts.scheme == 'https' else None
+    self.port = parts.port or (443 if self.ssl else 80)
+    self.path = parts.path
+    self.timeout = timeout
+    self.max_connections = max_connections
+    self._idle = []
+    self._semaphore = None
+
+  async def _connect(self):
+    return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+  async def _request(self, conn, target, headers):
+    reader, writer = conn
+    lines = ['GET {} HTTP/1.1'.format(target), 'Host: {}:{}'.format(self.host, self.port)]
+    lines.extend('{}: {}'.format(k, v) for k, v in headers.items())
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+    await writer.drain()
+    return await read_response(reader)
+
+  async def request(self, target, headers):
+    """
+    Send a GET request for `target` (path and query string). Returns the
+    status code, the headers and the body.
+    """
+    if self._semaphore is None:
+      self._semaphore = asyncio.Semaphore(self.max_connections)
+    async with self._semaphore:
+      reused = bool(self._idle)
+      conn = self._idle.pop() if reused else await self._connect()
+      try:
+        try:
+          status, resp_headers, body = await asyncio.wait_for(
+            self._request(conn, target, headers), self.timeout)
+        except (ConnectionClosed, ConnectionError, asyncio.IncompleteReadError):
+          if not reused:
+            raise
+          # closed by the server while idle
+          conn[1].close()
+          conn = await self._connect()
+          status, resp_headers, body = await asyncio.wait_for(
+            self._request(conn, target, headers), self.timeout)
+      except BaseException:
+        conn[1].close()
+        raise
+      if resp_headers.get('connection', '').lower() == 'close':
+        conn[1].close()
+      else:
+        self._idle.append(conn)
+      return status, resp_headers, body
+
+  async def query(self, collection, q, user_auth=None, **kw):
+    """
+    Send query `q` for `collection` to Solr. Returns the JSON response as a dict.
+    Additional `kw` parameters are sent as further GET parameters.
+    Raises `SolrException` on error.
+    """
+    kw['q'] = q
+    # None values are not sent (as requests)
+    params = dict((k, v) for k, v in kw.items() if v is not None)
+    target = '{}/{}/select?{}'.format(self.path, collection, urlencode(params, doseq=True))
+    headers = {'Accept-Encoding': 'identity', 'Connection': 'keep-alive'}
+    if user_auth:
+      headers['Authorization'] = 'Basic ' + base64.b64encode(
+        '{}:{}'.format(*user_auth).encode('utf-8')).decode('ascii')
+    status, resp_headers, body = await self.request(target, headers)
+    resp = Response(self.url + target[len(self.path):], status, resp_headers, body)
+    if status == 401:
+      raise SolrUnauthenticatedError()
+    if not resp.ok:
+      raise SolrException(resp)
+    return resp.json()
+
+  def close(self):
+    """
+    Close all idle connections.
+    """
+    while self._idle:
+      self._idle.pop()[1].close()
@@ -0,0 +1,224 @@
+"""
+The cachebench module replays a query log against Solr and reports the hit
+ratio of the queryResultCache for different row strategies:
+
+fixed: 1000 rows for each collection and query (geocodr.api)
+adaptive: rows and fields as requested by geocodr_mv.api (min_rows, extended
+  for tied scores up to max_rows, only the sort fields)
+
+The query log contains one query per line (optionally prefixed with a count
+and a tab, as in the output of `sort | uniq -c`). Queries are replayed in the
+order of the log, a count repeats the query. The cache statistics are read
+from the metrics API of Solr before and after each strategy. Collections are
+reloaded before each strategy (--no-reload to disable) so that each strategy
+starts with empty caches.
+"""
+
+import argparse
+import json
+import logging
+import re
+import sys
+import time
+
+from geocodr.api import MIN_COLLECTION_ROWS
+from geocodr.solr import Solr, strip_special_chars
+
+from geocodr_mv.api import fetch_docs, search_field_list
+from geocodr_mv.loadtest import percentile
+from geocodr_mv.warmup import MAPPING, mapping_collections, re_count
+
+
+log = logging.getLogger('geocodr_mv.cachebench')
+
+STRATEGIES = ('fixed', 'adaptive')
+CACHE = 'CACHE.searcher.queryResultCache'
+
+
+def read_log(path):
+  """
+  Return all normalized queries of the log file `path` in order, with
+  repetitions.
+  """
+  queries = []
+  with open(path, 'r', encoding='utf-8') as f:
+    for line in f:
+      line = line.rstrip('\n')
+      count = 1
+      m = re_count.match(line)
+      if m:
+        count, line = int(m.group(1)), m.group(2)
+      query = strip_special_chars(line)
+      if query:
+        queries.extend([query] * count)
+  return queries
+
+
+def cache_stats(metrics, collections):
+  """
+  Return dict with the sum of the queryResultCache lookups and hits of all
+  cores of `collections` from the `metrics` response of Solr. Core names
+  contain the name of the Solr collection (e.g. gemeinden-2 for the alias
+  gemeinden).
+  """
+  names = '|'.join(re.escape(c) for c in collections)
+  core = re.compile(r'^solr\.core\.({})(-\d+)?\.'.format(names))
+  stats = {'lookups': 0, 'hits': 0}
+  for name, values in metrics.get('metrics', {}).items():
+    if not core.match(name):
+      continue
+    cache = values.get(CACHE) or {}
+    for k in stats:
+      stats[k] += cache.get('cumulative_' + k, cache.get(k, 0))
+  return stats
+
+
+def hit_ratio(before, after):
+  lookups = after['lookups'] - before['lookups']
+  hits = after['hits'] - before['hits']
+  return {
+    'lookups': lookups,
+    'hits': hits,
+    'hit_ratio': hits / lookups if lookups else 0.0,
+  }
+
+
+class Bench(object):
+  """
+  Replay `queries` for all mapping `collections` with `strategy`.
+  """
+
+  def __init__(self, solr, collections, limit=10):
+    self.solr = solr
+    self.collections = collections
+    self.limit = limit
+
+  def fetch(self, strategy, collection, params):
+    def select(start, rows):
+      self.requests += 1
+      return self.solr.query(collection.name, start=start, rows=rows, **params)
+
+    if strategy == 'fixed':
+      select(0, max(self.limit, MIN_COLLECTION_ROWS))
+    else:
+      fetch_docs(select, collection, self.limit)
+
+  def replay(self, strategy, queries):
+    """
+    Send all `queries` and return the number of Solr requests and the
+    latencies of all geocodr queries (sum of all collections).
+    """
+    self.requests = 0
+    latencies = []
+    for query in queries:
+      start = time.time()
+      for coll in self.collections:
+        if len(query) < coll.min_query_length:
+          continue
+        q = coll.query(query)
+        if not q:
+          continue
+        fl = coll.field_list if strategy == 'fixed' else search_field_list(coll)
+        self.fetch(strategy, coll, {'q': q, 'sort': coll.sort, 'fl': fl})
+      latencies.append(time.time() - start)
+    latencies.sort()
+    return self.requests, latencies
+
+
+class SolrAdmin(object):
+  def __init__(self, url):
+    self.url = url
+    self.solr = Solr(url)
+
+  def get(self, path, **params):
+    resp = self.solr._s.get(self.url + path, params=params)
+    resp.raise_for_status()
+    return resp.json()
+
+  def cache_stats(self, collections):
+    return cache_stats(self.get('/admin/metrics', group='core', prefix=CACHE), collections)
+
+  def reload(self, collection):
+    self.get('/admin/collections', action='RELOAD', name=collection)
+
+
+def run(admin, collections, queries, strategies=STRATEGIES, limit=10, reload=True):
+  names = sorted(set(c.name for c in collections))
+  bench = Bench(admin.solr, collections, limit=limit)
+  results = []
+  for strategy in strategies:
+    if reload:
+      for name in names:
+        admin.reload(name)
+    before = admin.cache_stats(names)
+    start = time.time()
+    requests, latencies = bench.replay(strategy, queries)
+    result = {
+      'strategy': strategy,
+      'queries': len(queries),
+      'solr_requests': requests,
+      'duration': time.time() - start,
+      'p50': percentile(latencies, 50) * 1000 if latencies else 0.0,
+      'p95': percentile(latencies, 95) * 1000 if latencies else 0.0,
+    }
+    result.update(hit_ratio(before, admin.cache_stats(names)))
+    results.append(result)
+  return results
+
+
+def format_results(results):
+  lines = ['{:<10} {:>8} {:>8} {:>8} {:>8} {:>7} {:>8} {:>8}'.format(
+    'strategy', 'queries', 'solr', 'lookups', 'hits', 'ratio', 'p50 ms', 'p95 ms')]
+  for r in results:
+    lines.append('{:<10} {:>8} {:>8} {:>8} {:>8} {:>6.1f}% {:>8.1f} {:>8.1f}'.format(
+      r['strategy'], r['queries'], r['solr_requests'], r['lookups'], r['hits'],
+      r['hit_ratio'] * 100, r['p50'], r['p95']))
+  return '\n'.join(lines)
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  logging.getLogger('urllib3').setLevel(logging.WARN)
+
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--url", default="http://localhost:8983/solr")
+  parser.add_argument("--mapping", default=MAPPING,
+                      help='geocodr mapping to build Solr queries (default: %(default)s)')
+  parser.add_argument("--collection", action='append',
+                      help='name of a collection in the mapping (default: all)')
+  parser.add_argument("--strategy", action='append', choices=STRATEGIES,
+                      help='row strategy (default: all)')
+  parser.add_argument("--limit", type=int, default=10,
+                      help='limit of each geocodr query (default: %(default)s)')
+  parser.add_argument("--no-reload", action='store_true',
+                      help='do not reload the collections before each strategy')
+  parser.add_argument("--json", action='store_true', help='print results as JSON')
+  parser.add_argument("queries", help='log file with one query per line')
+  args = parser.parse_args()
+
+  mapping = mapping_collections(args.mapping)
+  names = args.collection or sorted(mapping)
+  collections = []
+  for name in names:
+    if name not in mapping:
+      parser.error('unknown collection {}'.format(name))
+    collections.extend(mapping[name])
+
+  results = run(
+    SolrAdmin(args.url),
+    collections,
+    read_log(args.queries),
+    strategies=args.strategy or STRATEGIES,
+    limit=args.limit,
+    reload=not args.no_reload,
+  )
+  if args.json:
+    json.dump(results, sys.stdout, indent=2)
+    print()
+  else:
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+  main()
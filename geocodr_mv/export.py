@@ -0,0 +1,425 @@
+"""
+The export module exports the PostgreSQL tables for all collections as CSV
+files for the import with geocodr-post.
+
+The SELECT statement for each collection is stored in scripts/sql/<collection>.sql.
+`${DBSCHEMA}` is replaced with the --schema option. With --precompute-4326,
+the geometry is also exported in EPSG:4326, together with its centroid and
+bbox (see PRECOMPUTE_4326), for out_epsg=4326 requests. With --geometry-lod,
+simplified variants of the geometry are exported for requests with the
+simplify parameter (see GEOMETRY_LOD). All collections are
+exported concurrently by separate psql processes. Files are written to a
+temporary file first and renamed after a successful export, so that a failed
+export never replaces the CSV of the previous run.
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from string import Template
+
+
+log = logging.getLogger('geocodr_mv.export')
+
+SQL_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'scripts', 'sql'))
+
+# These collections need the most time (large tables with ST_Buffer(ST_Simplify(...))).
+# They are started first to keep the total duration short.
+SLOW_COLLECTIONS = (
+  'flurstueckseigentuemer',
+  'flurstuecke',
+  'flurstuecke_hro',
+  'adressen',
+)
+
+# These collections are only exported if requested explicitly (see
+# UNIFIED_ADDRESSES in conf/geocodr_mapping.py).
+OPTIONAL_COLLECTIONS = (
+  'adressen_alle',
+  'adressen_alle_hro',
+)
+
+CHUNK_SIZE = 1024 * 1024
+
+# Adds the geometry, centroid and bbox in EPSG:4326 to the SELECT statement
+# of a collection (geometrie is the WKT in EPSG:25833). The centroid is
+# calculated from the reprojected geometry, as geocodr does for
+# shape=centroid.
+PRECOMPUTE_4326 = """SELECT q.*,
+  ST_AsText(g.geometrie) AS geometrie_4326,
+  ST_AsText(ST_Centroid(g.geometrie)) AS geometrie_4326_punkt,
+  ST_AsText(ST_Envelope(g.geometrie)) AS geometrie_4326_bbox
+FROM (
+{}
+) q
+CROSS JOIN LATERAL (
+  SELECT ST_Transform(ST_GeomFromText(q.geometrie, 25833), 4326) AS geometrie
+) g"""
+
+# Tolerances (in meters) of the simplified geometries (geometrie_lod_<tolerance>)
+# in addition to the simplification of each SELECT statement.
+GEOMETRY_LOD_TOLERANCES = (5, 25)
+
+# Adds the simplified geometries for all GEOMETRY_LOD_TOLERANCES to the
+# SELECT statement of a collection.
+GEOMETRY_LOD = """SELECT q.*,
+{columns}
+FROM (
+{query}
+) q
+CROSS JOIN LATERAL (
+  SELECT ST_GeomFromText(q.geometrie, 25833) AS geometrie
+) g"""
+
+
+def geometry_lod_query(query, tolerances=GEOMETRY_LOD_TOLERANCES):
+  columns = ',\n'.join(
+    '  ST_AsText(ST_SimplifyPreserveTopology(g.geometrie, {0})) AS geometrie_lod_{0}'.format(t)
+    for t in tolerances)
+  return GEOMETRY_LOD.format(columns=columns, query=query)
+
+
+class ExportError(Exception):
+  pass
+
+
+def available_collections(sql_dir=SQL_DIR):
+  """
+  Return names of all collections with an SQL file in `sql_dir`, except for
+  optional collections. Slow collections are returned first.
+  """
+  names = sorted(f[:-len('.sql')] for f in os.listdir(sql_dir)
+                 if f.endswith('.sql') and f[:-len('.sql')] not in OPTIONAL_COLLECTIONS)
+  slow = [n for n in SLOW_COLLECTIONS if n in names]
+  return slow + [n for n in names if n not in slow]
+
+
+def load_query(collection, schema='public', sql_dir=SQL_DIR, precompute_4326=False,
+               geometry_lod=False):
+  """
+  Return the SELECT statement for `collection` with the DBSCHEMA placeholder
+  replaced. Adds the precomputed EPSG:4326 geometries if `precompute_4326`
+  is set and the simplified geometries if `geometry_lod` is set.
+  """
+  with open(os.path.join(sql_dir, collection + '.sql'), 'r') as f:
+    sql = f.read()
+  query = Template(sql).substitute(DBSCHEMA=schema).strip().rstrip(';')
+  if precompute_4326:
+    query = PRECOMPUTE_4326.format(query)
+  if geometry_lod:
+    query = geometry_lod_query(query)
+  return query
+
+
+def source_tables(collection, sql_dir=SQL_DIR):
+  """
+  Return the names of all `${DBSCHEMA}.<table>` tables used in the SELECT
+  statement of `collection`.
+  """
+  with open(os.path.join(sql_dir, collection + '.sql'), 'r') as f:
+    sql = f.read()
+  return sorted(set(re.findall(r'\$\{DBSCHEMA\}\.(\w+)', sql)))
+
+
+def quote_literal(value):
+  return "'" + value.replace("'", "''") + "'"
+
+
+def psql_rows(query, psql='psql'):
+  """
+  Run `query` with psql and return the output rows.
+  """
+  try:
+    out = subprocess.check_output(
+      [psql, '--no-psqlrc', '--quiet', '--no-align', '--tuples-only',
+       '-v', 'ON_ERROR_STOP=1', '-c', query],
+      stderr=subprocess.PIPE,
+    )
+  except subprocess.CalledProcessError as ex:
+    raise ExportError('psql failed with exit code {}: {}'.format(
+      ex.returncode, ex.stderr.decode('utf-8', 'replace').strip()))
+  return out.decode('utf-8').split()
+
+
+def change_marker(tables, schema='public', psql='psql'):
+  """
+  Return a marker that changes with each insert, update, delete or truncate
+  in one of the `tables`. The marker is built from the statistics of
+  PostgreSQL and the file node of each table (TRUNCATE does not change the
+  statistics, but assigns a new file node) and does not require a table
+  scan. Returns None if statistics are not available for all tables (e.g.
+  for views).
+  Statistics are updated after the end of each transaction, changes from
+  running transactions are only reflected in the next marker.
+  """
+  if not tables:
+    return None
+  query = (
+    "SELECT s.relname || ':' || s.relid || ':' || c.relfilenode || ':' || s.n_tup_ins"
+    " || ':' || s.n_tup_upd || ':' || s.n_tup_del FROM pg_stat_all_tables s"
+    " JOIN pg_class c ON c.oid = s.relid"
+    " WHERE s.schemaname = {} AND s.relname IN ({}) ORDER BY s.relname"
+  ).format(quote_literal(schema), ', '.join(quote_literal(t) for t in tables))
+  rows = psql_rows(query, psql=psql)
+  if len(rows) != len(tables):
+    return None
+  return ','.join(rows)
+
+
+def table_size(tables, schema='public', psql='psql'):
+  """
+  Return the estimated number of rows and bytes of the largest of the
+  `tables` as a dict. The estimate is taken from the planner statistics
+  (pg_class.reltuples) and the table size (without indexes), no table scan
+  is required. Returns None if no statistics are available.
+  """
+  if not tables:
+    return None
+  query = (
+    "SELECT c.reltuples::bigint || ':' || pg_table_size(c.oid) FROM pg_class c"
+    " JOIN pg_namespace n ON n.oid = c.relnamespace"
+    " WHERE n.nspname = {} AND c.relname IN ({}) AND c.reltuples >= 0"
+  ).format(quote_literal(schema), ', '.join(quote_literal(t) for t in tables))
+  sizes = [tuple(int(v) for v in row.split(':')) for row in psql_rows(query, psql=psql)]
+  if not sizes:
+    return None
+  return {'rows': max(r for r, _ in sizes), 'bytes': max(b for _, b in sizes)}
+
+
+def copy_statement(query):
+  return 'COPY ({}\n) TO STDOUT WITH CSV HEADER;'.format(query)
+
+
+def csv_records(stream):
+  """
+  Split the CSV `stream` (bytes) into records. A record can span multiple lines
+  if a quoted field contains a newline: a record is only complete if it
+  contains an even number of quote characters (quotes in quoted fields are
+  doubled).
+  Returns an iterator of complete records (bytes, including the newline).
+  """
+  pending = []
+  quotes = 0
+  for line in stream:
+    quotes += line.count(b'"')
+    if quotes % 2:
+      pending.append(line)
+      continue
+    if pending:
+      pending.append(line)
+      line = b''.join(pending)
+      pending = []
+    quotes = 0
+    yield line
+  if pending:
+    raise ExportError('incomplete CSV record at end of export')
+
+
+class PSQLCopy(object):
+  """
+  PSQLCopy runs COPY for `query` with psql and provides the CSV output as
+  a stream of records. Connection parameters are taken from the PG*
+  environment variables, as with psql.
+  """
+
+  def __init__(self, query, psql='psql'):
+    self.query = query
+    self.psql = psql
+    self.proc = None
+
+  def __enter__(self):
+    # errors are written to a file, a second pipe could block psql
+    self.stderr = tempfile.TemporaryFile()
+    self.proc = subprocess.Popen(
+      [self.psql, '--no-psqlrc', '--quiet', '-v', 'ON_ERROR_STOP=1',
+       '-c', copy_statement(self.query)],
+      stdout=subprocess.PIPE,
+      stderr=self.stderr,
+      bufsize=CHUNK_SIZE,
+    )
+    return self
+
+  def records(self):
+    return csv_records(self.proc.stdout)
+
+  def __exit__(self, exc_type, exc, tb):
+    if exc_type is not None:
+      self.proc.kill()
+    self.proc.stdout.close()
+    rc = self.proc.wait()
+    self.stderr.seek(0)
+    stderr = self.stderr.read()
+    self.stderr.close()
+    if exc_type is None and rc != 0:
+      raise ExportError('psql failed with exit code {}: {}'.format(
+        rc, stderr.decode('utf-8', 'replace').strip()))
+
+
+def output_path(outdir, collection, compress=True):
+  return os.path.join(outdir, collection + ('.csv.gz' if compress else '.csv'))
+
+
+class AtomicFile(object):
+  """
+  Write to a temporary file in the target directory and rename it to `path`
+  only if the block finished without an exception.
+  """
+
+  def __init__(self, path, compress=False, compresslevel=6):
+    self.path = path
+    self.compress = compress
+    self.compresslevel = compresslevel
+
+  def __enter__(self):
+    dirname, basename = os.path.split(self.path)
+    fd, self.tmp_path = tempfile.mkstemp(prefix='.' + basename + '.', suffix='.tmp', dir=dirname)
+    self.raw = os.fdopen(fd, 'wb')
+    if self.compress:
+      self.f = gzip.GzipFile(filename='', mode='wb', fileobj=self.raw,
+                             compresslevel=self.compresslevel, mtime=0)
+    else:
+      self.f = self.raw
+    return self.f
+
+  def __exit__(self, exc_type, exc, tb):
+    try:
+      if self.compress:
+        self.f.close()
+      self.raw.flush()
+      os.fsync(self.raw.fileno())
+    finally:
+      self.raw.close()
+    if exc_type is not None:
+      os.unlink(self.tmp_path)
+      return
+    os.chmod(self.tmp_path, 0o644)
+    os.replace(self.tmp_path, self.path)
+
+
+def export_collection(collection, outdir, schema='public', compress=True, psql='psql',
+                      sql_dir=SQL_DIR, precompute_4326=False, geometry_lod=False):
+  """
+  Export `collection` as CSV into `outdir`. Returns a dict with the number of
+  rows, the file size and the duration.
+  """
+  start = time.time()
+  query = load_query(collection, schema=schema, sql_dir=sql_dir,
+                     precompute_4326=precompute_4326, geometry_lod=geometry_lod)
+  path = output_path(outdir, collection, compress=compress)
+
+  rows = -1  # do not count the header
+  with AtomicFile(path, compress=compress) as f:
+    with PSQLCopy(query, psql=psql) as copy:
+      for record in copy.records():
+        f.write(record)
+        rows += 1
+
+  result = {
+    'collection': collection,
+    'path': path,
+    'rows': max(rows, 0),
+    'bytes': os.path.getsize(path),
+    'duration': time.time() - start,
+  }
+  log.info('exported %s: %d rows, %.1f MB in %.1fs', collection, result['rows'],
+           result['bytes'] / 1e6, result['duration'])
+  return result
+
+
+def export_all(collections, outdir, workers=4, **kw):
+  """
+  Export all `collections` with up to `workers` concurrent psql processes.
+  Returns a list with a result dict for each collection. Failed exports
+  contain an 'error' instead of the row count.
+  """
+  def run(collection):
+    try:
+      return export_collection(collection, outdir, **kw)
+    except Exception as ex:
+      log.error('export of %s failed: %s', collection, ex)
+      return {'collection': collection, 'error': str(ex)}
+
+  with ThreadPoolExecutor(max_workers=workers) as e:
+    return list(e.map(run, collections))
+
+
+def format_results(results, duration):
+  lines = ['{:<24} {:>10} {:>10} {:>9}'.format('collection', 'rows', 'MB', 'seconds')]
+  for r in results:
+    if 'error' in r:
+      lines.append('{:<24} {:>10}'.format(r['collection'], 'FAILED'))
+    else:
+      lines.append('{:<24} {:>10} {:>10.1f} {:>9.1f}'.format(
+        r['collection'], r['rows'], r['bytes'] / 1e6, r['duration']))
+  lines.append('total: {:.1f}s'.format(duration))
+  return '\n'.join(lines)
+
+
+def main():
+  logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+  )
+
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--outdir", default=os.environ.get('CSV_OUTDIR', '/tmp/geocodr-csv'),
+                      help='output directory (default: $CSV_OUTDIR or %(default)s)')
+  parser.add_argument("--schema", default=os.environ.get('DBSCHEMA', 'public'),
+                      help='database schema (default: $DBSCHEMA or %(default)s)')
+  parser.add_argument("--workers", type=int, default=4,
+                      help='number of concurrent exports (default: %(default)s)')
+  parser.add_argument("--no-compress", action='store_true',
+                      help='write plain .csv files instead of .csv.gz')
+  parser.add_argument("--sql-dir", default=SQL_DIR,
+                      help='directory with <collection>.sql files')
+  parser.add_argument("--psql", default='psql', help='psql executable')
+  parser.add_argument("--precompute-4326", action='store_true',
+                      help='add the geometry, centroid and bbox in EPSG:4326')
+  parser.add_argument("--geometry-lod", action='store_true',
+                      help='add simplified geometries (tolerances: {})'.format(
+                        ', '.join(str(t) for t in GEOMETRY_LOD_TOLERANCES)))
+  parser.add_argument("--report", help='write JSON report with rows and durations to this file')
+  parser.add_argument('collections', metavar='COLLECTION', nargs='*',
+                      help='collections to export (default: all)')
+
+  args = parser.parse_args()
+
+  collections = args.collections or available_collections(args.sql_dir)
+  if not os.path.isdir(args.outdir):
+    os.makedirs(args.outdir)
+
+  start = time.time()
+  results = export_all(
+    collections,
+    args.outdir,
+    workers=args.workers,
+    schema=args.schema,
+    compress=not args.no_compress,
+    psql=args.psql,
+    sql_dir=args.sql_dir,
+    precompute_4326=args.precompute_4326,
+    geometry_lod=args.geometry_lod,
+  )
+  duration = time.time() - start
+  print(format_results(results, duration))
+
+  if args.report:
+    with open(args.report, 'w') as f:
+      json.dump({'duration': duration, 'collections': results}, f, indent=2)
+
+  if any('error' in r for r in results):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,348 @@
+"""
+The fakesolr module provides a minimal Solr replacement for load tests and local
+development. It answers /select requests for every collection with synthetic
+documents that contain all properties used by conf/geocodr_mapping.py.
+The real-time get handler (/get) returns the documents of the `ids` of the
+collection.
+The Schema API returns the schemas of the solr directory and the aliases of
+the Collections API (LISTALIASES) are set with `aliases`.
+"""
+
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+import xml.etree.ElementTree as ET
+
+from urllib.parse import parse_qs
+
+
+# (gemeinde_name, gemeindeteil_name, strasse_name, postleitzahl, gemarkung_name,
+#  gemarkung_schluessel, x, y) in EPSG:25833
+PLACES = [
+  ('Rostock, Hanse- und Universitätsstadt', 'Lichtenhagen', 'Stettiner Str.', '18109',
+   'Lütten Klein', '132221', 307678, 6004531),
+  ('Neubukow, Stadt', 'Buschmühlen', 'Grüner Weg', '18233',
+   'Neubukow', '132050', 282414, 5993115),
+  ('Bartenshagen-Parkentin', 'Parkentin', 'Wiesengrund', '18209',
+   'Parkentin', '132090', 302544, 5998865),
+  ('Kröpelin, Stadt', 'Schmadebeck', 'Am Sportplatz', '18236',
+   'Schmadebeck', '132130', 289973, 5996076),
+  ('Torgelow, Stadt', 'Torgelow', 'Kopernikusstr.', '17358',
+   'Torgelow', '131610', 434533, 5942812),
+  ('Schwerin, Landeshauptstadt', 'Altstadt', 'Puschkinstr.', '19055',
+   'Schwerin', '130430', 262966, 5948220),
+  ('Greifswald, Universitäts- und Hansestadt', 'Innenstadt', 'Lange Str.', '17489',
+   'Greifswald', '130920', 394056, 5995305),
+  ('Stralsund, Hansestadt', 'Altstadt', 'Ossenreyerstr.', '18439',
+   'Stralsund', '131820', 375740, 6019696),
+]
+
+# half size of the polygon geometries for each collection in meter
+POLYGON_SIZE = {
+  'gemeinden': 4000,
+  'gemeindeteile': 1500,
+  'gemeindeteile_hro': 1500,
+  'gemarkungen': 2500,
+  'gemarkungen_hro': 2500,
+  'fluren': 800,
+  'fluren_hro': 800,
+  'flurstuecke': 40,
+  'flurstuecke_hro': 40,
+  'flurstueckseigentuemer': 40,
+  'postleitzahlengebiete': 3000,
+}
+
+LINE_COLLECTIONS = ('strassen', 'strassen_hro')
+
+IDS_QUERY = '{!terms f=id}'
+
+SCHEMA_DIR = os.path.join(os.path.dirname(__file__), '..', 'solr')
+
+
+PARAM_REF = re.compile(r'\$(\w+)')
+
+
+def dereference(q, params):
+  """
+  Return `q` with all parameter references (`v=$t1`) replaced by the quoted
+  value of the parameter.
+  """
+  return PARAM_REF.sub(lambda m: "'{}'".format(params.get(m.group(1), '')), q)
+
+
+def collection_seed(collection, q):
+  return zlib.crc32('{}:{}'.format(collection, q).encode('utf-8'))
+
+
+def geometry_wkt(collection, x, y, vertices=16):
+  """
+  Return a synthetic WKT geometry for `collection` near x/y.
+  """
+  if collection in LINE_COLLECTIONS:
+    return 'LINESTRING ({} {}, {} {}, {} {})'.format(
+      x - 150, y - 20, x, y, x + 150, y + 35)
+  size = POLYGON_SIZE.get(collection)
+  if not size:
+    return 'POINT ({} {})'.format(x, y)
+
+  # approximate a circle so that geometry parsing and reprojection costs
+  # something similar to real data
+  coords = []
+  for i in range(vertices):
+    a = 2 * math.pi * i / vertices
+    coords.append('{:.3f} {:.3f}'.format(x + math.cos(a) * size, y + math.sin(a) * size))
+  coords.append(coords[0])
+  return 'POLYGON (({}))'.format(', '.join(coords))
+
+
+def make_doc(collection, n, score):
+  """
+  Return a synthetic document with all properties that are used by the
+  Collections in our mapping. `n` selects the place and the house number.
+  """
+  (gemeinde_name, gemeindeteil_name, strasse_name, postleitzahl, gemarkung_name,
+   gemarkung_schluessel, x, y) = PLACES[n % len(PLACES)]
+  hausnummer = str(n // len(PLACES) % 120 + 1)
+  flur = '%03d' % (n % 7 + 1)
+  zaehler = '%05d' % (n % 400 + 1)
+  nenner = '%04d' % (n % 3)
+  # spread documents of the same place over a few hundred meters
+  x += (n * 37) % 600 - 300
+  y += (n * 53) % 600 - 300
+
+  prop = {
+    'uuid': '{}-{:08d}'.format(collection, n),
+    'gemeinde_name': gemeinde_name,
+    'gemeinde_name_suchzusatz': None,
+    'gemeinde_ist_stadt': gemeinde_name.endswith('stadt') or ', ' in gemeinde_name,
+    'gemeinde_flaeche': 50e6 + len(gemeinde_name) * 1e6,
+    'gemeindeteil_name': gemeindeteil_name,
+    'gemeindeteil_flaeche': 5e6 + len(gemeindeteil_name) * 1e5,
+    'strasse_name': strasse_name,
+    'strasse_schluessel': '%05d' % (zlib.crc32(strasse_name.encode('utf-8')) % 100000),
+    'strasse_laenge': 300.0 + len(strasse_name) * 10,
+    'postleitzahl': postleitzahl,
+    'hausnummer': hausnummer,
+    'hausnummer_int': int(hausnummer),
+    'hausnummer_zusatz': 'a' if n % 11 == 0 else None,
+    'gemarkung_name': gemarkung_name,
+    'gemarkung_schluessel': gemarkung_schluessel,
+    'flur': flur,
+    'zaehler': zaehler,
+    'nenner': nenner,
+    'flurstuecksnummer': gemarkung_schluessel + flur + zaehler + nenner,
+    'flurstueckskennzeichen': '{}-{}-{}/{}'.format(gemarkung_schluessel, flur, zaehler, nenner),
+    'eigentuemer': 'Eigentümer {}'.format(n % 97),
+    'bezeichnung': 'Schule {}'.format(gemeindeteil_name),
+    'art': 'Grundschule',
+    'name': 'Ort {}'.format(n),
+    'category': 'poi',
+    'category_title': 'Sehenswürdigkeit',
+    'historisch_seit': None,
+    'gueltigkeit_bis': None,
+  }
+
+  doc = dict(prop)
+  doc['id'] = prop['uuid']
+  doc['score'] = score
+  doc['geometrie'] = geometry_wkt(collection, x, y)
+  doc['json'] = json.dumps(prop)
+  return doc
+
+
+def schema_json(path):
+  """
+  Return the schema file `path` in the format of the Schema API.
+  """
+  root = ET.parse(path).getroot()
+  field_types = []
+  for node in root.iter('fieldType'):
+    field_type = dict(node.attrib)
+    for analyzer in node.iter('analyzer'):
+      key = {'index': 'indexAnalyzer', 'query': 'queryAnalyzer'}.get(
+        analyzer.get('type'), 'analyzer')
+      field_type[key] = {
+        'charFilters': [dict(c.attrib) for c in analyzer.iter('charFilter')],
+        'tokenizer': dict(analyzer.find('tokenizer').attrib),
+        'filters': [dict(f.attrib) for f in analyzer.iter('filter')],
+      }
+    field_types.append(field_type)
+  return {
+    'name': root.get('name'),
+    'fieldTypes': field_types,
+    'fields': [dict(f.attrib) for f in root.iter('field')],
+    'copyFields': [dict(c.attrib) for c in root.iter('copyField')],
+  }
+
+
+def field_list(doc, fl):
+  """
+  Return `doc` with the fields of the Solr `fl` parameter (e.g.
+  `id,score,geometrie:[geo f=geometrie w=WKT]`).
+  """
+  names = [f.split(':', 1)[0].strip() for f in fl.split(',')]
+  if '*' in names:
+    return doc
+  return dict((k, v) for k, v in doc.items() if k in names)
+
+
+class FakeSolr(object):
+  """
+  WSGI application that imitates the Solr /select and /get handlers, the
+  Schema API, the health check (/admin/info/health) and LISTALIASES of the
+  Collections API (`aliases`, dict with the collection of each alias).
+
+  Results are deterministic for each collection and query. `num_found` is
+  the simulated size of each collection. `delay` (in seconds) is added to
+  each request, `collection_delays` overrides the delay for single
+  collections.
+  """
+
+  def __init__(self, num_found=5000, delay=0, collection_delays=None, jitter=0):
+    self.num_found = num_found
+    self.delay = delay
+    self.collection_delays = collection_delays or {}
+    self.jitter = jitter
+    self.aliases = {}
+    self.requests = 0
+    self._lock = threading.Lock()
+
+  def select(self, collection, params):
+    q = dereference(params.get('q', '*'), params)
+    rows = int(params.get('rows', 10))
+    start = int(params.get('start', 0))
+
+    if q.startswith(IDS_QUERY):
+      # documents by id ({!terms f=id}id1,id2,...)
+      ids = q[len(IDS_QUERY):].split(',')
+      docs = [make_doc(collection, int(i.rsplit('-', 1)[1]), 1.0) for i in ids[start:start + rows]]
+      num_found = len(ids)
+    else:
+      seed = collection_seed(collection, q)
+      # SolrCloud scores of different collections are never identical, this
+      # also avoids comparing sort tiebreakers of different collections.
+      factor = 1 + zlib.crc32(collection.encode('utf-8')) % 1000 / 1e4
+      docs = []
+      for i in range(start, min(start + rows, self.num_found)):
+        # scores decrease in steps so that tiebreakers are used as well
+        score = 10.0 * factor / (1 + (i // 3) * 0.05)
+        docs.append(make_doc(collection, seed + i, score))
+      num_found = self.num_found
+
+    if params.get('fl'):
+      docs = [field_list(doc, params['fl']) for doc in docs]
+
+    return {
+      'responseHeader': {
+        'status': 0,
+        'QTime': 0,
+        'params': params,
+      },
+      'response': {
+        'numFound': num_found,
+        'start': start,
+        'maxScore': docs[0].get('score', 0.0) if docs else 0.0,
+        'docs': docs,
+      },
+    }
+
+  def get(self, collection, params):
+    docs = []
+    for i in params.get('ids', '').split(','):
+      # only ids of make_doc for this collection
+      prefix, _, n = i.rpartition('-')
+      if prefix == collection and n.isdigit():
+        docs.append(make_doc(collection, int(n), 1.0))
+    if params.get('fl'):
+      docs = [field_list(doc, params['fl']) for doc in docs]
+    for doc in docs:
+      # no score for /get
+      doc.pop('score', None)
+    return {
+      'response': {
+        'numFound': len(docs),
+        'start': 0,
+        'docs': docs,
+      },
+    }
+
+  def wait(self, collection):
+    delay = self.collection_delays.get(collection, self.delay)
+    if self.jitter:
+      delay += random.expovariate(1.0 / self.jitter)
+    if delay:
+      time.sleep(delay)
+
+  def __call__(self, environ, start_response):
+    with self._lock:
+      self.requests += 1
+
+    path = environ.get('PATH_INFO', '').strip('/')
+    params = dict((k, v[-1]) for k, v in parse_qs(environ.get('QUERY_STRING', '')).items())
+    if path == 'admin/info/health':
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return [json.dumps({'status': 'OK'}).encode('utf-8')]
+    if path == 'admin/collections' and params.get('action') == 'LISTALIASES':
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return [json.dumps({'aliases': dict(self.aliases)}).encode('utf-8')]
+
+    parts = path.split('/')
+    schema_path = os.path.join(SCHEMA_DIR, '{}-schema.xml'.format(parts[0]))
+    if len(parts) == 2 and parts[1] == 'schema' and os.path.exists(schema_path):
+      start_response('200 OK', [('Content-Type', 'application/json')])
+      return [json.dumps({'schema': schema_json(schema_path)}).encode('utf-8')]
+    if len(parts) != 2 or parts[1] not in ('select', 'get'):
+      start_response('404 Not Found', [('Content-Type', 'application/json')])
+      return [json.dumps({'error': {'msg': 'unknown handler', 'code': 404}}).encode('utf-8')]
+
+    collection = parts[0]
+    self.wait(collection)
+    if parts[1] == 'get':
+      doc = self.get(collection, params)
+    else:
+      doc = self.select(collection, params)
+    body = json.dumps(doc).encode('utf-8')
+    start_response('200 OK', [
+      ('Content-Type', 'application/json; charset=utf-8'),
+      ('Content-Length', str(len(body))),
+    ])
+    return [body]
+
+
+class BackgroundServer(object):
+  """
+  Serve a WSGI application with waitress in a background thread.
+  Uses a random free port if `port` is 0.
+  """
+
+  def __init__(self, app, host='127.0.0.1', port=0, threads=8):
+    from waitress.server import create_server
+    self.server = create_server(app, host=host, port=port, threads=threads)
+    self.host = host
+    self.port = self.server.effective_port
+    self.thread = threading.Thread(target=self.server.run)
+    self.thread.daemon = True
+
+  @property
+  def url(self):
+    return 'http://{}:{}'.format(self.host, self.port)
+
+  def start(self):
+    self.thread.start()
+    return self
+
+  def stop(self):
+    def close():
+      # called in the server thread, the loop ends as soon as the map is empty
+      for channel in list(self.server._map.values()):
+        if channel is not self.server.trigger:
+          channel.close()
+
+    self.server.trigger.pull_trigger(close)
+    self.thread.join(5)
+    self.server.task_dispatcher.shutdown()
@@ -0,0 +1,434 @@
+"""
+The fallback module provides a local search index for geocodr_mv.api that
+answers queries while Solr is unavailable (degraded mode), e.g. during a
+rolling upgrade of SolrCloud or ZooKeeper.
+
+The index is a SQLite database with an FTS5 table for the text search and an
+R-tree for the bboxes of the geometries. It is built from the CSV exports of
+geocodr-pg2csv.sh (`python -m geocodr_mv.fallback --csv-dir /tmp/geocodr-csv
+--output fallback.sqlite`) for the collections in FALLBACK_COLLECTIONS. The
+documents keep all columns of the export (with the types of the Solr schema,
+see FIELD_TYPES), so that the collections of the mapping build the same
+features as from Solr documents.
+
+FallbackIndex.query has the arguments and results of geocodr.solr.Solr.query
+for the queries of geocodr_mv.api, but interprets `q` as plain text: all
+terms have to match (as prefix) in the SEARCH_COLUMNS of a document and the
+documents are ranked by BM25. The ranking is only approximate, the boosts
+and n-gram fields of the mapping are not used. Spatial filters (`geofilt`
+and bbox ranges) and the exclusion of historic records are supported.
+
+SolrHealth checks the health endpoint of Solr (which fails if Solr lost its
+ZooKeeper connection) in a background thread. geocodr_mv.api switches to the
+fallback index while the check fails and marks the responses with
+`degraded: true`.
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import shapely.geometry
+import shapely.wkt
+
+from geocodr_mv.export import output_path
+
+
+log = logging.getLogger('geocodr_mv.fallback')
+
+FALLBACK_COLLECTIONS = ('adressen', 'gemeinden', 'postleitzahlengebiete')
+
+# columns of each collection that are searched
+SEARCH_COLUMNS = {
+  'adressen': ('strasse_name', 'hausnummer', 'postleitzahl', 'gemeindeteil_name',
+               'gemeinde_name'),
+  'gemeinden': ('gemeinde_name',),
+  'postleitzahlengebiete': ('postleitzahl',),
+}
+
+
+def parse_pg_bool(value):
+  return value == 't'
+
+
+# types of the Solr schema for the CSV columns, all other columns are strings
+FIELD_TYPES = {
+  'gemeinde_ist_stadt': parse_pg_bool,
+  'historisch': parse_pg_bool,
+  'gemeinde_flaeche': float,
+  'gemeindeteil_flaeche': float,
+  'strasse_laenge': float,
+  'hausnummer_int': int,
+}
+
+GEOMETRY_COLUMN = 'geometrie'
+IDS_QUERY = '{!terms f=id}'
+
+# seconds between checks for a replaced index file
+CHECK_INTERVAL = 10
+# seconds between health checks of Solr
+HEALTH_INTERVAL = 2
+HEALTH_TIMEOUT = 2
+
+SCHEMA = """
+CREATE TABLE docs (
+  rowid INTEGER PRIMARY KEY,
+  collection TEXT NOT NULL,
+  id TEXT NOT NULL,
+  doc TEXT NOT NULL
+);
+CREATE UNIQUE INDEX docs_id ON docs (collection, id);
+CREATE VIRTUAL TABLE search USING fts5(
+  text, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3'
+);
+CREATE VIRTUAL TABLE bounds USING rtree(rowid, minx, maxx, miny, maxy);
+"""
+
+re_terms = re.compile(r'\w+')
+re_range_fq = re.compile(r'^\s*(\w+):\["(\S+) (\S+)" TO "(\S+) (\S+)"\]\s*$')
+re_geofilt_fq = re.compile(r'^\s*\{!geofilt sfield=(\w+)\}\s*$')
+re_exclude_fq = re.compile(r'^\s*-(\w+):true\s*$')
+
+
+def csv_path(csv_dir, collection):
+  """
+  Return the path of the export of `collection` in `csv_dir`
+  (<collection>.csv.gz or <collection>.csv).
+  """
+  path = output_path(csv_dir, collection, compress=True)
+  if not os.path.exists(path):
+    path = output_path(csv_dir, collection, compress=False)
+  return path
+
+
+def read_docs(path):
+  """
+  Return an iterator of the documents of the CSV export `path`. Empty
+  values are left out (as in Solr).
+  """
+  csv.field_size_limit(sys.maxsize)
+  opener = gzip.open if path.endswith('.gz') else open
+  with opener(path, 'rt', encoding='utf-8', newline='') as f:
+    for row in csv.DictReader(f):
+      doc = {}
+      for name, value in row.items():
+        if value == '':
+          continue
+        doc[name] = FIELD_TYPES[name](value) if name in FIELD_TYPES else value
+      yield doc
+
+
+def search_text(collection, doc):
+  return ' '.join(str(doc[c]) for c in SEARCH_COLUMNS[collection] if c in doc)
+
+
+def build_index(csv_dir, path, collections=FALLBACK_COLLECTIONS):
+  """
+  Build the fallback index `path` from the CSV exports in `csv_dir`. The
+  file is replaced after a successful build. Returns a dict with the number
+  of documents of each collection.
+  """
+  dirname = os.path.dirname(os.path.abspath(path))
+  fd, tmp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp',
+                                  dir=dirname)
+  os.close(fd)
+  counts = {}
+  try:
+    conn = sqlite3.connect(tmp_path)
+    try:
+      conn.executescript(SCHEMA)
+      for collection in collections:
+        if collection not in SEARCH_COLUMNS:
+          raise ValueError('no SEARCH_COLUMNS for collection {}'.format(collection))
+        counts[collection] = add_collection(conn, collection, csv_path(csv_dir, collection))
+      conn.execute("INSERT INTO search(search) VALUES ('optimize')")
+      conn.commit()
+    finally:
+      conn.close()
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+  except BaseException:
+    os.unlink(tmp_path)
+    raise
+  return counts
+
+
+def add_collection(conn, collection, path):
+  count = 0
+  for doc in read_docs(path):
+    cur = conn.execute('INSERT INTO docs (collection, id, doc) VALUES (?, ?, ?)',
+                       (collection, doc['id'], json.dumps(doc)))
+    rowid = cur.lastrowid
+    conn.execute('INSERT INTO search (rowid, text) VALUES (?, ?)',
+                 (rowid, search_text(collection, doc)))
+    if doc.get(GEOMETRY_COLUMN):
+      minx, miny, maxx, maxy = shapely.wkt.loads(doc[GEOMETRY_COLUMN]).bounds
+      conn.execute('INSERT INTO bounds VALUES (?, ?, ?, ?, ?)',
+                   (rowid, minx, maxx, miny, maxy))
+    count += 1
+  log.info('added %d documents of %s', count, collection)
+  return count
+
+
+def match_expression(q):
+  """
+  Return the FTS5 query for the plain text `q` (all terms as prefix) or
+  None for `*` and queries without terms.
+  """
+  terms = re_terms.findall(q.lower())
+  if not terms:
+    return None
+  return ' AND '.join('"{}"*'.format(t) for t in terms)
+
+
+class SpatialFilter(object):
+  """
+  Filter of the `fq` parameters of geocodr_mv.api. `bbox` is used for the
+  R-tree, `match(doc)` checks the exact filters.
+  """
+
+  def __init__(self, fq, pt=None, d=None):
+    self.bbox = None
+    self.checks = []
+    if isinstance(fq, str):
+      fq = [fq]
+    for f in fq or []:
+      m = re_geofilt_fq.match(f)
+      if m:
+        y, x = (float(v) for v in pt.split(','))
+        d = float(d)
+        self.add_bbox((x - d, y - d, x + d, y + d))
+        point = shapely.geometry.Point(x, y)
+        self.checks.append(lambda doc, field=m.group(1), point=point, d=d: (
+          field in doc and shapely.wkt.loads(doc[field]).distance(point) <= d))
+        continue
+      m = re_range_fq.match(f)
+      if m:
+        bbox = tuple(float(v) for v in m.groups()[1:])
+        self.add_bbox(bbox)
+        box = shapely.geometry.box(*bbox)
+        self.checks.append(lambda doc, field=m.group(1), box=box: (
+          field in doc and shapely.wkt.loads(doc[field]).intersects(box)))
+        continue
+      m = re_exclude_fq.match(f)
+      if m:
+        self.checks.append(lambda doc, field=m.group(1): doc.get(field) is not True)
+        continue
+      raise ValueError('unsupported filter query for the fallback index: {}'.format(f))
+
+  def add_bbox(self, bbox):
+    if self.bbox:
+      bbox = (max(self.bbox[0], bbox[0]), max(self.bbox[1], bbox[1]),
+              min(self.bbox[2], bbox[2]), min(self.bbox[3], bbox[3]))
+    self.bbox = bbox
+
+  def match(self, doc):
+    return all(check(doc) for check in self.checks)
+
+
+def field_list(doc, score, fl):
+  """
+  Return `doc` with the fields of the Solr `fl` parameter.
+  """
+  names = set(f.split(':', 1)[0].strip() for f in (fl or '*').split(','))
+  if '*' in names:
+    result = dict(doc)
+  else:
+    result = dict((k, v) for k, v in doc.items() if k in names)
+  if 'score' in names:
+    result['score'] = score
+  return result
+
+
+class FallbackIndex(object):
+  """
+  Read-only fallback index of `path`. Each thread uses its own connection.
+  Connections are reopened if the file was replaced (checked every
+  `check_interval` seconds).
+  """
+
+  def __init__(self, path, check_interval=CHECK_INTERVAL):
+    self.path = path
+    self.check_interval = check_interval
+    self._local = threading.local()
+
+  def _stat(self):
+    try:
+      st = os.stat(self.path)
+      return (st.st_ino, st.st_mtime_ns, st.st_size)
+    except OSError:
+      return None
+
+  def connection(self):
+    local = self._local
+    now = time.time()
+    if getattr(local, 'conn', None) is not None and now - local.checked < self.check_interval:
+      return local.conn
+    stat = self._stat()
+    if getattr(local, 'conn', None) is None or stat != local.stat:
+      if getattr(local, 'conn', None) is not None:
+        local.conn.close()
+      local.conn = sqlite3.connect('file:{}?mode=ro'.format(self.path), uri=True)
+      local.stat = stat
+      local.collections = set(
+        r[0] for r in local.conn.execute('SELECT DISTINCT collection FROM docs'))
+    local.checked = now
+    return local.conn
+
+  def has_collection(self, collection):
+    """
+    Check whether the index contains `collection`.
+    """
+    self.connection()
+    return collection in self._local.collections
+
+  def query(self, collection, q, user_auth=None, start=0, rows=10, fl=None, fq=None,
+            pt=None, d=None, **kw):
+    """
+    Query `collection` with the plain text `q` (see module documentation).
+    Returns a Solr response.
+    """
+    conn = self.connection()
+    start, rows = int(start), int(rows)
+    if q.startswith(IDS_QUERY):
+      docs, num_found = self.get_ids(conn, collection, q[len(IDS_QUERY):].split(','))
+      docs = docs[start:start + rows]
+    else:
+      docs, num_found = self.search(conn, collection, q, SpatialFilter(fq, pt, d), start, rows)
+    return {
+      'responseHeader': {'status': 0, 'QTime': 0},
+      'response': {
+        'numFound': num_found,
+        'start': start,
+        'docs': [field_list(doc, score, fl) for doc, score in docs],
+      },
+    }
+
+  def get_ids(self, conn, collection, ids):
+    found = {}
+    for i in range(0, len(ids), 500):
+      chunk = ids[i:i + 500]
+      for id, doc in conn.execute(
+          'SELECT id, doc FROM docs WHERE collection = ? AND id IN ({})'.format(
+            ','.join('?' * len(chunk))), [collection] + chunk):
+        found[id] = json.loads(doc)
+    docs = [(found[id], 1.0) for id in ids if id in found]
+    return docs, len(docs)
+
+  def search(self, conn, collection, q, spatial_filter, start, rows):
+    match = match_expression(q)
+    if match:
+      sql = ('SELECT d.doc, -bm25(search) FROM search JOIN docs d ON d.rowid = search.rowid '
+             'WHERE search MATCH ? AND d.collection = ?')
+      args = [match, collection]
+      order = ' ORDER BY bm25(search), d.rowid'
+    else:
+      sql = 'SELECT d.doc, 1.0 FROM docs d WHERE d.collection = ?'
+      args = [collection]
+      order = ' ORDER BY d.rowid'
+    if spatial_filter.bbox:
+      minx, miny, maxx, maxy = spatial_filter.bbox
+      sql += (' AND d.rowid IN (SELECT rowid FROM bounds '
+              'WHERE minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?)')
+      args += [maxx, minx, maxy, miny]
+
+    if not spatial_filter.checks:
+      num_found = conn.execute('SELECT count(*) FROM ({})'.format(sql), args).fetchone()[0]
+      cur = conn.execute(sql + order + ' LIMIT ? OFFSET ?', args + [rows, start])
+      return [(json.loads(doc), score) for doc, score in cur], num_found
+
+    docs = []
+    for doc, score in conn.execute(sql + order, args):
+      doc = json.loads(doc)
+      if spatial_filter.match(doc):
+        docs.append((doc, score))
+    return docs[start:start + rows], len(docs)
+
+
+class SolrHealth(object):
+  """
+  Health of the Solr server `url`, checked every `interval` seconds in a
+  background thread. The thread is started by the first call of `healthy`
+  in each process (after the fork of geocodr_mv.prefork).
+  """
+
+  def __init__(self, url, interval=HEALTH_INTERVAL, timeout=HEALTH_TIMEOUT):
+    self.url = url.rstrip('/') + '/admin/info/health'
+    self.interval = interval
+    self.timeout = timeout
+    self._healthy = True
+    self._pid = None
+    self._lock = threading.Lock()
+
+  def check(self):
+    """
+    Request the health endpoint of Solr and return the new state.
+    """
+    try:
+      resp = requests.get(self.url, timeout=self.timeout)
+      # Solr answers, but requires authentication
+      healthy = resp.ok or resp.status_code == 401
+    except requests.RequestException:
+      healthy = False
+    if healthy != self._healthy:
+      if healthy:
+        log.warning('Solr is available again, leaving degraded mode')
+      else:
+        log.warning('Solr health check failed, switching to the fallback index')
+    self._healthy = healthy
+    return healthy
+
+  def report_failure(self):
+    """
+    Mark Solr as unavailable until the next successful check (e.g. after a
+    connection error).
+    """
+    if self._healthy:
+      log.warning('Solr request failed, switching to the fallback index')
+    self._healthy = False
+
+  def run(self):
+    while True:
+      time.sleep(self.interval)
+      self.check()
+
+  def healthy(self):
+    if self._pid != os.getpid():
+      with self._lock:
+        if self._pid != os.getpid():
+          self.check()
+          threading.Thread(target=self.run, daemon=True).start()
+          self._pid = os.getpid()
+    return self._healthy
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+
+  parser = argparse.ArgumentParser(description='Build the fallback index from CSV exports.')
+  parser.add_argument("--csv-dir", required=True,
+                      help='directory with the <collection>.csv.gz exports')
+  parser.add_argument("--output", required=True, help='SQLite file of the fallback index')
+  parser.add_argument("collections", nargs='*', default=list(FALLBACK_COLLECTIONS),
+                      help='collections to add (default: %(default)s)')
+  args = parser.parse_args()
+
+  start = time.time()
+  counts = build_index(args.csv_dir, args.output, args.collections)
+  for collection, count in counts.items():
+    print('{:<24} {:>9}'.format(collection, count))
+  print('built {} in {:.1f}s'.format(args.output, time.time() - start))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,263 @@
+"""
+The geomstore module stores the geometries of a collection in a binary file
+outside of Solr, so that geocodr_mv.api does not need to load and parse the
+WKT geometries from Solr.
+
+geocodr_mv.reindex writes `<collection>.geom` into --geometry-dir with each
+import. The file contains an index sorted by a hash of the document id and
+the geometry of each document as WKB, together with the bbox and the point
+that is returned for shape=centroid (both in the projection of the
+collection). The file is opened with mmap (shared by all processes on a host)
+and looked up with a binary search without reading the whole file.
+
+Imports write the new file to `<collection>.geom.new` (staging_path) and
+publish it with an atomic rename only after the Solr collection is committed
+and live (publish_store), or remove it if the import failed
+(discard_store). GeometryStores reopens the file after each import.
+"""
+
+import csv
+import hashlib
+import io
+import logging
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+
+import shapely.geometry
+import shapely.wkb
+import shapely.wkt
+
+from geocodr.lib.geom import point_on_geom
+
+from geocodr_mv.export import AtomicFile, ExportError
+
+
+log = logging.getLogger('geocodr_mv.geomstore')
+
+MAGIC = b'GMVGEOM1'
+# magic, number of documents
+HEADER = struct.Struct('<8sQ')
+# key, offset, length, bbox (minx, miny, maxx, maxy), point (x, y)
+ENTRY = struct.Struct('<16sQI6d')
+KEY_SIZE = 16
+# seconds between checks for a new file of a collection
+CHECK_INTERVAL = 5
+
+
+def store_path(directory, collection):
+  return os.path.join(directory, collection + '.geom')
+
+
+def staging_path(directory, collection):
+  """
+  Return the path of a new store of `collection` until it is published.
+  """
+  return store_path(directory, collection) + '.new'
+
+
+def publish_store(directory, collection):
+  """
+  Replace the store of `collection` with the new store of staging_path.
+  """
+  os.replace(staging_path(directory, collection), store_path(directory, collection))
+
+
+def discard_store(directory, collection):
+  """
+  Remove the unpublished store of `collection`, if any.
+  """
+  try:
+    os.unlink(staging_path(directory, collection))
+  except FileNotFoundError:
+    pass
+
+
+def document_key(id):
+  return hashlib.blake2b(id.encode('utf-8'), digest_size=KEY_SIZE).digest()
+
+
+def envelope(bounds):
+  """
+  Return the envelope for `bounds` as shapely (GEOS) does: a Point for the
+  bounds of a point, otherwise a Polygon (with the same ring order).
+  """
+  minx, miny, maxx, maxy = bounds
+  if minx == maxx and miny == maxy:
+    return shapely.geometry.Point(minx, miny)
+  return shapely.geometry.Polygon([
+    (minx, miny), (maxx, miny), (maxx, maxy), (minx, maxy), (minx, miny)])
+
+
+class GeometryRecord(object):
+  """
+  Geometry of a single document. `wkb` is a memoryview into the mmap of the
+  store.
+  """
+
+  def __init__(self, wkb, bounds, point):
+    self.wkb = wkb
+    self.bounds = bounds
+    self.point_xy = point
+
+  def geometry(self):
+    return shapely.wkb.loads(bytes(self.wkb))
+
+  def point(self):
+    return shapely.geometry.Point(*self.point_xy)
+
+  def bbox(self):
+    return envelope(self.bounds)
+
+
+class GeometryWriter(object):
+  """
+  Write a new geometry store to `path`. Geometries are added as WKT with
+  `add(id, wkt)` and the file is only replaced if the block finished without
+  an exception.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.rows = 0
+
+  def __enter__(self):
+    self._entries = []
+    self._offset = 0
+    self._data = tempfile.TemporaryFile(dir=os.path.dirname(self.path) or '.')
+    return self
+
+  def add(self, id, wkt):
+    geom = shapely.wkt.loads(wkt)
+    data = geom.wkb
+    # shape=centroid as geocodr.search.Collection.to_features
+    point = point_on_geom(geom.centroid)
+    self._entries.append(ENTRY.pack(document_key(id), self._offset, len(data),
+                                    *(geom.bounds + (point.x, point.y))))
+    self._data.write(data)
+    self._offset += len(data)
+    self.rows += 1
+
+  def __exit__(self, exc_type, exc, tb):
+    try:
+      if exc_type is not None:
+        return
+      # entries start with the key
+      self._entries.sort()
+      with AtomicFile(self.path) as f:
+        f.write(HEADER.pack(MAGIC, len(self._entries)))
+        for entry in self._entries:
+          f.write(entry)
+        self._data.seek(0)
+        shutil.copyfileobj(self._data, f)
+    finally:
+      self._data.close()
+      self._entries = None
+
+
+def geometry_records(records, out, column='geometrie'):
+  """
+  Pass all CSV `records` and add the geometry of each record to `out`
+  (GeometryWriter).
+  """
+  records = iter(records)
+  header = next(records, None)
+  if header is None:
+    return
+  columns = next(csv.reader(io.StringIO(header.decode('utf-8'))))
+  try:
+    id_index, geom_index = columns.index('id'), columns.index(column)
+  except ValueError:
+    raise ExportError('export has no id or {} column'.format(column))
+  yield header
+  for record in records:
+    values = next(csv.reader(io.StringIO(record.decode('utf-8'))))
+    if values[geom_index]:
+      out.add(values[id_index], values[geom_index])
+    yield record
+
+
+class GeometryStore(object):
+  """
+  Read-only geometry store of `path`.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, 'rb') as f:
+      self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, self.count = HEADER.unpack_from(self._mm, 0)
+    if magic != MAGIC:
+      raise ValueError('{} is not a geometry store'.format(path))
+    self._data_start = HEADER.size + self.count * ENTRY.size
+    self._view = memoryview(self._mm)
+
+  def __len__(self):
+    return self.count
+
+  def get(self, id):
+    """
+    Return the GeometryRecord of document `id` or None.
+    """
+    key = document_key(id)
+    mm = self._mm
+    lo, hi = 0, self.count
+    while lo < hi:
+      mid = (lo + hi) // 2
+      pos = HEADER.size + mid * ENTRY.size
+      k = mm[pos:pos + KEY_SIZE]
+      if k < key:
+        lo = mid + 1
+      elif k > key:
+        hi = mid
+      else:
+        values = ENTRY.unpack_from(mm, pos)
+        start = self._data_start + values[1]
+        return GeometryRecord(self._view[start:start + values[2]], values[3:7], values[7:9])
+    return None
+
+
+class GeometryStores(object):
+  """
+  Geometry stores of all collections in `directory`. Stores are reopened if
+  the file was replaced (checked every `check_interval` seconds).
+  """
+
+  def __init__(self, directory, check_interval=CHECK_INTERVAL):
+    self.directory = directory
+    self.check_interval = check_interval
+    self._stores = {}
+    self._lock = threading.Lock()
+
+  def get(self, collection):
+    """
+    Return the GeometryStore of `collection` or None.
+    """
+    if not self.directory:
+      return None
+    now = time.time()
+    with self._lock:
+      store, stat, checked = self._stores.get(collection, (None, None, 0))
+      if now - checked < self.check_interval:
+        return store
+      path = store_path(self.directory, collection)
+      try:
+        st = os.stat(path)
+        new_stat = (st.st_ino, st.st_mtime_ns, st.st_size)
+      except OSError:
+        new_stat = None
+      if new_stat != stat:
+        store = None
+        if new_stat:
+          try:
+            store = GeometryStore(path)
+            log.info('opened geometry store %s with %d documents', path, len(store))
+          except (OSError, ValueError, struct.error) as ex:
+            log.warning('unable to open geometry store %s: %s', path, ex)
+      # the old mmap is closed when the last record is released
+      self._stores[collection] = (store, new_stat, now)
+      return store
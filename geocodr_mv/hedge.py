@@ -0,0 +1,174 @@
+"""
+The hedge module implements hedged Solr requests for geocodr_mv.api
+(--hedge).
+
+Each request is sent to one Solr node (round robin). If it has not returned
+after the hedge delay of the collection, a duplicate is sent to the next
+node and the first successful response is used. The hedge delay is the p95
+latency of the last requests of each collection (LatencyTracker). Requests
+are not hedged before `min_samples` latencies of the collection are known.
+
+The number of hedged requests is limited by a budget (HedgeBudget): each
+request adds `max_ratio` to the budget (up to `burst`) and each hedge
+consumes 1. Hedging does not add more than `max_ratio` extra requests, even
+if all nodes are slow.
+
+The response of the slower request is discarded. The request itself is not
+aborted (the connection is returned to the pool when it completes), a
+queued request that has not started yet is cancelled.
+"""
+
+import collections
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from geocodr.solr import Solr, SolrException, SolrUnauthenticatedError
+
+from geocodr_mv.loadtest import percentile
+
+
+# number of latencies per collection for the hedge delay
+WINDOW = 200
+# latencies of a collection before requests are hedged
+MIN_SAMPLES = 20
+# percentile of the latencies that is used as hedge delay
+PERCENTILE = 95
+# lower bound of the hedge delay in seconds
+MIN_DELAY = 0.005
+# maximum ratio of hedged requests
+MAX_RATIO = 0.05
+# maximum number of hedged requests in a row
+BURST = 10
+# threads for all Solr requests of a HedgedSolr
+MAX_WORKERS = 64
+
+
+class LatencyTracker(object):
+  """
+  The last `window` latencies of each collection.
+  """
+
+  def __init__(self, window=WINDOW, min_samples=MIN_SAMPLES, p=PERCENTILE,
+               min_delay=MIN_DELAY):
+    self.window = window
+    self.min_samples = min_samples
+    self.p = p
+    self.min_delay = min_delay
+    self._latencies = {}
+    self._lock = threading.Lock()
+
+  def add(self, collection, latency):
+    with self._lock:
+      values = self._latencies.get(collection)
+      if values is None:
+        values = self._latencies[collection] = collections.deque(maxlen=self.window)
+      values.append(latency)
+
+  def delay(self, collection):
+    """
+    Return the hedge delay of `collection` in seconds or None if there are
+    not enough latencies.
+    """
+    with self._lock:
+      values = sorted(self._latencies.get(collection, ()))
+    if len(values) < self.min_samples:
+      return None
+    return max(percentile(values, self.p), self.min_delay)
+
+
+class HedgeBudget(object):
+  """
+  Limits the hedged requests to `max_ratio` of all requests.
+  """
+
+  def __init__(self, max_ratio=MAX_RATIO, burst=BURST):
+    self.max_ratio = max_ratio
+    self.burst = burst
+    self._tokens = 0.0
+    self._lock = threading.Lock()
+
+  def request(self):
+    with self._lock:
+      self._tokens = min(self._tokens + self.max_ratio, self.burst)
+
+  def acquire(self):
+    """
+    Return True if a request can be hedged.
+    """
+    with self._lock:
+      if self._tokens < 1.0:
+        return False
+      self._tokens -= 1.0
+      return True
+
+
+class HedgedSolr(Solr):
+  """
+  Solr with hedged requests to the nodes `urls` (see module documentation).
+  """
+
+  def __init__(self, urls, min_samples=MIN_SAMPLES, p=PERCENTILE, max_ratio=MAX_RATIO,
+               burst=BURST, max_workers=MAX_WORKERS):
+    Solr.__init__(self, urls[0])
+    self.urls = list(urls)
+    self.tracker = LatencyTracker(min_samples=min_samples, p=p)
+    self.budget = HedgeBudget(max_ratio=max_ratio, burst=burst)
+    self.executor = ThreadPoolExecutor(max_workers=max_workers)
+    self.stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0}
+    self._next = 0
+    self._lock = threading.Lock()
+
+  def _query_url(self, url, collection, params, user_auth):
+    start = time.time()
+    resp = self._s.get('{}/{}/select'.format(url, collection), params=params, auth=user_auth)
+    if resp.status_code == 401:
+      raise SolrUnauthenticatedError()
+    if not resp.ok:
+      raise SolrException(resp)
+    doc = resp.json()
+    self.tracker.add(collection, time.time() - start)
+    return doc
+
+  def _urls(self):
+    with self._lock:
+      self.stats['requests'] += 1
+      n = self._next
+      self._next = (n + 1) % len(self.urls)
+    return self.urls[n], self.urls[(n + 1) % len(self.urls)]
+
+  def query(self, collection, q, user_auth=None, **kw):
+    """
+    Send query `q` for `collection` to Solr, as geocodr.solr.Solr.query.
+    """
+    kw['q'] = q
+    primary, secondary = self._urls()
+    self.budget.request()
+    first = self.executor.submit(self._query_url, primary, collection, kw, user_auth)
+    delay = self.tracker.delay(collection)
+    if delay is None:
+      return first.result()
+
+    done, _ = wait([first], timeout=delay)
+    if done or not self.budget.acquire():
+      return first.result()
+
+    with self._lock:
+      self.stats['hedged'] += 1
+    hedge = self.executor.submit(self._query_url, secondary, collection, kw, user_auth)
+    pending = set([first, hedge])
+    error = None
+    while pending:
+      done, pending = wait(pending, return_when=FIRST_COMPLETED)
+      for f in done:
+        if f.exception() is not None:
+          error = error or f.exception()
+          continue
+        for other in pending:
+          other.cancel()
+        if f is hedge:
+          with self._lock:
+            self.stats['hedge_wins'] += 1
+        return f.result()
+    raise error
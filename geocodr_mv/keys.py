@@ -0,0 +1,106 @@
+"""
+The keys module extends the API keys of geocodr (CSV with the columns `key`
+and `domains`) with optional columns for the defaults of each key.
+
+- `historic`: include historic records (true/false) if the request has no
+  `historic` parameter. Empty for the default of the API.
+- `rate`: maximum number of requests per second (see geocodr_mv.admission).
+- `burst`: maximum number of requests above `rate` in a short burst
+  (default: `rate`).
+- `concurrency`: maximum number of concurrent requests.
+- `lane`: `interactive` (default) or `batch`. Batch requests get fewer
+  slots under load.
+
+Empty values disable the limit.
+"""
+
+import csv
+
+from geocodr_mv.admission import LANES
+
+from geocodr.keys import APIKeys as _APIKeys
+
+
+TRUE_VALUES = ('true', '1', 'yes')
+FALSE_VALUES = ('false', '0', 'no')
+
+
+def parse_bool(value):
+  """
+  Return True or False for `value` or None if it is empty. Raises ValueError
+  for all other values.
+  """
+  value = (value or '').strip().lower()
+  if not value:
+    return None
+  if value in TRUE_VALUES:
+    return True
+  if value in FALSE_VALUES:
+    return False
+  raise ValueError("expected true or false, got '{}'".format(value))
+
+
+def parse_number(value, type=float):
+  """
+  Return the positive number `value` as `type` or None if it is empty.
+  Raises ValueError for all other values.
+  """
+  value = (value or '').strip()
+  if not value:
+    return None
+  number = type(value)
+  if number <= 0:
+    raise ValueError("expected a positive number, got '{}'".format(value))
+  return number
+
+
+def parse_lane(value):
+  """
+  Return the lane `value` or None if it is empty. Raises ValueError for
+  unknown lanes.
+  """
+  value = (value or '').strip().lower()
+  if not value:
+    return None
+  if value not in LANES:
+    raise ValueError("expected {}, got '{}'".format(' or '.join(LANES), value))
+  return value
+
+
+class APIKeys(_APIKeys):
+  """
+  APIKeys with the defaults of each key (see `option`).
+  """
+
+  def _load(self):
+    self.options = {}
+    with open(self.fname, 'r') as f:
+      for row in csv.DictReader(f):
+        if row['key'].startswith('#'):
+          continue
+        options = {}
+        historic = parse_bool(row.get('historic'))
+        if historic is not None:
+          options['historic'] = historic
+        for name, value in (
+          ('rate', parse_number(row.get('rate'))),
+          ('burst', parse_number(row.get('burst'))),
+          ('concurrency', parse_number(row.get('concurrency'), int)),
+          ('lane', parse_lane(row.get('lane'))),
+        ):
+          if value is not None:
+            options[name] = value
+        self.options[row['key'].strip()] = options
+    return _APIKeys._load(self)
+
+  def option(self, request, name, default=None):
+    """
+    Return the option `name` of the key of `request` or `default`.
+    """
+    return self.options.get(request.args.get('key'), {}).get(name, default)
+
+  def limits(self, request):
+    """
+    Return the options of the key of `request` for geocodr_mv.admission.
+    """
+    return self.options.get(request.args.get('key'), {})
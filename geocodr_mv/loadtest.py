@@ -0,0 +1,595 @@
+"""
+The loadtest module generates synthetic load for a geocodr-mv deployment.
+
+The request mix is modelled on our production traffic: typeahead sequences
+(growing prefixes of addresses), parcel identifiers in all formats accepted
+by parse_flst, reverse lookups within Mecklenburg-Vorpommern and
+bbox-filtered searches.
+
+The load is either sent to a running instance (--url) or to a local geocodr
+instance with a fake Solr backend (--in-process).
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import sys
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+log = logging.getLogger('geocodr_mv.loadtest')
+
+# EPSG:4326 bounds of Mecklenburg-Vorpommern (lon/lat)
+MV_BOUNDS = (10.59, 53.11, 14.41, 54.68)
+
+# Search terms for typeahead sequences.
+TYPEAHEAD_TERMS = [
+  'rostock steinstr 1',
+  'neubukow',
+  'parkentin wiesen',
+  'seestr rostock',
+  'kröpelin am sportplatz 6',
+  'kopernikusstr 46 torgelow',
+  'rostock barnstorfer weg 21a',
+  'stettiner str 35 rostock',
+  'schwerin puschkinstr',
+  'greifswald lange str 12',
+  'stralsund ossenreyerstr',
+  'warnemünde',
+]
+
+# Gemarkungen (schluessel, name) for parcel identifiers.
+GEMARKUNGEN = [
+  ('132232', 'Krummendorf'),
+  ('132090', 'Parkentin'),
+  ('132241', 'Flurbezirk II'),
+  ('132221', 'Lütten Klein'),
+]
+
+DEFAULT_MIX = OrderedDict([
+  ('typeahead', 6),
+  ('parcel', 2),
+  ('reverse', 1),
+  ('bbox', 1),
+])
+
+
+class Client(object):
+  """
+  Client sends geocodr requests as HTTP GET. Unlike the client in the
+  acceptance tests, it only returns the response and does not check the result.
+  """
+
+  def __init__(self, url, key=None, timeout=30):
+    self.url = url
+    self.key = key
+    self.timeout = timeout
+    self._s = requests.Session()
+    a = requests.adapters.HTTPAdapter(pool_maxsize=100)
+    self._s.mount('http://', a)
+    self._s.mount('https://', a)
+
+  def search(self, q, **kw):
+    if 'type' not in kw:
+      kw['type'] = 'search'
+    return self.call(q, **kw)
+
+  def reverse(self, q, **kw):
+    if 'type' not in kw:
+      kw['type'] = 'reverse'
+    return self.call(q, **kw)
+
+  def call(self, q, **params):
+    d = {'query': q}
+    if self.key:
+      d['key'] = self.key
+    d.update(params)
+    return self._s.get(self.url, params=d, timeout=self.timeout)
+
+
+class JSONClient(Client):
+  """
+  JSONClient sends geocodr requests as JSON POST.
+  """
+
+  def call(self, q, **kw):
+    d = {'query': q}
+    d.update(kw)
+    params = {}
+    if self.key:
+      params['key'] = self.key
+    if 'key' in d:
+      params['key'] = d.pop('key')
+    return self._s.post(self.url, json=d, params=params, timeout=self.timeout)
+
+
+class Request(object):
+  """
+  A single geocodr request of a scenario. `think` is the delay in seconds
+  before the request is sent (e.g. time between two keystrokes).
+  """
+
+  def __init__(self, type_, q, params, think=0):
+    self.type = type_
+    self.q = q
+    self.params = params
+    self.think = think
+
+  def send(self, client):
+    if self.type == 'reverse':
+      return client.reverse(self.q, **self.params)
+    return client.search(self.q, **self.params)
+
+
+def output_params(rnd):
+  """
+  Return out_epsg and shape parameters as requested by our clients. Most
+  web clients request EPSG:4326, often only with a point geometry.
+  """
+  params = {}
+  out_epsg = rnd.choice([4326, 4326, 4326, 25833, None])
+  if out_epsg:
+    params['out_epsg'] = out_epsg
+  shape = rnd.choice(['centroid', 'centroid', 'geometry', 'bbox'])
+  if shape != 'geometry':
+    params['shape'] = shape
+  return params
+
+
+def typeahead(rnd, min_length=3, think=0.15):
+  """
+  Return requests for a typeahead sequence: one request for each prefix of
+  a random term, starting with `min_length` characters.
+  """
+  term = rnd.choice(TYPEAHEAD_TERMS)
+  base = {'class': 'address', 'limit': 10}
+  base.update(output_params(rnd))
+  reqs = []
+  for n in range(min_length, len(term) + 1):
+    prefix = term[:n]
+    if prefix.endswith(' '):
+      # clients do not query again after a whitespace
+      continue
+    reqs.append(Request('search', prefix, dict(base), think=think))
+  return reqs
+
+
+def parcel_identifier(rnd):
+  """
+  Return a random parcel identifier in one of the formats supported by
+  geocodr.lib.flst.parse_flst.
+  """
+  gemarkung, name = rnd.choice(GEMARKUNGEN)
+  flur = rnd.randint(1, 12)
+  zaehler = rnd.randint(1, 400)
+  nenner = rnd.randint(1, 20)
+
+  formats = [
+    # long-form, numeric
+    lambda: gemarkung,
+    lambda: gemarkung[2:],
+    lambda: '{}{:03d}'.format(gemarkung, flur),
+    lambda: '{}-{:03d}-{:05d}'.format(gemarkung, flur, zaehler),
+    lambda: '{}-{:03d}-{:05d}-{:02d}'.format(gemarkung, flur, zaehler, nenner),
+    lambda: '{}{:03d}{:05d}{:04d}'.format(gemarkung, flur, zaehler, nenner),
+    lambda: '{}{:03d}{:05d}{:04d}'.format(gemarkung[2:], flur, zaehler, nenner),
+    lambda: '{} {},{}'.format(gemarkung, flur, zaehler),
+    lambda: '{} {},{}/{}'.format(gemarkung[2:], flur, zaehler, nenner),
+    lambda: '{} flur{} {}'.format(gemarkung, flur, zaehler),
+    # long-form, with gemarkung name
+    lambda: '{} flur {}'.format(name, flur),
+    lambda: '{} {} {}'.format(name, flur, zaehler),
+    lambda: '{} flur{} {}/{}'.format(name, flur, zaehler, nenner),
+    # short-form
+    lambda: '{}'.format(rnd.randint(10, 999)),
+    lambda: '{}/{}'.format(zaehler, nenner),
+    lambda: '{} {}/{}'.format(gemarkung[2:], zaehler, nenner),
+    lambda: '{}, {}/{}'.format(name, zaehler, nenner),
+  ]
+  return rnd.choice(formats)()
+
+
+def parcel(rnd):
+  params = {'class': 'parcel'}
+  params.update(output_params(rnd))
+  return [Request('search', parcel_identifier(rnd), params)]
+
+
+def random_point(rnd, bounds=MV_BOUNDS):
+  return (rnd.uniform(bounds[0], bounds[2]), rnd.uniform(bounds[1], bounds[3]))
+
+
+def reverse(rnd):
+  x, y = random_point(rnd)
+  params = {
+    'class': rnd.choice(['address', 'parcel', 'address,parcel']),
+    'in_epsg': 4326,
+    'radius': rnd.choice([10, 50, 50, 50, 200]),
+    'limit': rnd.choice([10, 50]),
+  }
+  return [Request('reverse', '{:.6f},{:.6f}'.format(x, y), params)]
+
+
+def bbox(rnd):
+  x, y = random_point(rnd)
+  # map extents between a few streets and a whole Landkreis
+  d = rnd.choice([0.005, 0.02, 0.1, 0.5])
+  params = {
+    'class': 'address',
+    'bbox': '{:.5f},{:.5f},{:.5f},{:.5f}'.format(x - d, y - d / 2, x + d, y + d / 2),
+    'bbox_epsg': 4326,
+  }
+  params.update(output_params(rnd))
+  return [Request('search', rnd.choice(TYPEAHEAD_TERMS).split(' ')[0], params)]
+
+
+SCENARIOS = OrderedDict([
+  ('typeahead', typeahead),
+  ('parcel', parcel),
+  ('reverse', reverse),
+  ('bbox', bbox),
+])
+
+
+def percentile(sorted_values, p):
+  """
+  Return the `p` percentile (0-100) of `sorted_values` (nearest-rank).
+  """
+  if not sorted_values:
+    return 0.0
+  k = max(int(math.ceil(p / 100.0 * len(sorted_values))) - 1, 0)
+  return sorted_values[min(k, len(sorted_values) - 1)]
+
+
+class ScenarioStats(object):
+  def __init__(self, name):
+    self.name = name
+    self.latencies = []
+    self.errors = 0
+    self.status = {}
+
+  def add(self, latency, status):
+    self.latencies.append(latency)
+    self.status[status] = self.status.get(status, 0) + 1
+    if status != 200:
+      self.errors += 1
+
+  def summary(self, duration):
+    lat = sorted(self.latencies)
+    n = len(lat)
+    return OrderedDict([
+      ('scenario', self.name),
+      ('requests', n),
+      ('errors', self.errors),
+      ('error_rate', self.errors / n if n else 0.0),
+      ('throughput', n / duration if duration else 0.0),
+      ('p50', percentile(lat, 50)),
+      ('p90', percentile(lat, 90)),
+      ('p95', percentile(lat, 95)),
+      ('p99', percentile(lat, 99)),
+      ('max', lat[-1] if lat else 0.0),
+      ('status', dict((str(k), v) for k, v in sorted(self.status.items(), key=str))),
+    ])
+
+
+class Stats(object):
+  def __init__(self):
+    self.scenarios = OrderedDict()
+    self._lock = threading.Lock()
+    self.start = None
+    self.end = None
+
+  def add(self, scenario, latency, status):
+    with self._lock:
+      if scenario not in self.scenarios:
+        self.scenarios[scenario] = ScenarioStats(scenario)
+      self.scenarios[scenario].add(latency, status)
+
+  def report(self):
+    duration = (self.end or time.time()) - self.start
+    total = ScenarioStats('total')
+    for s in self.scenarios.values():
+      total.latencies.extend(s.latencies)
+      total.errors += s.errors
+      for k, v in s.status.items():
+        total.status[k] = total.status.get(k, 0) + v
+    rows = [s.summary(duration) for s in self.scenarios.values()]
+    rows.append(total.summary(duration))
+    return {'duration': duration, 'scenarios': rows}
+
+
+class RampProfile(object):
+  """
+  RampProfile returns the target load (arrival rate or number of workers) for
+  a point in time. The load increases linearly from `start` to `target`
+  within `ramp` seconds and stays at `target` until `duration`.
+  """
+
+  def __init__(self, target, duration, ramp=0, start=0):
+    self.target = target
+    self.duration = duration
+    self.ramp = ramp
+    self.start = start
+
+  def at(self, t):
+    if t >= self.duration:
+      return 0
+    if self.ramp and t < self.ramp:
+      return self.start + (self.target - self.start) * t / self.ramp
+    return self.target
+
+
+def parse_mix(mix):
+  """
+  Parse scenario weights, e.g. typeahead=6,parcel=2,reverse=1,bbox=1.
+  """
+  weights = OrderedDict()
+  for part in mix.split(','):
+    if not part.strip():
+      continue
+    name, _, weight = part.partition('=')
+    name = name.strip()
+    if name not in SCENARIOS:
+      raise ValueError('unknown scenario {!r}, supported: {}'.format(
+        name, ', '.join(SCENARIOS)))
+    weights[name] = float(weight or 1)
+  return weights
+
+
+class LoadTest(object):
+  """
+  LoadTest runs the scenarios against `client`.
+
+  With `rate`, scenarios are started with a Poisson arrival process (open
+  workload). The rate increases during `ramp` seconds. At most
+  `concurrency` scenarios run at the same time; arrivals are counted as
+  'dropped' if all workers are busy.
+
+  Without `rate`, `concurrency` workers run scenarios back-to-back (closed
+  workload) and workers are started gradually during `ramp` seconds.
+  """
+
+  def __init__(self, client, mix=DEFAULT_MIX, concurrency=8, rate=None, duration=60,
+               ramp=0, seed=None, think=True):
+    self.client = client
+    self.mix = mix
+    self.concurrency = concurrency
+    self.rate = rate
+    self.duration = duration
+    self.ramp = ramp
+    self.think = think
+    self.rnd = random.Random(seed)
+    self._rnd_lock = threading.Lock()
+    self.stats = Stats()
+    self.dropped = 0
+    self.deadline = None
+
+  def next_scenario(self):
+    with self._rnd_lock:
+      name = self.rnd.choices(list(self.mix.keys()), weights=list(self.mix.values()))[0]
+      reqs = SCENARIOS[name](random.Random(self.rnd.random()))
+    return name, reqs
+
+  def run_scenario(self, name, reqs):
+    for req in reqs:
+      if self.think and req.think:
+        time.sleep(req.think)
+      if time.time() >= self.deadline:
+        # do not start new requests of long typeahead sequences after the test
+        return
+      start = time.perf_counter()
+      try:
+        resp = req.send(self.client)
+        # read the complete body before measuring the latency
+        resp.content
+        status = resp.status_code
+      except requests.RequestException as ex:
+        log.debug('request failed: %s', ex)
+        status = 'exception'
+      self.stats.add(name, time.perf_counter() - start, status)
+
+  def run(self):
+    self.stats.start = time.time()
+    self.deadline = self.stats.start + self.duration
+    if self.rate:
+      self._run_open()
+    else:
+      self._run_closed()
+    self.stats.end = time.time()
+    report = self.stats.report()
+    report['dropped'] = self.dropped
+    return report
+
+  def _run_closed(self):
+    profile = RampProfile(self.concurrency, self.duration, ramp=self.ramp, start=1)
+    t0 = time.time()
+
+    def worker(n):
+      while True:
+        t = time.time() - t0
+        if t >= self.duration:
+          return
+        if n >= profile.at(t):
+          # worker not yet started by the ramp profile
+          time.sleep(0.05)
+          continue
+        self.run_scenario(*self.next_scenario())
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(self.concurrency)]
+    for th in threads:
+      th.start()
+    for th in threads:
+      th.join()
+
+  def _run_open(self):
+    profile = RampProfile(self.rate, self.duration, ramp=self.ramp, start=self.rate * 0.1)
+    busy = threading.Semaphore(self.concurrency)
+    t0 = time.time()
+    next_arrival = 0.0
+
+    def task(name, reqs):
+      try:
+        self.run_scenario(name, reqs)
+      finally:
+        busy.release()
+
+    with ThreadPoolExecutor(max_workers=self.concurrency) as e:
+      while True:
+        rate = profile.at(next_arrival)
+        if not rate:
+          break
+        with self._rnd_lock:
+          next_arrival += self.rnd.expovariate(rate)
+        wait = t0 + next_arrival - time.time()
+        if wait > 0:
+          time.sleep(wait)
+        if next_arrival >= self.duration:
+          break
+        if not busy.acquire(blocking=False):
+          self.dropped += 1
+          continue
+        e.submit(task, *self.next_scenario())
+
+
+def format_report(report):
+  lines = []
+  header = '{:<12} {:>8} {:>7} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8}'.format(
+    'scenario', 'requests', 'errors', 'err%', 'req/s', 'p50 ms', 'p90 ms', 'p95 ms',
+    'p99 ms', 'max ms')
+  lines.append(header)
+  lines.append('-' * len(header))
+  for s in report['scenarios']:
+    lines.append('{:<12} {:>8} {:>7} {:>7.2f} {:>9.1f} {:>8.1f} {:>8.1f} {:>8.1f} {:>8.1f} '
+                 '{:>8.1f}'.format(
+                   s['scenario'], s['requests'], s['errors'], s['error_rate'] * 100,
+                   s['throughput'], s['p50'] * 1000, s['p90'] * 1000, s['p95'] * 1000,
+                   s['p99'] * 1000, s['max'] * 1000))
+  lines.append('duration: {:.1f}s, dropped arrivals: {}'.format(
+    report['duration'], report.get('dropped', 0)))
+  return '\n'.join(lines)
+
+
+class InProcess(object):
+  """
+  Start a fake Solr and a geocodr API with `mapping` in background threads.
+  """
+
+  def __init__(self, mapping, solr_delay=0, solr_jitter=0, api_keys_csv=None, threads=8,
+               hedge=False):
+    from geocodr_mv.api import create_app
+    from .fakesolr import BackgroundServer, FakeSolr
+
+    self.solr = FakeSolr(delay=solr_delay, jitter=solr_jitter)
+    self.solr_server = BackgroundServer(self.solr, threads=threads * 4).start()
+    self.replica_server = None
+    config = {
+      'solr_url': self.solr_server.url,
+      'mapping': mapping,
+      'api_keys_csv': api_keys_csv,
+    }
+    if hedge:
+      # second node with the same latency distribution
+      self.replica_server = BackgroundServer(
+        FakeSolr(delay=solr_delay, jitter=solr_jitter), threads=threads * 4).start()
+      config.update(hedge=True, hedge_urls=[self.replica_server.url])
+    self.app = create_app(config)
+    self.api_server = BackgroundServer(self.app, threads=threads).start()
+
+  @property
+  def url(self):
+    return self.api_server.url + '/query'
+
+  def stop(self):
+    self.api_server.stop()
+    self.solr_server.stop()
+    if self.replica_server:
+      self.replica_server.stop()
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  logging.getLogger('urllib3').setLevel(logging.WARN)
+
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--url", default="http://localhost:5000/query",
+                      help='URL of the geocodr query endpoint')
+  parser.add_argument("--key", help='geocodr API key')
+  parser.add_argument("--client", choices=['get', 'json'], default='get',
+                      help='send requests as GET or JSON POST')
+  parser.add_argument("--in-process", action='store_true',
+                      help='start a local geocodr with a fake Solr instead of using --url')
+  parser.add_argument("--mapping", default='conf/geocodr_mapping.py',
+                      help='mapping for --in-process')
+  parser.add_argument("--solr-delay", type=float, default=0,
+                      help='delay of the fake Solr in seconds (--in-process)')
+  parser.add_argument("--solr-jitter", type=float, default=0,
+                      help='mean of exponential distributed extra delay of the fake Solr '
+                           'in seconds (--in-process)')
+  parser.add_argument("--hedge", action='store_true',
+                      help='start a second fake Solr and hedge slow requests (--in-process)')
+  parser.add_argument("--mix", default=','.join('{}={}'.format(k, v)
+                                                for k, v in DEFAULT_MIX.items()),
+                      help='scenario weights (default: %(default)s)')
+  parser.add_argument("--concurrency", type=int, default=8,
+                      help='max number of concurrent scenarios')
+  parser.add_argument("--rate", type=float,
+                      help='arrival rate of new scenarios per second (open workload). '
+                           'Default: run --concurrency workers back-to-back')
+  parser.add_argument("--ramp", type=float, default=0,
+                      help='seconds to ramp up to --rate/--concurrency')
+  parser.add_argument("--duration", type=float, default=60, help='duration in seconds')
+  parser.add_argument("--no-think", action='store_true',
+                      help='send typeahead requests without delay between keystrokes')
+  parser.add_argument("--seed", type=int, help='random seed for reproducible request sequences')
+  parser.add_argument("--json", action='store_true', help='print report as JSON')
+
+  args = parser.parse_args()
+
+  try:
+    mix = parse_mix(args.mix)
+  except ValueError as ex:
+    parser.error(str(ex))
+
+  local = None
+  url = args.url
+  if args.in_process:
+    local = InProcess(args.mapping, solr_delay=args.solr_delay, solr_jitter=args.solr_jitter,
+                      hedge=args.hedge)
+    url = local.url
+    log.info('started local geocodr at %s', url)
+
+  client_cls = JSONClient if args.client == 'json' else Client
+  test = LoadTest(
+    client_cls(url, key=args.key),
+    mix=mix,
+    concurrency=args.concurrency,
+    rate=args.rate,
+    duration=args.duration,
+    ramp=args.ramp,
+    seed=args.seed,
+    think=not args.no_think,
+  )
+  try:
+    report = test.run()
+  finally:
+    if local:
+      local.stop()
+
+  if args.json:
+    json.dump(report, sys.stdout, indent=2)
+    print()
+  else:
+    print(format_report(report))
+
+
+if __name__ == '__main__':
+  main()
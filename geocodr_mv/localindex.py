@@ -0,0 +1,625 @@
+"""
+The localindex module answers the search queries of small collections (e.g.
+gemeinden and postleitzahlengebiete, with `local_index = True` in the
+mapping) in the process of geocodr_mv.api instead of Solr.
+
+All documents of these collections are loaded from Solr at startup,
+together with the analyzers of their fields (Schema API). The query fields
+(`qfields`) of the mapping are indexed in memory with the same analysis as
+in Solr (charFilters, StandardTokenizer, LowerCaseFilter,
+GermanNormalizationFilter, n-grams and edge n-grams; the sources of n-gram
+fields are taken from the copyFields). Queries are evaluated like the Solr
+queries of the mapping: each term is searched in all qfields (exclusive
+`Only` fields, `PatternReplace`, 3-gram `edismax` queries with their
+minimum match and prefix queries with constant scores), the best field
+counts for each term and all terms have to match. Documents are scored
+with BM25 of Lucene with the boosts of the mapping, so that the scores
+match the Solr scores of a collection with a single shard or with
+ExactStatsCache.
+
+Only the first request of each collection (the sort fields of
+sort_field_list) is answered locally. The page of the result is loaded
+from Solr (or from the geometry stores) by id, as before. Reverse
+geocoding, spatial filters, requests with all fields (debug=true) and
+requests with Solr credentials are sent to Solr.
+
+A background thread checks the aliases of SolrCloud every `check_interval`
+seconds and reloads a collection after its alias was changed (e.g. by
+geocodr_mv.reindex). Collections that fail to load are queried in Solr and
+loaded again with the next check.
+"""
+
+import bisect
+import json
+import logging
+import math
+import os
+import re
+import threading
+import time
+
+import requests
+
+from geocodr.search import (
+  GermanNGramField,
+  NGramField,
+  Only,
+  PatternReplace,
+  PrefixField,
+  SimpleField,
+)
+
+from geocodr_mv.fallback import field_list
+from geocodr_mv.search import NGRAM_MM
+
+
+log = logging.getLogger('geocodr_mv.localindex')
+
+# rows of each request while loading a collection
+LOAD_ROWS = 1000
+# seconds between checks for changed aliases
+CHECK_INTERVAL = 30
+TIMEOUT = 30
+
+# BM25 parameters of Lucene (BM25Similarity)
+K1 = 1.2
+B = 0.75
+
+re_tokens = re.compile(r'\w+')
+re_java_group = re.compile(r'\$(\d)')
+
+
+def german_normalize(term):
+  """
+  Normalize `term` as the GermanNormalizationFilter of Lucene: `ß` is
+  replaced by `ss`, umlauts by their base vowel, `ae`, `oe` and `ue` by `a`,
+  `o` and `u` (`ue` not after a vowel or `q`).
+  """
+  N, V, U = 0, 1, 2
+  state = N
+  out = []
+  for c in term:
+    if c in 'ao':
+      state = U
+    elif c == 'u':
+      state = U if state == N else V
+    elif c == 'e':
+      if state == U:
+        state = V
+        continue
+      state = V
+    elif c in 'iqy':
+      state = V
+    elif c in 'äöü':
+      c = {'ä': 'a', 'ö': 'o', 'ü': 'u'}[c]
+      state = V
+    elif c == 'ß':
+      c = 'ss'
+      state = N
+    else:
+      state = N
+    out.append(c)
+  return ''.join(out)
+
+
+def ngrams(term, min_gram, max_gram, edge=False):
+  """
+  Return the n-grams of `term` in the order of the (Edge)NGramFilter of
+  Lucene.
+  """
+  if edge:
+    return [term[:n] for n in range(min_gram, min(max_gram, len(term)) + 1)]
+  return [term[i:i + n] for i in range(len(term)) for n in range(min_gram, max_gram + 1)
+          if i + n <= len(term)]
+
+
+def factory_name(spec):
+  """
+  Return the short name of the factory `spec` of the Schema API (e.g.
+  `lowercase` for `solr.LowerCaseFilterFactory`).
+  """
+  name = (spec.get('class') or spec.get('name') or '').rsplit('.', 1)[-1].lower()
+  for suffix in ('factory', 'charfilter', 'tokenizer', 'filter'):
+    if name.endswith(suffix):
+      name = name[:-len(suffix)]
+  return name
+
+
+class Analyzer(object):
+  """
+  Analyzer of a Solr field type, from the `analyzer` of the Schema API.
+  Fields without analyzer (StrField) are indexed as a single token.
+  """
+
+  def __init__(self, spec=None):
+    self.char_filters = []
+    self.tokenizer = 'keyword'
+    self.filters = []
+    if spec is None:
+      return
+    for f in spec.get('charFilters', []):
+      if factory_name(f) != 'patternreplace':
+        raise ValueError('unsupported charFilter {}'.format(f))
+      self.char_filters.append((re.compile(f['pattern']),
+                                re_java_group.sub(r'\\g<\1>', f.get('replacement', ''))))
+    self.tokenizer = factory_name(spec.get('tokenizer', {}))
+    if self.tokenizer not in ('standard', 'keyword'):
+      raise ValueError('unsupported tokenizer {}'.format(spec.get('tokenizer')))
+    for f in spec.get('filters', []):
+      name = factory_name(f)
+      if name in ('lowercase', 'germannormalization'):
+        self.filters.append((name, None))
+      elif name in ('ngram', 'edgengram'):
+        self.filters.append((name, (int(f.get('minGramSize', 1)), int(f.get('maxGramSize', 2)))))
+      else:
+        raise ValueError('unsupported filter {}'.format(f))
+
+  def normalize(self, term):
+    """
+    Return `term` after the filters without tokenizer and n-grams (terms of
+    prefix queries).
+    """
+    for name, _ in self.filters:
+      if name == 'lowercase':
+        term = term.lower()
+      elif name == 'germannormalization':
+        term = german_normalize(term)
+    return term
+
+  def tokens(self, text):
+    """
+    Return the tokens of `text` with their position increments.
+    """
+    for pattern, repl in self.char_filters:
+      text = pattern.sub(repl, text)
+    if self.tokenizer == 'standard':
+      tokens = [(t, 1) for t in re_tokens.findall(text)]
+    else:
+      tokens = [(text, 1)] if text else []
+    for name, args in self.filters:
+      if name == 'lowercase':
+        tokens = [(t.lower(), inc) for t, inc in tokens]
+      elif name == 'germannormalization':
+        tokens = [(german_normalize(t), inc) for t, inc in tokens]
+      else:
+        grams = []
+        pending = 0
+        for t, inc in tokens:
+          # all n-grams of a token have the same position
+          pending += inc
+          for gram in ngrams(t, args[0], args[1], edge=name == 'edgengram'):
+            grams.append((gram, pending))
+            pending = 0
+        tokens = grams
+    return tokens
+
+  def terms(self, text):
+    return [t for t, _ in self.tokens(text)]
+
+
+def decode_length(length):
+  """
+  Return `length` after the lossy encoding of the norms of Lucene
+  (SmallFloat.intToByte4 and byte4ToInt).
+  """
+  free_values = 24
+  if length < free_values:
+    return length
+  i = length - free_values
+  bits = i.bit_length()
+  if bits >= 4:
+    shift = bits - 4
+    encoded = ((i >> shift) & 0x07) | ((shift + 1) << 3)
+    i = ((encoded & 0x07) | 0x08) << ((encoded >> 3) - 1)
+  return free_values + i
+
+
+class FieldIndex(object):
+  """
+  Inverted index of one Solr field with the statistics for BM25.
+  """
+
+  def __init__(self, analyzer, query_analyzer=None):
+    self.analyzer = analyzer
+    self.query_analyzer = query_analyzer or analyzer
+    self.postings = {}
+    self.lengths = {}
+    self.total_terms = 0
+    self.terms = []
+    self.avgdl = 1.0
+
+  def add(self, docno, texts):
+    tokens = []
+    for text in texts:
+      tokens.extend(self.analyzer.tokens(text))
+    if not tokens:
+      return
+    for t, _ in tokens:
+      freqs = self.postings.setdefault(t, {})
+      freqs[docno] = freqs.get(docno, 0) + 1
+    self.total_terms += len(tokens)
+    # overlapping tokens (n-grams at the same position) are not counted
+    self.lengths[docno] = decode_length(sum(1 for _, inc in tokens if inc))
+
+  def finish(self):
+    self.terms = sorted(self.postings)
+    if self.lengths:
+      self.avgdl = self.total_terms / len(self.lengths)
+
+  def score(self, term, boost=1.0):
+    """
+    Return a dict with the BM25 score of `term` for each document.
+    """
+    freqs = self.postings.get(term)
+    if not freqs:
+      return {}
+    n = len(self.lengths)
+    idf = math.log(1 + (n - len(freqs) + 0.5) / (len(freqs) + 0.5))
+    weight = boost * idf
+    scores = {}
+    for docno, freq in freqs.items():
+      norm = K1 * (1 - B + B * self.lengths[docno] / self.avgdl)
+      scores[docno] = weight * freq / (freq + norm)
+    return scores
+
+  def prefix(self, prefix):
+    """
+    Return the documents with a term that starts with `prefix`.
+    """
+    docs = set()
+    i = bisect.bisect_left(self.terms, prefix)
+    while i < len(self.terms) and self.terms[i].startswith(prefix):
+      docs.update(self.postings[self.terms[i]])
+      i += 1
+    return docs
+
+
+def query_boost(boost):
+  """
+  Return `boost` as formatted in the Solr queries of geocodr.search.
+  """
+  return float('{:.2}'.format(boost))
+
+
+def min_should_match(clauses, spec=NGRAM_MM):
+  """
+  Return the number of `clauses` that have to match for the `mm` `spec`
+  (conditional specs with negative numbers only).
+  """
+  required = clauses
+  for part in spec.split():
+    upper, value = part.split('<')
+    if clauses > int(upper):
+      required = clauses + int(value)
+  return max(required, 0)
+
+
+def leaf_field(qfield):
+  """
+  Return the field of the mapping `qfield` without Only and PatternReplace.
+  """
+  while isinstance(qfield, (Only, PatternReplace)):
+    qfield = qfield.qfield
+  return qfield
+
+
+def parse_sort(sort):
+  """
+  Return the fields of a Solr `sort` (without score) with the direction
+  (True for descending).
+  """
+  fields = []
+  for part in sort.split(','):
+    name, _, direction = part.strip().partition(' ')
+    if name and name != 'score':
+      fields.append((name, direction.strip().lower() == 'desc'))
+  return fields
+
+
+class CollectionIndex(object):
+  """
+  In-memory index of the mapping `collection` for the `schema` (Schema API)
+  and all `docs` of the collection.
+  """
+
+  def __init__(self, collection, schema, docs):
+    self.collection = collection
+    self.fields = {}
+    self.sort = parse_sort(collection.sort)
+    types = dict((t['name'], t) for t in schema.get('fieldTypes', []))
+    schema_fields = dict((f['name'], f) for f in schema.get('fields', []))
+    sources = {}
+    for copy in schema.get('copyFields', []):
+      sources.setdefault(copy['dest'], []).append(copy['source'])
+
+    indexed = {}
+    for qfield in collection.qfields:
+      field = leaf_field(qfield)
+      if not isinstance(field, (SimpleField, PrefixField, NGramField)):
+        raise ValueError('unsupported query field {!r}'.format(field))
+      if field.field in indexed:
+        continue
+      if field.field not in schema_fields:
+        raise ValueError('unknown field {}'.format(field.field))
+      field_type = types[schema_fields[field.field]['type']]
+      analyzer = field_type.get('indexAnalyzer') or field_type.get('analyzer')
+      query_analyzer = field_type.get('queryAnalyzer') or field_type.get('analyzer')
+      indexed[field.field] = (FieldIndex(Analyzer(analyzer), Analyzer(query_analyzer)),
+                              sources.get(field.field, [field.field]))
+    self.source_fields = sorted(set(s for _, names in indexed.values() for s in names))
+
+    self.keep = set(['id'] + [name for name, _ in self.sort])
+    if hasattr(collection, 'sort_field_list'):
+      self.keep.update(f for f in collection.sort_field_list.split(',') if f != 'score')
+    self.docs = []
+    for docno, doc in enumerate(docs):
+      blob = None
+      for index, names in indexed.values():
+        texts = []
+        for name in names:
+          value = doc.get(name)
+          if value is None and collection.jsonblob_field in doc:
+            # not stored in Solr
+            if blob is None:
+              blob = json.loads(doc[collection.jsonblob_field])
+            value = blob.get(name)
+          if value is not None:
+            texts.append(str(value))
+        index.add(docno, texts)
+      self.docs.append(dict((k, v) for k, v in doc.items() if k in self.keep))
+    for name, (index, _) in indexed.items():
+      index.finish()
+      self.fields[name] = index
+
+  @property
+  def load_field_list(self):
+    """
+    Return the Solr `fl` to load the documents.
+    """
+    names = set(self.keep) | set(self.source_fields)
+    names.add(self.collection.jsonblob_field)
+    return ','.join(sorted(names))
+
+  def has_fields(self, fl):
+    """
+    Check whether the documents contain all fields of the Solr `fl`.
+    """
+    names = set(f.split(':', 1)[0].strip() for f in (fl or '*').split(','))
+    return names <= self.keep | set(['score'])
+
+  def field_scores(self, qfield, term):
+    """
+    Return the scores (dict by document) of `qfield` for `term` and whether
+    the query is exclusive, or None if `qfield` does not query `term` (see
+    geocodr.search).
+    """
+    if isinstance(qfield, Only):
+      if not qfield.regexp.match(term):
+        return None
+      result = self.field_scores(qfield.qfield, term)
+      return (result[0], True) if result else None
+    if isinstance(qfield, PatternReplace):
+      return self.field_scores(qfield.qfield, qfield.regexp.sub(qfield.repl, term))
+
+    index = self.fields[qfield.field]
+    if isinstance(qfield, NGramField):
+      if isinstance(qfield, GermanNGramField):
+        term = qfield.normalize_german(term.lower())
+      grams = qfield.tokenize(term)
+      if not grams:
+        return None
+      boost = query_boost(1.0 / len(grams) * qfield.boost)
+      # each gram is analyzed by Solr, grams without tokens are dropped
+      clauses = [c for c in (index.query_analyzer.terms(g) for g in grams) if c]
+      required = min_should_match(len(clauses))
+      matches, scores = {}, {}
+      for terms in clauses:
+        clause = {}
+        for t in terms:
+          for docno, score in index.score(t, boost).items():
+            clause[docno] = clause.get(docno, 0) + score
+        for docno, score in clause.items():
+          matches[docno] = matches.get(docno, 0) + 1
+          scores[docno] = scores.get(docno, 0) + score
+      return dict((d, s) for d, s in scores.items() if matches[d] >= required), False
+
+    boost = 1.0 if qfield.boost == 1.0 else query_boost(qfield.boost)
+    if isinstance(qfield, PrefixField):
+      if len(term) < qfield.min_term:
+        return None
+      # constant score of prefix queries
+      return dict((d, boost) for d in index.prefix(index.query_analyzer.normalize(term))), False
+    if not term:
+      return None
+    scores = {}
+    for t in index.query_analyzer.terms(term):
+      for docno, score in index.score(t, boost).items():
+        scores[docno] = scores.get(docno, 0) + score
+    return scores, False
+
+  def term_scores(self, term, qfields):
+    """
+    Return the score of `term` for each matching document (maximum of all
+    fields).
+    """
+    parts = []
+    for qfield in qfields:
+      result = self.field_scores(qfield, term)
+      if result is not None:
+        parts.append(result)
+    if any(exclusive for _, exclusive in parts):
+      parts = [p for p in parts if p[1]]
+    scores = {}
+    for part, _ in parts:
+      for docno, score in part.items():
+        if score > scores.get(docno, -1):
+          scores[docno] = score
+    return scores
+
+  def search(self, query):
+    """
+    Return the matching documents of `query` with their scores, sorted as
+    by Solr.
+    """
+    collection = self.collection
+    if hasattr(collection, 'expand_query'):
+      query = collection.expand_query(query)
+    qfields = collection.qfields
+    if hasattr(collection, 'shape_query'):
+      shape = collection.shape_query(query)
+      terms = shape.terms
+      if shape.strategy == 'simple':
+        qfields = [f for f in qfields if not isinstance(leaf_field(f), NGramField)]
+    else:
+      terms = [t for t in query.split(' ') if t]
+    if not terms:
+      return []
+
+    scores = None
+    for term in terms:
+      term_scores = self.term_scores(term, qfields)
+      if scores is None:
+        scores = term_scores
+      else:
+        scores = dict((d, s + term_scores[d]) for d, s in scores.items() if d in term_scores)
+      if not scores:
+        return []
+
+    results = [(self.docs[d], s) for d, s in scores.items()]
+    results.sort(key=lambda r: r[0]['id'])
+    for name, descending in reversed(self.sort):
+      results.sort(key=lambda r: (r[0].get(name) is None, r[0].get(name)), reverse=descending)
+    results.sort(key=lambda r: r[1], reverse=True)
+    return results
+
+  def query(self, q, start=0, rows=10, fl=None):
+    """
+    Return the Solr response for the search `q` (not the Solr query).
+    """
+    start, rows = int(start), int(rows)
+    results = self.search(q)
+    return {
+      'responseHeader': {'status': 0, 'QTime': 0},
+      'response': {
+        'numFound': len(results),
+        'start': start,
+        'docs': [field_list(doc, score, fl) for doc, score in results[start:start + rows]],
+      },
+    }
+
+
+def load_collection(url, collection, timeout=TIMEOUT, rows=LOAD_ROWS):
+  """
+  Return the CollectionIndex of the mapping `collection` with the schema
+  and the documents from the Solr server `url`.
+  """
+  resp = requests.get('{}/{}/schema'.format(url, collection.name), params={'wt': 'json'},
+                      timeout=timeout)
+  resp.raise_for_status()
+  schema = resp.json()['schema']
+  # the field list depends on the schema, without documents
+  fl = CollectionIndex(collection, schema, []).load_field_list
+
+  docs = []
+  while True:
+    resp = requests.get('{}/{}/select'.format(url, collection.name), params={
+      'q': '*:*', 'sort': 'id asc', 'fl': fl, 'start': len(docs), 'rows': rows, 'wt': 'json',
+    }, timeout=timeout)
+    resp.raise_for_status()
+    result = resp.json()['response']
+    docs.extend(result['docs'])
+    if not result['docs'] or len(docs) >= result['numFound']:
+      break
+  index = CollectionIndex(collection, schema, docs)
+  log.info('loaded %d documents of %s', len(docs), collection.name)
+  return index
+
+
+class LocalIndex(object):
+  """
+  Local indexes of the mapping `collections` from the Solr server `url`
+  (see module documentation). `load` loads all collections, the check for
+  changed aliases is started by the first call of `get` in each process
+  (after the fork of geocodr_mv.prefork).
+  """
+
+  def __init__(self, url, collections, check_interval=CHECK_INTERVAL, timeout=TIMEOUT):
+    self.url = url.rstrip('/')
+    self.collections = dict((c.name, c) for c in collections)
+    self.check_interval = check_interval
+    self.timeout = timeout
+    self.indexes = {}
+    self.aliases = {}
+    self._pid = None
+    self._lock = threading.Lock()
+
+  def list_aliases(self):
+    """
+    Return the aliases of SolrCloud, an empty dict for Solr without
+    Collections API or None if the request failed.
+    """
+    try:
+      resp = requests.get(self.url + '/admin/collections',
+                          params={'action': 'LISTALIASES', 'wt': 'json'}, timeout=self.timeout)
+    except requests.RequestException as ex:
+      log.warning('unable to list aliases: %s', ex)
+      return None
+    if resp.status_code in (400, 404):
+      return {}
+    if not resp.ok:
+      log.warning('unable to list aliases: %s', resp.status_code)
+      return None
+    return resp.json().get('aliases', {})
+
+  def load(self, names=None, aliases=None):
+    """
+    Load the collections `names` (default: all). Returns the names of the
+    loaded collections.
+    """
+    if aliases is None:
+      aliases = self.list_aliases() or {}
+    loaded = []
+    for name in names or list(self.collections):
+      try:
+        index = load_collection(self.url, self.collections[name], self.timeout)
+      except (requests.RequestException, ValueError, KeyError) as ex:
+        log.warning('unable to load %s, queries are sent to Solr: %s', name, ex)
+        continue
+      self.indexes[name] = index
+      self.aliases[name] = aliases.get(name)
+      loaded.append(name)
+    return loaded
+
+  def check(self):
+    """
+    Reload collections with a changed alias and collections that are not
+    loaded. Returns the names of the reloaded collections.
+    """
+    aliases = self.list_aliases()
+    if aliases is None:
+      return []
+    names = [n for n in self.collections
+             if n not in self.indexes or aliases.get(n) != self.aliases.get(n)]
+    if not names:
+      return []
+    log.info('reloading %s', ', '.join(names))
+    return self.load(names, aliases)
+
+  def run(self):
+    while True:
+      time.sleep(self.check_interval)
+      try:
+        self.check()
+      except Exception:
+        log.exception('checking the local collections')
+
+  def get(self, name):
+    """
+    Return the CollectionIndex of collection `name` or None.
+    """
+    if self._pid != os.getpid():
+      with self._lock:
+        if self._pid != os.getpid():
+          threading.Thread(target=self.run, daemon=True).start()
+          self._pid = os.getpid()
+    return self.indexes.get(name)
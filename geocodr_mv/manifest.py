@@ -0,0 +1,180 @@
+"""
+The manifest module stores the state of the last import of each collection:
+the Solr collection, a fingerprint of the SQL and Solr schema, the time of
+the last full rebuild and a content hash for each row (keyed by the `id`
+column). The row hashes are used to send only changed rows to Solr.
+
+Each collection has a `<collection>.json` file and a
+`<collection>.<timestamp>.hashes.gz` file with one `<id> <hash>` line for each
+row. The JSON file references the current hash file and is replaced last, so
+that an aborted run never leaves an inconsistent manifest.
+"""
+
+import csv
+import gzip
+import hashlib
+import io
+import json
+import os
+import re
+import time
+
+from geocodr_mv.export import SQL_DIR, AtomicFile, ExportError
+
+
+SOLR_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'solr'))
+
+DIGEST_SIZE = 12
+CHECKSUM_MOD = 2 ** (DIGEST_SIZE * 8)
+
+
+def row_hash(record):
+  return hashlib.blake2b(record, digest_size=DIGEST_SIZE).digest()
+
+
+def id_column(header):
+  """
+  Return the index of the `id` column in the CSV `header` record.
+  """
+  columns = next(csv.reader(io.StringIO(header.decode('utf-8'))))
+  try:
+    return columns.index('id')
+  except ValueError:
+    raise ExportError('export has no id column')
+
+
+def record_id(record, index):
+  """
+  Return the value of column `index` of the CSV `record`.
+  """
+  if index == 0 and not record.startswith(b'"'):
+    # fast path for unquoted ids (uuid) in the first column
+    return record.split(b',', 1)[0].rstrip(b'\r\n').decode('utf-8')
+  return next(csv.reader(io.StringIO(record.decode('utf-8'))))[index]
+
+
+def fingerprint(collection, sql_dir=SQL_DIR, solr_dir=SOLR_DIR, precompute_4326=False,
+                geometry_lod=False):
+  """
+  Return a hash of all files and options that define the documents of
+  `collection`. A new fingerprint requires a full rebuild of the collection.
+  """
+  h = hashlib.sha1()
+  if precompute_4326:
+    h.update(b'precompute_4326\n')
+  if geometry_lod:
+    h.update(b'geometry_lod\n')
+  for path in [
+    os.path.join(sql_dir, collection + '.sql'),
+    os.path.join(solr_dir, collection + '-schema.xml'),
+    os.path.join(solr_dir, 'solrconfig.xml'),
+  ]:
+    if os.path.exists(path):
+      with open(path, 'rb') as f:
+        h.update(f.read())
+  return h.hexdigest()
+
+
+def changed_records(records, previous, out):
+  """
+  Pass the CSV header and all records that are new or changed compared to
+  the `previous` row hashes ({id: hash}). The id and hash of each record are
+  written to `out` (HashWriter).
+  Unchanged records are removed from `previous`. `previous` only contains
+  the ids of deleted rows when the iterator is exhausted.
+  """
+  records = iter(records)
+  header = next(records, None)
+  if header is None:
+    return
+  index = id_column(header)
+  yield header
+  for record in records:
+    id = record_id(record, index)
+    digest = row_hash(record)
+    out.write(id, digest, len(record))
+    if previous.pop(id, None) != digest:
+      yield record
+
+
+class HashWriter(object):
+  """
+  Write `<id> <hash>` lines into a new (compressed) hash file. Counts the
+  rows and the CSV bytes of all rows.
+  """
+
+  def __init__(self, path):
+    self.path = path
+    self.rows = 0
+    self.bytes = 0
+    self._sum = 0
+
+  def __enter__(self):
+    self._file = AtomicFile(self.path, compress=True)
+    self._f = self._file.__enter__()
+    return self
+
+  def write(self, id, digest, size=0):
+    self._f.write('{} {}\n'.format(id, digest.hex()).encode('utf-8'))
+    self.rows += 1
+    self.bytes += size
+    self._sum = (self._sum + int.from_bytes(digest, 'big')) % CHECKSUM_MOD
+
+  @property
+  def checksum(self):
+    """
+    Checksum of all rows. The checksum does not depend on the order of the
+    rows, as the order of COPY without ORDER BY can change.
+    """
+    return '{}:{:0{}x}'.format(self.rows, self._sum, DIGEST_SIZE * 2)
+
+  def __exit__(self, exc_type, exc, tb):
+    return self._file.__exit__(exc_type, exc, tb)
+
+
+class Manifest(object):
+  """
+  Manifest of `collection` in the `directory`.
+  """
+
+  def __init__(self, directory, collection):
+    self.directory = directory
+    self.collection = collection
+    self.path = os.path.join(directory, collection + '.json')
+
+  def load(self):
+    """
+    Return the manifest as dict or None if the collection was not imported
+    before.
+    """
+    if not os.path.exists(self.path):
+      return None
+    with open(self.path, 'r') as f:
+      return json.load(f)
+
+  def load_hashes(self, meta):
+    """
+    Return dict with the row hash for each id of the manifest `meta`.
+    """
+    hashes = {}
+    with gzip.open(os.path.join(self.directory, meta['hashes']), 'rb') as f:
+      for line in f:
+        id, digest = line.rstrip(b'\n').rsplit(b' ', 1)
+        hashes[id.decode('utf-8')] = bytes.fromhex(digest.decode('ascii'))
+    return hashes
+
+  def hash_writer(self):
+    name = '{}.{}-{}.hashes.gz'.format(self.collection, time.strftime('%Y%m%dT%H%M%S'),
+                                       os.getpid())
+    return HashWriter(os.path.join(self.directory, name))
+
+  def save(self, meta):
+    """
+    Replace the manifest with `meta` and remove unused hash files.
+    """
+    with AtomicFile(self.path) as f:
+      f.write(json.dumps(meta, indent=2, sort_keys=True).encode('utf-8'))
+    hash_file = re.compile(r'^{}\.[^.]+\.hashes\.gz$'.format(re.escape(self.collection)))
+    for name in os.listdir(self.directory):
+      if hash_file.match(name) and name != meta['hashes']:
+        os.unlink(os.path.join(self.directory, name))
@@ -0,0 +1,172 @@
+"""
+The parambench module compares inline Solr queries (all terms and n-grams in
+`q`) with parameterized queries (a template in `q` with the terms and
+n-grams as separate `$t1`/`$g2` parameters, see --parameterized-queries of
+geocodr_mv.api).
+
+The queries are read from a log file (as geocodr_mv.warmup) and sent once
+for each query type and collection, in alternating order, with the sort,
+fields and rows of the mapping. The results report the Solr QTime, the
+latency, the size of the URL query string, the number of distinct `q`
+values (templates) and the number of queries where both types return the
+same first document.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+
+from urllib.parse import urlencode
+
+from geocodr.solr import Solr
+
+from geocodr_mv.api import collection_rows, search_field_list
+from geocodr_mv.loadtest import percentile
+from geocodr_mv.warmup import MAPPING, load_queries, mapping_collections
+
+
+log = logging.getLogger('geocodr_mv.parambench')
+
+COLLECTIONS = ('adressen', 'strassen', 'gemeindeteile', 'gemeinden', 'schulen')
+TOP_QUERIES = 200
+
+
+def query_size(params):
+  """
+  Return the size of the URL query string of `params` in bytes.
+  """
+  return len(urlencode(params, doseq=True))
+
+
+def cases(collections, queries):
+  """
+  Return (inline params, parameterized params) for all `queries` of the
+  mapping `collections` (all with the same name).
+  """
+  result = []
+  for coll in collections:
+    if not hasattr(coll, 'query_params'):
+      continue
+    common = {
+      'sort': coll.sort,
+      'fl': search_field_list(coll),
+      'rows': collection_rows(coll)[0],
+    }
+    for query in queries:
+      if len(query) < coll.min_query_length:
+        continue
+      q = coll.query(query)
+      if not q:
+        continue
+      inline = dict(common, q=q)
+      parameterized = dict(common, **coll.query_params(query))
+      result.append((inline, parameterized))
+  return result
+
+
+def first_id(resp):
+  docs = resp['response']['docs']
+  return docs[0].get('id') if docs else None
+
+
+def run(select, cases):
+  """
+  Send all `cases` of each collection with both query types.
+  `select(collection, params)` returns the Solr response. Returns the
+  results for each collection and query type.
+  """
+  names = ('inline', 'parameterized')
+  results = []
+  for collection, pairs in sorted(cases.items()):
+    stats = dict((name, {'qtime': [], 'latency': [], 'size': [], 'templates': set()})
+                 for name in names)
+    same = 0
+    for i, pair in enumerate(pairs):
+      order = [0, 1] if i % 2 == 0 else [1, 0]
+      ids = [None, None]
+      for j in order:
+        params = pair[j]
+        start = time.time()
+        resp = select(collection, params)
+        s = stats[names[j]]
+        s['latency'].append(time.time() - start)
+        s['qtime'].append(resp['responseHeader'].get('QTime', 0))
+        s['size'].append(query_size(params))
+        s['templates'].add(params['q'])
+        ids[j] = first_id(resp)
+      same += ids[0] == ids[1]
+
+    for name in names:
+      s = stats[name]
+      s['qtime'].sort()
+      s['latency'].sort()
+      results.append({
+        'collection': collection,
+        'query': name,
+        'requests': len(pairs),
+        'templates': len(s['templates']),
+        'size': sum(s['size']) / len(pairs) if pairs else 0,
+        'qtime_p50': percentile(s['qtime'], 50) if pairs else 0.0,
+        'qtime_p95': percentile(s['qtime'], 95) if pairs else 0.0,
+        'p50': percentile(s['latency'], 50) * 1000 if pairs else 0.0,
+        'p95': percentile(s['latency'], 95) * 1000 if pairs else 0.0,
+        'same_first': same,
+      })
+  return results
+
+
+def format_results(results):
+  lines = ['{:<15} {:<13} {:>8} {:>9} {:>8} {:>9} {:>9} {:>8} {:>8} {:>6}'.format(
+    'collection', 'query', 'requests', 'templates', 'bytes', 'qtime p50', 'qtime p95',
+    'p50 ms', 'p95 ms', 'same')]
+  for r in results:
+    lines.append(
+      '{:<15} {:<13} {:>8} {:>9} {:>8.0f} {:>9.1f} {:>9.1f} {:>8.1f} {:>8.1f} {:>6}'.format(
+        r['collection'], r['query'], r['requests'], r['templates'], r['size'],
+        r['qtime_p50'], r['qtime_p95'], r['p50'], r['p95'], r['same_first']))
+  return '\n'.join(lines)
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  logging.getLogger('urllib3').setLevel(logging.WARN)
+
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--url", default="http://localhost:8983/solr")
+  parser.add_argument("--mapping", default=MAPPING,
+                      help='geocodr mapping for queries, sort and fields (default: %(default)s)')
+  parser.add_argument("--queries", required=True,
+                      help='log file with one query per line (optionally count<TAB>query)')
+  parser.add_argument("--top", type=int, default=TOP_QUERIES,
+                      help='number of most frequent queries (default: %(default)s)')
+  parser.add_argument("--collection", action='append', dest='collections',
+                      help='collection to query, can be repeated (default: {})'.format(
+                        ', '.join(COLLECTIONS)))
+  parser.add_argument("--json", action='store_true', help='print results as JSON')
+  args = parser.parse_args()
+
+  solr = Solr(args.url)
+  mapping = mapping_collections(args.mapping)
+  queries = load_queries(args.queries, top=args.top)
+  log.info('loaded %d queries', len(queries))
+
+  all_cases = dict((name, cases(mapping[name], queries))
+                   for name in args.collections or COLLECTIONS)
+
+  def select(collection, params):
+    params = dict(params)
+    return solr.query(collection, params.pop('q'), **params)
+
+  results = run(select, all_cases)
+  if args.json:
+    json.dump(results, sys.stdout, indent=2)
+    print()
+  else:
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+  main()
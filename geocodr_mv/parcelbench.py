@@ -0,0 +1,142 @@
+"""
+The parcelbench module compares the latency of parcel number prefix queries
+with a wildcard query on flurstuecksnummer and with a term query on the
+edge n-gram field flurstuecksnummer_prefix.
+
+Prefixes with 6 (gemarkung), 9 (+ flur), 14 (+ zaehler) and 18 (+ nenner)
+digits are taken from a sample of the flurstuecksnummer values of the
+collection. Each prefix is sent once for each query type, in alternating
+order, with the sort and fields of the mapping (as geocodr_mv.api).
+"""
+
+import argparse
+import json
+import logging
+import random
+import sys
+import time
+
+from geocodr.solr import Solr
+
+from geocodr_mv.api import collection_rows, search_field_list
+from geocodr_mv.loadtest import percentile
+from geocodr_mv.warmup import MAPPING, mapping_collections
+
+
+log = logging.getLogger('geocodr_mv.parcelbench')
+
+LENGTHS = (6, 9, 14, 18)
+SAMPLE_SIZE = 200
+
+QUERIES = {
+  'wildcard': 'flurstuecksnummer:{}*',
+  'term': 'flurstuecksnummer_prefix:{}^=1',
+}
+
+
+def sample_numbers(solr, collection, size=SAMPLE_SIZE, chunks=10, rnd=random):
+  """
+  Return up to `size` flurstuecksnummer values from random positions of
+  `collection`.
+  """
+  resp = solr.query(collection, '*:*', rows=0)
+  num_found = resp['response']['numFound']
+  rows = max(size // chunks, 1)
+  numbers = set()
+  for _ in range(chunks):
+    start = rnd.randrange(max(num_found - rows, 1))
+    resp = solr.query(collection, '*:*', start=start, rows=rows, fl='flurstuecksnummer')
+    numbers.update(d['flurstuecksnummer'] for d in resp['response']['docs']
+                   if d.get('flurstuecksnummer'))
+  return sorted(numbers)[:size]
+
+
+def prefixes(numbers, lengths=LENGTHS):
+  """
+  Return dict with the unique prefixes of all `numbers` for each length.
+  """
+  return dict(
+    (length, sorted(set(n[:length] for n in numbers if len(n) >= length)))
+    for length in lengths
+  )
+
+
+def run(select, prefixes, queries=QUERIES):
+  """
+  Send all `prefixes` with each query type. `select(q)` returns the Solr
+  response. Returns the p50/p95 latency (ms) and the mean number of matches
+  for each length and query type.
+  """
+  latencies = dict(((length, name), []) for length in prefixes for name in queries)
+  found = dict((key, []) for key in latencies)
+  for length, values in sorted(prefixes.items()):
+    for i, prefix in enumerate(values):
+      names = sorted(queries)
+      if i % 2:
+        names.reverse()
+      for name in names:
+        start = time.time()
+        resp = select(queries[name].format(prefix))
+        latencies[length, name].append(time.time() - start)
+        found[length, name].append(resp['response']['numFound'])
+
+  results = []
+  for (length, name), values in sorted(latencies.items()):
+    values.sort()
+    results.append({
+      'length': length,
+      'query': name,
+      'requests': len(values),
+      'found': sum(found[length, name]) / len(values) if values else 0,
+      'p50': percentile(values, 50) * 1000 if values else 0.0,
+      'p95': percentile(values, 95) * 1000 if values else 0.0,
+    })
+  return results
+
+
+def format_results(results):
+  lines = ['{:>6} {:<9} {:>8} {:>9} {:>8} {:>8}'.format(
+    'digits', 'query', 'requests', 'found', 'p50 ms', 'p95 ms')]
+  for r in results:
+    lines.append('{:>6} {:<9} {:>8} {:>9.1f} {:>8.1f} {:>8.1f}'.format(
+      r['length'], r['query'], r['requests'], r['found'], r['p50'], r['p95']))
+  return '\n'.join(lines)
+
+
+def main():
+  logging.basicConfig(level=logging.INFO)
+  logging.getLogger('urllib3').setLevel(logging.WARN)
+
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--url", default="http://localhost:8983/solr")
+  parser.add_argument("--mapping", default=MAPPING,
+                      help='geocodr mapping for sort and fields (default: %(default)s)')
+  parser.add_argument("--collection", default='flurstuecke',
+                      choices=['flurstuecke', 'flurstuecke_hro', 'flurstueckseigentuemer'])
+  parser.add_argument("--sample-size", type=int, default=SAMPLE_SIZE,
+                      help='number of sampled parcel numbers (default: %(default)s)')
+  parser.add_argument("--seed", type=int, help='random seed for the sample')
+  parser.add_argument("--json", action='store_true', help='print results as JSON')
+  args = parser.parse_args()
+
+  solr = Solr(args.url)
+  coll = mapping_collections(args.mapping)[args.collection][0]
+  numbers = sample_numbers(solr, args.collection, size=args.sample_size,
+                           rnd=random.Random(args.seed))
+  log.info('sampled %d parcel numbers', len(numbers))
+
+  def select(q):
+    return solr.query(args.collection, q, sort=coll.sort, fl=search_field_list(coll),
+                      rows=collection_rows(coll)[0])
+
+  results = run(select, prefixes(numbers))
+  if args.json:
+    json.dump(results, sys.stdout, indent=2)
+    print()
+  else:
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+  main()
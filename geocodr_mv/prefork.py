@@ -0,0 +1,387 @@
+"""
+The prefork module serves geocodr_mv.api with several worker processes that
+share one listening socket (`python -m geocodr_mv.prefork --workers 8 ...`,
+with all options of geocodr_mv.api).
+
+The master process loads the mapping and creates the application before the
+workers are forked, so that the collections and all other read-only data
+are shared copy-on-write (gc.freeze keeps the garbage collector from
+touching these pages, the objects of the previous application are
+unfrozen and collected after a reload). The geometry stores (--geometry-dir) are memory
+mapped and shared by all workers through the page cache. The transformers
+of pyproj are not fork-safe and are created by each worker thread.
+
+Each worker runs waitress with --threads threads and its own admission
+control (--max-in-flight slots for each worker, see
+geocodr_mv.admission.waitress_limits). Workers that exit are
+restarted, with an increasing delay (up to MAX_RESPAWN_DELAY seconds) for
+workers that exit directly after their start. SIGTERM and SIGINT stop all
+workers gracefully: the workers stop accepting connections and finish their
+requests (up to --graceful-timeout seconds). The shutdown uses internals
+of waitress (see WaitressWorker), which are checked at startup.
+
+The workers are restarted one after another (rolling restart) if the
+mapping file changed (checked every --check-interval seconds) or on SIGHUP.
+A new worker with the new mapping is started before an old worker is
+stopped. The old workers keep running if the new mapping can not be loaded.
+"""
+
+import gc
+import logging
+import os
+import signal
+import socket
+import threading
+import time
+
+from geocodr_mv.admission import THREADS, waitress_limits
+from geocodr_mv.api import app_config, argument_parser, create_app
+
+
+log = logging.getLogger('geocodr_mv.prefork')
+
+GRACEFUL_TIMEOUT = 30
+CHECK_INTERVAL = 2
+# workers that exit within MIN_UPTIME seconds are restarted after a delay
+# that doubles with each failure, from RESPAWN_DELAY to MAX_RESPAWN_DELAY
+MIN_UPTIME = 5
+RESPAWN_DELAY = 0.1
+MAX_RESPAWN_DELAY = 30
+# connections with activity within this number of seconds are not closed
+# by the graceful shutdown (their request may not be read yet)
+IDLE_TIMEOUT = 1
+
+
+def listen_socket(host, port, backlog=1024):
+  """
+  Return a listening TCP socket for `host` and `port` that is inherited by
+  all workers.
+  """
+  sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  sock.bind((host, port))
+  sock.listen(backlog)
+  sock.set_inheritable(True)
+  return sock
+
+
+class WaitressWorker(object):
+  """
+  Adapter for the waitress internals that are required to stop accepting
+  connections of `server` and to wait for its running requests. waitress
+  has no public API for this, so the internals are checked before the
+  server is used (see check_waitress). Tested with the waitress versions of
+  server/conf/requirements-api.txt.
+  """
+
+  def __init__(self, server):
+    from waitress.channel import HTTPChannel
+    from waitress.server import BaseWSGIServer
+
+    check_waitress(server)
+    self.server = server
+    self._channel_class = HTTPChannel
+    self._server_class = BaseWSGIServer
+
+  def channels(self, cls):
+    return [c for c in list(self.server._map.values()) if isinstance(c, cls)]
+
+  def stop_accepting(self):
+    # the listening socket stays open for the other workers
+    for channel in self.channels(self._server_class):
+      channel.del_channel()
+
+  def close(self):
+    # the loop ends as soon as the map is empty (also closes the trigger)
+    for channel in self.channels(self._channel_class):
+      channel.close()
+    self.server.close()
+
+  def busy(self):
+    idle = time.time() - IDLE_TIMEOUT
+    return any(c.requests or c.request is not None or c.total_outbufs_len
+               or c.last_activity > idle for c in self.channels(self._channel_class))
+
+  def drain(self, timeout):
+    """
+    Stop accepting connections, wait up to `timeout` seconds for running
+    requests (and for connections that were active within IDLE_TIMEOUT
+    seconds) and close all connections. Called from another thread than
+    the main loop.
+    """
+    self.server.trigger.pull_trigger(self.stop_accepting)
+    deadline = time.time() + timeout
+    while time.time() < deadline and self.busy():
+      time.sleep(0.05)
+    self.server.trigger.pull_trigger(self.close)
+
+  def shutdown(self):
+    self.server.task_dispatcher.shutdown()
+
+
+def waitress_missing(server=None):
+  """
+  Return the names of the waitress internals of WaitressWorker that are
+  missing in the installed waitress version (and in `server`).
+  """
+  from waitress.channel import HTTPChannel
+  from waitress.server import BaseWSGIServer
+
+  missing = []
+  if not hasattr(BaseWSGIServer, 'del_channel'):
+    missing.append('BaseWSGIServer.del_channel')
+  for name in ('request', 'total_outbufs_len', 'close', 'last_activity'):
+    if not hasattr(HTTPChannel, name):
+      missing.append('HTTPChannel.' + name)
+  # instance attribute, set by __init__
+  if 'requests' not in HTTPChannel.__init__.__code__.co_names:
+    missing.append('HTTPChannel.requests')
+  if server is not None:
+    if not isinstance(getattr(server, '_map', None), dict):
+      missing.append('server._map')
+    if not hasattr(getattr(server, 'trigger', None), 'pull_trigger'):
+      missing.append('server.trigger.pull_trigger')
+    if not hasattr(getattr(server, 'task_dispatcher', None), 'shutdown'):
+      missing.append('server.task_dispatcher.shutdown')
+  return missing
+
+
+def check_waitress(server=None):
+  """
+  Raise RuntimeError if the installed waitress version (or `server`) does
+  not support the graceful shutdown of the workers.
+  """
+  missing = waitress_missing(server)
+  if missing:
+    raise RuntimeError('unsupported waitress version for graceful shutdown, missing: {}'.format(
+      ', '.join(missing)))
+
+
+def serve_worker(app, sock, threads=THREADS, graceful_timeout=GRACEFUL_TIMEOUT,
+                 connection_limit=None):
+  """
+  Serve `app` on the listening `sock` with waitress until SIGTERM.
+  """
+  from waitress.server import create_server
+
+  kw = {'connection_limit': connection_limit} if connection_limit else {}
+  server = create_server(app, sockets=[sock], threads=threads, **kw)
+  worker = WaitressWorker(server)
+
+  def stop(signum, frame):
+    threading.Thread(target=worker.drain, args=(graceful_timeout,), daemon=True).start()
+
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+  signal.signal(signal.SIGHUP, signal.SIG_IGN)
+  server.run()
+  worker.shutdown()
+
+
+def mapping_mtime(path):
+  try:
+    return os.stat(path).st_mtime_ns
+  except OSError:
+    return None
+
+
+class Master(object):
+  """
+  Starts and supervises `workers` processes for the application of `config`
+  on the listening `sock`.
+  """
+
+  def __init__(self, config, sock, workers, threads=THREADS,
+               graceful_timeout=GRACEFUL_TIMEOUT, check_interval=CHECK_INTERVAL,
+               connection_limit=None):
+    self.config = config
+    self.sock = sock
+    self.num_workers = workers
+    self.threads = threads
+    self.connection_limit = connection_limit
+    self.graceful_timeout = graceful_timeout
+    self.check_interval = check_interval
+    self.app = None
+    self.mtime = None
+    # pid: start time
+    self.workers = {}
+    # times of pending restarts
+    self.respawns = []
+    self.respawn_delay = 0
+    self.stopping = False
+    self.reload_requested = False
+
+  def load(self):
+    """
+    Create the application that is shared by all new workers.
+    """
+    mtime = mapping_mtime(self.config['mapping'])
+    # the previous application can be collected after it was replaced
+    gc.unfreeze()
+    try:
+      app = create_app(self.config)
+      self.app, self.mtime = app, mtime
+    finally:
+      # objects of the master are shared copy-on-write with the workers
+      gc.collect()
+      gc.freeze()
+
+  def spawn(self):
+    pid = os.fork()
+    if pid == 0:
+      status = 0
+      try:
+        serve_worker(self.app, self.sock, self.threads, self.graceful_timeout,
+                     self.connection_limit)
+      except BaseException:
+        log.exception('worker %d failed', os.getpid())
+        status = 1
+      finally:
+        os._exit(status)
+    self.workers[pid] = time.time()
+    log.info('started worker %d', pid)
+    return pid
+
+  def stop_worker(self, pid):
+    """
+    Stop worker `pid` gracefully and wait until it exited.
+    """
+    try:
+      os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+      pass
+    deadline = time.time() + self.graceful_timeout + 5
+    while time.time() < deadline:
+      done, _ = os.waitpid(pid, os.WNOHANG)
+      if done:
+        break
+      time.sleep(0.05)
+    else:
+      log.warning('killing worker %d', pid)
+      os.kill(pid, signal.SIGKILL)
+      os.waitpid(pid, 0)
+    self.workers.pop(pid, None)
+
+  def reap(self):
+    """
+    Schedule the restart of workers that exited.
+    """
+    while self.workers:
+      try:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+      except ChildProcessError:
+        return
+      if not pid:
+        return
+      if pid in self.workers:
+        started = self.workers.pop(pid)
+        log.warning('worker %d exited with status %d', pid, status)
+        if self.stopping:
+          continue
+        if time.time() - started < MIN_UPTIME:
+          self.respawn_delay = min(max(2 * self.respawn_delay, RESPAWN_DELAY), MAX_RESPAWN_DELAY)
+          log.warning('restarting worker in %.1f seconds', self.respawn_delay)
+        else:
+          self.respawn_delay = 0
+        self.respawns.append(time.time() + self.respawn_delay)
+
+  def respawn(self):
+    """
+    Start the workers of pending restarts that are due.
+    """
+    now = time.time()
+    due = [t for t in self.respawns if t <= now]
+    self.respawns = [t for t in self.respawns if t > now]
+    for _ in due:
+      self.spawn()
+
+  def reload(self):
+    """
+    Replace all workers with workers for the current mapping, one after
+    another.
+    """
+    self.reload_requested = False
+    try:
+      self.load()
+    except Exception:
+      # keep the current workers
+      log.exception('unable to load %s, workers are not restarted', self.config['mapping'])
+      self.mtime = mapping_mtime(self.config['mapping'])
+      return
+    log.info('rolling restart of %d workers', len(self.workers))
+    for pid in list(self.workers):
+      if self.stopping:
+        return
+      self.spawn()
+      self.stop_worker(pid)
+
+  def run(self):
+    def stop(signum, frame):
+      self.stopping = True
+
+    def hup(signum, frame):
+      self.reload_requested = True
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGHUP, hup)
+
+    self.load()
+    for _ in range(self.num_workers):
+      self.spawn()
+
+    last_check = time.time()
+    while not self.stopping:
+      time.sleep(0.1)
+      self.reap()
+      self.respawn()
+      if time.time() - last_check >= self.check_interval:
+        last_check = time.time()
+        if mapping_mtime(self.config['mapping']) != self.mtime:
+          self.reload_requested = True
+      if self.reload_requested and not self.stopping:
+        self.reload()
+
+    log.info('stopping %d workers', len(self.workers))
+    for pid in list(self.workers):
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except ProcessLookupError:
+        pass
+    for pid in list(self.workers):
+      self.stop_worker(pid)
+
+
+def main():
+  logging.basicConfig(level=logging.INFO,
+                      format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s')
+
+  parser = argument_parser(description=__doc__.strip().split('\n\n')[0])
+  parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                      help='number of worker processes (default: %(default)s)')
+  parser.add_argument("--graceful-timeout", type=float, default=GRACEFUL_TIMEOUT,
+                      help='seconds to finish requests before a worker is killed '
+                           '(default: %(default)s)')
+  parser.add_argument("--check-interval", type=float, default=CHECK_INTERVAL,
+                      help='seconds between checks for a changed mapping (default: %(default)s)')
+  args = parser.parse_args()
+
+  config = app_config(args)
+  try:
+    config['max_in_flight'], connection_limit = waitress_limits(args.threads,
+                                                                args.max_in_flight)
+  except ValueError as ex:
+    parser.error(str(ex))
+  # fail before any worker is started
+  check_waitress()
+  sock = listen_socket(args.host, args.port)
+  host, port = sock.getsockname()[:2]
+  log.info('listening on http://%s:%d with %d workers', host, port, args.workers)
+  master = Master(config, sock, args.workers, threads=args.threads,
+                  graceful_timeout=args.graceful_timeout, check_interval=args.check_interval,
+                  connection_limit=connection_limit)
+  master.run()
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,672 @@
+"""
+The reindex module streams the PostgreSQL export of each collection directly
+into a new SolrCloud collection and swaps the alias afterwards.
+
+It works like geocodr-post (new `<collection>-1` or `<collection>-2`
+collection, alias swap at the end), but the COPY output of psql is posted in
+bounded batches while the export is still running. Batches are posted with
+commitWithin. One hard commit is sent after the last batch, before the alias
+is changed. Several collections are imported in parallel.
+
+With --warmup-queries, the most frequent queries from a query log are sent
+to the new collection until the latency is stable, before the alias is
+changed (see geocodr_mv.warmup).
+
+With --manifest-dir, a content hash of each row (keyed by `id`) is stored
+after each import. The next run only posts new and changed rows and deletes
+removed rows in the live collection. A full rebuild is done if the SQL or
+Solr schema changed, if the alias was changed by another tool or after
+--full-every days.
+Collections are skipped without an export if the statistics of all source
+tables in PostgreSQL show no changes since the last run. The commit is
+skipped if the export is identical to the last run. The decision for each
+collection is stored in the manifest and in reindex.json.
+
+With --geometry-dir, the geometries of all rows are written into a geometry
+store (`<collection>.geom`, see geocodr_mv.geomstore) for geocodr_mv.api.
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing
+from queue import Full, Queue
+
+from geocodr_import.solr import (
+  SolrCloud as _SolrCloud,
+  ignore_solr_error,
+  raise_on_non_200,
+)
+
+from geocodr_mv.export import (
+  SQL_DIR,
+  AtomicFile,
+  ExportError,
+  PSQLCopy,
+  available_collections,
+  change_marker,
+  load_query,
+  output_path,
+  source_tables,
+)
+from geocodr_mv import shards, warmup
+from geocodr_mv.geomstore import (
+  GeometryWriter, discard_store, geometry_records, publish_store, staging_path,
+)
+from geocodr_mv.manifest import (
+  Manifest,
+  changed_records,
+  fingerprint,
+)
+
+
+log = logging.getLogger('geocodr_mv.reindex')
+
+BATCH_ROWS = 20000
+BATCH_BYTES = 32 * 1024 * 1024
+COMMIT_WITHIN = 60000  # ms
+# number of batches that are read from psql while the previous batch is posted
+QUEUED_BATCHES = 2
+DELETE_BATCH = 1000
+# full rebuild after this many seconds, even if delta updates are possible
+FULL_EVERY = 7 * 24 * 3600
+
+
+class ReindexError(Exception):
+  pass
+
+
+class SolrCloud(_SolrCloud):
+  """
+  SolrCloud with additional calls for batched updates.
+  """
+
+  @raise_on_non_200
+  def update_csv_batch(self, collection, data, commit_within=COMMIT_WITHIN):
+    return self._s.post(
+      '{}/{}/update'.format(self.solr_url, collection),
+      headers={'Content-type': 'text/csv'},
+      params={'commitWithin': commit_within},
+      data=data,
+    )
+
+  @raise_on_non_200
+  def delete_ids(self, collection, ids, commit_within=COMMIT_WITHIN):
+    return self._s.post(
+      '{}/{}/update'.format(self.solr_url, collection),
+      params={'commitWithin': commit_within},
+      json={'delete': ids},
+    )
+
+  @raise_on_non_200
+  def _select(self, collection, params):
+    return self._s.get('{}/{}/select'.format(self.solr_url, collection), params=params)
+
+  def select(self, collection, params):
+    return self._select(collection, params).json()
+
+  @raise_on_non_200
+  def commit(self, collection):
+    return self._s.get(
+      '{}/{}/update'.format(self.solr_url, collection),
+      params={'commit': 'true', 'waitSearcher': 'true'},
+    )
+
+
+def next_collection(cs, collection):
+  """
+  Return the name of the collection that should be used for the import,
+  either `collection-1` or `collection-2`, depending on which name the
+  existing alias points to. Returns the current collection as well (None
+  if the alias does not exist).
+  """
+  current = cs.list_aliases().json()['aliases'].get(collection)
+  if current and current.endswith('-1'):
+    return collection + '-2', current
+  return collection + '-1', current
+
+
+def batches(records, batch_rows=BATCH_ROWS, batch_bytes=BATCH_BYTES):
+  """
+  Group CSV `records` into batches with up to `batch_rows` records or
+  `batch_bytes` bytes. The first record is the CSV header and it is repeated
+  at the start of each batch.
+  Returns an iterator of (rows, data) tuples.
+  """
+  records = iter(records)
+  header = next(records, None)
+  if header is None:
+    return
+  batch = [header]
+  size = len(header)
+  for record in records:
+    batch.append(record)
+    size += len(record)
+    if len(batch) - 1 >= batch_rows or size >= batch_bytes:
+      yield len(batch) - 1, b''.join(batch)
+      batch = [header]
+      size = len(header)
+  if len(batch) > 1:
+    yield len(batch) - 1, b''.join(batch)
+
+
+def tee(records, f):
+  """
+  Write each record to `f` while iterating.
+  """
+  for record in records:
+    f.write(record)
+    yield record
+
+
+def read_ahead(iterable, size=QUEUED_BATCHES):
+  """
+  Consume `iterable` in a background thread, so that psql and PostgreSQL keep
+  exporting while the current batch is posted. At most `size` items are
+  queued. Exceptions from `iterable` are re-raised in the caller.
+  Close the returned generator to stop the thread.
+  """
+  queue = Queue(maxsize=size)
+  done = object()
+  stop = threading.Event()
+
+  def put(item):
+    while not stop.is_set():
+      try:
+        queue.put(item, timeout=0.1)
+        return True
+      except Full:
+        pass
+    return False
+
+  def run():
+    try:
+      for item in iterable:
+        if not put((item, None)):
+          return
+    except Exception as ex:
+      put((done, ex))
+      return
+    put((done, None))
+
+  threading.Thread(target=run, daemon=True).start()
+  try:
+    while True:
+      item, err = queue.get()
+      if item is done:
+        if err is not None:
+          raise err
+        return
+      yield item
+  finally:
+    stop.set()
+
+
+def post_export(cs, solr_collection, query, batch_rows=BATCH_ROWS, batch_bytes=BATCH_BYTES,
+                commit_within=COMMIT_WITHIN, csv_path=None, hashes=None, previous=None,
+                geometries=None, psql='psql'):
+  """
+  Run the export `query` and post the rows in batches into `solr_collection`.
+  Writes the CSV to `csv_path`, the row hashes to `hashes` (HashWriter) and
+  the geometries of all rows to `geometries` (GeometryWriter) if set. Only
+  new or changed rows are posted if `previous` row hashes are set.
+  Returns the number of posted rows and batches.
+  """
+  rows = 0
+  num_batches = 0
+  with ExitStack() as stack:
+    # entered before psql, so that errors from psql discard the CSV, hash and
+    # geometry files
+    if csv_path:
+      f = stack.enter_context(AtomicFile(csv_path, compress=True))
+    if hashes:
+      stack.enter_context(hashes)
+    if geometries:
+      stack.enter_context(geometries)
+    records = stack.enter_context(PSQLCopy(query, psql=psql)).records()
+    if csv_path:
+      records = tee(records, f)
+    if geometries:
+      records = geometry_records(records, geometries)
+    if hashes:
+      records = changed_records(records, {} if previous is None else previous, hashes)
+    posts = stack.enter_context(closing(read_ahead(batches(records, batch_rows, batch_bytes))))
+    for n, data in posts:
+      cs.update_csv_batch(solr_collection, data, commit_within=commit_within)
+      rows += n
+      num_batches += 1
+      log.debug('posted %d rows into %s', rows, solr_collection)
+  return rows, num_batches
+
+
+def import_collection(cs, collection, schema='public', config_name=None, num_shards=2,
+                      replication_factor=2, csv_outdir=None, manifest=None, marker=None,
+                      reason=None, warmup=None, geometry_dir=None, precompute_4326=False,
+                      geometry_lod=False, sql_dir=SQL_DIR, **kw):
+  """
+  Export `collection` from PostgreSQL and post it in batches into a new Solr
+  collection. The alias is only changed if the export and all batches were
+  successful. Optionally writes the exported CSV into `csv_outdir` as well.
+  Stores the row hashes in `manifest` (Manifest) if set, together with the
+  change `marker` and the `reason` for the rebuild.
+  `warmup(collection, solr_collection)` is called before the alias is
+  changed. The geometry store is written into `geometry_dir` if set and
+  replaces the previous store after the alias was changed.
+  `precompute_4326` adds the EPSG:4326 geometries and `geometry_lod` the
+  simplified geometries (see load_query).
+  Returns a dict with the number of rows, batches and the duration.
+  """
+  start = time.time()
+  query = load_query(collection, schema=schema, sql_dir=sql_dir,
+                     precompute_4326=precompute_4326, geometry_lod=geometry_lod)
+
+  if collection in cs.list_collections().json()['collections']:
+    raise ReindexError('target collection {} exists'.format(collection))
+
+  new_collection, current = next_collection(cs, collection)
+
+  with ignore_solr_error():
+    log.info('deleting old collection %s', new_collection)
+    cs.delete_collection(new_collection)
+
+  log.info('creating new collection %s', new_collection)
+  cs.create_collection(
+    new_collection,
+    config_name=config_name or collection,
+    num_shards=num_shards,
+    replication_factor=replication_factor,
+  )
+
+  hashes = manifest.hash_writer() if manifest else None
+  try:
+    rows, num_batches = post_export(
+      cs, new_collection, query,
+      csv_path=output_path(csv_outdir, collection) if csv_outdir else None,
+      hashes=hashes,
+      geometries=GeometryWriter(staging_path(geometry_dir, collection)) if geometry_dir else None,
+      **kw
+    )
+    log.info('committing %d rows into %s', rows, new_collection)
+    cs.commit(new_collection)
+    warmup_result = None
+    if warmup:
+      log.info('warming up %s', new_collection)
+      warmup_result = warmup(collection, new_collection)
+  except Exception:
+    log.info('deleting incomplete collection %s', new_collection)
+    with ignore_solr_error():
+      cs.delete_collection(new_collection)
+    if geometry_dir:
+      discard_store(geometry_dir, collection)
+    raise
+
+  log.info('linking %s to %s', new_collection, collection)
+  try:
+    cs.alias(new_collection, collection)
+  except Exception:
+    if geometry_dir:
+      discard_store(geometry_dir, collection)
+    raise
+  if geometry_dir:
+    publish_store(geometry_dir, collection)
+
+  if manifest:
+    now = time.time()
+    manifest.save({
+      'collection': collection,
+      'solr_collection': new_collection,
+      'fingerprint': fingerprint(collection, sql_dir=sql_dir, precompute_4326=precompute_4326,
+                                 geometry_lod=geometry_lod),
+      'full_rebuild': now,
+      'updated': now,
+      'rows': rows,
+      'bytes': hashes.bytes,
+      'hashes': os.path.basename(hashes.path),
+      'checksum': hashes.checksum,
+      'marker': marker,
+      'decision': 'full',
+      'reason': reason,
+    })
+
+  result = {
+    'collection': collection,
+    'mode': 'full',
+    'reason': reason,
+    'solr_collection': new_collection,
+    'previous': current,
+    'shards': num_shards,
+    'rows': rows,
+    'batches': num_batches,
+    'warmup': warmup_result,
+    'duration': time.time() - start,
+  }
+  log.info('imported %s: %d rows in %d batches in %.1fs', collection, rows, num_batches,
+           result['duration'])
+  return result
+
+
+def delta_collection(cs, collection, manifest, meta, schema='public', csv_outdir=None,
+                     commit_within=COMMIT_WITHIN, marker=None, geometry_dir=None,
+                     precompute_4326=False, geometry_lod=False, sql_dir=SQL_DIR, **kw):
+  """
+  Export `collection` and post only new and changed rows into the live Solr
+  collection of the manifest `meta`. Rows that are missing in the export are
+  deleted. The manifest and the geometry store are only updated after the
+  final commit. The commit is skipped if the export is identical to the last
+  run.
+  Returns a dict with the number of upserted and deleted rows.
+  """
+  start = time.time()
+  query = load_query(collection, schema=schema, sql_dir=sql_dir,
+                     precompute_4326=precompute_4326, geometry_lod=geometry_lod)
+  solr_collection = meta['solr_collection']
+
+  previous = manifest.load_hashes(meta)
+  hashes = manifest.hash_writer()
+  try:
+    upserts, num_batches = post_export(
+      cs, solr_collection, query,
+      csv_path=output_path(csv_outdir, collection) if csv_outdir else None,
+      hashes=hashes,
+      previous=previous,
+      geometries=GeometryWriter(staging_path(geometry_dir, collection)) if geometry_dir else None,
+      commit_within=commit_within,
+      **kw
+    )
+
+    # previous contains all ids that were not exported
+    deletes = list(previous)
+    for i in range(0, len(deletes), DELETE_BATCH):
+      cs.delete_ids(solr_collection, deletes[i:i + DELETE_BATCH], commit_within=commit_within)
+
+    if upserts or deletes:
+      mode, reason = 'delta', None
+      log.info('committing %d upserts and %d deletes into %s', upserts, len(deletes),
+               solr_collection)
+      cs.commit(solr_collection)
+    else:
+      mode, reason = 'skip', 'rows unchanged'
+      log.info('skipping commit of unchanged %s', collection)
+  except Exception:
+    if geometry_dir:
+      discard_store(geometry_dir, collection)
+    raise
+
+  if geometry_dir:
+    publish_store(geometry_dir, collection)
+  now = time.time()
+  meta = dict(meta, checked=now, rows=hashes.rows, bytes=hashes.bytes,
+              hashes=os.path.basename(hashes.path),
+              checksum=hashes.checksum, marker=marker, decision=mode, reason=reason)
+  if mode == 'delta':
+    meta['updated'] = now
+  manifest.save(meta)
+
+  result = {
+    'collection': collection,
+    'mode': mode,
+    'reason': reason,
+    'solr_collection': solr_collection,
+    'previous': solr_collection,
+    'rows': hashes.rows,
+    'upserts': upserts,
+    'deletes': len(deletes),
+    'batches': num_batches,
+    'duration': time.time() - start,
+  }
+  log.info('updated %s: %d upserts and %d deletes of %d rows in %.1fs', collection, upserts,
+           len(deletes), hashes.rows, result['duration'])
+  return result
+
+
+def rebuild_reason(manifest, meta, alias, fp, full_every=FULL_EVERY, now=None):
+  """
+  Return the reason why the collection needs a full rebuild, or None if a
+  delta update is possible.
+  """
+  if meta is None:
+    return 'no manifest'
+  if meta.get('fingerprint') != fp:
+    return 'schema changed'
+  if meta.get('solr_collection') != alias:
+    return 'alias changed'
+  if not os.path.exists(os.path.join(manifest.directory, meta['hashes'])):
+    return 'no row hashes'
+  if full_every is not None and (now or time.time()) - meta['full_rebuild'] >= full_every:
+    return 'schedule'
+  return None
+
+
+def reindex_collection(cs, collection, manifest_dir=None, full=False, full_every=FULL_EVERY,
+                       shard_policy=None, sql_dir=SQL_DIR, **kw):
+  """
+  Import `collection` with a full rebuild or with a delta update if a
+  `manifest_dir` is set and the manifest of the last run is still valid.
+  New collections are created with the number of shards of `shard_policy`
+  (ShardPolicy) if set.
+  """
+  # options for new collections
+  create_kw = dict((k, kw.pop(k)) for k in ('config_name', 'num_shards', 'replication_factor',
+                                            'warmup') if k in kw)
+
+  def num_shards(meta=None):
+    if not shard_policy:
+      return create_kw
+    size = None
+    if shard_policy.needs_size(collection):
+      size = shards.collection_size(collection, meta, schema=kw.get('schema', 'public'),
+                                    psql=kw.get('psql', 'psql'), sql_dir=sql_dir)
+    n = shard_policy.num_shards(collection, size)
+    log.info('%d shards for %s (%s)', n, collection, size or 'unknown size')
+    return dict(create_kw, num_shards=n)
+
+  if not manifest_dir:
+    return import_collection(cs, collection, sql_dir=sql_dir, **dict(kw, **num_shards()))
+
+  manifest = Manifest(manifest_dir, collection)
+  meta = manifest.load()
+  if full:
+    reason = 'requested'
+  else:
+    alias = cs.list_aliases().json()['aliases'].get(collection)
+    fp = fingerprint(collection, sql_dir=sql_dir,
+                     precompute_4326=kw.get('precompute_4326', False),
+                     geometry_lod=kw.get('geometry_lod', False))
+    reason = rebuild_reason(manifest, meta, alias, fp, full_every=full_every)
+
+  marker = table_marker(collection, kw.get('schema', 'public'), kw.get('psql', 'psql'),
+                        sql_dir=sql_dir)
+  if reason is None:
+    if marker is not None and marker == meta.get('marker'):
+      return skip_collection(collection, manifest, meta)
+    return delta_collection(cs, collection, manifest, meta, marker=marker, sql_dir=sql_dir,
+                            **kw)
+
+  log.info('full rebuild of %s: %s', collection, reason)
+  return import_collection(cs, collection, manifest=manifest, marker=marker, reason=reason,
+                           sql_dir=sql_dir, **dict(kw, **num_shards(meta)))
+
+
+def table_marker(collection, schema, psql, sql_dir=SQL_DIR):
+  """
+  Return the change marker of all tables of `collection` or None if it is
+  not available.
+  """
+  try:
+    return change_marker(source_tables(collection, sql_dir=sql_dir), schema=schema, psql=psql)
+  except ExportError as ex:
+    log.warning('no change marker for %s: %s', collection, ex)
+    return None
+
+
+def skip_collection(collection, manifest, meta):
+  """
+  Record that `collection` was skipped, as no source table changed since the
+  last run.
+  """
+  log.info('skipping %s: tables unchanged', collection)
+  manifest.save(dict(meta, checked=time.time(), decision='skip', reason='tables unchanged'))
+  return {
+    'collection': collection,
+    'mode': 'skip',
+    'reason': 'tables unchanged',
+    'solr_collection': meta['solr_collection'],
+    'previous': meta['solr_collection'],
+    'rows': meta['rows'],
+    'upserts': 0,
+    'deletes': 0,
+    'batches': 0,
+    'duration': 0.0,
+  }
+
+
+def import_all(cs, collections, workers=4, **kw):
+  """
+  Import all `collections` with up to `workers` parallel imports. Returns a
+  list with a result dict for each collection. Failed imports contain an
+  'error' instead of the row count.
+  """
+  def run(collection):
+    try:
+      return reindex_collection(cs, collection, **kw)
+    except Exception as ex:
+      log.error('import of %s failed: %s', collection, ex)
+      return {'collection': collection, 'error': str(ex)}
+
+  with ThreadPoolExecutor(max_workers=workers) as e:
+    return list(e.map(run, collections))
+
+
+def format_results(results, duration):
+  lines = ['{:<24} {:>6} {:>10} {:>8} {:>8} {:>9}'.format(
+    'collection', 'mode', 'rows', 'upserts', 'deletes', 'seconds')]
+  for r in results:
+    if 'error' in r:
+      lines.append('{:<24} {:>6}'.format(r['collection'], 'FAILED'))
+    else:
+      lines.append('{:<24} {:>6} {:>10} {:>8} {:>8} {:>9.1f}'.format(
+        r['collection'], r['mode'], r['rows'], r.get('upserts', r['rows']),
+        r.get('deletes', '-'), r['duration']))
+  lines.append('total: {:.1f}s'.format(duration))
+  return '\n'.join(lines)
+
+
+def main():
+  logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+  )
+  logging.getLogger('urllib3').setLevel(logging.WARN)
+  logging.getLogger('requests').setLevel(logging.WARN)
+
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--url", default="http://localhost:8983/solr")
+  parser.add_argument("--schema", default=os.environ.get('DBSCHEMA', 'public'),
+                      help='database schema (default: $DBSCHEMA or %(default)s)')
+  parser.add_argument("--workers", type=int, default=4,
+                      help='number of parallel imports (default: %(default)s)')
+  parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS,
+                      help='maximum number of rows for each update request '
+                           '(default: %(default)s)')
+  parser.add_argument("--batch-mb", type=float, default=BATCH_BYTES / 1024 / 1024,
+                      help='maximum size of each update request in MB (default: %(default)s)')
+  parser.add_argument("--commit-within", type=int, default=COMMIT_WITHIN,
+                      help='commitWithin for each batch in ms (default: %(default)s)')
+  parser.add_argument("--csv-outdir",
+                      help='also write the exported <collection>.csv.gz into this directory')
+  parser.add_argument("--manifest-dir",
+                      help='directory for manifests with row hashes, enables delta updates')
+  parser.add_argument("--geometry-dir",
+                      help='write a geometry store <collection>.geom into this directory')
+  parser.add_argument("--full", action='store_true',
+                      help='full rebuild of all collections, even with a valid manifest')
+  parser.add_argument("--full-every", type=float, default=FULL_EVERY / 86400,
+                      help='full rebuild if the last one is older than this number of days '
+                           '(default: %(default)s)')
+  shards.add_arguments(parser)
+  parser.add_argument("--solr-replication-factor", type=int, default=2,
+                      help='replication factor for new collections')
+  parser.add_argument("--sql-dir", default=SQL_DIR,
+                      help='directory with <collection>.sql files')
+  parser.add_argument("--psql", default='psql', help='psql executable')
+  parser.add_argument("--precompute-4326", action='store_true',
+                      help='add the geometry, centroid and bbox in EPSG:4326')
+  parser.add_argument("--geometry-lod", action='store_true',
+                      help='add simplified geometries (see geocodr_mv.export)')
+  warmup.add_arguments(parser)
+  parser.add_argument("--report", help='write JSON report with rows and durations to this file')
+  parser.add_argument('collections', metavar='COLLECTION', nargs='*',
+                      help='collections to import (default: all)')
+
+  args = parser.parse_args()
+  try:
+    shard_policy = shards.policy(args)
+  except ValueError as ex:
+    parser.error(str(ex))
+
+  collections = args.collections or available_collections(args.sql_dir)
+  for d in (args.csv_outdir, args.manifest_dir, args.geometry_dir):
+    if d and not os.path.isdir(d):
+      os.makedirs(d)
+
+  cs = SolrCloud(args.url)
+  warmup_func = None
+  if args.warmup_queries:
+    queries = warmup.load_queries(args.warmup_queries, top=args.warmup_top)
+    mapping_collections = warmup.mapping_collections(args.mapping)
+
+    def warmup_func(collection, solr_collection):
+      return warmup.warmup_collection(
+        lambda params: cs.select(solr_collection, params),
+        mapping_collections.get(collection, []),
+        queries,
+        **warmup.options(args)
+      )
+
+  start = time.time()
+  results = import_all(
+    cs,
+    collections,
+    workers=args.workers,
+    schema=args.schema,
+    shard_policy=shard_policy,
+    replication_factor=args.solr_replication_factor,
+    batch_rows=args.batch_rows,
+    batch_bytes=int(args.batch_mb * 1024 * 1024),
+    commit_within=args.commit_within,
+    csv_outdir=args.csv_outdir,
+    geometry_dir=args.geometry_dir,
+    manifest_dir=args.manifest_dir,
+    full=args.full,
+    full_every=args.full_every * 86400,
+    warmup=warmup_func,
+    psql=args.psql,
+    sql_dir=args.sql_dir,
+    precompute_4326=args.precompute_4326,
+    geometry_lod=args.geometry_lod,
+  )
+  duration = time.time() - start
+  print(format_results(results, duration))
+
+  report = {'start': start, 'duration': duration, 'collections': results}
+  if args.report:
+    with open(args.report, 'w') as f:
+      json.dump(report, f, indent=2)
+  if args.manifest_dir:
+    # decisions (full, delta, skip) of the last run
+    with AtomicFile(os.path.join(args.manifest_dir, 'reindex.json')) as f:
+      f.write(json.dumps(report, indent=2).encode('utf-8'))
+
+  if any('error' in r for r in results):
+    sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
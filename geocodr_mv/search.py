@@ -0,0 +1,543 @@
+"""
+The search module contains the base classes for the collections of the
+mapping (conf/geocodr_mapping.py), as geocodr.search.
+
+Collection extends the collections of geocodr with the query building of
+geocodr_mv.api: the query budget (shape_query and QueryShape), the
+parameterized queries (query_params, field_query), the sort and page fields
+of the two-phase requests and the conversion into features with
+precomputed, pre-simplified and rounded geometries. UnifiedCollection
+queries several collections that are indexed in a single Solr collection.
+"""
+
+import json
+import re
+import threading
+
+import numpy
+import pyproj
+import shapely
+import shapely.geometry
+import shapely.wkt
+
+from geocodr import proj
+from geocodr.lib.geom import point_on_geom
+from geocodr.search import (
+  Collection as BaseCollection,
+  Exclusive,
+  GermanNGramField,
+  NGramField,
+  Only,
+  PatternReplace,
+  PrefixField,
+  SimpleField,
+  is_exclusive,
+)
+
+
+epsg_4326 = proj.epsg(4326)
+
+_transformers = threading.local()
+
+
+def transform(src, dst, geom):
+  """
+  Transform `geom` from `src` into `dst` projection, as geocodr.proj.transform.
+  The Transformer is created once for each thread and all coordinates are
+  transformed at once.
+  """
+  key = (src.srs, dst.srs)
+  transformer = _transformers.__dict__.get(key)
+  if transformer is None:
+    transformer = pyproj.Transformer.from_crs(src, dst, always_xy=True)
+    _transformers.__dict__[key] = transformer
+
+  def transform_coords(coords):
+    return numpy.column_stack(transformer.transform(coords[:, 0], coords[:, 1]))
+
+  return shapely.transform(geom, transform_coords)
+
+
+def round_coords(geom, precision):
+  """
+  Round all coordinates of `geom` to `precision` decimal places.
+  """
+  return shapely.transform(geom, lambda coords: numpy.round(coords, precision))
+
+
+def ngram_count(qfield, term):
+  """
+  Return the number of n-grams that `qfield` queries for `term`.
+  """
+  if isinstance(qfield, PatternReplace):
+    return ngram_count(qfield.qfield, qfield.regexp.sub(qfield.repl, term))
+  if isinstance(qfield, Only):
+    return ngram_count(qfield.qfield, term) if qfield.regexp.match(term) else 0
+  if isinstance(qfield, GermanNGramField):
+    term = qfield.normalize_german(term.lower())
+  if isinstance(qfield, NGramField):
+    return len(qfield.tokenize(term))
+  return 0
+
+
+def is_ngram_field(qfield):
+  if isinstance(qfield, (PatternReplace, Only)):
+    return is_ngram_field(qfield.qfield)
+  return isinstance(qfield, NGramField)
+
+
+# minimum match of NGramField
+NGRAM_MM = '2<-1 4<-2 6<-3 8<-4'
+
+
+# reference of a dereferenced parameter in a query template
+re_param_ref = re.compile(r'\$(\w+)')
+
+
+def add_param(params, prefix, value):
+  """
+  Add `value` to `params` and return its name. Equal values share one name.
+  """
+  for name, v in params.items():
+    if v == value:
+      return name
+  name = '{}{}'.format(prefix, len(params) + 1)
+  params[name] = value
+  return name
+
+
+def field_query(qfield, term, params=None):
+  """
+  Return the query of `qfield` for `term`. With `params` (dict), the same
+  query as qfield.query is built as a template and the term (or the n-grams)
+  is added as a parameter that is dereferenced by the template (e.g.
+  `{!df=strasse_name v=$t1}` instead of `strasse_name:rostock`). The
+  minimum match of all n-gram queries is passed once as `mm`.
+  """
+  if params is None:
+    return qfield.query(term)
+  if isinstance(qfield, Only):
+    if not qfield.regexp.match(term):
+      return None
+    q = field_query(qfield.qfield, term, params)
+    return Exclusive(q) if q else None
+  if isinstance(qfield, PatternReplace):
+    return field_query(qfield.qfield, qfield.regexp.sub(qfield.repl, term), params)
+  if isinstance(qfield, NGramField):
+    if isinstance(qfield, GermanNGramField):
+      term = qfield.normalize_german(term.lower())
+    grams = qfield.tokenize(term)
+    if not grams:
+      return None
+    params.setdefault('mm', NGRAM_MM)
+    return '{{!edismax qf={0} v=${1} mm=$mm}}^{2:.2}'.format(
+      qfield.field, add_param(params, 'g', ' '.join(grams)), 1.0 / len(grams) * qfield.boost)
+  if isinstance(qfield, PrefixField):
+    if len(term) < qfield.min_term:
+      return None
+    value = term + '*'
+  elif isinstance(qfield, SimpleField):
+    if not term:
+      return None
+    value = term
+  else:
+    return qfield.query(term)
+  q = '{{!df={} v=${}}}'.format(qfield.field, add_param(params, 't', value))
+  if qfield.boost != 1.0:
+    q += '^{:.2}'.format(qfield.boost)
+  return q
+
+
+class QueryShape(object):
+  """
+  Terms of a query after Collection.shape_query. `strategy` is `full`,
+  `dedup` (duplicate terms removed), `selective` (only the longest terms) or
+  `simple` (no n-gram fields). `grams` is the number of n-grams of all terms.
+  """
+
+  def __init__(self, terms, strategy='full', grams=0, dropped=()):
+    self.terms = terms
+    self.strategy = strategy
+    self.grams = grams
+    self.dropped = list(dropped)
+
+  def as_mapping(self):
+    return {
+      'terms': self.terms,
+      'strategy': self.strategy,
+      'grams': self.grams,
+      'dropped': self.dropped,
+    }
+
+
+class Collection(BaseCollection):
+  """
+  Base class for the collections of the mapping, with the query building
+  and the conversion into features of geocodr_mv.api. Project dependent
+  options (projection, field names) are set by the mapping.
+  """
+  # number of rows that geocodr_mv.api requests for each query (at least
+  # limit + offset) and the maximum number of rows to fetch for docs that can
+  # tie with the last requested doc (see score_tie_ratio)
+  min_rows = 100
+  max_rows = 1000
+  # to_features aligns the score of each doc to the previous score within
+  # this ratio
+  score_tie_ratio = 1.0
+
+  # geocodr_mv.api sorts the docs of all collections with the fields of
+  # sort_field_list (score, sort_fields, align_score_fields and
+  # tiebreaker_fields) and loads the json blob, the fields and the geometry
+  # (page_field_list) only for the features of the requested page.
+  # tiebreaker_fields lists all fields that sort_tiebreaker reads besides
+  # sort_fields.
+  tiebreaker_fields = ()
+  # return only these keys of the json blob as properties (all keys if None)
+  json_keys = None
+  # doc key with the geometry from a geometry store (geocodr_mv.geomstore),
+  # used instead of the WKT of geometry_field
+  geometry_record_key = '_geometry_'
+  # query budget of shape_query: maximum number of terms and n-grams
+  max_query_terms = 6
+  max_query_grams = 100
+  # boolean field that is true for historic records (excluded by
+  # geocodr_mv.api with historic=false)
+  historic_field = None
+  # search queries are answered by geocodr_mv.localindex (small collections
+  # with SimpleField, PrefixField and NGramField queries only)
+  local_index = False
+  # fields with the precomputed geometry for each shape in EPSG:4326, used
+  # if precomputed_4326 is set
+  precomputed_4326 = False
+  precomputed_fields = {}
+  # fields with geometries that are simplified with each tolerance (in the
+  # units of src_proj), used if geometry_lod is set
+  geometry_lod = False
+  lod_fields = {}
+
+  @property
+  def sort_field_list(self):
+    names = set(self.sort_fields) | set(self.tiebreaker_fields)
+    names.update(getattr(self, 'align_score_fields', ()))
+    return ','.join(['id', 'score'] + sorted(names))
+
+  @property
+  def page_fields(self):
+    return ['id', self.jsonblob_field] + list(self.fields)
+
+  @property
+  def page_field_list(self):
+    return ','.join(self.page_fields + ['{0}:[geo f={0} w=WKT]'.format(self.geometry_field)])
+
+  def precomputed_field(self, dst_proj, shape, distance_pt=None, simplify=None):
+    """
+    Return the field with the precomputed geometry for `dst_proj` and
+    `shape` or None. The distance is calculated with the original geometry.
+    """
+    if not self.precomputed_4326 or distance_pt or not dst_proj:
+      return None
+    if simplify and shape == 'geometry':
+      # simplify with the tolerance in the units of src_proj
+      return None
+    if dst_proj.srs != epsg_4326.srs:
+      return None
+    return self.precomputed_fields.get(shape)
+
+  def lod_field(self, shape, simplify=None, distance_pt=None):
+    """
+    Return the field with the most simplified geometry that is within the
+    `simplify` tolerance or None.
+    """
+    if not self.geometry_lod or not simplify or distance_pt or shape != 'geometry':
+      return None
+    tolerances = [t for t in self.lod_fields if t <= simplify]
+    if not tolerances:
+      return None
+    return self.lod_fields[max(tolerances)]
+
+  def shape_query(self, query):
+    """
+    Return the QueryShape of `query`. Duplicate terms are removed. Only the
+    longest (most selective) `max_query_terms` terms are kept and n-gram
+    fields are not queried if the terms have more than `max_query_grams`
+    n-grams.
+    """
+    terms, dropped = [], []
+    seen = set()
+    for term in query.split(' '):
+      if not term:
+        continue
+      if term.lower() in seen:
+        dropped.append(term)
+        continue
+      seen.add(term.lower())
+      terms.append(term)
+    strategy = 'dedup' if dropped else 'full'
+
+    if len(terms) > self.max_query_terms:
+      keep = sorted(range(len(terms)), key=lambda i: (-len(terms[i]), i))
+      keep = sorted(keep[:self.max_query_terms])
+      dropped.extend(t for i, t in enumerate(terms) if i not in keep)
+      terms = [terms[i] for i in keep]
+      strategy = 'selective'
+
+    grams = sum(ngram_count(f, t) for f in self.qfields for t in terms)
+    if grams > self.max_query_grams:
+      strategy = 'simple'
+    return QueryShape(terms, strategy, grams, dropped)
+
+  def query_shapes(self, query):
+    """
+    Return a list with the name and the QueryShape of each queried
+    collection.
+    """
+    return [(self.name, self.shape_query(query))]
+
+  def queries_for_term(self, term, qfields=None, params=None):
+    """
+    Build queries for `term` in `qfields` (default: all qfields), as
+    geocodr.search.Collection. The terms are passed as separate Solr
+    parameters if `params` is a dict (see field_query).
+    """
+    parts = []
+    for f in self.qfields if qfields is None else qfields:
+      part = field_query(f, term, params)
+      if part:
+        parts.append(part)
+    # only use exclusive parts (Only) if at least one part is exclusive
+    if any(is_exclusive(part) for part in parts):
+      parts = [p for p in parts if is_exclusive(p)]
+    return ' OR '.join(parts)
+
+  def build_query(self, query, params=None):
+    """
+    Return the Solr query for `query`. All terms and n-grams are added to
+    `params` and dereferenced by the query if `params` is a dict.
+    """
+    if params is not None and type(self).query is not Collection.query:
+      # custom queries (e.g. parcel numbers) are not parameterized
+      return self.query(query)
+    shape = self.shape_query(query)
+    qfields = None
+    if shape.strategy == 'simple':
+      qfields = [f for f in self.qfields if not is_ngram_field(f)]
+    qparts = []
+    for term in shape.terms:
+      qparts.append('_query_:"{{!maxscore tie=0}}({})"'.format(
+        self.queries_for_term(term, qfields, params)))
+    return ' AND '.join(qparts)
+
+  def expand_query(self, query):
+    """
+    Return `query` before it is split into terms (e.g. with a prefix for
+    numbers), used by custom `query` methods and geocodr_mv.localindex.
+    """
+    return query
+
+  def query(self, query):
+    return self.build_query(query)
+
+  def query_params(self, query):
+    """
+    Return the Solr parameters for `query` with the query template in `q`
+    and the terms (t1, t2, ...) and n-grams (g1, g2, ...) as separate
+    parameters. The template is the same for all queries with the same
+    number of terms, grams and repeated values.
+    """
+    params = {}
+    q = self.build_query(query, params)
+    # parameters of dropped parts (e.g. non-exclusive parts)
+    used = set(re_param_ref.findall(q or ''))
+    params = dict((k, v) for k, v in params.items() if k in used)
+    params['q'] = q
+    return params
+
+  def align_scores(self, docs):
+    """
+    Align the scores of `docs` (in place) before they are sorted.
+    """
+    pass
+
+  def ranked_docs(self, docs):
+    """
+    Align the scores of `docs` and return them in the order of to_features.
+    """
+    self.align_scores(docs)
+    return docs
+
+  def to_features(self, docs, dst_proj=proj.epsg(4326), distance_pt=None, shape='geometry',
+                  align_scores=True, simplify=None, precision=None):
+    """
+    Convert `docs` into GeoJSON features, as geocodr.search.Collection.
+    Precomputed geometries for `dst_proj` and `shape` (precomputed_field)
+    are used without reprojection if available. Otherwise the geometry is
+    taken from the geometry record of each doc or from the WKT. The bbox and
+    centroid of the record are used if the geometry is not reprojected.
+
+    Geometries are simplified with the `simplify` tolerance (in the units
+    of src_proj, starting with the pre-simplified geometry of lod_field) and
+    all coordinates are rounded to `precision` decimal places.
+    """
+    if align_scores:
+      self.align_scores(docs)
+
+    precomputed_field = self.precomputed_field(dst_proj, shape, distance_pt, simplify)
+    lod_field = self.lod_field(shape, simplify, distance_pt)
+    if distance_pt:
+      distance_pt = shapely.geometry.Point(*distance_pt)
+    reproject = dst_proj and self.src_proj and dst_proj.srs != self.src_proj.srs
+    keep = None
+    if self.json_keys is not None:
+      keep = set(self.json_keys) | set(self.fields) | set([
+        self.distance_attrib, self.collection_title_attrib, self.class_title_attrib])
+
+    features = []
+    for doc in docs:
+      prop = {}
+      if self.jsonblob_field:
+        prop = json.loads(doc[self.jsonblob_field])
+
+      precomputed = doc.get(precomputed_field) if precomputed_field else None
+      record = doc.get(self.geometry_record_key)
+      if precomputed:
+        geom = None
+      elif record is not None and not reproject and not distance_pt and shape != 'geometry':
+        geom = None
+      elif lod_field and doc.get(lod_field):
+        geom = shapely.wkt.loads(doc[lod_field])
+      elif record is not None:
+        geom = record.geometry()
+      else:
+        geom = shapely.wkt.loads(doc[self.geometry_field])
+
+      if distance_pt:
+        dist = 0
+        if not geom.contains(distance_pt):
+          dist = geom.distance(distance_pt)
+        prop[self.distance_attrib] = dist
+        # also add as _distance_ for sorting reverse geocoder results
+        prop['_distance_'] = dist
+        prop['_collection_rank_'] = self.collection_rank
+
+      if simplify and shape == 'geometry':
+        geom = geom.simplify(simplify, preserve_topology=True)
+
+      if reproject and geom is not None:
+        geom = transform(self.src_proj, dst_proj, geom)
+
+      for f in self.fields:
+        prop[f] = doc.get(f)
+
+      prop['_score_'] = doc['score']
+      prop['_sort_tiebreaker_'] = self.sort_tiebreaker(doc)
+      prop['_id_'] = doc['id']
+      prop['_collection_'] = self.name
+      prop['_class_'] = self.class_
+      prop['_title_'] = self.to_title(prop)
+      prop[self.collection_title_attrib] = self.title
+      prop[self.class_title_attrib] = self.class_title
+      if keep is not None:
+        for k in list(prop):
+          if k not in keep and not k.startswith('_'):
+            del prop[k]
+
+      if precomputed:
+        geom = shapely.wkt.loads(precomputed)
+        if shape == 'bbox':
+          # same ring order as the envelope of the reprojected geometry
+          geom = geom.envelope
+      elif shape == 'centroid':
+        geom = record.point() if geom is None else point_on_geom(geom.centroid)
+      elif shape == 'bbox':
+        geom = record.bbox() if geom is None else geom.envelope
+
+      if precision is not None:
+        geom = round_coords(geom, precision)
+
+      features.append({
+        'type': 'Feature',
+        'geometry': shapely.geometry.mapping(geom),
+        'properties': prop,
+      })
+    return features
+
+
+class UnifiedCollection(Collection):
+  """
+  Collection for a Solr collection with the documents of all `members`.
+  `type_field` contains the name of the member collection of each document.
+  The query combines the queries of all members, each restricted to the
+  documents of the member and boosted by `type_boosts`. The results are
+  converted by the member collections, so that titles (objektgruppe),
+  tiebreakers and score alignment are the same as for separate collections.
+  The results of separate collections are merged by their scores without
+  weights, so members without `type_boosts` keep this order (the scores
+  only differ by the term statistics of the combined collection).
+  """
+  type_field = 'typ'
+  members = ()
+  type_boosts = {}
+
+  @property
+  def historic_field(self):
+    for member in self.members:
+      if member.historic_field:
+        return member.historic_field
+
+  def build_query(self, query, params=None):
+    parts = []
+    for member in self.members:
+      if len(query.strip()) < member.min_query_length:
+        continue
+      q = member.build_query(query, params)
+      if not q:
+        continue
+      parts.append('(filter({}:{}) AND ({}))^{}'.format(
+        self.type_field, member.name, q, self.type_boosts.get(member.name, 1.0)))
+    if not parts:
+      return
+    return ' OR '.join(parts)
+
+  def query_shapes(self, query):
+    return [(member.name, member.shape_query(query)) for member in self.members
+            if len(query.strip()) >= member.min_query_length]
+
+  @property
+  def sort_field_list(self):
+    names = set([self.type_field])
+    for member in self.members:
+      names.update(member.sort_field_list.split(','))
+    return ','.join(['id', 'score'] + sorted(names - set(['id', 'score'])))
+
+  @property
+  def page_fields(self):
+    fields = ['id', self.jsonblob_field, self.type_field]
+    for member in self.members:
+      fields.extend(f for f in member.fields if f not in fields)
+    return fields
+
+  def member(self, doc):
+    for member in self.members:
+      if member.name == doc[self.type_field]:
+        return member
+
+  def docs_by_member(self, docs):
+    docs_by_type = {}
+    for doc in docs:
+      docs_by_type.setdefault(doc[self.type_field], []).append(doc)
+    return [(m, docs_by_type[m.name]) for m in self.members if m.name in docs_by_type]
+
+  def ranked_docs(self, docs):
+    ranked = []
+    for member, member_docs in self.docs_by_member(docs):
+      ranked.extend(member.ranked_docs(member_docs))
+    return ranked
+
+  def sort_tiebreaker(self, doc):
+    return self.member(doc).sort_tiebreaker(doc)
+
+  def to_features(self, docs, **kw):
+    features = []
+    for member, member_docs in self.docs_by_member(docs):
+      features.extend(member.to_features(member_docs, **kw))
+    return features
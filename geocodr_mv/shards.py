@@ -0,0 +1,244 @@
+"""
+The shards module chooses the number of shards for new SolrCloud collections
+from the size of each collection and compares the query latency of different
+shard layouts.
+
+Small collections (gemeinden, postleitzahlengebiete, ...) are created with a
+single shard: distributed search adds latency and the scores depend on the
+document counts of each shard. Large collections get one shard for each
+DOCS_PER_SHARD documents or BYTES_PER_SHARD bytes (CSV export), up to
+MAX_SHARDS. The size is taken from the manifest of the last import or
+estimated from the PostgreSQL statistics of the source tables.
+
+As a benchmark (python -m geocodr_mv.shards), each collection is imported
+from PostgreSQL into temporary collections with different shard counts
+(e.g. --shards 1,2). The most frequent queries of a query log are sent to
+each layout after a warmup and the latency percentiles are reported.
+"""
+
+import argparse
+import json
+import logging
+import math
+import sys
+
+from geocodr_import.solr import ignore_solr_error
+
+from geocodr_mv.export import ExportError, load_query, source_tables, table_size
+from geocodr_mv.loadtest import percentile
+from geocodr_mv import warmup
+
+
+log = logging.getLogger('geocodr_mv.shards')
+
+DEFAULT_SHARDS = 2
+DOCS_PER_SHARD = 2000000
+BYTES_PER_SHARD = 2 * 1024 * 1024 * 1024
+MAX_SHARDS = 4
+
+
+def shard_count(rows, bytes=None, docs_per_shard=DOCS_PER_SHARD,
+                bytes_per_shard=BYTES_PER_SHARD, max_shards=MAX_SHARDS):
+  """
+  Return the number of shards for a collection with `rows` documents and
+  `bytes` bytes.
+  """
+  n = math.ceil(rows / docs_per_shard)
+  if bytes:
+    n = max(n, math.ceil(bytes / bytes_per_shard))
+  return min(max(n, 1), max_shards)
+
+
+def parse_overrides(values):
+  """
+  Parse a list of `collection=shards` values (comma separated or repeated).
+  """
+  overrides = {}
+  for value in values or []:
+    for part in value.split(','):
+      if not part.strip():
+        continue
+      name, sep, n = part.partition('=')
+      if not sep or not n.strip().isdigit() or int(n) < 1:
+        raise ValueError('invalid shard override {!r}, expected collection=shards'.format(part))
+      overrides[name.strip()] = int(n)
+  return overrides
+
+
+class ShardPolicy(object):
+  """
+  Number of shards for new collections. `overrides` (dict) sets the number of
+  shards for single collections, `fixed` for all other collections. Without
+  `fixed`, the number is derived from the size of the collection.
+  """
+
+  def __init__(self, overrides=None, fixed=None, docs_per_shard=DOCS_PER_SHARD,
+               bytes_per_shard=BYTES_PER_SHARD, max_shards=MAX_SHARDS):
+    self.overrides = overrides or {}
+    self.fixed = fixed
+    self.docs_per_shard = docs_per_shard
+    self.bytes_per_shard = bytes_per_shard
+    self.max_shards = max_shards
+
+  def needs_size(self, collection):
+    return collection not in self.overrides and not self.fixed
+
+  def num_shards(self, collection, size=None):
+    """
+    Return the number of shards for `collection`. `size` is a dict with the
+    number of `rows` and `bytes` or None if the size is unknown.
+    """
+    if collection in self.overrides:
+      return self.overrides[collection]
+    if self.fixed:
+      return self.fixed
+    if not size or not size.get('rows'):
+      return DEFAULT_SHARDS
+    return shard_count(size['rows'], size.get('bytes'), docs_per_shard=self.docs_per_shard,
+                       bytes_per_shard=self.bytes_per_shard, max_shards=self.max_shards)
+
+
+def collection_size(collection, meta=None, schema='public', psql='psql', sql_dir=None):
+  """
+  Return the size of `collection` from the manifest `meta` of the last import
+  or estimated from PostgreSQL. Returns None if the size is unknown.
+  """
+  if meta and meta.get('rows') is not None:
+    return {'rows': meta['rows'], 'bytes': meta.get('bytes')}
+  kw = {'sql_dir': sql_dir} if sql_dir else {}
+  try:
+    return table_size(source_tables(collection, **kw), schema=schema, psql=psql)
+  except ExportError as ex:
+    log.warning('no size estimate for %s: %s', collection, ex)
+    return None
+
+
+def add_arguments(parser):
+  parser.add_argument("--solr-num-shards", type=int,
+                      help='number of shards for all new collections without --shards '
+                           '(default: from the size of each collection)')
+  parser.add_argument("--shards", action='append', metavar='COLLECTION=N',
+                      help='number of shards for a single collection, also with '
+                           '--solr-num-shards (repeat or separate with commas)')
+  parser.add_argument("--docs-per-shard", type=int, default=DOCS_PER_SHARD,
+                      help='documents for each shard (default: %(default)s)')
+  parser.add_argument("--max-shards", type=int, default=MAX_SHARDS,
+                      help='maximum number of shards (default: %(default)s)')
+
+
+def policy(args):
+  return ShardPolicy(
+    overrides=parse_overrides(args.shards),
+    fixed=args.solr_num_shards,
+    docs_per_shard=args.docs_per_shard,
+    max_shards=args.max_shards,
+  )
+
+
+def benchmark_layout(cs, collection, num_shards, params, schema='public', psql='psql',
+                     replication_factor=1, rounds=5, keep=False):
+  """
+  Import `collection` into a new collection with `num_shards` shards, warm it
+  up and send all `params` in `rounds` rounds. Returns the latency
+  percentiles (ms).
+  """
+  from geocodr_mv.reindex import post_export
+
+  bench_collection = '{}-shards{}'.format(collection, num_shards)
+  with ignore_solr_error():
+    cs.delete_collection(bench_collection)
+  cs.create_collection(bench_collection, config_name=collection, num_shards=num_shards,
+                       replication_factor=replication_factor)
+  try:
+    rows, _ = post_export(cs, bench_collection, load_query(collection, schema=schema),
+                          psql=psql)
+    cs.commit(bench_collection)
+
+    def select(p):
+      return cs.select(bench_collection, p)
+
+    w = warmup.Warmup(select, params)
+    w.run()
+    latencies = []
+    for _ in range(rounds):
+      latencies.extend(w.round())
+    latencies.sort()
+  finally:
+    if not keep:
+      with ignore_solr_error():
+        cs.delete_collection(bench_collection)
+
+  return {
+    'collection': collection,
+    'shards': num_shards,
+    'rows': rows,
+    'requests': len(latencies),
+    'p50': percentile(latencies, 50) * 1000 if latencies else 0.0,
+    'p95': percentile(latencies, 95) * 1000 if latencies else 0.0,
+    'p99': percentile(latencies, 99) * 1000 if latencies else 0.0,
+  }
+
+
+def format_results(results):
+  lines = ['{:<24} {:>6} {:>10} {:>8} {:>8} {:>8} {:>8}'.format(
+    'collection', 'shards', 'rows', 'requests', 'p50 ms', 'p95 ms', 'p99 ms')]
+  for r in results:
+    lines.append('{:<24} {:>6} {:>10} {:>8} {:>8.1f} {:>8.1f} {:>8.1f}'.format(
+      r['collection'], r['shards'], r['rows'], r['requests'], r['p50'], r['p95'], r['p99']))
+  return '\n'.join(lines)
+
+
+def main():
+  logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+  )
+  logging.getLogger('urllib3').setLevel(logging.WARN)
+
+  from geocodr_mv.reindex import SolrCloud
+
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--url", default="http://localhost:8983/solr")
+  parser.add_argument("--schema", default='public', help='database schema')
+  parser.add_argument("--psql", default='psql', help='psql executable')
+  parser.add_argument("--shards", default='1,2',
+                      help='shard counts to compare (default: %(default)s)')
+  parser.add_argument("--replication-factor", type=int, default=1,
+                      help='replication factor of the benchmark collections')
+  parser.add_argument("--rounds", type=int, default=5,
+                      help='measured rounds after the warmup (default: %(default)s)')
+  parser.add_argument("--queries", required=True, help='log file with one query per line')
+  parser.add_argument("--top", type=int, default=warmup.TOP_QUERIES,
+                      help='number of most frequent queries (default: %(default)s)')
+  parser.add_argument("--mapping", default=warmup.MAPPING)
+  parser.add_argument("--keep", action='store_true',
+                      help='keep the benchmark collections (<collection>-shards<N>)')
+  parser.add_argument("--json", action='store_true', help='print results as JSON')
+  parser.add_argument('collections', metavar='COLLECTION', nargs='+')
+  args = parser.parse_args()
+
+  cs = SolrCloud(args.url)
+  queries = warmup.load_queries(args.queries, top=args.top)
+  mapping = warmup.mapping_collections(args.mapping)
+  results = []
+  for collection in args.collections:
+    params = warmup.solr_params(mapping.get(collection, []), queries)
+    if not params:
+      parser.error('no queries for collection {}'.format(collection))
+    for n in (int(v) for v in args.shards.split(',')):
+      log.info('benchmark of %s with %d shards', collection, n)
+      results.append(benchmark_layout(
+        cs, collection, n, params, schema=args.schema, psql=args.psql,
+        replication_factor=args.replication_factor, rounds=args.rounds, keep=args.keep,
+      ))
+
+  if args.json:
+    json.dump(results, sys.stdout, indent=2)
+    print()
+  else:
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+  main()
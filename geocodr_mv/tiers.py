@@ -0,0 +1,122 @@
+"""
+The tiers module implements the tiered query mode of geocodr_mv.api
+(--tiered).
+
+The collections of a request are queried in tiers, ordered by their
+collection_rank (gemeinden before gemeindeteile before strassen and
+adressen) and the sum of the qfield boosts. Collections of the same rank are
+queried concurrently. After each tier, a collection of the following tiers is
+skipped if the result page (limit + offset) is already filled with features
+that have a higher score than the score ceiling of the collection. Skipped
+collections are not included in features_total.
+
+Solr scores are not bounded, so the score ceiling of each collection is
+learned from the maximum score of previous queries with the same number of
+terms (ScoreCeilings), multiplied by a safety margin (at least the
+score_tie_ratio of the collection). Collections are never skipped before
+`min_samples` queries are observed and all tiers are queried for a fraction
+of the requests (`probe_ratio`) so that the ceilings follow new data.
+"""
+
+import heapq
+import random
+import threading
+
+
+# ceiling = maximum observed score * margin
+MARGIN = 1.2
+# number of observed queries before a collection can be skipped
+MIN_SAMPLES = 50
+# fraction of requests that query all tiers to update the ceilings
+PROBE_RATIO = 0.05
+# queries with more terms share the ceiling of this number of terms
+MAX_TERMS = 4
+
+
+def query_terms(query):
+  return min(len(query.split()), MAX_TERMS)
+
+
+def boost_sum(collection):
+  return sum(getattr(f, 'boost', 1.0) for f in getattr(collection, 'qfields', ()))
+
+
+def tiers(collections):
+  """
+  Return `collections` as a list of tiers (lists of collections with the
+  same collection_rank), ordered by collection_rank and boosts.
+  """
+  ordered = sorted(collections, key=lambda c: (c.collection_rank, -boost_sum(c)))
+  result = []
+  for collection in ordered:
+    if result and result[-1][0].collection_rank == collection.collection_rank:
+      result[-1].append(collection)
+    else:
+      result.append([collection])
+  return result
+
+
+def page_score(features, needed):
+  """
+  Return the lowest score of the first `needed` `features` or None if there
+  are fewer features.
+  """
+  if not needed or len(features) < needed:
+    return None
+  return heapq.nlargest(needed, (f['properties']['_score_'] for f in features))[-1]
+
+
+class ScoreCeilings(object):
+  """
+  Learned score ceilings of all collections.
+  """
+
+  def __init__(self, margin=MARGIN, min_samples=MIN_SAMPLES, probe_ratio=PROBE_RATIO,
+               rnd=random):
+    self.margin = margin
+    self.min_samples = min_samples
+    self.probe_ratio = probe_ratio
+    self.rnd = rnd
+    # (collection name, terms) -> [samples, max score]
+    self._scores = {}
+    self._lock = threading.Lock()
+
+  def observe(self, collection, query, docs):
+    """
+    Record the maximum score of `docs` (Solr docs of `collection` for
+    `query`).
+    """
+    score = max((d['score'] for d in docs), default=0.0)
+    key = (collection.name, query_terms(query))
+    with self._lock:
+      stats = self._scores.setdefault(key, [0, 0.0])
+      stats[0] += 1
+      stats[1] = max(stats[1], score)
+
+  def ceiling(self, collection, query):
+    """
+    Return the score ceiling of `collection` for `query` or None if it is
+    unknown.
+    """
+    with self._lock:
+      samples, score = self._scores.get((collection.name, query_terms(query)), (0, 0.0))
+    if samples < self.min_samples:
+      return None
+    return score * max(self.margin, getattr(collection, 'score_tie_ratio', 1.0))
+
+  def probe(self):
+    """
+    Return True if the next request should query all tiers.
+    """
+    return self.rnd.random() < self.probe_ratio
+
+  def skip(self, collection, query, features, needed):
+    """
+    Return True if no doc of `collection` can be sorted into the first
+    `needed` `features`.
+    """
+    ceiling = self.ceiling(collection, query)
+    if ceiling is None:
+      return False
+    score = page_score(features, needed)
+    return score is not None and ceiling < score
@@ -0,0 +1,251 @@
+"""
+The warmup module replays frequent queries against a new Solr collection
+before the alias is swapped, so that the first users do not hit a cold
+searcher.
+
+Queries are read from a log file with one query per line (optionally
+prefixed with a count and a tab, as in the output of `sort | uniq -c`).
+The queries are normalized like geocodr requests and the N most frequent
+ones are converted into Solr queries with `Collection.query` of the mapping.
+The query set is repeated in rounds until the median latency of a round
+changes by less than the tolerance.
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from geocodr.mapping import load_collections
+from geocodr.solr import Solr, strip_special_chars
+
+from geocodr_mv.api import collection_rows, search_field_list
+from geocodr_mv.loadtest import percentile
+
+
+log = logging.getLogger('geocodr_mv.warmup')
+
+MAPPING = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'conf',
+                                       'geocodr_mapping.py'))
+
+TOP_QUERIES = 200
+TOLERANCE = 0.1
+MIN_ROUNDS = 2
+MAX_ROUNDS = 10
+MAX_DURATION = 300
+CONCURRENCY = 4
+
+re_count = re.compile(r'^\s*(\d+)[\t ](.*)$')
+
+
+def load_queries(path, top=TOP_QUERIES):
+  """
+  Return the `top` most frequent normalized queries from the log file `path`.
+  """
+  counts = Counter()
+  with open(path, 'r', encoding='utf-8') as f:
+    for line in f:
+      line = line.rstrip('\n')
+      count = 1
+      m = re_count.match(line)
+      if m:
+        count, line = int(m.group(1)), m.group(2)
+      query = strip_special_chars(line)
+      if query:
+        counts[query] += count
+  return [q for q, _ in counts.most_common(top)]
+
+
+def solr_params(collections, queries):
+  """
+  Return the Solr parameters of all `queries` for the mapping `collections`
+  (all with the same name), as sent by geocodr_mv.api for the first page.
+  """
+  params = []
+  seen = set()
+  for coll in collections:
+    for query in queries:
+      if len(query) < coll.min_query_length:
+        continue
+      q = coll.query(query)
+      if not q or (q, coll.sort) in seen:
+        continue
+      seen.add((q, coll.sort))
+      params.append({
+        'q': q,
+        'sort': coll.sort,
+        'fl': search_field_list(coll),
+        'rows': collection_rows(coll)[0],
+      })
+  return params
+
+
+class WarmupError(Exception):
+  pass
+
+
+class Warmup(object):
+  """
+  Warmup sends all `params` with `select(params)` in rounds until the median
+  latency is stable.
+  """
+
+  def __init__(self, select, params, concurrency=CONCURRENCY, tolerance=TOLERANCE,
+               min_rounds=MIN_ROUNDS, max_rounds=MAX_ROUNDS, max_duration=MAX_DURATION):
+    self.select = select
+    self.params = params
+    self.concurrency = concurrency
+    self.tolerance = tolerance
+    self.min_rounds = min_rounds
+    self.max_rounds = max_rounds
+    self.max_duration = max_duration
+
+  def request(self, params):
+    start = time.time()
+    try:
+      self.select(params)
+    except Exception as ex:
+      log.debug('warmup query %s failed: %s', params['q'], ex)
+      return None
+    return time.time() - start
+
+  def round(self):
+    """
+    Send all queries once. Returns the latencies of all successful queries.
+    """
+    with ThreadPoolExecutor(max_workers=self.concurrency) as e:
+      latencies = list(e.map(self.request, self.params))
+    return sorted(t for t in latencies if t is not None)
+
+  def is_stable(self, medians):
+    if len(medians) < max(self.min_rounds, 2):
+      return False
+    prev, curr = medians[-2:]
+    return abs(curr - prev) <= self.tolerance * prev
+
+  def run(self):
+    """
+    Run rounds until the median latency is stable or until `max_rounds` or
+    `max_duration` are reached. Returns a dict with the median and p95
+    latency (ms) of each round.
+    """
+    start = time.time()
+    rounds = []
+    medians = []
+    stable = False
+    if not self.params:
+      return {'queries': 0, 'rounds': rounds, 'stable': stable, 'duration': 0.0}
+
+    while len(rounds) < self.max_rounds:
+      latencies = self.round()
+      if not latencies:
+        raise WarmupError('all {} warmup queries failed'.format(len(self.params)))
+      medians.append(percentile(latencies, 50))
+      rounds.append({
+        'p50': medians[-1] * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'errors': len(self.params) - len(latencies),
+      })
+      log.debug('warmup round %d: p50 %.1fms', len(rounds), rounds[-1]['p50'])
+      if self.is_stable(medians):
+        stable = True
+        break
+      if time.time() - start >= self.max_duration:
+        break
+
+    return {
+      'queries': len(self.params),
+      'rounds': rounds,
+      'stable': stable,
+      'duration': time.time() - start,
+    }
+
+
+def warmup_collection(select, collections, queries, **kw):
+  """
+  Warm up a Solr collection with `queries` for the mapping `collections`.
+  `select(params)` sends a single query to the new collection.
+  """
+  result = Warmup(select, solr_params(collections, queries), **kw).run()
+  if result['rounds']:
+    log.info('warmup with %d queries in %d rounds: p50 %.1fms -> %.1fms (%s)',
+             result['queries'], len(result['rounds']), result['rounds'][0]['p50'],
+             result['rounds'][-1]['p50'], 'stable' if result['stable'] else 'not stable')
+  return result
+
+
+def mapping_collections(mapping=MAPPING):
+  """
+  Return dict with a list of all mapping collections for each collection name.
+  """
+  collections = {}
+  for coll in load_collections(mapping):
+    collections.setdefault(coll.name, []).append(coll)
+  return collections
+
+
+def add_arguments(parser):
+  parser.add_argument("--warmup-queries",
+                      help='log file with queries to warm up new collections')
+  parser.add_argument("--warmup-top", type=int, default=TOP_QUERIES,
+                      help='number of most frequent queries (default: %(default)s)')
+  parser.add_argument("--warmup-tolerance", type=float, default=TOLERANCE,
+                      help='stop if the median latency changes by less than this '
+                           '(default: %(default)s)')
+  parser.add_argument("--warmup-max-rounds", type=int, default=MAX_ROUNDS,
+                      help='maximum number of rounds (default: %(default)s)')
+  parser.add_argument("--warmup-max-duration", type=float, default=MAX_DURATION,
+                      help='maximum duration in seconds (default: %(default)s)')
+  parser.add_argument("--mapping", default=MAPPING,
+                      help='geocodr mapping to build Solr queries (default: %(default)s)')
+
+
+def options(args):
+  return {
+    'tolerance': args.warmup_tolerance,
+    'max_rounds': args.warmup_max_rounds,
+    'max_duration': args.warmup_max_duration,
+  }
+
+
+def main():
+  logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s',
+  )
+
+  parser = argparse.ArgumentParser(description=__doc__,
+                                   formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--url", default="http://localhost:8983/solr")
+  parser.add_argument("--collection", required=True,
+                      help='name of the collection in the mapping (e.g. gemeinden)')
+  parser.add_argument("--solr-collection",
+                      help='Solr collection to warm up (e.g. gemeinden-2), '
+                           'defaults to --collection')
+  add_arguments(parser)
+  args = parser.parse_args()
+  if not args.warmup_queries:
+    parser.error('--warmup-queries is required')
+
+  solr = Solr(args.url)
+  solr_collection = args.solr_collection or args.collection
+  collections = mapping_collections(args.mapping).get(args.collection)
+  if not collections:
+    parser.error('unknown collection {}'.format(args.collection))
+
+  result = warmup_collection(
+    lambda params: solr.query(solr_collection, **params),
+    collections,
+    load_queries(args.warmup_queries, top=args.warmup_top),
+    **options(args)
+  )
+  print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -3,29 +3,37 @@
 set -e # exit on error
 set -u # strict mode
 
-# Export data from PostgreSQL as CSV and post data into SolrCloud.
+# Export data from PostgreSQL and post data into SolrCloud.
 # Set environment variables to configure DB parameters:
 #
-# % CSV_OUTDIR=/tmp/geocodr-csv $CSV_INDIR=/tmp/geocodr-csv PGHOST=server PGDATABASE=data PGUSER=dbuser PGPASSWORD=pw DBSCHEMA=public geocodr-reindex.sh
+# % PGHOST=server PGDATABASE=data PGUSER=dbuser PGPASSWORD=pw DBSCHEMA=public geocodr-reindex.sh
+#
+# The COPY output of each collection is posted directly into a new collection
+# (geocodr_mv.reindex), no intermediate CSV files are required. Set CSV_OUTDIR
+# to keep a copy of the exported data as <collection>.csv.gz.
+# Set MANIFEST_DIR to store row hashes of each import and to only post changed
+# rows in the next run (delta update, see geocodr_mv.reindex --full-every).
+# Set GEOMETRY_DIR to write the geometries of each collection into a geometry
+# store for geocodr_mv.api (--geometry-dir).
+# Set PRECOMPUTE_4326=1 to add the geometry, centroid and bbox in EPSG:4326.
+# Set GEOMETRY_LOD=1 to add simplified geometries.
+# Set WARMUP_QUERIES to a log file with one query per line to warm up new
+# collections with the most frequent queries before the alias is changed.
+# REINDEX_WORKERS (default 4) collections are imported in parallel. Optional
+# arguments are passed to geocodr_mv.reindex (e.g. the names of the
+# collections to import).
 
-/usr/local/geocodr-mv/geocodr-mv/scripts/geocodr-pg2csv.sh
+BASEDIR="$(cd "$(dirname "${BASH_SOURCE[0]}")/.." && pwd)"
 
-cat <<EOF | xargs -I % /usr/local/geocodr-mv/virtualenv/bin/geocodr-post --url http://localhost:8983/solr --csv $CSV_INDIR/%.csv --collection %
-flurstueckseigentuemer
-schulen
-adressen
-fluren
-gemarkungen
-gemeinden
-gemeindeteile
-strassen
-flurstuecke
-adressen_hro
-fluren_hro
-gemarkungen_hro
-gemeindeteile_hro
-strassen_hro
-flurstuecke_hro
-postleitzahlengebiete
-EOF
+export PGDATABASE="${PGDATABASE:-geocodr}"
+export DBSCHEMA="${DBSCHEMA:-public}"
+SOLR_URL="${SOLR_URL:-http://localhost:8983/solr}"
+REINDEX_WORKERS="${REINDEX_WORKERS:-4}"
+PYTHON="${PYTHON:-/usr/local/geocodr-mv/virtualenv/bin/python}"
 
+PYTHONPATH="$BASEDIR${PYTHONPATH:+:$PYTHONPATH}" exec $PYTHON -m geocodr_mv.reindex \
+  --url "$SOLR_URL" --schema "$DBSCHEMA" --workers "$REINDEX_WORKERS" \
+  ${CSV_OUTDIR:+--csv-outdir "$CSV_OUTDIR"} ${MANIFEST_DIR:+--manifest-dir "$MANIFEST_DIR"} \
+  ${GEOMETRY_DIR:+--geometry-dir "$GEOMETRY_DIR"} \
+  ${PRECOMPUTE_4326:+--precompute-4326} ${GEOMETRY_LOD:+--geometry-lod} \
+  ${WARMUP_QUERIES:+--warmup-queries "$WARMUP_QUERIES"} "$@"
@@ -0,0 +1,15 @@
+SELECT
+  a.uuid AS id,
+  ST_AsText(a.geometrie) AS geometrie,
+  strasse_name,
+  strasse_schluessel,
+  postleitzahl,
+  gemeindeteil_name,
+  a.gemeinde_name,
+  hausnummer AS hausnummer_int,
+  hausnummer || coalesce(hausnummer_zusatz, '') AS hausnummer,
+  ST_Area(g.geometrie) as gemeinde_flaeche,
+  a.gemeinde_name ilike '%stadt' as gemeinde_ist_stadt,
+  to_jsonb(a) - 'geometrie' AS json
+FROM ${DBSCHEMA}.adressen a
+LEFT JOIN ${DBSCHEMA}.gemeinden g ON g.gemeinde_schluessel = a.gemeinde_schluessel
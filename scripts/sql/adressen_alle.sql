@@ -0,0 +1,73 @@
+SELECT
+  a.uuid AS id,
+  'adressen' AS typ,
+  ST_AsText(a.geometrie) AS geometrie,
+  strasse_name,
+  strasse_schluessel,
+  postleitzahl,
+  gemeindeteil_name,
+  a.gemeinde_name,
+  hausnummer AS hausnummer_int,
+  hausnummer || coalesce(hausnummer_zusatz, '') AS hausnummer,
+  NULL::double precision AS strasse_laenge,
+  ST_Area(g.geometrie) as gemeinde_flaeche,
+  NULL::double precision AS gemeindeteil_flaeche,
+  a.gemeinde_name ilike '%stadt' as gemeinde_ist_stadt,
+  to_jsonb(a) - 'geometrie' AS json
+FROM ${DBSCHEMA}.adressen a
+LEFT JOIN ${DBSCHEMA}.gemeinden g ON g.gemeinde_schluessel = a.gemeinde_schluessel
+UNION ALL
+SELECT
+  s.uuid AS id,
+  'strassen' AS typ,
+  ST_AsText(ST_Simplify(s.geometrie, 1)) AS geometrie,
+  strasse_name,
+  NULL AS strasse_schluessel,
+  NULL AS postleitzahl,
+  gemeindeteil_name,
+  s.gemeinde_name,
+  NULL AS hausnummer_int,
+  NULL AS hausnummer,
+  ST_Length(s.geometrie) as strasse_laenge,
+  ST_Area(g.geometrie) as gemeinde_flaeche,
+  NULL AS gemeindeteil_flaeche,
+  s.gemeinde_name ilike '%stadt' as gemeinde_ist_stadt,
+  to_jsonb(s) - 'geometrie' AS json
+FROM ${DBSCHEMA}.strassen s
+LEFT JOIN ${DBSCHEMA}.gemeinden g ON g.gemeinde_schluessel = s.gemeinde_schluessel
+UNION ALL
+SELECT
+  uuid AS id,
+  'gemeinden' AS typ,
+  ST_AsText(ST_Buffer(ST_Simplify(geometrie, 5), 0)) AS geometrie,
+  NULL AS strasse_name,
+  NULL AS strasse_schluessel,
+  NULL AS postleitzahl,
+  NULL AS gemeindeteil_name,
+  gemeinde_name,
+  NULL AS hausnummer_int,
+  NULL AS hausnummer,
+  NULL AS strasse_laenge,
+  ST_Area(geometrie) as gemeinde_flaeche,
+  NULL AS gemeindeteil_flaeche,
+  gemeinde_name ilike '%stadt' as gemeinde_ist_stadt,
+  to_jsonb(gemeinden) - 'geometrie' AS json
+FROM ${DBSCHEMA}.gemeinden
+UNION ALL
+SELECT
+  uuid AS id,
+  'gemeindeteile' AS typ,
+  ST_AsText(ST_Buffer(ST_Simplify(geometrie, 5), 0)) AS geometrie,
+  NULL AS strasse_name,
+  NULL AS strasse_schluessel,
+  NULL AS postleitzahl,
+  gemeindeteil_name,
+  gemeinde_name,
+  NULL AS hausnummer_int,
+  NULL AS hausnummer,
+  NULL AS strasse_laenge,
+  NULL AS gemeinde_flaeche,
+  ST_Area(geometrie) as gemeindeteil_flaeche,
+  NULL AS gemeinde_ist_stadt,
+  to_jsonb(gemeindeteile) - 'geometrie' AS json
+FROM ${DBSCHEMA}.gemeindeteile
@@ -0,0 +1,50 @@
+SELECT
+  uuid AS id,
+  'adressen_hro' AS typ,
+  ST_AsText(geometrie) AS geometrie,
+  strasse_name,
+  strasse_schluessel,
+  postleitzahl,
+  gemeindeteil_name,
+  gemeinde_name,
+  hausnummer AS hausnummer_int,
+  hausnummer || coalesce(hausnummer_zusatz, '') AS hausnummer,
+  NULL::double precision AS strasse_laenge,
+  NULL::double precision AS gemeindeteil_flaeche,
+  coalesce(to_jsonb(adressen_hro) ->> 'historisch_seit', to_jsonb(adressen_hro) ->> 'gueltigkeit_bis') IS NOT NULL AS historisch,
+  to_jsonb(adressen_hro) - 'geometrie' AS json
+FROM ${DBSCHEMA}.adressen_hro
+UNION ALL
+SELECT
+  uuid AS id,
+  'strassen_hro' AS typ,
+  ST_AsText(ST_Simplify(geometrie, 1)) AS geometrie,
+  strasse_name,
+  NULL AS strasse_schluessel,
+  NULL AS postleitzahl,
+  gemeindeteil_name,
+  gemeinde_name,
+  NULL AS hausnummer_int,
+  NULL AS hausnummer,
+  ST_Length(geometrie) as strasse_laenge,
+  NULL AS gemeindeteil_flaeche,
+  false AS historisch,
+  to_jsonb(strassen) - 'geometrie' AS json
+FROM ${DBSCHEMA}.strassen WHERE kreis_schluessel = '13003'
+UNION ALL
+SELECT
+  uuid AS id,
+  'gemeindeteile_hro' AS typ,
+  ST_AsText(ST_Buffer(ST_Simplify(geometrie, 5), 0)) AS geometrie,
+  NULL AS strasse_name,
+  NULL AS strasse_schluessel,
+  NULL AS postleitzahl,
+  gemeindeteil_name,
+  gemeinde_name,
+  NULL AS hausnummer_int,
+  NULL AS hausnummer,
+  NULL AS strasse_laenge,
+  ST_Area(geometrie) as gemeindeteil_flaeche,
+  false AS historisch,
+  to_jsonb(gemeindeteile) - 'geometrie' AS json
+FROM ${DBSCHEMA}.gemeindeteile WHERE kreis_schluessel = '13003'
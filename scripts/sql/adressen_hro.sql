@@ -0,0 +1,13 @@
+SELECT
+  uuid AS id,
+  ST_AsText(geometrie) AS geometrie,
+  strasse_name,
+  strasse_schluessel,
+  postleitzahl,
+  gemeindeteil_name,
+  gemeinde_name,
+  hausnummer AS hausnummer_int,
+  hausnummer || coalesce(hausnummer_zusatz, '') AS hausnummer,
+  coalesce(to_jsonb(adressen_hro) ->> 'historisch_seit', to_jsonb(adressen_hro) ->> 'gueltigkeit_bis') IS NOT NULL AS historisch,
+  to_jsonb(adressen_hro) - 'geometrie' AS json
+FROM ${DBSCHEMA}.adressen_hro
@@ -0,0 +1,9 @@
+SELECT
+  uuid AS id,
+  ST_AsText(ST_Buffer(ST_Simplify(geometrie, 1), 0)) AS geometrie,
+  gemarkung_name,
+  gemarkung_schluessel,
+  gemeinde_name,
+  flur,
+  to_jsonb(fluren) - 'geometrie' AS json
+FROM ${DBSCHEMA}.fluren WHERE kreis_schluessel = '13003'
@@ -0,0 +1,16 @@
+SELECT
+  uuid AS id,
+  CASE
+   WHEN ST_IsEmpty(ST_Buffer(ST_Simplify(geometrie, 0.4), 0)) OR ST_Buffer(ST_Simplify(geometrie, 0.4), 0) IS NULL THEN ST_AsText(ST_Buffer(ST_Simplify(geometrie, 0.008), 0))
+   ELSE ST_AsText(ST_Buffer(ST_Simplify(geometrie, 0.4), 0))
+  END AS geometrie,
+  gemarkung_name,
+  gemeinde_name,
+  flur,
+  zaehler,
+  nenner,
+  flurstuecksnummer,
+  flurstueckskennzeichen,
+  coalesce(to_jsonb(flurstuecke_hro) ->> 'historisch_seit', to_jsonb(flurstuecke_hro) ->> 'gueltigkeit_bis') IS NOT NULL AS historisch,
+  to_jsonb(flurstuecke_hro) - 'geometrie' AS json
+FROM ${DBSCHEMA}.flurstuecke_hro
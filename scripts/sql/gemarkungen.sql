@@ -0,0 +1,8 @@
+SELECT
+  uuid AS id,
+  ST_AsText(ST_Buffer(ST_Simplify(geometrie, 5), 0)) AS geometrie,
+  gemarkung_name,
+  gemarkung_schluessel,
+  gemeinde_name,
+  to_jsonb(gemarkungen) - 'geometrie' AS json
+FROM ${DBSCHEMA}.gemarkungen
@@ -0,0 +1,8 @@
+SELECT
+  uuid AS id,
+  ST_AsText(ST_Buffer(ST_Simplify(geometrie, 5), 0)) AS geometrie,
+  gemeinde_name,
+  ST_Area(geometrie) as gemeinde_flaeche,
+  gemeinde_name ilike '%stadt' as gemeinde_ist_stadt,
+  to_jsonb(gemeinden) - 'geometrie' AS json
+FROM ${DBSCHEMA}.gemeinden
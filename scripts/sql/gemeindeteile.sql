@@ -0,0 +1,8 @@
+SELECT
+  uuid AS id,
+  ST_AsText(ST_Buffer(ST_Simplify(geometrie, 5), 0)) AS geometrie,
+  gemeinde_name,
+  gemeindeteil_name,
+  ST_Area(geometrie) as gemeindeteil_flaeche,
+  to_jsonb(gemeindeteile) - 'geometrie' AS json
+FROM ${DBSCHEMA}.gemeindeteile
@@ -0,0 +1,6 @@
+SELECT
+  uuid AS id,
+  ST_AsText(geometrie) AS geometrie,
+  postleitzahl,
+  to_jsonb(postleitzahlengebiete) - 'geometrie' AS json
+FROM ${DBSCHEMA}.postleitzahlengebiete
@@ -0,0 +1,14 @@
+SELECT
+  uuid AS id,
+  ST_AsText(geometrie) AS geometrie,
+  bezeichnung,
+  art,
+  strasse_name,
+  strasse_schluessel,
+  postleitzahl,
+  gemeindeteil_name,
+  gemeinde_name,
+  hausnummer AS hausnummer_int,
+  hausnummer || coalesce(hausnummer_zusatz, '') AS hausnummer,
+  to_jsonb(schulen) - 'geometrie' AS json
+FROM ${DBSCHEMA}.schulen
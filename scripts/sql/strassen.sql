@@ -0,0 +1,12 @@
+SELECT
+  s.uuid AS id,
+  ST_AsText(ST_Simplify(s.geometrie, 1)) AS geometrie,
+  s.gemeinde_name,
+  gemeindeteil_name,
+  strasse_name,
+  ST_Length(s.geometrie) as strasse_laenge,
+  ST_Area(g.geometrie) as gemeinde_flaeche,
+  s.gemeinde_name ilike '%stadt' as gemeinde_ist_stadt,
+  to_jsonb(s) - 'geometrie' AS json
+FROM ${DBSCHEMA}.strassen s
+LEFT JOIN ${DBSCHEMA}.gemeinden g ON g.gemeinde_schluessel = s.gemeinde_schluessel
@@ -0,0 +1,9 @@
+SELECT
+  uuid AS id,
+  ST_AsText(ST_Simplify(geometrie, 1)) AS geometrie,
+  gemeinde_name,
+  gemeindeteil_name,
+  strasse_name,
+  ST_Length(geometrie) as strasse_laenge,
+  to_jsonb(strassen) - 'geometrie' AS json
+FROM ${DBSCHEMA}.strassen WHERE kreis_schluessel = '13003'
@@ -0,0 +1,200 @@
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from werkzeug.test import Client
+
+from geocodr_mv import api, asgi
+from geocodr_mv.admission import (
+  BATCH, INTERACTIVE, Admission, Rejected, TokenBucket, waitress_limits,
+)
+from geocodr_mv.fakesolr import BackgroundServer, FakeSolr
+from geocodr_mv.keys import APIKeys
+
+from test_asgi import call
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+class Clock(object):
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+
+def test_token_bucket():
+  bucket = TokenBucket(2, 3, 0)
+  assert [bucket.take(0) for _ in range(3)] == [0, 0, 0]
+  assert bucket.take(0) == 0.5
+  assert bucket.take(0.5) == 0
+  # not more than burst
+  assert [bucket.take(100) for _ in range(4)] == [0, 0, 0, 0.5]
+
+
+def test_rate_limit():
+  clock = Clock()
+  adm = Admission(clock=clock)
+  limits = {'rate': 1, 'burst': 2}
+  adm.release(adm.enter('a', limits))
+  adm.release(adm.enter('a', limits))
+  with pytest.raises(Rejected) as ex:
+    adm.enter('a', limits)
+  assert ex.value.status == 429
+  assert ex.value.retry_after == 1
+  # other keys are not limited
+  adm.release(adm.enter('b', limits))
+  clock.now = 1
+  adm.release(adm.enter('a', limits))
+
+
+def test_concurrency_limit():
+  adm = Admission()
+  limits = {'concurrency': 2}
+  tickets = [adm.enter('a', limits), adm.enter('a', limits)]
+  with pytest.raises(Rejected) as ex:
+    adm.enter('a', limits)
+  assert ex.value.status == 429
+  adm.release(tickets.pop())
+  tickets.append(adm.enter('a', limits))
+
+
+def test_max_in_flight():
+  adm = Admission(max_in_flight=2, queue_timeout=0.05)
+  tickets = [adm.enter('a', {}), adm.enter('b', {})]
+  start = time.time()
+  with pytest.raises(Rejected) as ex:
+    adm.enter('c', {'concurrency': 1})
+  assert ex.value.status == 503
+  assert 0.05 <= time.time() - start < 1
+  # the rejected request is not counted for its key
+  assert 'c' not in adm._key_in_flight
+
+  # a waiting request gets the next free slot
+  threading.Timer(0.05, adm.release, [tickets.pop()]).start()
+  adm.queue_timeout = 5
+  tickets.append(adm.enter('c', {}))
+  assert adm.in_flight == {INTERACTIVE: 2, BATCH: 0}
+
+
+def test_batch_lane():
+  adm = Admission(max_in_flight=4, queue_timeout=0.01, batch_ratio=0.5)
+  batch = {'lane': BATCH}
+  tickets = [adm.enter('batch', batch), adm.enter('batch', batch)]
+  with pytest.raises(Rejected):
+    adm.enter('batch', batch)
+  # interactive requests use the other slots
+  tickets += [adm.enter('a', {}), adm.enter('a', {})]
+  assert adm.in_flight == {INTERACTIVE: 2, BATCH: 2}
+
+
+def test_interactive_priority():
+  adm = Admission(max_in_flight=1, queue_timeout=5)
+  ticket = adm.enter('a', {})
+
+  def request(key, limits):
+    adm.release(adm.enter(key, limits))
+
+  batch = threading.Thread(target=request, args=('batch', {'lane': BATCH}))
+  batch.start()
+  time.sleep(0.05)
+  adm.wait_start(INTERACTIVE)
+  adm.release(ticket)
+  time.sleep(0.05)
+  # the batch request waits while an interactive request is waiting
+  assert adm.in_flight[BATCH] == 0
+  adm.wait_end(INTERACTIVE)
+  batch.join(5)
+  assert not batch.is_alive()
+
+
+def test_waitress_limits():
+  # requests above max_in_flight wait in the admission control
+  assert waitress_limits(8) == (4, 100)
+  assert waitress_limits(8, 6) == (6, 100)
+  assert waitress_limits(32) == (16, 256)
+  for threads, max_in_flight in ((8, 8), (4, 16), (1, None)):
+    with pytest.raises(ValueError):
+      waitress_limits(threads, max_in_flight)
+
+
+def test_api_arguments():
+  parser = api.argument_parser()
+  args = parser.parse_args(['--mapping', mapping])
+  assert args.max_in_flight is None
+  assert asgi.asgi_config(asgi.asgi_argument_parser().parse_args(
+    ['--mapping', mapping]))['max_in_flight'] > 0
+
+
+def test_keys_limits(tmp_path):
+  keys = tmp_path / 'apikeys.csv'
+  keys.write_text('key,domains,rate,burst,concurrency,lane\n'
+                  'a,,5,10,2,batch\nb,,,,,\n')
+  options = APIKeys(str(keys)).options
+  assert options['a'] == {'rate': 5.0, 'burst': 10.0, 'concurrency': 2, 'lane': BATCH}
+  assert options['b'] == {}
+
+  keys.write_text('key,domains,lane\na,,bulk\n')
+  with pytest.raises(ValueError):
+    APIKeys(str(keys))
+
+
+@pytest.fixture(scope='module')
+def solr_url():
+  server = BackgroundServer(FakeSolr(delay=0.001)).start()
+  yield server.url
+  server.stop()
+
+
+def test_api_rate_limit(tmp_path, solr_url):
+  keys = tmp_path / 'apikeys.csv'
+  keys.write_text('key,domains,rate,burst\nslow,,0.1,2\nfast,,,\n')
+  config = {'solr_url': solr_url, 'mapping': mapping, 'api_keys_csv': str(keys)}
+  app = api.create_app(config)
+  client = Client(app)
+  params = {'type': 'search', 'class': 'address', 'query': 'rostock', 'limit': 1}
+
+  statuses = [client.get('/query', query_string=dict(params, key='slow')).status_code
+              for _ in range(3)]
+  assert statuses == [200, 200, 429]
+  resp = client.get('/query', query_string=dict(params, key='slow'))
+  assert resp.get_json()['status'] == 429
+  assert int(resp.headers['Retry-After']) >= 1
+  assert client.get('/query', query_string=dict(params, key='fast')).status_code == 200
+
+  async def run():
+    # same limits as the WSGI application
+    asgi_app = asgi.AsyncGeocodr(app)
+    try:
+      return [(await call(asgi_app, '/query', dict(params, key=key)))[0]
+              for key in ['slow', 'fast']]
+    finally:
+      asgi_app.solr.close()
+
+  assert asyncio.run(run()) == [429, 200]
+
+
+def test_asgi_overload(solr_url):
+  config = {'solr_url': solr_url, 'mapping': mapping, 'max_in_flight': 1,
+            'queue_timeout': 0.05}
+  params = {'type': 'search', 'class': 'address', 'query': 'rostock', 'limit': 1}
+
+  async def run():
+    app = asgi.create_asgi_app(config)
+    ticket = app.app.admission.enter(None, {})
+    try:
+      status, headers, _ = await call(app, '/query', params)
+      app.app.admission.release(ticket)
+      return status, headers, (await call(app, '/query', params))[0]
+    finally:
+      app.solr.close()
+
+  status, headers, next_status = asyncio.run(run())
+  assert status == 503
+  assert headers[b'retry-after'] == b'1'
+  assert next_status == 200
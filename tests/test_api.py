@@ -0,0 +1,425 @@
+import os
+
+import pyproj
+import pytest
+import shapely
+import shapely.wkt
+
+from geocodr import proj
+from geocodr.api import create_app as geocodr_create_app
+from geocodr.request import GeocodrRequest
+from geocodr.solr import Solr
+from werkzeug.test import Client, EnvironBuilder
+
+from geocodr_mv import api, cachebench, geomstore, search
+from geocodr_mv.fakesolr import (BackgroundServer, FakeSolr, collection_seed, field_list,
+                                 make_doc)
+from geocodr_mv.warmup import mapping_collections
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+class Coll(object):
+  min_rows = 4
+  max_rows = 20
+  score_tie_ratio = 1.0
+
+
+def fake_select(scores, calls):
+  def select(start, rows):
+    calls.append((start, rows))
+    return {'response': {
+      'numFound': len(scores),
+      'docs': [{'score': s} for s in scores[start:start + rows]],
+    }}
+  return select
+
+
+def test_fetch_docs():
+  calls = []
+  docs, num_found = api.fetch_docs(fake_select([5, 4, 3, 2, 1, 1, 1], calls), Coll(), 2)
+  assert calls == [(0, 4)]
+  assert len(docs) == 4
+  assert num_found == 7
+
+
+def test_fetch_docs_tie():
+  calls = []
+  scores = [5] + [2] * 10 + [1] * 10
+  docs, _ = api.fetch_docs(fake_select(scores, calls), Coll(), 2)
+  # doubles the rows until the tie with the second doc ends
+  assert calls == [(0, 4), (4, 4), (8, 8)]
+  assert len(docs) == 16
+
+
+def test_fetch_docs_tie_ratio():
+  coll = Coll()
+  coll.score_tie_ratio = 1.1
+  calls = []
+  # 2.0 / 1.85 is within the ratio and can be aligned to 2.0
+  scores = [2, 2, 2, 2, 1.85, 1.5, 1.4, 1.3]
+  docs, _ = api.fetch_docs(fake_select(scores, calls), coll, 2)
+  assert calls == [(0, 4), (4, 4)]
+  assert not api.may_tie(coll, docs, 2)
+
+
+def test_fetch_docs_max_rows():
+  calls = []
+  api.fetch_docs(fake_select([1] * 100, calls), Coll(), 2)
+  assert calls == [(0, 4), (4, 4), (8, 8), (16, 4)]
+
+  calls = []
+  api.fetch_docs(fake_select([1] * 100, calls), Coll(), 30)
+  assert calls == [(0, 30)]
+
+
+@pytest.fixture(scope='module')
+def local():
+  solr_server = BackgroundServer(FakeSolr()).start()
+  app = api.create_app({'solr_url': solr_server.url, 'mapping': mapping})
+  yield solr_server.url, Client(app)
+  solr_server.stop()
+
+
+@pytest.mark.parametrize('params', [
+  {'class': 'address', 'query': 'rostock stettiner', 'limit': 5},
+  {'class': 'address', 'query': 'rostock stettiner', 'limit': 10, 'offset': 20},
+  {'class': 'parcel', 'query': 'parkentin flur 1', 'limit': 10},
+  {'class': 'address', 'query': 'rostock stettiner', 'limit': 5, 'shape': 'centroid',
+   'out_epsg': '25833', 'bbox': '300000,5990000,310000,6010000', 'bbox_epsg': '25833'},
+  {'class': 'address', 'query': 'rostock stettiner', 'limit': 5, 'debug': 'true'},
+])
+def test_query_same_as_geocodr_api(local, params):
+  solr_url, client = local
+  orig = Client(geocodr_create_app({'solr_url': solr_url, 'mapping': mapping}))
+
+  def query(client):
+    resp = client.get('/query', query_string=dict(params, type='search'))
+    assert resp.status_code == 200
+    return resp.get_json()
+
+  fc = query(client)
+  assert fc['properties']['features_returned'] == params['limit']
+  assert fc == query(orig)
+
+
+def test_query_paging(local):
+  _, client = local
+
+  def query(limit, offset):
+    resp = client.get('/query', query_string={
+      'type': 'search', 'class': 'address', 'query': 'rostock stettiner',
+      'limit': limit, 'offset': offset})
+    return [f['properties']['_title_'] for f in resp.get_json()['features']]
+
+  assert query(20, 0)[10:] == query(10, 10)
+
+
+class RecordingSolr(FakeSolr):
+  def select(self, collection, params):
+    self.params.append((collection, params))
+    return FakeSolr.select(self, collection, params)
+
+
+def test_query_trimmed_fields():
+  fake = RecordingSolr()
+  fake.params = []
+  solr_server = BackgroundServer(fake).start()
+  try:
+    client = Client(api.create_app({'solr_url': solr_server.url, 'mapping': mapping}))
+    resp = client.get('/query', query_string={
+      'type': 'search', 'class': 'address', 'query': 'rostock stettiner', 'limit': 3})
+    fc = resp.get_json()
+  finally:
+    solr_server.stop()
+
+  collections = dict((c.name, c) for colls in mapping_collections(mapping).values()
+                     for c in colls)
+  searches = [(c, p) for c, p in fake.params if not p['q'].startswith('{!terms')]
+  pages = [(c, p) for c, p in fake.params if p['q'].startswith('{!terms')]
+  assert len(searches) == 4
+  for c, p in searches:
+    assert p['fl'] == collections[c].sort_field_list
+  # the json blob is only loaded for the 3 features of the page
+  assert sum(len(p['q'].split(',')) for _, p in pages) == 3
+  for c, p in pages:
+    assert p['fl'] == collections[c].page_field_list
+  assert len(fc['features']) == 3
+  assert fc['features'][0]['properties']['gemeinde_name_suchzusatz'] is None
+
+
+@pytest.mark.parametrize('key,params,excluded', [
+  ('all', {}, False),
+  ('all', {'historic': 'false'}, True),
+  ('current', {}, True),
+  ('current', {'historic': 'true'}, False),
+  ('default', {}, False),
+])
+def test_query_historic(tmp_path, key, params, excluded):
+  keys = tmp_path / 'apikeys.csv'
+  keys.write_text('key,domains,historic\nall,,true\ncurrent,,false\ndefault,,\n')
+  fake = RecordingSolr()
+  fake.params = []
+  solr_server = BackgroundServer(fake).start()
+  try:
+    client = Client(api.create_app({
+      'solr_url': solr_server.url, 'mapping': mapping, 'api_keys_csv': str(keys)}))
+    resp = client.get('/query', query_string=dict(
+      params, key=key, type='search', query='rostock stettiner', limit=3,
+      **{'class': 'address_hro'}))
+    assert resp.status_code == 200
+  finally:
+    solr_server.stop()
+
+  fqs = dict((c, p.get('fq')) for c, p in fake.params if not p['q'].startswith('{!terms'))
+  assert fqs['adressen_hro'] == ('-historisch:true' if excluded else None)
+  # collections without historic records
+  assert fqs['strassen_hro'] is None
+
+
+class BBoxFilter(object):
+  def query_params(self, field):
+    return {'fq': field + ':["1 2" TO "3 4"]'}
+
+
+def test_query_historic_fq(local):
+  solr_url, _ = local
+  app = api.create_app({'solr_url': solr_url, 'mapping': mapping, 'historic': False})
+  coll = [c for c in app.collections if c.name == 'adressen_hro'][0]
+  params = {'type': 'search', 'class': 'address_hro', 'query': 'rostock'}
+  request = GeocodrRequest(EnvironBuilder(query_string=params).get_environ())
+  assert not app.include_historic(request)
+  solr_params = app.solr_params(request, coll, BBoxFilter(), historic=False)
+  assert solr_params['fq'] == ['geometrie:["1 2" TO "3 4"]', '-historisch:true']
+  assert 'fq' not in app.solr_params(request, coll, None, historic=True)
+
+  client = Client(app)
+  assert client.get('/query', query_string=params).status_code == 200
+  params['historic'] = 'maybe'
+  assert client.get('/query', query_string=params).status_code == 400
+
+
+@pytest.mark.parametrize('params', [
+  {'shape': 'geometry'},
+  {'shape': 'centroid', 'out_epsg': '25833'},
+  {'shape': 'bbox', 'out_epsg': '25833'},
+])
+def test_query_geometry_store(local, tmp_path, monkeypatch, params):
+  solr_url, _ = local
+  query = 'rostock stettiner'
+  # only the first docs are in the store, all other geometries from Solr
+  for coll in mapping_collections(mapping)['gemeinden'] + mapping_collections(mapping)['adressen']:
+    seed = collection_seed(coll.name, coll.query(query))
+    with geomstore.GeometryWriter(geomstore.store_path(str(tmp_path), coll.name)) as w:
+      for i in range(3):
+        doc = make_doc(coll.name, seed + i, 1.0)
+        w.add(doc['id'], doc['geometrie'])
+
+  client = Client(api.create_app({
+    'solr_url': solr_url, 'mapping': mapping, 'geometry_dir': str(tmp_path)}))
+  orig = Client(geocodr_create_app({'solr_url': solr_url, 'mapping': mapping}))
+  params = dict(params, type='search', query=query, limit=10)
+  params['class'] = 'address'
+  records = []
+  get = geomstore.GeometryStore.get
+
+  def record_get(self, id):
+    records.append(get(self, id))
+    return records[-1]
+
+  monkeypatch.setattr(geomstore.GeometryStore, 'get', record_get)
+  fc = client.get('/query', query_string=params).get_json()
+  assert fc == orig.get('/query', query_string=params).get_json()
+  # geometries from the store and from Solr
+  assert None in records
+  assert len([r for r in records if r is not None]) >= 3
+
+
+class PrecomputedSolr(FakeSolr):
+  """
+  FakeSolr with geometries in EPSG:4326, as exported with --precompute-4326.
+  Documents with an odd id were imported without.
+  """
+  transformer = pyproj.Transformer.from_crs(25833, 4326, always_xy=True)
+
+  def select(self, collection, params):
+    self.params.append(params)
+    resp = FakeSolr.select(self, collection, dict(params, fl='*'))
+    docs = resp['response']['docs']
+    for doc in docs:
+      if int(doc['id'].rsplit('-', 1)[1]) % 2:
+        continue
+      geom = shapely.transform(shapely.wkt.loads(doc['geometrie']), self.transform_coords)
+      doc['geometrie_4326'] = geom.wkt
+      doc['geometrie_4326_punkt'] = geom.centroid.wkt
+      doc['geometrie_4326_bbox'] = geom.envelope.wkt
+    if params.get('fl'):
+      resp['response']['docs'] = [field_list(doc, params['fl']) for doc in docs]
+    return resp
+
+  def transform_coords(self, coords):
+    x, y = self.transformer.transform(coords[:, 0], coords[:, 1])
+    coords = coords.copy()
+    coords[:, 0], coords[:, 1] = x, y
+    return coords
+
+
+@pytest.mark.parametrize('shape', ['geometry', 'centroid', 'bbox'])
+def test_query_precomputed_4326(monkeypatch, shape):
+  fake = PrecomputedSolr()
+  fake.params = []
+  solr_server = BackgroundServer(fake).start()
+  try:
+    orig = Client(geocodr_create_app({'solr_url': solr_server.url, 'mapping': mapping}))
+    monkeypatch.setenv('GEOCODR_PRECOMPUTED_4326', '1')
+    client = Client(api.create_app({'solr_url': solr_server.url, 'mapping': mapping}))
+    params = {'type': 'search', 'class': 'address', 'query': 'rostock stettiner',
+              'limit': 10, 'shape': shape, 'out_epsg': '4326'}
+    fc = client.get('/query', query_string=params).get_json()
+    assert fc == orig.get('/query', query_string=params).get_json()
+  finally:
+    solr_server.stop()
+
+  field = {'geometry': 'geometrie_4326', 'centroid': 'geometrie_4326_punkt',
+           'bbox': 'geometrie_4326_bbox'}[shape]
+  pages = [p for p in fake.params if p['q'].startswith('{!terms')]
+  assert pages and all(p['fl'].endswith(',' + field) for p in pages if ',json,' in p['fl'])
+  # geometries of documents without precomputed values are loaded from Solr
+  assert any(p['fl'] == 'id,geometrie:[geo f=geometrie w=WKT]' for p in pages)
+
+
+def coords(geometry):
+  if geometry['type'] == 'Point':
+    return [geometry['coordinates']]
+  if geometry['type'] == 'LineString':
+    return geometry['coordinates']
+  return [c for ring in geometry['coordinates'] for c in ring]
+
+
+def test_query_simplify_precision(local):
+  _, client = local
+  params = {'type': 'search', 'class': 'address', 'query': 'rostock stettiner', 'limit': 20,
+            'out_epsg': '4326'}
+
+  def query(**kw):
+    resp = client.get('/query', query_string=dict(params, **kw))
+    assert resp.status_code == 200
+    return resp.get_json()['features']
+
+  full = query()
+  reduced = query(simplify='500', precision='5')
+  assert len(reduced) == len(full)
+  simplified = 0
+  for f, orig in zip(reduced, full):
+    assert f['properties'] == orig['properties']
+    assert f['geometry']['type'] == orig['geometry']['type']
+    n = len(coords(f['geometry']))
+    assert n <= len(coords(orig['geometry']))
+    if n < len(coords(orig['geometry'])):
+      simplified += 1
+    for x, y in coords(f['geometry']):
+      assert round(x, 5) == x and round(y, 5) == y
+  assert simplified
+
+  for kw in ({'simplify': '-1'}, {'simplify': 'nan'}, {'precision': '16'},
+             {'precision': 'x'}):
+    assert client.get('/query', query_string=dict(params, **kw)).status_code == 400
+  # lists and objects of JSON requests
+  for kw in ({'simplify': [1]}, {'precision': {'x': 1}}):
+    resp = client.post('/query', json=dict(params, **kw))
+    assert resp.status_code == 400
+    assert list(kw)[0] in resp.get_json()['message']
+
+
+def test_feature_lookup():
+  fake = FakeSolr()
+  solr_server = BackgroundServer(fake).start()
+  try:
+    client = Client(api.create_app({'solr_url': solr_server.url, 'mapping': mapping}))
+    found = client.get('/query', query_string={
+      'type': 'search', 'class': 'address', 'query': 'rostock stettiner', 'limit': 5,
+      'debug': 'true'}).get_json()['features']
+    ids = [f['properties']['_id_'] for f in found]
+    collections = sorted(set(f['properties']['_collection_'] for f in found))
+
+    requests = fake.requests
+    resp = client.get('/feature', query_string={
+      'id': ','.join(ids[::-1] + ['unknown']), 'collection': ','.join(collections)})
+    assert resp.status_code == 200
+    # one request to /get for each collection
+    assert fake.requests - requests == len(collections)
+    fc = resp.get_json()
+    assert fc['properties']['missing_ids'] == ['unknown']
+    assert [f['properties']['_title_'] for f in fc['features']] == [
+      f['properties']['_title_'] for f in found[::-1]]
+    assert [f['geometry'] for f in fc['features']] == [f['geometry'] for f in found[::-1]]
+    assert '_id_' not in fc['features'][0]['properties']
+
+    resp = client.post('/feature', json={
+      'id': ids[:1], 'collection': [found[0]['properties']['_collection_']],
+      'out_epsg': 4326, 'shape': 'centroid'})
+    geometry = resp.get_json()['features'][0]['geometry']
+    assert geometry['type'] == 'Point' and 10 < geometry['coordinates'][0] < 15
+
+    assert client.get('/feature', query_string={
+      'id': ids[0], 'collection': 'unknown'}).status_code == 400
+    assert client.get('/feature', query_string={
+      'id': ','.join(str(i) for i in range(api.MAX_FEATURE_IDS + 1)),
+      'collection': collections[0]}).status_code == 400
+    # the limit applies before duplicates are removed
+    resp = client.post('/feature', json={
+      'id': [ids[0]] * (api.MAX_FEATURE_IDS + 1), 'collection': collections[0]})
+    assert resp.status_code == 400
+    resp = client.post('/feature', json={'id': [ids[0], ids[0]], 'collection': collections})
+    assert resp.get_json()['properties']['features_returned'] == 1
+  finally:
+    solr_server.stop()
+
+
+def test_lod_field():
+  coll = mapping_collections(mapping)['gemeinden'][0]
+  coll.geometry_lod = True
+  assert coll.lod_field('geometry', None) is None
+  assert coll.lod_field('geometry', 2) is None
+  assert coll.lod_field('geometry', 5) == 'geometrie_lod_5'
+  assert coll.lod_field('geometry', 100) == 'geometrie_lod_25'
+  assert coll.lod_field('centroid', 100) is None
+  assert coll.lod_field('geometry', 100, distance_pt=(1, 2)) is None
+
+  doc = make_doc(coll.name, 1, 1.0)
+  doc['geometrie_lod_25'] = 'POINT (1 2)'
+  # pre-simplified geometry for simplify >= 25
+  f, = coll.to_features([dict(doc)], dst_proj=None, simplify=30)
+  assert f['geometry'] == {'type': 'Point', 'coordinates': (1.0, 2.0)}
+  f, = coll.to_features([dict(doc)], dst_proj=None, simplify=10)
+  assert f['geometry']['type'] == 'Polygon'
+
+
+def test_transform():
+  geom = shapely.wkt.loads('LINESTRING (310000 6000000, 311000 6001000, 311500 6000500)')
+  src, dst = proj.epsg(25833), proj.epsg(4326)
+  assert search.transform(src, dst, geom).equals_exact(proj.transform(src, dst, geom), 0)
+
+
+def test_cache_stats():
+  metrics = {'metrics': {
+    'solr.core.gemeinden-2.shard1.replica_n1': {cachebench.CACHE: {
+      'lookups': 2, 'hits': 1, 'cumulative_lookups': 10, 'cumulative_hits': 6}},
+    'solr.core.gemeinden-2.shard2.replica_n2': {cachebench.CACHE: {
+      'cumulative_lookups': 5, 'cumulative_hits': 4}},
+    'solr.core.gemeindeteile-1.shard1.replica_n1': {cachebench.CACHE: {
+      'cumulative_lookups': 7, 'cumulative_hits': 7}},
+  }}
+  stats = cachebench.cache_stats(metrics, ['gemeinden'])
+  assert stats == {'lookups': 15, 'hits': 10}
+  assert cachebench.hit_ratio({'lookups': 5, 'hits': 2}, stats)['hit_ratio'] == 0.8
+
+
+def test_bench_replay(local):
+  solr_url, _ = local
+  collections = mapping_collections(mapping)['adressen']
+  bench = cachebench.Bench(Solr(solr_url), collections, limit=10)
+  requests, latencies = bench.replay('adaptive', ['rostock', 'rostock'])
+  assert requests == 2
+  assert len(latencies) == 2
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+
+from urllib.parse import urlencode
+
+import pytest
+
+from werkzeug.test import Client
+
+from geocodr_mv import api, asgi
+from geocodr_mv.asyncsolr import AsyncSolr
+from geocodr_mv.fakesolr import BackgroundServer, FakeSolr
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+@pytest.fixture(scope='module')
+def solr_url():
+  server = BackgroundServer(FakeSolr(delay=0.001)).start()
+  yield server.url
+  server.stop()
+
+
+async def call(app, path, params=None, method='GET', body=b'', headers=()):
+  """
+  Send a request to the ASGI `app`. Returns the status, the headers and the
+  body.
+  """
+  scope = {
+    'type': 'http', 'method': method, 'path': path, 'root_path': '',
+    'query_string': urlencode(params or {}).encode('latin-1'),
+    'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+    'server': ('localhost', 5000), 'client': ('127.0.0.1', 1234), 'scheme': 'http',
+    'http_version': '1.1',
+  }
+  received = [{'type': 'http.request', 'body': body, 'more_body': False}]
+  sent = []
+
+  async def receive():
+    return received.pop(0)
+
+  async def send(message):
+    sent.append(message)
+
+  await app(scope, receive, send)
+  start, body = sent
+  return start['status'], dict(start['headers']), body['body']
+
+
+QUERIES = [
+  {'type': 'search', 'class': 'address', 'query': 'rostock', 'limit': 5},
+  {'type': 'search', 'class': 'address,parcel', 'query': 'rostock markt 12', 'limit': 3,
+   'offset': 2, 'out_epsg': 4326, 'shape': 'centroid'},
+  {'type': 'search', 'class': 'address', 'query': 'rostock', 'debug': 'true', 'limit': 2},
+  {'type': 'search', 'class': 'parcel', 'query': '132090-001-12/3'},
+  {'type': 'reverse', 'class': 'address', 'query': '12.1,54.08', 'in_epsg': 4326, 'limit': 3},
+  {'type': 'search', 'class': 'unknown', 'query': 'rostock'},
+  {'type': 'search', 'class': 'address', 'query': 'rostock', 'limit': 'x'},
+]
+
+
+@pytest.mark.parametrize('params', QUERIES)
+def test_asgi_same_as_wsgi(solr_url, params):
+  config = {'solr_url': solr_url, 'mapping': mapping}
+  resp = Client(api.create_app(config)).get('/query', query_string=params)
+
+  async def run():
+    app = asgi.create_asgi_app(dict(config, cpu_workers=2))
+    try:
+      return await call(app, '/query', params)
+    finally:
+      app.solr.close()
+
+  status, headers, body = asyncio.run(run())
+  assert status == resp.status_code
+  assert headers[b'content-type'] == resp.headers['Content-Type'].encode('latin-1')
+  assert json.loads(body) == resp.get_json()
+
+
+def test_asgi_json_post(solr_url):
+  params = {'type': 'search', 'class': 'address', 'query': 'rostock', 'limit': 3}
+
+  async def run():
+    app = asgi.create_asgi_app({'solr_url': solr_url, 'mapping': mapping})
+    try:
+      return await call(app, '/query', method='POST', body=json.dumps(params).encode('utf-8'),
+                        headers=[('Content-Type', 'application/json')])
+    finally:
+      app.solr.close()
+
+  status, _, body = asyncio.run(run())
+  assert status == 200
+  assert len(json.loads(body)['features']) == 3
+
+
+def test_asgi_concurrent(solr_url):
+  async def run():
+    app = asgi.create_asgi_app({'solr_url': solr_url, 'mapping': mapping,
+                                'max_solr_connections': 8})
+    try:
+      results = await asyncio.gather(*[
+        call(app, '/query', {'type': 'search', 'class': 'address', 'query': q, 'limit': 5})
+        for q in ['rostock', 'wismar', 'neubukow', 'parkentin'] * 25
+      ])
+      return results, len(app.solr._idle)
+    finally:
+      app.solr.close()
+
+  results, idle = asyncio.run(run())
+  assert [status for status, _, _ in results] == [200] * 100
+  assert results[0][2] == results[4][2]
+  # connections are reused
+  assert 0 < idle <= 8
+
+
+def test_asgi_other_paths(solr_url, tmpdir):
+  tmpdir.join('info.txt').write('geocodr')
+  config = {'solr_url': solr_url, 'mapping': mapping, 'static_files': str(tmpdir)}
+
+  async def run():
+    app = asgi.create_asgi_app(config)
+    return await call(app, '/static/info.txt')
+
+  status, headers, body = asyncio.run(run())
+  assert status == 200
+  assert body == b'geocodr'
+
+
+def chunked_app(environ, start_response):
+  # no Content-Length, sent with chunked transfer encoding
+  start_response('200 OK', [('Content-Type', 'application/json')])
+  return [b'{"response": ', b'{"numFound": 0, "docs": []}', b'}']
+
+
+def test_async_solr_chunked():
+  server = BackgroundServer(chunked_app).start()
+  try:
+    async def run():
+      solr = AsyncSolr(server.url)
+      try:
+        return [await solr.query('strassen', '*:*') for _ in range(3)]
+      finally:
+        solr.close()
+
+    assert asyncio.run(run()) == [{'response': {'numFound': 0, 'docs': []}}] * 3
+  finally:
+    server.stop()
+
+
+def test_async_solr_error(solr_url):
+  async def run():
+    solr = AsyncSolr(solr_url)
+    try:
+      await solr.query('strassen/unknown', '*:*')
+    finally:
+      solr.close()
+
+  with pytest.raises(asgi.solr.SolrException):
+    asyncio.run(run())
@@ -0,0 +1,120 @@
+import gzip
+import io
+import os
+import stat
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from geocodr_mv import export
+
+
+CSV = (
+  b'id,geometrie,strasse_name,json\n'
+  b'1,POINT (1 2),Seestr.,"{""a"": 1}"\n'
+  b'2,POINT (3 4),"Am ""Markt""\nNord","{}"\n'
+  b'3,POINT (5 6),Wiesengrund,"{}"\n'
+)
+
+
+def fake_psql(tmp_path, output=CSV, exit_code=0):
+  data = tmp_path / 'psql-output.csv'
+  data.write_bytes(output)
+  script = tmp_path / 'psql'
+  script.write_text('#! /bin/sh\ncat {}\nexit {}\n'.format(data, exit_code))
+  script.chmod(script.stat().st_mode | stat.S_IEXEC)
+  return str(script)
+
+
+def test_csv_records():
+  records = list(export.csv_records(io.BytesIO(CSV)))
+  assert len(records) == 4
+  assert records[2] == b'2,POINT (3 4),"Am ""Markt""\nNord","{}"\n'
+  assert b''.join(records) == CSV
+
+
+def test_csv_records_incomplete():
+  with pytest.raises(export.ExportError):
+    list(export.csv_records(io.BytesIO(b'id,name\n1,"foo\n')))
+
+
+def test_load_query():
+  query = export.load_query('gemeinden', schema='geodata')
+  assert 'FROM geodata.gemeinden' in query
+  assert '${DBSCHEMA}' not in query
+
+
+def test_load_query_precompute_4326():
+  query = export.load_query('gemeinden', schema='geodata', precompute_4326=True)
+  assert 'FROM geodata.gemeinden' in query
+  assert 'ST_Transform' in query
+  for column in ('geometrie_4326', 'geometrie_4326_punkt', 'geometrie_4326_bbox'):
+    assert 'AS ' + column in query
+
+
+@pytest.mark.parametrize('collection', export.available_collections())
+def test_schema_precomputed_fields(collection):
+  # Solr only loads well-formed schemas (no "--" in comments)
+  path = os.path.join(os.path.dirname(__file__), '..', 'solr', collection + '-schema.xml')
+  fields = [f.get('name') for f in ET.parse(path).getroot().iter('field')]
+  for column in ('geometrie_4326', 'geometrie_4326_punkt', 'geometrie_4326_bbox'):
+    assert column in fields
+
+
+def test_load_query_geometry_lod():
+  query = export.load_query('gemeinden', schema='geodata', geometry_lod=True)
+  assert 'FROM geodata.gemeinden' in query
+  for t in export.GEOMETRY_LOD_TOLERANCES:
+    assert 'ST_SimplifyPreserveTopology(g.geometrie, {0})) AS geometrie_lod_{0}'.format(t) in query
+
+
+def test_available_collections():
+  collections = export.available_collections()
+  assert collections[0] == 'flurstueckseigentuemer'
+  assert 'postleitzahlengebiete' in collections
+  assert len(collections) == len(set(collections))
+
+
+def test_source_tables():
+  assert export.source_tables('strassen') == ['gemeinden', 'strassen']
+
+
+def test_change_marker(tmp_path):
+  psql = fake_psql(tmp_path, output=b'gemeinden:1234:5678:10:2:0\nstrassen:1235:5679:3:0:1\n')
+  marker = export.change_marker(['gemeinden', 'strassen'], psql=psql)
+  assert marker == 'gemeinden:1234:5678:10:2:0,strassen:1235:5679:3:0:1'
+  # no statistics for one table
+  assert export.change_marker(['gemeinden', 'strassen', 'view'], psql=psql) is None
+
+  # the file node of pg_class changes with TRUNCATE
+  script = tmp_path / 'psql'
+  script.write_text('#! /bin/sh\necho "$@" > {0}/psql-args\ncat {0}/psql-output.csv\n'.format(
+    tmp_path))
+  export.change_marker(['gemeinden'], psql=psql)
+  assert 'c.relfilenode' in (tmp_path / 'psql-args').read_text()
+
+
+def test_export_collection(tmp_path):
+  result = export.export_collection('gemeinden', str(tmp_path), psql=fake_psql(tmp_path))
+  assert result['rows'] == 3
+  assert result['path'] == str(tmp_path / 'gemeinden.csv.gz')
+  with gzip.open(result['path'], 'rb') as f:
+    assert f.read() == CSV
+
+
+def test_export_collection_failed(tmp_path):
+  path = tmp_path / 'gemeinden.csv'
+  path.write_bytes(b'previous export')
+  with pytest.raises(export.ExportError):
+    export.export_collection('gemeinden', str(tmp_path), compress=False,
+                             psql=fake_psql(tmp_path, exit_code=1))
+  # previous file is unchanged and no temporary files are left
+  assert path.read_bytes() == b'previous export'
+  assert sorted(os.listdir(str(tmp_path))) == ['gemeinden.csv', 'psql', 'psql-output.csv']
+
+
+def test_export_all(tmp_path):
+  results = export.export_all(['gemeinden', 'unknown'], str(tmp_path), workers=2,
+                              psql=fake_psql(tmp_path))
+  assert results[0]['rows'] == 3
+  assert 'error' in results[1]
@@ -0,0 +1,177 @@
+import asyncio
+import csv
+import gzip
+import io
+import json
+import os
+
+import pytest
+
+from werkzeug.test import Client
+
+from geocodr_mv import api, asgi
+from geocodr_mv.fakesolr import BackgroundServer, FakeSolr, make_doc
+from geocodr_mv.fallback import FallbackIndex, build_index
+
+from test_asgi import call
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+# columns of scripts/sql/*.sql
+COLUMNS = {
+  'adressen': ('id', 'geometrie', 'strasse_name', 'strasse_schluessel', 'postleitzahl',
+               'gemeindeteil_name', 'gemeinde_name', 'hausnummer_int', 'hausnummer',
+               'gemeinde_flaeche', 'gemeinde_ist_stadt', 'json'),
+  'gemeinden': ('id', 'geometrie', 'gemeinde_name', 'gemeinde_flaeche', 'gemeinde_ist_stadt',
+                'json'),
+  'postleitzahlengebiete': ('id', 'geometrie', 'postleitzahl', 'json'),
+}
+SIZES = {'adressen': 40, 'gemeinden': 8, 'postleitzahlengebiete': 8}
+
+
+def write_export(path, collection):
+  out = io.StringIO()
+  writer = csv.writer(out)
+  writer.writerow(COLUMNS[collection])
+  for n in range(SIZES[collection]):
+    doc = make_doc(collection, n, 1.0)
+    doc['gemeinde_ist_stadt'] = 't' if doc['gemeinde_ist_stadt'] else 'f'
+    writer.writerow([doc[c] for c in COLUMNS[collection]])
+  data = out.getvalue().encode('utf-8')
+  if path.endswith('.gz'):
+    data = gzip.compress(data)
+  with open(path, 'wb') as f:
+    f.write(data)
+
+
+@pytest.fixture(scope='module')
+def index_path(tmp_path_factory):
+  tmp = tmp_path_factory.mktemp('fallback')
+  write_export(str(tmp / 'adressen.csv.gz'), 'adressen')
+  write_export(str(tmp / 'gemeinden.csv'), 'gemeinden')
+  write_export(str(tmp / 'postleitzahlengebiete.csv.gz'), 'postleitzahlengebiete')
+  path = str(tmp / 'fallback.sqlite')
+  assert build_index(str(tmp), path) == SIZES
+  return path
+
+
+def test_search(index_path):
+  index = FallbackIndex(index_path)
+  resp = index.query('adressen', 'stettiner rostock', rows=3, fl='id,score,gemeinde_ist_stadt')
+  assert resp['response']['numFound'] == 5
+  docs = resp['response']['docs']
+  assert len(docs) == 3
+  assert docs[0]['gemeinde_ist_stadt'] is True
+  assert set(docs[0]) == set(['id', 'score', 'gemeinde_ist_stadt'])
+  assert docs[0]['score'] > 0
+
+  # prefix, without diacritics
+  resp = index.query('gemeinden', 'kropel', fl='*')
+  assert [d['gemeinde_name'] for d in resp['response']['docs']] == ['Kröpelin, Stadt']
+  assert 'score' not in resp['response']['docs'][0]
+  assert index.query('gemeinden', 'unknown')['response']['numFound'] == 0
+
+  ids = ['adressen-00000009', 'adressen-00000001', 'unknown']
+  resp = index.query('adressen', '{!terms f=id}' + ','.join(ids), rows=3, fl='id')
+  assert resp['response']['docs'] == [{'id': ids[0]}, {'id': ids[1]}]
+
+
+def test_spatial_filter(index_path):
+  index = FallbackIndex(index_path)
+  # documents of the first place, within 50 m of the first address
+  resp = index.query('adressen', '*', rows=100, fl='id', fq='{!geofilt sfield=geometrie}',
+                     pt='6004231,307378', d='50')
+  assert [d['id'] for d in resp['response']['docs']] == ['adressen-00000000']
+
+  resp = index.query('adressen', 'rostock', rows=100, fl='id',
+                     fq=['geometrie:["300000 6000000" TO "310000 6010000"]'])
+  assert resp['response']['numFound'] == 5
+
+  with pytest.raises(ValueError):
+    index.query('adressen', '*', fq='{!bbox sfield=geometrie}')
+
+
+def test_api_degraded(index_path):
+  # nothing listens on port 9 (discard)
+  app = api.create_app({'solr_url': 'http://127.0.0.1:9/solr', 'mapping': mapping,
+                        'fallback_index': index_path})
+  client = Client(app)
+  resp = client.get('/query', query_string={
+    'type': 'search', 'class': 'address', 'query': 'rostock stettiner', 'limit': 3,
+    'out_epsg': 4326, 'shape': 'centroid'})
+  assert resp.status_code == 200
+  result = resp.get_json()
+  assert result['properties']['degraded'] is True
+  assert len(result['features']) == 3
+  assert result['features'][0]['properties']['_title_'].startswith(
+    'Rostock, Hanse- und Universitätsstadt, Lichtenhagen, Stettiner Str.')
+  assert 11 < result['features'][0]['geometry']['coordinates'][0] < 13
+
+  resp = client.get('/query', query_string={
+    'type': 'reverse', 'class': 'address', 'query': '307380,6004240', 'in_epsg': 25833})
+  result = resp.get_json()
+  assert resp.status_code == 200
+  assert [f['properties']['objektgruppe'] for f in result['features']] == [
+    'Gemeinde', 'Adresse']
+  assert result['features'][1]['properties']['entfernung'] > 0
+
+  resp = client.get('/feature', query_string={
+    'id': 'adressen-00000009,adressen-00000001', 'collection': 'adressen,gemeinden'})
+  result = resp.get_json()
+  assert result['properties']['degraded'] is True
+  assert [f['properties']['uuid'] for f in result['features']] == [
+    'adressen-00000009', 'adressen-00000001']
+
+
+def test_api_degraded_unified(index_path, monkeypatch):
+  # the index contains the members of the unified collections
+  monkeypatch.setenv('GEOCODR_UNIFIED_ADDRESSES', '1')
+  app = api.create_app({'solr_url': 'http://127.0.0.1:9/solr', 'mapping': mapping,
+                        'fallback_index': index_path})
+  client = Client(app)
+  resp = client.get('/query', query_string={
+    'type': 'search', 'class': 'address', 'query': 'rostock stettiner', 'limit': 3})
+  assert resp.status_code == 200
+  result = resp.get_json()
+  assert result['properties']['degraded'] is True
+  assert [f['properties']['objektgruppe'] for f in result['features']] == ['Adresse'] * 3
+
+  resp = client.get('/feature', query_string={
+    'id': 'adressen-00000009,gemeinden-00000001', 'collection': 'adressen_alle'})
+  assert [f['properties']['uuid'] for f in resp.get_json()['features']] == [
+    'adressen-00000009', 'gemeinden-00000001']
+
+
+def test_api_health(index_path):
+  server = BackgroundServer(FakeSolr()).start()
+  try:
+    app = api.create_app({'solr_url': server.url, 'mapping': mapping,
+                          'fallback_index': index_path})
+    client = Client(app)
+    params = {'type': 'search', 'class': 'address', 'query': 'rostock', 'limit': 1}
+    assert 'degraded' not in client.get('/query', query_string=params).get_json()['properties']
+    app.solr_health.report_failure()
+    assert client.get('/query', query_string=params).get_json()['properties']['degraded']
+    assert app.solr_health.check()
+    assert 'degraded' not in client.get('/query', query_string=params).get_json()['properties']
+  finally:
+    server.stop()
+
+
+def test_asgi_fallback_only(index_path):
+  config = {'solr_url': 'http://127.0.0.1:9/solr', 'mapping': mapping,
+            'fallback_index': index_path, 'fallback_only': True}
+  params = {'type': 'search', 'class': 'address', 'query': '18233', 'limit': 10}
+
+  async def run():
+    app = asgi.create_asgi_app(config)
+    try:
+      return await call(app, '/query', params)
+    finally:
+      app.solr.close()
+
+  status, _, body = asyncio.run(run())
+  assert status == 200
+  assert json.loads(body)['properties']['degraded'] is True
+  assert body == Client(api.create_app(config)).get('/query', query_string=params).data
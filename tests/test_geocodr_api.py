@@ -101,7 +101,7 @@ class JSONClient(object):
 )
 def client(geocodr_url, solr_url, geocodr_test_key, geocodr_mapping, request):
   if solr_url != "":
-    from geocodr.api import create_app
+    from geocodr_mv.api import create_app
     app = create_app({
       'solr_url': solr_url,
       'mapping': geocodr_mapping,
@@ -780,6 +780,47 @@ def test_paging(client):
   ])
 
 
+@pytest.fixture(scope='session')
+def local_app(solr_url, geocodr_mapping):
+  if solr_url == "":
+    pytest.skip('requires --solr-url')
+  from geocodr_mv.api import create_app
+  return create_app({
+    'solr_url': solr_url,
+    'mapping': geocodr_mapping,
+    'local_index': True,
+  })
+
+
+@pytest.mark.parametrize('collection,query', [
+  ('gemeinden', 'Rostock'),
+  ('gemeinden', 'kroepelin'),
+  ('gemeinden', 'bad dobran'),
+  ('gemeindeteile', 'lichtenhagen rostock'),
+  ('gemeindeteile_hro', 'warnemünde'),
+  ('gemarkungen', 'parkentin'),
+  ('gemarkungen_hro', 'lütten klein'),
+  ('gemarkungen_hro', '2221'),
+  ('postleitzahlengebiete', '1810'),
+  ('postleitzahlengebiete', '18233'),
+])
+def test_local_index(local_app, collection, query):
+  """
+  The local index returns the same documents and scores as Solr.
+  """
+  coll = [c for c in local_app.collections if c.name == collection][0]
+  index = local_app.local_index.get(collection)
+  assert index is not None, 'collection {} not loaded'.format(collection)
+
+  expected = local_app.solr.query(collection=collection, q=coll.query(query), fl='id,score',
+                                  rows=1000)['response']
+  result = index.query(query, rows=1000, fl='id,score')['response']
+  assert result['numFound'] == expected['numFound']
+  scores = dict((d['id'], d['score']) for d in expected['docs'])
+  for doc in result['docs']:
+    assert doc['score'] == pytest.approx(scores[doc['id']], rel=1e-4)
+
+
 class R(object):
   """
   R is an expected result for checks with assert_results.
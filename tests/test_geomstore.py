@@ -0,0 +1,65 @@
+import os
+
+import pytest
+import shapely.wkt
+
+from geocodr_mv import geomstore
+
+
+POLYGON = 'POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0), (2 2, 4 2, 4 4, 2 4, 2 2))'
+
+
+def write_store(path, geometries):
+  with geomstore.GeometryWriter(path) as w:
+    for id, wkt in geometries:
+      w.add(id, wkt)
+  return w
+
+
+def test_store(tmp_path):
+  path = str(tmp_path / 'gemeinden.geom')
+  geometries = [('id-{}'.format(i), 'POINT ({} {})'.format(i, i * 2)) for i in range(100)]
+  geometries.append(('polygon', POLYGON))
+  assert write_store(path, geometries).rows == 101
+
+  store = geomstore.GeometryStore(path)
+  assert len(store) == 101
+  for id, wkt in geometries:
+    assert store.get(id).geometry().equals(shapely.wkt.loads(wkt))
+  assert store.get('id-100') is None
+
+  record = store.get('polygon')
+  geom = shapely.wkt.loads(POLYGON)
+  assert record.bbox().equals(geom.envelope)
+  assert record.point().equals(geom.centroid)
+  assert store.get('id-3').bbox().geom_type == 'Point'
+
+
+def test_envelope():
+  for wkt in ['POINT (1 2)', 'LINESTRING (0 0, 5 0)', 'LINESTRING (0 0, 5 3)', POLYGON]:
+    geom = shapely.wkt.loads(wkt)
+    assert geomstore.envelope(geom.bounds).wkt == geom.envelope.wkt
+
+
+def test_writer_failed(tmp_path):
+  path = str(tmp_path / 'gemeinden.geom')
+  with pytest.raises(ValueError):
+    with geomstore.GeometryWriter(path) as w:
+      w.add('1', 'POINT (1 2)')
+      raise ValueError()
+  assert os.listdir(str(tmp_path)) == []
+
+
+def test_stores_reload(tmp_path):
+  write_store(str(tmp_path / 'gemeinden.geom'), [('1', 'POINT (1 2)')])
+  stores = geomstore.GeometryStores(str(tmp_path), check_interval=0)
+  assert stores.get('strassen') is None
+  record = stores.get('gemeinden').get('1')
+
+  write_store(str(tmp_path / 'gemeinden.geom'), [('2', 'POINT (3 4)')])
+  assert stores.get('gemeinden').get('1') is None
+  assert stores.get('gemeinden').get('2').point_xy == (3, 4)
+  # records of the previous file remain valid
+  assert record.geometry().equals(shapely.wkt.loads('POINT (1 2)'))
+
+  assert geomstore.GeometryStores(None).get('gemeinden') is None
@@ -0,0 +1,115 @@
+import os
+import time
+
+from werkzeug.test import Client
+
+from geocodr_mv import api, hedge
+from geocodr_mv.fakesolr import BackgroundServer, FakeSolr
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+def test_latency_tracker():
+  tracker = hedge.LatencyTracker(window=10, min_samples=5, min_delay=0.001)
+  for latency in (0.01, 0.02, 0.03, 0.04):
+    tracker.add('strassen', latency)
+  assert tracker.delay('strassen') is None
+  tracker.add('strassen', 0.05)
+  assert tracker.delay('strassen') == 0.05
+  assert tracker.delay('adressen') is None
+  for _ in range(10):
+    tracker.add('strassen', 0.0)
+  # only the last 10 latencies, at least min_delay
+  assert tracker.delay('strassen') == 0.001
+
+
+def test_hedge_budget():
+  budget = hedge.HedgeBudget(max_ratio=0.25, burst=2)
+  assert not budget.acquire()
+  for _ in range(4):
+    budget.request()
+  assert budget.acquire()
+  assert not budget.acquire()
+  for _ in range(100):
+    budget.request()
+  assert budget.acquire() and budget.acquire()
+  assert not budget.acquire()
+
+
+class SlowSolr(FakeSolr):
+  """
+  FakeSolr with a long pause for every `every`-th request.
+  """
+
+  def __init__(self, pause, every, **kw):
+    FakeSolr.__init__(self, **kw)
+    self.pause = pause
+    self.every = every
+
+  def wait(self, collection):
+    FakeSolr.wait(self, collection)
+    if self.requests % self.every == 0:
+      time.sleep(self.pause)
+
+
+def test_hedged_solr():
+  slow = BackgroundServer(SlowSolr(pause=0.5, every=5, delay=0.002)).start()
+  fast = BackgroundServer(FakeSolr(delay=0.002)).start()
+  try:
+    solr = hedge.HedgedSolr([slow.url, fast.url], min_samples=5, max_ratio=0.5)
+    latencies = []
+    for i in range(40):
+      start = time.time()
+      resp = solr.query('strassen', 'rostock', rows=1)
+      latencies.append(time.time() - start)
+      assert resp['response']['docs']
+    expected = FakeSolr().select('strassen', {'q': 'rostock', 'rows': '1'})
+    assert resp['response']['docs'] == expected['response']['docs']
+  finally:
+    slow.stop()
+    fast.stop()
+
+  assert solr.stats['requests'] == 40
+  assert solr.stats['hedged'] >= 1
+  assert solr.stats['hedge_wins'] >= 1
+  # at most one hedge for every second request
+  assert solr.stats['hedged'] <= 20
+  # pauses after the first samples are hedged
+  assert max(latencies[10:]) < 0.4
+
+
+def test_hedged_solr_ratio():
+  slow = BackgroundServer(SlowSolr(pause=0.05, every=1)).start()
+  fast = BackgroundServer(FakeSolr()).start()
+  try:
+    # every request to the slow node exceeds the median
+    solr = hedge.HedgedSolr([slow.url, fast.url], min_samples=1, p=50, max_ratio=0.1,
+                            burst=1)
+    for i in range(30):
+      solr.query('strassen', 'rostock', rows=1)
+  finally:
+    slow.stop()
+    fast.stop()
+  assert 1 <= solr.stats['hedged'] <= 3
+
+
+def test_hedged_api():
+  nodes = [FakeSolr(), FakeSolr()]
+  servers = [BackgroundServer(node).start() for node in nodes]
+  try:
+    app = api.create_app({
+      'solr_url': servers[0].url, 'mapping': mapping, 'hedge': True,
+      'hedge_urls': [servers[1].url], 'hedge_options': {'min_samples': 1}})
+    assert isinstance(app.solr, hedge.HedgedSolr)
+    client = Client(app)
+    for _ in range(3):
+      resp = client.get('/query', query_string={
+        'type': 'search', 'class': 'address', 'query': 'rostock', 'limit': 5})
+      assert resp.status_code == 200
+      assert len(resp.get_json()['features']) == 5
+  finally:
+    for server in servers:
+      server.stop()
+  # round robin
+  assert all(node.requests for node in nodes)
@@ -0,0 +1,109 @@
+import os
+import random
+
+import pytest
+
+from geocodr.lib.flst import parse_flst
+
+from geocodr_mv import loadtest
+from geocodr_mv.fakesolr import FakeSolr
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+def test_typeahead_prefixes():
+  reqs = loadtest.typeahead(random.Random(1))
+  assert len(reqs) > 1
+  prev = ''
+  for req in reqs:
+    assert req.q.startswith(prev)
+    assert len(req.q) >= 3
+    assert not req.q.endswith(' ')
+    prev = req.q
+
+
+def test_parcel_identifiers_are_parsed():
+  rnd = random.Random(1)
+  for _ in range(200):
+    ident = loadtest.parcel_identifier(rnd)
+    assert parse_flst(ident, gemarkung_prefix='13'), ident
+
+
+def test_reverse_within_mv():
+  rnd = random.Random(1)
+  for _ in range(100):
+    req, = loadtest.reverse(rnd)
+    x, y = (float(v) for v in req.q.split(','))
+    assert loadtest.MV_BOUNDS[0] <= x <= loadtest.MV_BOUNDS[2]
+    assert loadtest.MV_BOUNDS[1] <= y <= loadtest.MV_BOUNDS[3]
+
+
+@pytest.mark.parametrize("p,expected", [
+  (50, 5),
+  (90, 9),
+  (99, 10),
+  (100, 10),
+])
+def test_percentile(p, expected):
+  assert loadtest.percentile(list(range(1, 11)), p) == expected
+
+
+def test_parse_mix():
+  assert loadtest.parse_mix('typeahead=3,reverse') == {'typeahead': 3.0, 'reverse': 1.0}
+  with pytest.raises(ValueError):
+    loadtest.parse_mix('unknown=1')
+
+
+def test_ramp_profile():
+  profile = loadtest.RampProfile(100, duration=60, ramp=10, start=10)
+  assert profile.at(0) == 10
+  assert profile.at(5) == 55
+  assert profile.at(30) == 100
+  assert profile.at(60) == 0
+
+
+class FakeResponse(object):
+  def __init__(self, status_code):
+    self.status_code = status_code
+    self.content = b''
+
+
+class StatusClient(object):
+  """
+  Client that returns an error for every parcel request.
+  """
+
+  def search(self, q, **kw):
+    return FakeResponse(500 if kw['class'] == 'parcel' else 200)
+
+  def reverse(self, q, **kw):
+    return FakeResponse(200)
+
+
+def test_loadtest_stats():
+  test = loadtest.LoadTest(StatusClient(), mix=loadtest.parse_mix('parcel=1,reverse=1'),
+                           concurrency=2, duration=0.2, seed=1, think=False)
+  report = test.run()
+  scenarios = dict((s['scenario'], s) for s in report['scenarios'])
+  assert scenarios['parcel']['error_rate'] == 1.0
+  assert scenarios['reverse']['errors'] == 0
+  assert scenarios['total']['requests'] == \
+    scenarios['parcel']['requests'] + scenarios['reverse']['requests']
+
+
+def test_fake_solr_docs():
+  resp = FakeSolr(num_found=20).select('adressen', {'q': 'foo', 'rows': '50'})
+  docs = resp['response']['docs']
+  assert len(docs) == 20
+  assert docs[0]['score'] >= docs[-1]['score']
+
+
+def test_in_process():
+  local = loadtest.InProcess(mapping)
+  try:
+    resp = loadtest.Client(local.url).search('rostock', limit=5, **{'class': 'address'})
+    assert resp.status_code == 200
+    assert len(resp.json()['features']) == 5
+  finally:
+    local.stop()
@@ -0,0 +1,167 @@
+import asyncio
+import math
+import os
+
+import pytest
+
+from geocodr.mapping import load_collections
+from geocodr.search import GermanNGramField
+from werkzeug.test import Client
+
+from geocodr_mv import api, asgi
+from geocodr_mv.fakesolr import BackgroundServer, FakeSolr
+from geocodr_mv.localindex import (
+  Analyzer, LocalIndex, decode_length, german_normalize, min_should_match,
+)
+
+from test_asgi import call
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+NAME_FOLD = {
+  'charFilters': [
+    {'class': 'solr.PatternReplaceCharFilterFactory', 'pattern': '(, .*)', 'replacement': ''}],
+  'tokenizer': {'class': 'solr.StandardTokenizerFactory'},
+  'filters': [{'class': 'solr.LowerCaseFilterFactory'},
+              {'class': 'solr.GermanNormalizationFilterFactory'}],
+}
+
+
+def test_german_normalize():
+  field = GermanNGramField('name')
+  for term in ['kröpelin', 'kroepelin', 'straße', 'mueller', 'bauer', 'neue', 'quelle']:
+    assert german_normalize(term) == field.normalize_german(term)
+
+
+def test_analyzer():
+  analyzer = Analyzer(NAME_FOLD)
+  assert analyzer.terms('Rostock, Hanse- und Universitätsstadt') == ['rostock']
+  assert analyzer.terms('Bad Doberan') == ['bad', 'doberan']
+  assert analyzer.normalize('Kröpelin') == 'kropelin'
+
+  ngram = dict(NAME_FOLD, filters=NAME_FOLD['filters'] + [
+    {'class': 'solr.NGramFilterFactory', 'minGramSize': '3', 'maxGramSize': '3'}])
+  # one position for all grams of a word
+  assert Analyzer(ngram).tokens('Bad Doberan') == [
+    ('bad', 1), ('dob', 1), ('obe', 0), ('ber', 0), ('era', 0), ('ran', 0)]
+  assert Analyzer().terms('132221') == ['132221']
+
+  with pytest.raises(ValueError):
+    Analyzer(dict(NAME_FOLD, filters=[{'class': 'solr.PorterStemFilterFactory'}]))
+
+
+def test_scoring_helpers():
+  assert [decode_length(n) for n in (1, 23, 24, 40, 41)] == [1, 23, 24, 40, 40]
+  assert [min_should_match(n) for n in range(1, 11)] == [1, 2, 2, 3, 3, 4, 4, 5, 5, 6]
+
+
+@pytest.fixture(scope='module')
+def fake_solr():
+  solr = FakeSolr(num_found=40)
+  server = BackgroundServer(solr).start()
+  yield solr, server.url
+  server.stop()
+
+
+@pytest.fixture(scope='module')
+def local_index(fake_solr):
+  collections = [c for c in load_collections(mapping) if getattr(c, 'local_index', False)]
+  index = LocalIndex(fake_solr[1], collections)
+  assert sorted(index.load()) == [
+    'gemarkungen', 'gemarkungen_hro', 'gemeinden', 'gemeindeteile', 'gemeindeteile_hro',
+    'postleitzahlengebiete']
+  return index
+
+
+def search(index, q, fl='id,score,gemeinde_name'):
+  return index.query(q, rows=100, fl=fl)['response']
+
+
+def test_search(local_index):
+  gemeinden = local_index.get('gemeinden')
+  resp = search(gemeinden, 'kröpelin')
+  assert resp['numFound'] == 5
+  assert set(d['gemeinde_name'] for d in resp['docs']) == set(['Kröpelin, Stadt'])
+  # BM25 of gemeinde_name^4.4: 5 of 40 documents, one term, 9 terms in all documents
+  idf = math.log(1 + (40 - 5 + 0.5) / (5 + 0.5))
+  assert resp['docs'][0]['score'] == pytest.approx(
+    4.4 * idf / (1 + 1.2 * (1 - 0.75 + 0.75 / (45 / 40))))
+
+  # n-grams (umlaut normalization and typos) score lower
+  typo = search(gemeinden, 'kroepelinn')
+  assert typo['numFound'] == 5
+  assert 0 < typo['docs'][0]['score'] < resp['docs'][0]['score']
+  # the suffix of gemeinde_name is removed by the analyzer
+  assert search(gemeinden, 'rostock hanse')['numFound'] == 0
+  assert search(gemeinden, 'unbekannt')['numFound'] == 0
+
+  # exclusive prefix field
+  plz = local_index.get('postleitzahlengebiete')
+  resp = search(plz, '1810', fl='id,score,postleitzahl')
+  assert set(d['postleitzahl'] for d in resp['docs']) == set(['18109'])
+  assert resp['docs'][0]['score'] == 1.0
+  assert search(plz, 'rostock')['numFound'] == 0
+
+  # 4-digit numbers of gemarkungen with prefix
+  gemarkungen = local_index.get('gemarkungen_hro')
+  assert search(gemarkungen, '2221')['numFound'] == 5
+  assert search(gemarkungen, '2221')['docs'] == search(gemarkungen, '132221')['docs']
+
+  assert gemeinden.has_fields(local_index.collections['gemeinden'].sort_field_list)
+  assert not gemeinden.has_fields('*,score')
+
+
+def test_reload(fake_solr, local_index):
+  solr = fake_solr[0]
+  gemeinden = local_index.get('gemeinden')
+  assert local_index.check() == []
+  solr.aliases = {'gemeinden': 'gemeinden-1'}
+  try:
+    assert local_index.check() == ['gemeinden']
+    assert local_index.get('gemeinden') is not gemeinden
+    assert local_index.check() == []
+  finally:
+    solr.aliases = {}
+
+  # collections stay in Solr if they can not be loaded
+  unavailable = LocalIndex('http://127.0.0.1:9', local_index.collections.values(), timeout=1)
+  assert unavailable.load() == []
+  assert unavailable.get('gemeinden') is None
+
+
+def test_api(fake_solr):
+  solr, url = fake_solr
+  app = api.create_app({'solr_url': url, 'mapping': mapping, 'local_index': True})
+  client = Client(app)
+  params = {'type': 'search', 'class': 'postcode_areas', 'query': '18109', 'limit': 2}
+
+  requests = solr.requests
+  result = client.get('/query', query_string=params).get_json()
+  # only the page is loaded from Solr
+  assert solr.requests - requests == 1
+  assert [f['properties']['postleitzahl'] for f in result['features']] == ['18109', '18109']
+  assert result['properties']['features_total'] == 5
+
+  requests = solr.requests
+  client.get('/query', query_string=dict(params, debug='true'))
+  assert solr.requests - requests == 1
+  client.get('/query', query_string=dict(params, bbox='300000,6000000,310000,6010000',
+                                         bbox_epsg=25833))
+  assert solr.requests - requests == 3
+
+
+def test_asgi(fake_solr):
+  config = {'solr_url': fake_solr[1], 'mapping': mapping, 'local_index': True}
+  params = {'type': 'search', 'class': 'address', 'query': 'kröpelin', 'limit': 5}
+
+  async def run():
+    app = asgi.create_asgi_app(config)
+    try:
+      return await call(app, '/query', params)
+    finally:
+      app.solr.close()
+
+  status, _, body = asyncio.run(run())
+  assert status == 200
+  assert body == Client(api.create_app(config)).get('/query', query_string=params).data
@@ -0,0 +1,89 @@
+import os
+
+import pytest
+
+from werkzeug.test import Client
+
+from geocodr_mv import api, parambench
+from geocodr_mv.fakesolr import BackgroundServer, FakeSolr, dereference
+from geocodr_mv.warmup import mapping_collections
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+@pytest.fixture(scope='module')
+def collections():
+  return mapping_collections(mapping)
+
+
+def test_query_params(collections):
+  coll, = collections['adressen']
+  params = coll.query_params('rostock stettiner 12a')
+  q = params['q']
+  for term in ('rostock', 'stettiner', '12a', 'ros'):
+    assert term not in q
+  assert 'v=$t1' in q and 'v=$g3' in q and 'mm=$mm' in q
+  assert params['t1'] == 'rostock'
+  assert params['g3'] == 'ros ost sto toc ock'
+  # equal values are passed once
+  assert len(set(params.values())) == len(params)
+  # same template for all queries with the same number of terms and grams
+  assert coll.query_params('parchim lindenweg 13b')['q'] == q
+  assert coll.query_params('parchim lindenweg')['q'] != q
+
+
+@pytest.mark.parametrize('name', ['adressen', 'strassen', 'gemeinden', 'schulen'])
+def test_query_params_dereference(collections, name):
+  coll, = collections[name]
+  params = coll.query_params('rostock markt 12a')
+  q = dereference(params['q'], params)
+  assert '$' not in q
+  for key, value in params.items():
+    if key not in ('q', 'mm'):
+      assert "v='{}'".format(value) in q
+
+
+def test_parameterized_api():
+  solr_server = BackgroundServer(FakeSolr()).start()
+  try:
+    config = {'solr_url': solr_server.url, 'mapping': mapping}
+    client = Client(api.create_app(config))
+    parameterized = Client(api.create_app(dict(config, parameterized=True)))
+
+    def query(client, q):
+      resp = client.get('/query', query_string={
+        'type': 'search', 'class': 'address', 'query': q, 'limit': 5})
+      assert resp.status_code == 200
+      return resp.get_json()['features']
+
+    features = query(parameterized, 'rostock')
+    assert len(features) == 5
+    assert query(parameterized, 'rostock') == features
+    assert query(parameterized, 'wismar') != features
+    assert query(client, 'rostock')
+  finally:
+    solr_server.stop()
+
+
+def test_run(collections):
+  cases = {'adressen': parambench.cases(
+    collections['adressen'], ['rostock', 'wismar markt 5', 'r'])}
+  assert len(cases['adressen']) == 2
+
+  fake = FakeSolr()
+  sent = []
+
+  def select(collection, params):
+    sent.append(params)
+    return fake.select(collection, dict((k, str(v)) for k, v in params.items()))
+
+  results = parambench.run(select, cases)
+  assert [(r['collection'], r['query'], r['requests'], r['templates']) for r in results] == [
+    ('adressen', 'inline', 2, 2), ('adressen', 'parameterized', 2, 2)]
+  inline, parameterized = results
+  assert parameterized['size'] < inline['size']
+  # alternating order
+  assert 't1' not in sent[0] and 't1' in sent[1]
+  assert 't1' in sent[2] and 't1' not in sent[3]
+  assert 'parameterized' in parambench.format_results(results)
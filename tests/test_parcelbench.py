@@ -0,0 +1,49 @@
+import os
+
+from geocodr_mv import parcelbench
+from geocodr_mv.warmup import mapping_collections
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+def test_parcel_number_queries():
+  collections = mapping_collections(mapping)
+  for name in ('flurstuecke', 'flurstuecke_hro', 'flurstueckseigentuemer'):
+    coll, = collections[name]
+    assert coll.query('132090-001-00012/0003') == \
+      'flurstuecksnummer_prefix:132090001000120003^=1'
+    assert coll.query('132090-001') == \
+      'flurstuecksnummer_prefix:132090^=1 AND zaehler:00001'
+    assert '*' not in coll.query('1320900010')
+
+
+def test_short_parcel_number_prefix(monkeypatch):
+  # 5 digit gemarkung with a shorter gemarkung_prefix, below the n-grams of the schema
+  coll, = mapping_collections(mapping)['flurstuecke']
+  monkeypatch.setitem(coll.query.__globals__, 'gemarkung_prefix', '1')
+  assert coll.query('2090-001') == 'flurstuecksnummer:12090* AND zaehler:00001'
+
+
+def test_prefixes():
+  numbers = ['132090001000120003', '132090001000130000', '132090002000010000']
+  p = parcelbench.prefixes(numbers)
+  assert p[6] == ['132090']
+  assert p[9] == ['132090001', '132090002']
+  assert len(p[14]) == 3
+  assert p[18] == numbers
+
+
+def test_run():
+  sent = []
+
+  def select(q):
+    sent.append(q)
+    return {'response': {'numFound': 2}}
+
+  results = parcelbench.run(select, {6: ['132090'], 9: ['132090001', '132090002']})
+  assert [(r['length'], r['query'], r['requests']) for r in results] == [
+    (6, 'term', 1), (6, 'wildcard', 1), (9, 'term', 2), (9, 'wildcard', 2)]
+  assert sent[:2] == ['flurstuecksnummer_prefix:132090^=1', 'flurstuecksnummer:132090*']
+  # alternating order
+  assert sent[4] == 'flurstuecksnummer:132090002*'
@@ -0,0 +1,185 @@
+import gc
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+import requests
+
+from geocodr_mv import prefork
+from geocodr_mv.fakesolr import BackgroundServer, FakeSolr
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+root = os.path.join(os.path.dirname(__file__), '..')
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/task'),
+                                reason='requires /proc to list the workers')
+
+
+def workers(pid):
+  children = set()
+  for task in os.listdir('/proc/{}/task'.format(pid)):
+    with open('/proc/{}/task/{}/children'.format(pid, task)) as f:
+      children.update(int(p) for p in f.read().split())
+  return children
+
+
+def wait_for(condition, timeout=20):
+  deadline = time.time() + timeout
+  while time.time() < deadline:
+    result = condition()
+    if result:
+      return result
+    time.sleep(0.1)
+  raise AssertionError('timeout')
+
+
+def test_waitress_drain():
+  from waitress.server import create_server
+
+  def app(environ, start_response):
+    time.sleep(0.3)
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [b'done']
+
+  sock = prefork.listen_socket('127.0.0.1', 0)
+  server = create_server(app, sockets=[sock], threads=2)
+  worker = prefork.WaitressWorker(server)
+  loop = threading.Thread(target=server.run, daemon=True)
+  loop.start()
+  url = 'http://127.0.0.1:{}/'.format(sock.getsockname()[1])
+  responses = []
+  request = threading.Thread(target=lambda: responses.append(requests.get(url)))
+  request.start()
+  wait_for(worker.busy, timeout=5)
+
+  # the running request is finished before the loop ends
+  worker.drain(5)
+  request.join(5)
+  loop.join(5)
+  assert not loop.is_alive()
+  assert [r.text for r in responses] == ['done']
+  worker.shutdown()
+  sock.close()
+
+
+def test_waitress_unsupported(monkeypatch):
+  from waitress.channel import HTTPChannel
+
+  prefork.check_waitress()
+  monkeypatch.delattr(HTTPChannel, 'total_outbufs_len')
+  with pytest.raises(RuntimeError) as ex:
+    prefork.check_waitress()
+  assert 'HTTPChannel.total_outbufs_len' in str(ex.value)
+
+
+def test_respawn_backoff(monkeypatch):
+  def fail(*args):
+    raise RuntimeError('startup failed')
+
+  monkeypatch.setattr(prefork, 'serve_worker', fail)
+  master = prefork.Master({}, None, 1)
+  started = []
+  spawn = master.spawn
+  monkeypatch.setattr(master, 'spawn', lambda: started.append(spawn()))
+  master.spawn()
+  deadline = time.time() + 1
+  while time.time() < deadline:
+    master.reap()
+    master.respawn()
+    time.sleep(0.01)
+  # restarts after 0.1, 0.2 and 0.4 seconds instead of a tight loop
+  assert 3 <= len(started) <= 5
+  assert master.respawn_delay >= 0.4
+  master.stopping = True
+  for pid in list(master.workers):
+    master.stop_worker(pid)
+
+
+def test_reload_unfreeze(monkeypatch):
+  monkeypatch.setattr(prefork, 'create_app', lambda config: [[] for _ in range(1000)])
+  master = prefork.Master({'mapping': mapping}, None, 1)
+  try:
+    master.load()
+    frozen = gc.get_freeze_count()
+    for _ in range(3):
+      master.load()
+    # the objects of the previous applications are collected
+    assert gc.get_freeze_count() <= frozen
+  finally:
+    gc.unfreeze()
+
+
+def test_prefork(tmpdir):
+  tmp_mapping = str(tmpdir.join('geocodr_mapping.py'))
+  shutil.copy(mapping, tmp_mapping)
+  solr_server = BackgroundServer(FakeSolr(delay=0.002)).start()
+  proc = subprocess.Popen(
+    [sys.executable, '-m', 'geocodr_mv.prefork', '--workers', '2', '--threads', '2',
+     '--port', '0', '--check-interval', '0.2', '--graceful-timeout', '5',
+     '--solr-url', solr_server.url, '--mapping', tmp_mapping],
+    cwd=root, stderr=subprocess.PIPE, universal_newlines=True)
+  try:
+    line = proc.stderr.readline()
+    url = re.search(r'(http://\S+) with', line).group(1) + '/query'
+    # keep reading the log, the pipe must not block the master
+    threading.Thread(target=proc.stderr.read, daemon=True).start()
+    params = {'type': 'search', 'class': 'address', 'query': 'rostock', 'limit': 5}
+
+    old = wait_for(lambda: len(workers(proc.pid)) == 2 and workers(proc.pid))
+    resp = requests.get(url, params=params)
+    assert resp.status_code == 200
+    expected = resp.json()
+
+    # requests during the rolling restart
+    errors = []
+    done = threading.Event()
+
+    def client():
+      while not done.is_set():
+        try:
+          resp = requests.get(url, params=params, timeout=10)
+          if resp.status_code != 200 or resp.json() != expected:
+            errors.append(resp.status_code)
+        except requests.RequestException as ex:
+          errors.append(ex)
+
+    clients = [threading.Thread(target=client) for _ in range(4)]
+    for c in clients:
+      c.start()
+    time.sleep(0.5)
+    with open(tmp_mapping, 'a') as f:
+      f.write('\n# changed\n')
+    new = wait_for(lambda: len(workers(proc.pid)) == 2 and not (workers(proc.pid) & old)
+                   and workers(proc.pid))
+    time.sleep(0.5)
+    done.set()
+    for c in clients:
+      c.join()
+    assert not errors
+    assert len(new) == 2
+
+    # an invalid mapping keeps the workers
+    with open(tmp_mapping, 'a') as f:
+      f.write('\ninvalid python(\n')
+    time.sleep(1)
+    assert workers(proc.pid) == new
+    assert requests.get(url, params=params).status_code == 200
+
+    # restart of a killed worker
+    os.kill(next(iter(new)), signal.SIGKILL)
+    wait_for(lambda: len(workers(proc.pid)) == 2 and workers(proc.pid) != new)
+  finally:
+    proc.send_signal(signal.SIGTERM)
+    try:
+      assert proc.wait(15) == 0
+    finally:
+      if proc.poll() is None:
+        proc.kill()
+      solr_server.stop()
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from geocodr.mapping import load_collections
+from geocodr.search import Collection as BaseCollection
+from werkzeug.test import Client
+
+from geocodr_mv import api
+from geocodr_mv.fakesolr import BackgroundServer, FakeSolr
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+@pytest.fixture(scope='module')
+def collections():
+  return dict((c.name, c) for c in load_collections(mapping))
+
+
+@pytest.mark.parametrize('query', ['rostock', 'rostock stettiner str 12a', 'am markt 18055'])
+def test_query_unchanged(collections, query):
+  for name in ('strassen', 'adressen', 'gemeinden', 'postleitzahlengebiete', 'schulen'):
+    coll = collections[name]
+    assert coll.shape_query(query).strategy == 'full'
+    assert coll.query(query) == BaseCollection.query(coll, query)
+
+
+def test_shape_query_dedup(collections):
+  coll = collections['strassen']
+  shape = coll.shape_query('rostock Rostock markt rostock')
+  assert shape.strategy == 'dedup'
+  assert shape.terms == ['rostock', 'markt']
+  assert shape.dropped == ['Rostock', 'rostock']
+  assert coll.query('rostock Rostock markt rostock') == coll.query('rostock markt')
+
+
+def test_shape_query_selective(collections):
+  coll = collections['gemeinden']
+  shape = coll.shape_query('a bb ccc dddd eeeee ffffff ggggggg h')
+  assert shape.strategy == 'selective'
+  # the longest terms in the original order
+  assert shape.terms == ['bb', 'ccc', 'dddd', 'eeeee', 'ffffff', 'ggggggg']
+  assert shape.dropped == ['a', 'h']
+
+
+def test_shape_query_simple(collections):
+  coll = collections['adressen']
+  query = 'dflskjdhf lskjdhfx lskjdhfy lskjdfh lskjdhz lskjdhw'
+  shape = coll.shape_query(query)
+  assert shape.strategy == 'simple'
+  assert shape.grams > coll.max_query_grams
+  q = coll.query(query)
+  assert 'edismax' not in q
+  assert q.count('_query_') == 6
+  assert 'edismax' in BaseCollection.query(coll, query)
+
+
+def test_query_shapes_debug():
+  solr_server = BackgroundServer(FakeSolr()).start()
+  try:
+    client = Client(api.create_app({'solr_url': solr_server.url, 'mapping': mapping}))
+
+    def query(q, **kw):
+      resp = client.get('/query', query_string=dict(
+        kw, type='search', query=q, limit=5, **{'class': 'address'}))
+      assert resp.status_code == 200
+      return resp.get_json()['properties']
+
+    props = query('rostock rostock', debug='true')
+    assert props['query_shapes']['adressen']['strategy'] == 'dedup'
+    assert sorted(props['query_shapes']) == ['adressen', 'gemeinden', 'gemeindeteile',
+                                             'strassen']
+    assert 'query_shapes' not in query('rostock', debug='true')
+    assert 'query_shapes' not in query('rostock rostock')
+  finally:
+    solr_server.stop()
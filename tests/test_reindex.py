@@ -0,0 +1,376 @@
+import gzip
+import os
+import stat
+
+import pytest
+
+from geocodr_import.solr import SolrCloudException
+
+from geocodr_mv import reindex, shards
+from geocodr_mv.geomstore import GeometryStore
+from geocodr_mv.manifest import Manifest
+
+from test_export import CSV, fake_psql
+
+
+class FakeResponse(object):
+  url = 'http://localhost:8983/solr'
+  content = b''
+
+  def __init__(self, doc):
+    self.doc = doc
+
+  def json(self):
+    return self.doc
+
+
+class FakeCloud(object):
+  """
+  In-memory SolrCloud with the calls used by reindex.
+  """
+
+  def __init__(self, aliases=None, fail_update=False):
+    self.aliases = dict(aliases or {})
+    self.collections = {}
+    self.committed = {}
+    self.fail_update = fail_update
+    self.deleted = []
+    self.calls = []
+    self.created = {}
+
+  def list_collections(self):
+    return FakeResponse({'collections': list(self.collections)})
+
+  def list_aliases(self):
+    return FakeResponse({'aliases': self.aliases})
+
+  def delete_collection(self, collection):
+    self.calls.append(('delete', collection))
+    self.collections.pop(collection, None)
+
+  def create_collection(self, collection, **kw):
+    self.calls.append(('create', collection))
+    self.collections[collection] = []
+    self.created[collection] = kw
+
+  def update_csv_batch(self, collection, data, commit_within):
+    if self.fail_update:
+      raise SolrCloudException(FakeResponse({}))
+    self.calls.append(('update', collection))
+    self.collections[collection].append(data)
+
+  def delete_ids(self, collection, ids, commit_within):
+    self.calls.append(('delete_ids', collection))
+    self.deleted.extend(ids)
+
+  def commit(self, collection):
+    self.calls.append(('commit', collection))
+    self.committed[collection] = len(self.collections[collection])
+
+  def alias(self, collection, alias):
+    self.calls.append(('alias', collection))
+    self.aliases[alias] = collection
+
+
+def test_batches():
+  records = [b'id,name\n'] + [b'%d,foo\n' % i for i in range(5)]
+  batches = list(reindex.batches(records, batch_rows=2))
+  assert [n for n, _ in batches] == [2, 2, 1]
+  assert batches[0][1] == b'id,name\n0,foo\n1,foo\n'
+  assert batches[2][1] == b'id,name\n4,foo\n'
+
+
+def test_batches_bytes():
+  records = [b'id,name\n'] + [b'%d,foo\n' % i for i in range(5)]
+  batches = list(reindex.batches(records, batch_rows=100, batch_bytes=20))
+  assert [n for n, _ in batches] == [2, 2, 1]
+
+
+def test_batches_empty():
+  assert list(reindex.batches([b'id,name\n'])) == []
+  assert list(reindex.batches([])) == []
+
+
+def test_read_ahead_error():
+  def items():
+    yield 1
+    raise ValueError('failed')
+
+  it = reindex.read_ahead(items())
+  assert next(it) == 1
+  with pytest.raises(ValueError):
+    next(it)
+
+
+def test_import_collection(tmp_path):
+  cs = FakeCloud(aliases={'gemeinden': 'gemeinden-1'})
+  result = reindex.import_collection(cs, 'gemeinden', batch_rows=2, csv_outdir=str(tmp_path),
+                                     psql=fake_psql(tmp_path))
+  assert result['rows'] == 3
+  assert result['batches'] == 2
+  assert result['solr_collection'] == 'gemeinden-2'
+  assert cs.aliases['gemeinden'] == 'gemeinden-2'
+  # hard commit after all batches and before the alias swap
+  assert [c for c, _ in cs.calls] == ['delete', 'create', 'update', 'update', 'commit', 'alias']
+  assert b''.join(cs.collections['gemeinden-2']).count(b'id,geometrie') == 2
+  with gzip.open(str(tmp_path / 'gemeinden.csv.gz'), 'rb') as f:
+    assert f.read() == CSV
+
+
+def test_import_collection_geometries(tmp_path):
+  cs = FakeCloud()
+  reindex.import_collection(cs, 'gemeinden', geometry_dir=str(tmp_path),
+                            psql=fake_psql(tmp_path))
+  store = GeometryStore(str(tmp_path / 'gemeinden.geom'))
+  assert len(store) == 3
+  assert store.get('2').point_xy == (3, 4)
+
+
+def test_import_collection_geometries_failed(tmp_path):
+  cs = FakeCloud()
+  reindex.import_collection(cs, 'gemeinden', geometry_dir=str(tmp_path),
+                            psql=fake_psql(tmp_path))
+  path = tmp_path / 'gemeinden.geom'
+  data = path.read_bytes()
+
+  def warmup(collection, solr_collection):
+    raise RuntimeError('warmup failed')
+
+  with pytest.raises(RuntimeError):
+    reindex.import_collection(cs, 'gemeinden', geometry_dir=str(tmp_path), warmup=warmup,
+                              psql=fake_psql(tmp_path, output=CSV_CHANGED))
+  # the store of the live collection is kept
+  assert cs.aliases['gemeinden'] == 'gemeinden-1'
+  assert path.read_bytes() == data
+  assert not (tmp_path / 'gemeinden.geom.new').exists()
+
+
+def test_import_collection_warmup(tmp_path):
+  cs = FakeCloud()
+
+  def warmup(collection, solr_collection):
+    cs.calls.append(('warmup', solr_collection))
+    return {'rounds': []}
+
+  result = reindex.import_collection(cs, 'gemeinden', warmup=warmup, psql=fake_psql(tmp_path))
+  assert result['warmup'] == {'rounds': []}
+  assert cs.calls[-3:] == [('commit', 'gemeinden-1'), ('warmup', 'gemeinden-1'),
+                           ('alias', 'gemeinden-1')]
+
+
+def test_import_collection_psql_failed(tmp_path):
+  cs = FakeCloud(aliases={'gemeinden': 'gemeinden-1'})
+  with pytest.raises(Exception):
+    reindex.import_collection(cs, 'gemeinden', csv_outdir=str(tmp_path),
+                              psql=fake_psql(tmp_path, exit_code=1))
+  assert cs.aliases['gemeinden'] == 'gemeinden-1'
+  assert 'gemeinden-2' not in cs.collections
+  assert not (tmp_path / 'gemeinden.csv.gz').exists()
+
+
+def test_import_all_update_failed(tmp_path):
+  cs = FakeCloud(fail_update=True)
+  results = reindex.import_all(cs, ['gemeinden'], psql=fake_psql(tmp_path))
+  assert 'error' in results[0]
+  assert cs.aliases == {}
+  assert cs.collections == {}
+
+
+CSV_CHANGED = (
+  b'id,geometrie,strasse_name,json\n'
+  b'1,POINT (1 2),Seestr.,"{""a"": 1}"\n'
+  b'3,POINT (5 7),Wiesengrund,"{}"\n'
+  b'4,POINT (7 8),Neue Str.,"{}"\n'
+)
+
+
+def test_reindex_delta(tmp_path):
+  manifest_dir = str(tmp_path / 'manifest')
+  os.mkdir(manifest_dir)
+  cs = FakeCloud()
+
+  result = reindex.reindex_collection(cs, 'gemeinden', manifest_dir=manifest_dir,
+                                      psql=fake_psql(tmp_path))
+  assert result['mode'] == 'full'
+  assert result['reason'] == 'no manifest'
+  meta = Manifest(manifest_dir, 'gemeinden').load()
+  assert meta['solr_collection'] == 'gemeinden-1'
+  assert meta['rows'] == 3
+
+  cs.calls = []
+  result = reindex.reindex_collection(cs, 'gemeinden', manifest_dir=manifest_dir,
+                                      psql=fake_psql(tmp_path, output=CSV_CHANGED))
+  assert result['mode'] == 'delta'
+  assert (result['rows'], result['upserts'], result['deletes']) == (3, 2, 1)
+  assert cs.deleted == ['2']
+  # changed rows are posted into the live collection, without alias swap
+  assert [c for c, _ in cs.calls] == ['update', 'delete_ids', 'commit']
+  assert cs.collections['gemeinden-1'][-1] == (
+    b'id,geometrie,strasse_name,json\n'
+    b'3,POINT (5 7),Wiesengrund,"{}"\n'
+    b'4,POINT (7 8),Neue Str.,"{}"\n'
+  )
+  # only the hash file of the current manifest is kept
+  meta = Manifest(manifest_dir, 'gemeinden').load()
+  assert sorted(os.listdir(manifest_dir)) == sorted(['gemeinden.json', meta['hashes']])
+
+  # nothing changed
+  result = reindex.reindex_collection(cs, 'gemeinden', manifest_dir=manifest_dir,
+                                      psql=fake_psql(tmp_path, output=CSV_CHANGED))
+  assert (result['upserts'], result['deletes']) == (0, 0)
+
+
+def test_reindex_delta_failed(tmp_path):
+  cs = FakeCloud()
+  reindex.reindex_collection(cs, 'gemeinden', manifest_dir=str(tmp_path),
+                             psql=fake_psql(tmp_path))
+  meta = Manifest(str(tmp_path), 'gemeinden').load()
+  cs.fail_update = True
+  with pytest.raises(SolrCloudException):
+    reindex.reindex_collection(cs, 'gemeinden', manifest_dir=str(tmp_path),
+                               psql=fake_psql(tmp_path, output=CSV_CHANGED))
+  assert Manifest(str(tmp_path), 'gemeinden').load() == meta
+
+
+def test_reindex_delta_geometries(tmp_path):
+  cs = FakeCloud()
+  geometry_dir = tmp_path / 'geometries'
+  geometry_dir.mkdir()
+  path = geometry_dir / 'gemeinden.geom'
+  for output in (CSV, CSV_CHANGED):
+    reindex.reindex_collection(cs, 'gemeinden', manifest_dir=str(tmp_path),
+                               geometry_dir=str(geometry_dir),
+                               psql=fake_psql(tmp_path, output=output))
+  assert GeometryStore(str(path)).get('4').point_xy == (7, 8)
+  data = path.read_bytes()
+
+  def commit(collection):
+    raise SolrCloudException(FakeResponse({}))
+
+  # the store is only replaced after the commit
+  cs.commit = commit
+  with pytest.raises(SolrCloudException):
+    reindex.reindex_collection(cs, 'gemeinden', manifest_dir=str(tmp_path),
+                               geometry_dir=str(geometry_dir), psql=fake_psql(tmp_path))
+  assert path.read_bytes() == data
+  assert os.listdir(str(geometry_dir)) == ['gemeinden.geom']
+
+
+def test_rebuild_reason(tmp_path):
+  manifest = Manifest(str(tmp_path), 'gemeinden')
+  (tmp_path / 'gemeinden.1.hashes.gz').write_bytes(b'')
+  meta = {
+    'solr_collection': 'gemeinden-1', 'fingerprint': 'abc', 'full_rebuild': 1000,
+    'hashes': 'gemeinden.1.hashes.gz',
+  }
+
+  def reason(meta, alias='gemeinden-1', fp='abc', now=2000):
+    return reindex.rebuild_reason(manifest, meta, alias, fp, full_every=3600, now=now)
+
+  assert reason(meta) is None
+  assert reason(None) == 'no manifest'
+  assert reason(meta, fp='def') == 'schema changed'
+  assert reason(meta, alias='gemeinden-2') == 'alias changed'
+  assert reason(meta, now=5000) == 'schedule'
+  assert reason(dict(meta, hashes='missing.hashes.gz')) == 'no row hashes'
+
+
+def fake_psql_marker(tmp_path, marker, output=CSV, size=''):
+  """
+  psql that returns `marker` for the pg_stat query, `size` for the pg_class
+  query and `output` for COPY.
+  """
+  (tmp_path / 'psql-output.csv').write_bytes(output)
+  (tmp_path / 'psql-marker').write_text(marker)
+  (tmp_path / 'psql-size').write_text(size)
+  script = tmp_path / 'psql'
+  script.write_text(
+    '#! /bin/sh\n'
+    'case "$*" in\n'
+    '  *pg_stat_all_tables*) cat {0}/psql-marker ;;\n'
+    '  *pg_class*) cat {0}/psql-size ;;\n'
+    '  *) cat {0}/psql-output.csv ;;\n'
+    'esac\n'.format(tmp_path)
+  )
+  script.chmod(script.stat().st_mode | stat.S_IEXEC)
+  return str(script)
+
+
+def test_reindex_skip(tmp_path):
+  manifest_dir = str(tmp_path / 'manifest')
+  os.mkdir(manifest_dir)
+  manifest = Manifest(manifest_dir, 'gemeinden')
+  cs = FakeCloud()
+
+  reindex.reindex_collection(cs, 'gemeinden', manifest_dir=manifest_dir,
+                             psql=fake_psql_marker(tmp_path, 'gemeinden:1:100:10:0:0\n'))
+  checksum = manifest.load()['checksum']
+  assert manifest.load()['marker'] == 'gemeinden:1:100:10:0:0'
+
+  # unchanged statistics: no export and no Solr requests
+  cs.calls = []
+  result = reindex.reindex_collection(cs, 'gemeinden', manifest_dir=manifest_dir,
+                                      psql=fake_psql_marker(tmp_path, 'gemeinden:1:100:10:0:0\n',
+                                                            output=b''))
+  assert (result['mode'], result['reason']) == ('skip', 'tables unchanged')
+  assert cs.calls == []
+  assert manifest.load()['decision'] == 'skip'
+
+  # changed statistics, but identical export: no commit
+  result = reindex.reindex_collection(cs, 'gemeinden', manifest_dir=manifest_dir,
+                                      psql=fake_psql_marker(tmp_path, 'gemeinden:1:100:12:2:0\n'))
+  assert (result['mode'], result['reason']) == ('skip', 'rows unchanged')
+  assert cs.calls == []
+  meta = manifest.load()
+  assert meta['checksum'] == checksum
+  assert meta['marker'] == 'gemeinden:1:100:12:2:0'
+
+  # changed rows
+  result = reindex.reindex_collection(cs, 'gemeinden', manifest_dir=manifest_dir,
+                                      psql=fake_psql_marker(tmp_path, 'gemeinden:1:100:14:2:0\n',
+                                                            output=CSV_CHANGED))
+  assert result['mode'] == 'delta'
+  assert manifest.load()['checksum'] != checksum
+  assert cs.calls[-1] == ('commit', 'gemeinden-1')
+
+
+def test_reindex_truncated(tmp_path):
+  manifest_dir = str(tmp_path / 'manifest')
+  os.mkdir(manifest_dir)
+  cs = FakeCloud()
+  reindex.reindex_collection(cs, 'gemeinden', manifest_dir=manifest_dir,
+                             psql=fake_psql_marker(tmp_path, 'gemeinden:1:100:10:0:0\n'))
+
+  # TRUNCATE keeps the statistics, but assigns a new file node
+  result = reindex.reindex_collection(
+    cs, 'gemeinden', manifest_dir=manifest_dir,
+    psql=fake_psql_marker(tmp_path, 'gemeinden:1:101:10:0:0\n',
+                          output=b'id,geometrie,strasse_name,json\n'))
+  assert (result['mode'], result['deletes']) == ('delta', 3)
+  assert sorted(cs.deleted) == ['1', '2', '3']
+
+
+def test_reindex_shards(tmp_path):
+  manifest_dir = str(tmp_path / 'manifest')
+  os.mkdir(manifest_dir)
+  policy = shards.ShardPolicy(docs_per_shard=2, overrides={'strassen': 3})
+  cs = FakeCloud()
+
+  # no manifest: size estimate from PostgreSQL (300 rows, but 1 doc per shard)
+  result = reindex.reindex_collection(
+    cs, 'gemeinden', manifest_dir=manifest_dir, shard_policy=policy,
+    psql=fake_psql_marker(tmp_path, 'gemeinden:1:100:10:0:0\n', size='300:8192\n'))
+  assert result['shards'] == shards.MAX_SHARDS
+  meta = Manifest(manifest_dir, 'gemeinden').load()
+  assert meta['bytes'] == len(CSV) - CSV.index(b'\n') - 1
+
+  # full rebuild: size of the last import (3 rows)
+  result = reindex.reindex_collection(
+    cs, 'gemeinden', manifest_dir=manifest_dir, shard_policy=policy, full=True,
+    psql=fake_psql_marker(tmp_path, 'gemeinden:1:100:10:0:0\n'))
+  assert result['shards'] == 2
+  assert cs.created['gemeinden-2']['num_shards'] == 2
+
+  result = reindex.reindex_collection(
+    cs, 'strassen', shard_policy=policy, psql=fake_psql_marker(tmp_path, ''))
+  assert result['shards'] == 3
@@ -0,0 +1,33 @@
+import pytest
+
+from geocodr_mv import shards
+
+
+def test_shard_count():
+  assert shards.shard_count(500) == 1
+  assert shards.shard_count(shards.DOCS_PER_SHARD + 1) == 2
+  assert shards.shard_count(500, bytes=3 * shards.BYTES_PER_SHARD) == 3
+  assert shards.shard_count(100 * shards.DOCS_PER_SHARD) == shards.MAX_SHARDS
+
+
+def test_parse_overrides():
+  assert shards.parse_overrides(['gemeinden=1,flurstuecke=4', 'adressen=2']) == {
+    'gemeinden': 1, 'flurstuecke': 4, 'adressen': 2}
+  assert shards.parse_overrides(None) == {}
+  for value in ['gemeinden', 'gemeinden=0', 'gemeinden=x']:
+    with pytest.raises(ValueError):
+      shards.parse_overrides([value])
+
+
+def test_policy():
+  policy = shards.ShardPolicy(overrides={'flurstuecke': 4})
+  assert policy.num_shards('gemeinden', {'rows': 800, 'bytes': 4000000}) == 1
+  assert policy.num_shards('flurstuecke', {'rows': 800}) == 4
+  assert not policy.needs_size('flurstuecke')
+  # unknown size: previous default
+  assert policy.num_shards('gemeinden', None) == shards.DEFAULT_SHARDS
+
+  policy = shards.ShardPolicy(overrides={'flurstuecke': 4}, fixed=2)
+  assert policy.num_shards('gemeinden', {'rows': 800}) == 2
+  assert policy.num_shards('flurstuecke') == 4
+  assert not policy.needs_size('gemeinden')
@@ -0,0 +1,108 @@
+import os
+
+from werkzeug.test import Client
+
+from geocodr_mv import api, tiers
+from geocodr_mv.fakesolr import BackgroundServer, FakeSolr
+from geocodr_mv.warmup import mapping_collections
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+class Coll(object):
+  def __init__(self, name, score_tie_ratio=1.0):
+    self.name = name
+    self.score_tie_ratio = score_tie_ratio
+
+
+def features(*scores):
+  return [{'properties': {'_score_': s}} for s in scores]
+
+
+def test_tiers():
+  collections = mapping_collections(mapping)
+  address = [c for name in ('adressen', 'strassen', 'gemeindeteile', 'gemeinden')
+             for c in collections[name]]
+  assert [[c.name for c in t] for t in tiers.tiers(address)] == [
+    ['gemeinden'], ['gemeindeteile'], ['strassen'], ['adressen']]
+
+
+def test_page_score():
+  assert tiers.page_score(features(1, 5, 3), 2) == 3
+  assert tiers.page_score(features(1, 5, 3), 4) is None
+
+
+def test_score_ceilings():
+  ceilings = tiers.ScoreCeilings(margin=1.5, min_samples=2)
+  coll = Coll('strassen')
+  ceilings.observe(coll, 'rostock', [{'score': 4.0}, {'score': 2.0}])
+  assert ceilings.ceiling(coll, 'rostock') is None
+  assert not ceilings.skip(coll, 'rostock', features(100, 100), 2)
+
+  ceilings.observe(coll, 'neubukow', [{'score': 3.0}])
+  assert ceilings.ceiling(coll, 'rostock') == 6.0
+  # different number of terms
+  assert ceilings.ceiling(coll, 'rostock stettiner') is None
+
+  assert ceilings.skip(coll, 'rostock', features(7, 8), 2)
+  assert not ceilings.skip(coll, 'rostock', features(6, 8), 2)
+  # page is not filled
+  assert not ceilings.skip(coll, 'rostock', features(7, 8), 3)
+  # aligned scores can exceed the ceiling by score_tie_ratio
+  assert ceilings.ceiling(Coll('strassen', score_tie_ratio=2.0), 'rostock') == 8.0
+
+
+class ScaledSolr(FakeSolr):
+  """
+  FakeSolr with higher scores for gemeinden.
+  """
+  scales = {'gemeinden': 10.0}
+
+  def select(self, collection, params):
+    self.collections.append(collection)
+    resp = FakeSolr.select(self, collection, params)
+    for doc in resp['response']['docs']:
+      if 'score' in doc:
+        doc['score'] *= self.scales.get(collection, 1.0)
+    return resp
+
+
+def test_tiered_query():
+  fake = ScaledSolr()
+  fake.collections = []
+  solr_server = BackgroundServer(fake).start()
+  try:
+    config = {'solr_url': solr_server.url, 'mapping': mapping}
+    client = Client(api.create_app(config))
+    tiered = Client(api.create_app(dict(
+      config, tiered=True, tiered_options={'min_samples': 5, 'probe_ratio': 0})))
+
+    def query(client, q):
+      resp = client.get('/query', query_string={
+        'type': 'search', 'class': 'address', 'query': q, 'limit': 10})
+      assert resp.status_code == 200
+      return resp.get_json()['features']
+
+    # learn the score ceilings, all collections are queried
+    for q in ('rostock', 'wismar', 'schwerin', 'parkentin', 'bentwisch'):
+      assert query(tiered, q) == query(client, q)
+
+    queries = ('neubukow', 'kritzmow', 'sanitz', 'tessin', 'graal')
+    del fake.collections[:]
+    for q in queries:
+      query(client, q)
+    requests = len(fake.collections)
+
+    del fake.collections[:]
+    same = sum(query(tiered, q) == query(client, q) for q in queries)
+    tiered_requests = len(fake.collections) - requests
+  finally:
+    solr_server.stop()
+
+  # same features in the same order for all queries
+  assert same == len(queries)
+  # only gemeinden (search and page request)
+  assert tiered_requests == 2 * len(queries)
+  # 4 search requests and the page request without tiers
+  assert requests == 5 * len(queries)
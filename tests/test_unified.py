@@ -0,0 +1,81 @@
+import os
+
+from geocodr.mapping import load_collections
+
+from geocodr_mv import export
+from geocodr_mv.fakesolr import make_doc
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+def unified_collections(monkeypatch):
+  monkeypatch.setenv('GEOCODR_UNIFIED_ADDRESSES', '1')
+  return dict((c.name, c) for c in load_collections(mapping))
+
+
+def test_unified_collections(monkeypatch):
+  collections = unified_collections(monkeypatch)
+  assert collections['adressen_alle'].class_ == 'address'
+  assert collections['adressen_alle_hro'].class_ == 'address_hro'
+  for name in ('strassen', 'adressen', 'gemeinden', 'gemeindeteile', 'adressen_hro'):
+    assert name not in collections
+
+  monkeypatch.delenv('GEOCODR_UNIFIED_ADDRESSES')
+  names = [c.name for c in load_collections(mapping)]
+  assert 'adressen' in names
+  assert 'adressen_alle' not in names
+
+
+def test_unified_query(monkeypatch):
+  coll = unified_collections(monkeypatch)['adressen_alle']
+  q = coll.query('rostock')
+  assert q.count('filter(typ:') == 4
+  assert q.startswith('(filter(typ:strassen) AND (_query_:')
+
+  # short queries for members with a longer min_query_length
+  coll.members[0].min_query_length = 4
+  try:
+    assert 'filter(typ:strassen)' not in coll.query('ros')
+  finally:
+    coll.members[0].min_query_length = 3
+
+
+def test_unified_to_features(monkeypatch):
+  coll = unified_collections(monkeypatch)['adressen_alle']
+  docs = []
+  for i, typ in enumerate(['adressen', 'gemeinden', 'adressen', 'strassen', 'gemeindeteile']):
+    doc = make_doc(typ, i, 10.0 - i)
+    doc['typ'] = typ
+    docs.append(doc)
+
+  features = coll.to_features(docs)
+  assert len(features) == 5
+  titles = dict((f['properties']['_id_'], f['properties']['objektgruppe']) for f in features)
+  assert sorted(titles.values()) == ['Adresse', 'Adresse', 'Gemeinde', 'Gemeindeteil', 'Straße']
+  assert titles[docs[1]['id']] == 'Gemeinde'
+  assert features[0]['properties']['_collection_'] == 'strassen'
+
+
+def test_unified_ranked_docs(monkeypatch):
+  coll = unified_collections(monkeypatch)['adressen_alle']
+  assert 'typ' in coll.sort_field_list.split(',')
+  assert 'strasse_laenge' in coll.sort_field_list.split(',')
+  assert coll.page_field_list.startswith('id,json,typ,')
+
+  docs = []
+  for i, typ in enumerate(['adressen', 'gemeinden', 'adressen']):
+    doc = make_doc(typ, i, 10.0 - i)
+    doc['typ'] = typ
+    docs.append(doc)
+  ranked = coll.ranked_docs(docs)
+  # in the order of to_features
+  assert [d['id'] for d in ranked] == [d['id'] for d in [docs[0], docs[2], docs[1]]]
+  assert coll.sort_tiebreaker(docs[1]) == coll.members[2].sort_tiebreaker(docs[1])
+
+
+def test_optional_collections():
+  assert 'adressen_alle' not in export.available_collections()
+  assert 'adressen' in export.available_collections()
+  assert export.source_tables('adressen_alle') == [
+    'adressen', 'gemeinden', 'gemeindeteile', 'strassen']
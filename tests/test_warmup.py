@@ -0,0 +1,58 @@
+import os
+import time
+
+import pytest
+
+from geocodr_mv import warmup
+
+
+mapping = os.path.join(os.path.dirname(__file__), '..', 'conf', 'geocodr_mapping.py')
+
+
+def test_load_queries(tmp_path):
+  log = tmp_path / 'queries.log'
+  log.write_text('rostock\n  12 Güstrow\nRostock\n"rostock"\n3\tgüstrow\n\n')
+  assert warmup.load_queries(str(log)) == ['Güstrow', 'güstrow', 'rostock', 'Rostock']
+  assert warmup.load_queries(str(log), top=1) == ['Güstrow']
+
+
+def test_solr_params():
+  collections = warmup.mapping_collections(mapping)
+  gemeinden = collections['gemeinden']
+  params = warmup.solr_params(gemeinden, ['ro', 'rostock', 'Rostock', 'rostock'])
+  # ro is too short, duplicate queries are only sent once
+  assert [p['q'] for p in params] == [gemeinden[0].query('rostock'), gemeinden[0].query('Rostock')]
+  assert params[0]['sort'] == gemeinden[0].sort
+  assert params[0]['fl'] == gemeinden[0].sort_field_list
+
+
+def test_warmup_stable():
+  calls = []
+
+  def select(params):
+    calls.append(params)
+    time.sleep(0.01)
+
+  result = warmup.Warmup(select, [{'q': 'a'}, {'q': 'b'}], tolerance=0.5).run()
+  assert result['stable']
+  assert len(result['rounds']) >= 2
+  assert len(calls) == 2 * len(result['rounds'])
+
+
+def test_warmup_max_rounds():
+  latencies = iter([0.001, 0.02, 0.001, 0.02, 0.001])
+
+  def select(params):
+    time.sleep(next(latencies))
+
+  result = warmup.Warmup(select, [{'q': 'a'}], concurrency=1, max_rounds=3).run()
+  assert not result['stable']
+  assert len(result['rounds']) == 3
+
+
+def test_warmup_failed():
+  def select(params):
+    raise ValueError('collection not found')
+
+  with pytest.raises(warmup.WarmupError):
+    warmup.Warmup(select, [{'q': 'a'}]).run()